@@ -64,7 +64,10 @@ type AsyncCalcGraph struct {
 }
 
 func NewAsyncCalcGraph(conf *config.Config, outputEvents chan<- interface{}) *AsyncCalcGraph {
-	eventBuffer := NewEventBuffer(conf)
+	// The event buffer merges datastore config updates into its own copy of the
+	// config, which belongs to the calculation graph's goroutine.  Other goroutines
+	// pick up reloaded config from the ConfigUpdate messages that it emits.
+	eventBuffer := NewEventBuffer(conf.Copy())
 	dispatcher := NewCalculationGraph(eventBuffer, conf.FelixHostname)
 	g := &AsyncCalcGraph{
 		inputEvents:  make(chan interface{}, 10),
@@ -76,6 +79,12 @@ func NewAsyncCalcGraph(conf *config.Config, outputEvents chan<- interface{}) *As
 	return g
 }
 
+// EnablePackedIPSetMembers tells the graph that the dataplane driver supports
+// the packed IP set member encoding.  Safe to call from any goroutine.
+func (acg *AsyncCalcGraph) EnablePackedIPSetMembers() {
+	acg.eventBuffer.EnablePackedIPSetMembers()
+}
+
 func (acg *AsyncCalcGraph) OnUpdates(updates []api.Update) {
 	log.Debugf("Got %v updates; queueing", len(updates))
 	acg.inputEvents <- updates
@@ -24,6 +24,7 @@ import (
 	"github.com/projectcalico/libcalico-go/lib/backend/model"
 	"github.com/projectcalico/libcalico-go/lib/net"
 	"strings"
+	"sync/atomic"
 )
 
 type EventHandler func(message interface{})
@@ -46,6 +47,10 @@ type EventBuffer struct {
 
 	pendingUpdates []interface{}
 
+	// packedIPSetMembers is set to 1 (atomically) once the dataplane driver
+	// has told us that it supports the packed IP set member encoding.
+	packedIPSetMembers int32
+
 	Callback EventHandler
 }
 
@@ -61,6 +66,14 @@ func NewEventBuffer(conf configInterface) *EventBuffer {
 	return buf
 }
 
+// EnablePackedIPSetMembers switches the IP set messages that we emit over to
+// the packed encoding.  Safe to call from any goroutine; it takes effect from
+// the next Flush().
+func (buf *EventBuffer) EnablePackedIPSetMembers() {
+	log.Info("Dataplane supports packed IP set members, enabling.")
+	atomic.StoreInt32(&buf.packedIPSetMembers, 1)
+}
+
 func (buf *EventBuffer) OnIPSetAdded(setID string) {
 	log.Debugf("IP set %v now active", setID)
 	if buf.knownIPSets.Contains(setID) && !buf.ipSetsRemoved.Contains(setID) {
@@ -110,6 +123,7 @@ func (buf *EventBuffer) OnIPRemoved(setID string, ip ip.Addr) {
 }
 
 func (buf *EventBuffer) Flush() {
+	packed := atomic.LoadInt32(&buf.packedIPSetMembers) != 0
 	buf.ipSetsRemoved.Iter(func(item interface{}) (err error) {
 		setID := item.(string)
 		log.Debugf("Flushing IP set remove: %v", setID)
@@ -126,23 +140,32 @@ func (buf *EventBuffer) Flush() {
 	buf.ipSetsAdded.Iter(func(item interface{}) (err error) {
 		setID := item.(string)
 		log.Debugf("Flushing IP set added: %v", setID)
-		members := make([]string, 0)
-		buf.ipsAdded.Iter(setID, func(value interface{}) {
-			members = append(members, value.(ip.Addr).String())
-		})
+		update := &proto.IPSetUpdate{
+			Id: setID,
+		}
+		if packed {
+			update.PackedV4Members, update.PackedV6Members = buf.packIPs(
+				buf.ipsAdded, setID)
+		} else {
+			members := make([]string, 0)
+			buf.ipsAdded.Iter(setID, func(value interface{}) {
+				members = append(members, value.(ip.Addr).String())
+			})
+			update.Members = members
+		}
 		buf.ipsAdded.DiscardKey(setID)
-		buf.Callback(&proto.IPSetUpdate{
-			Id:      setID,
-			Members: members,
-		})
+		buf.Callback(update)
 		buf.ipSetsAdded.Discard(item)
 		buf.knownIPSets.Add(item)
 		return
 	})
 	log.Debugf("Done flushing IP set adds")
-	buf.ipsRemoved.IterKeys(buf.flushAddsOrRemoves)
+	flushAddsOrRemoves := func(setID string) {
+		buf.flushAddsOrRemoves(setID, packed)
+	}
+	buf.ipsRemoved.IterKeys(flushAddsOrRemoves)
 	log.Debugf("Done flushing IP address removes")
-	buf.ipsAdded.IterKeys(buf.flushAddsOrRemoves)
+	buf.ipsAdded.IterKeys(flushAddsOrRemoves)
 	log.Debugf("Done flushing IP address adds")
 
 	log.Debugf("Flushing %v pending updates", len(buf.pendingUpdates))
@@ -153,24 +176,45 @@ func (buf *EventBuffer) Flush() {
 	buf.pendingUpdates = make([]interface{}, 0)
 }
 
-func (buf *EventBuffer) flushAddsOrRemoves(setID string) {
+func (buf *EventBuffer) flushAddsOrRemoves(setID string, packed bool) {
 	log.Debugf("Flushing IP set deltas: %v", setID)
 	deltaUpdate := proto.IPSetDeltaUpdate{
 		Id: setID,
 	}
-	buf.ipsAdded.Iter(setID, func(item interface{}) {
-		ip := item.(ip.Addr).String()
-		deltaUpdate.AddedMembers = append(deltaUpdate.AddedMembers, ip)
-	})
-	buf.ipsRemoved.Iter(setID, func(item interface{}) {
-		ip := item.(ip.Addr).String()
-		deltaUpdate.RemovedMembers = append(deltaUpdate.RemovedMembers, ip)
-	})
+	if packed {
+		deltaUpdate.PackedAddedV4Members, deltaUpdate.PackedAddedV6Members =
+			buf.packIPs(buf.ipsAdded, setID)
+		deltaUpdate.PackedRemovedV4Members, deltaUpdate.PackedRemovedV6Members =
+			buf.packIPs(buf.ipsRemoved, setID)
+	} else {
+		buf.ipsAdded.Iter(setID, func(item interface{}) {
+			ip := item.(ip.Addr).String()
+			deltaUpdate.AddedMembers = append(deltaUpdate.AddedMembers, ip)
+		})
+		buf.ipsRemoved.Iter(setID, func(item interface{}) {
+			ip := item.(ip.Addr).String()
+			deltaUpdate.RemovedMembers = append(deltaUpdate.RemovedMembers, ip)
+		})
+	}
 	buf.ipsAdded.DiscardKey(setID)
 	buf.ipsRemoved.DiscardKey(setID)
 	buf.Callback(&deltaUpdate)
 }
 
+// packIPs encodes the IPs stored against the given IP set ID as a pair of
+// byte slices containing the concatenated IPv4 and IPv6 addresses.
+func (buf *EventBuffer) packIPs(ips multidict.StringToIface, setID string) (v4, v6 []byte) {
+	ips.Iter(setID, func(item interface{}) {
+		switch addr := item.(type) {
+		case ip.V4Addr:
+			v4 = append(v4, addr[:]...)
+		case ip.V6Addr:
+			v6 = append(v6, addr[:]...)
+		}
+	})
+	return
+}
+
 func (buf *EventBuffer) OnDatastoreNotReady() {
 	buf.pendingUpdates = append(buf.pendingUpdates, &DatastoreNotReady{})
 }
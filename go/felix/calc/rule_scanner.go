@@ -22,8 +22,20 @@ import (
 	"github.com/projectcalico/libcalico-go/lib/net"
 	"github.com/projectcalico/libcalico-go/lib/numorstring"
 	"github.com/projectcalico/libcalico-go/lib/selector"
+	"github.com/prometheus/client_golang/prometheus"
 )
 
+var (
+	dedupedSelectorsGauge = prometheus.NewGauge(prometheus.GaugeOpts{
+		Name: "felix_calc_deduped_selectors",
+		Help: "Number of active selectors that share an IP set with an equivalent selector.",
+	})
+)
+
+func init() {
+	prometheus.MustRegister(dedupedSelectorsGauge)
+}
+
 // RuleScanner calculates the active set of selectors and tags from the current set of policies/profiles.
 // It generates events for selectors becoming active/inactive.
 type RuleScanner struct {
@@ -33,6 +45,10 @@ type RuleScanner struct {
 	rulesIDToUIDs multidict.IfaceToString
 	// activeResourcesByUid maps from selector UID back to the "set" of resources using it.
 	uidsToRulesIDs multidict.StringToIface
+	// rulesIDToRawUIDs and rawUIDsToRulesIDs track the UIDs of the selectors as written,
+	// before canonicalisation, so that we can report how many IP sets were saved.
+	rulesIDToRawUIDs  multidict.IfaceToString
+	rawUIDsToRulesIDs multidict.StringToIface
 
 	OnSelectorActive   func(selector selector.Selector)
 	OnSelectorInactive func(selector selector.Selector)
@@ -47,6 +63,9 @@ func NewRuleScanner() *RuleScanner {
 		tagsOrSelsByUID: make(map[string]tagOrSel),
 		rulesIDToUIDs:   multidict.NewIfaceToString(),
 		uidsToRulesIDs:  multidict.NewStringToIface(),
+
+		rulesIDToRawUIDs:  multidict.NewIfaceToString(),
+		rawUIDsToRulesIDs: multidict.NewStringToIface(),
 	}
 	return calc
 }
@@ -76,6 +95,7 @@ func (rs *RuleScanner) updateRules(key interface{}, inbound, outbound []model.Ru
 		len(inbound), len(outbound), key)
 	// Extract all the new selectors/tags.
 	currentUIDToTagOrSel := make(map[string]tagOrSel)
+	currentRawUIDs := set.New()
 	parsedInbound := make([]*ParsedRule, len(inbound))
 	for ii, rule := range inbound {
 		parsed, allToS, err := ruleToParsedRule(&rule)
@@ -85,6 +105,7 @@ func (rs *RuleScanner) updateRules(key interface{}, inbound, outbound []model.Ru
 		parsedInbound[ii] = parsed
 		for _, tos := range allToS {
 			currentUIDToTagOrSel[tos.uid] = tos
+			currentRawUIDs.Add(tos.rawUID)
 		}
 	}
 	parsedOutbound := make([]*ParsedRule, len(outbound))
@@ -96,6 +117,7 @@ func (rs *RuleScanner) updateRules(key interface{}, inbound, outbound []model.Ru
 		parsedOutbound[ii] = parsed
 		for _, tos := range allToS {
 			currentUIDToTagOrSel[tos.uid] = tos
+			currentRawUIDs.Add(tos.rawUID)
 		}
 	}
 	parsedRules = &ParsedRules{
@@ -172,9 +194,38 @@ func (rs *RuleScanner) updateRules(key interface{}, inbound, outbound []model.Ru
 		}
 		return nil
 	})
+
+	rs.updateRawUIDs(key, currentRawUIDs)
 	return
 }
 
+// updateRawUIDs updates the index of selectors as written and refreshes the count of
+// selectors that were folded into an equivalent, already-active IP set.
+func (rs *RuleScanner) updateRawUIDs(key interface{}, currentRawUIDs set.Set) {
+	removedRawUIDs := set.New()
+	rs.rulesIDToRawUIDs.Iter(key, func(rawUID string) {
+		if !currentRawUIDs.Contains(rawUID) {
+			removedRawUIDs.Add(rawUID)
+		}
+	})
+	removedRawUIDs.Iter(func(item interface{}) error {
+		rawUID := item.(string)
+		rs.rulesIDToRawUIDs.Discard(key, rawUID)
+		rs.rawUIDsToRulesIDs.Discard(rawUID, key)
+		return nil
+	})
+	currentRawUIDs.Iter(func(item interface{}) error {
+		rawUID := item.(string)
+		rs.rulesIDToRawUIDs.Put(key, rawUID)
+		rs.rawUIDsToRulesIDs.Put(rawUID, key)
+		return nil
+	})
+	numDeduped := rs.rawUIDsToRulesIDs.Len() - rs.uidsToRulesIDs.Len()
+	log.Debugf("%v selectors/tags share an IP set with an equivalent selector",
+		numDeduped)
+	dedupedSelectorsGauge.Set(float64(numDeduped))
+}
+
 type ParsedRules struct {
 	InboundRules  []*ParsedRule
 	OutboundRules []*ParsedRule
@@ -303,16 +354,27 @@ type tagOrSel struct {
 	tag      string
 	selector selector.Selector
 	uid      string
+	// rawUID is the UID of the selector as written, before canonicalisation.  For
+	// tags, it is the same as uid.
+	rawUID string
 }
 
 func tagOrSelFromTag(tag string) tagOrSel {
-	return tagOrSel{tag: tag, uid: hash.MakeUniqueID("t", tag)}
+	uid := hash.MakeUniqueID("t", tag)
+	return tagOrSel{tag: tag, uid: uid, rawUID: uid}
 }
 
 func tagOrSelFromSel(sel string) (tos tagOrSel, err error) {
-	selector, err := selector.Parse(sel)
+	parsedSel, err := selector.Parse(sel)
 	if err == nil {
-		tos = tagOrSel{selector: selector, uid: selector.UniqueId()}
+		// Equivalent selectors map to the same canonical selector and hence share
+		// an IP set.
+		canonSel := CanonicaliseSelector(parsedSel)
+		tos = tagOrSel{
+			selector: canonSel,
+			uid:      canonSel.UniqueId(),
+			rawUID:   parsedSel.UniqueId(),
+		}
 	}
 	return
 }
@@ -0,0 +1,362 @@
+// Copyright (c) 2016 Tigera, Inc. All rights reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package calc
+
+import (
+	"errors"
+	"sort"
+	"strings"
+
+	log "github.com/Sirupsen/logrus"
+	"github.com/projectcalico/libcalico-go/lib/selector"
+	"github.com/projectcalico/libcalico-go/lib/selector/tokenizer"
+)
+
+// CanonicaliseSelector returns a selector that is semantically equivalent to sel but
+// is rewritten into a canonical form, so that selectors that differ only in the order of
+// their && and || terms, in redundant parentheses or double negation, or in has(x)
+// terms that are implied by an x == "..." or x in {...} term, share a UniqueId() and
+// hence an IP set.
+//
+// The selector's AST isn't exposed by libcalico-go so we build our own from the
+// selector's tokens, using the same tokenizer as the selector parser.  Selectors that
+// are already in canonical form are returned unchanged, so they keep their UniqueId().
+// If anything goes wrong, the input selector is returned unchanged; that only loses
+// the deduplication.
+func CanonicaliseSelector(sel selector.Selector) selector.Selector {
+	canonStr, err := canonicalSelectorString(sel.String())
+	if err != nil {
+		log.WithError(err).WithField("selector", sel.String()).Warn(
+			"Failed to canonicalise selector, using it as-is")
+		return sel
+	}
+	if canonStr == sel.String() {
+		return sel
+	}
+	canonSel, err := selector.Parse(canonStr)
+	if err != nil {
+		log.WithError(err).WithFields(log.Fields{
+			"selector":  sel.String(),
+			"canonical": canonStr,
+		}).Warn("Failed to parse canonical selector, using original")
+		return sel
+	}
+	log.Debugf("Canonicalised selector %v -> %v", sel, canonSel)
+	return canonSel
+}
+
+var errBadSelector = errors.New("unexpected selector syntax")
+
+type selNodeKind int
+
+const (
+	selAnd selNodeKind = iota
+	selOr
+	selNot
+	selAll
+	selHas
+	selEq
+	selNe
+	selIn
+	selNotIn
+)
+
+// selNode is a node in the selector's AST.  Interior nodes are &&, || or !; leaves
+// test a label.
+type selNode struct {
+	kind     selNodeKind
+	operands []*selNode
+	label    string
+	// values holds the value for == and !=, or the sorted set for in and not in.
+	values []string
+}
+
+// selParser builds a selNode tree from the selector's tokens.  It follows the grammar
+// of libcalico-go's selector parser.
+type selParser struct {
+	tokens []tokenizer.Token
+	pos    int
+}
+
+func (p *selParser) peek() tokenizer.Kind {
+	if p.pos >= len(p.tokens) {
+		return tokenizer.TokEof
+	}
+	return p.tokens[p.pos].Kind
+}
+
+func (p *selParser) next() tokenizer.Token {
+	if p.pos >= len(p.tokens) {
+		return tokenizer.Token{Kind: tokenizer.TokEof}
+	}
+	tok := p.tokens[p.pos]
+	p.pos++
+	return tok
+}
+
+func (p *selParser) parseBinary(
+	kind selNodeKind,
+	tokKind tokenizer.Kind,
+	parseOperand func() (*selNode, error),
+) (*selNode, error) {
+	first, err := parseOperand()
+	if err != nil {
+		return nil, err
+	}
+	operands := []*selNode{first}
+	for p.peek() == tokKind {
+		p.pos++
+		next, err := parseOperand()
+		if err != nil {
+			return nil, err
+		}
+		operands = append(operands, next)
+	}
+	if len(operands) == 1 {
+		return first, nil
+	}
+	return &selNode{kind: kind, operands: operands}, nil
+}
+
+func (p *selParser) parseOr() (*selNode, error) {
+	return p.parseBinary(selOr, tokenizer.TokOr, p.parseAnd)
+}
+
+func (p *selParser) parseAnd() (*selNode, error) {
+	return p.parseBinary(selAnd, tokenizer.TokAnd, p.parseOperation)
+}
+
+func (p *selParser) parseOperation() (*selNode, error) {
+	tok := p.next()
+	switch tok.Kind {
+	case tokenizer.TokNot:
+		operand, err := p.parseOperation()
+		if err != nil {
+			return nil, err
+		}
+		return &selNode{kind: selNot, operands: []*selNode{operand}}, nil
+	case tokenizer.TokLParen:
+		inner, err := p.parseOr()
+		if err != nil {
+			return nil, err
+		}
+		if p.next().Kind != tokenizer.TokRParen {
+			return nil, errBadSelector
+		}
+		return inner, nil
+	case tokenizer.TokAll:
+		return &selNode{kind: selAll}, nil
+	case tokenizer.TokHas:
+		return &selNode{kind: selHas, label: tok.Value.(string)}, nil
+	case tokenizer.TokLabel:
+		node := &selNode{label: tok.Value.(string)}
+		switch p.next().Kind {
+		case tokenizer.TokEq:
+			node.kind = selEq
+		case tokenizer.TokNe:
+			node.kind = selNe
+		case tokenizer.TokIn:
+			node.kind = selIn
+		case tokenizer.TokNotIn:
+			node.kind = selNotIn
+		default:
+			return nil, errBadSelector
+		}
+		var err error
+		if node.kind == selEq || node.kind == selNe {
+			valueTok := p.next()
+			if valueTok.Kind != tokenizer.TokStringLiteral {
+				return nil, errBadSelector
+			}
+			node.values = []string{valueTok.Value.(string)}
+		} else {
+			node.values, err = p.parseStringSet()
+		}
+		return node, err
+	}
+	return nil, errBadSelector
+}
+
+// parseStringSet parses a set literal such as {"a", "b"} and returns its values,
+// sorted and deduplicated.
+func (p *selParser) parseStringSet() ([]string, error) {
+	if p.next().Kind != tokenizer.TokLBrace {
+		return nil, errBadSelector
+	}
+	seen := map[string]bool{}
+	values := []string{}
+	if p.peek() == tokenizer.TokRBrace {
+		p.pos++
+		return values, nil
+	}
+	for {
+		tok := p.next()
+		if tok.Kind != tokenizer.TokStringLiteral {
+			return nil, errBadSelector
+		}
+		value := tok.Value.(string)
+		if !seen[value] {
+			seen[value] = true
+			values = append(values, value)
+		}
+		switch p.next().Kind {
+		case tokenizer.TokComma:
+			continue
+		case tokenizer.TokRBrace:
+			sort.Strings(values)
+			return values, nil
+		default:
+			return nil, errBadSelector
+		}
+	}
+}
+
+// canonicalSelectorString calculates the canonical rendering of the given selector
+// string.
+func canonicalSelectorString(s string) (string, error) {
+	tokens, err := tokenizer.Tokenize(s)
+	if err != nil {
+		return "", err
+	}
+	p := &selParser{tokens: tokens}
+	node, err := p.parseOr()
+	if err != nil {
+		return "", err
+	}
+	if p.next().Kind != tokenizer.TokEof {
+		return "", errBadSelector
+	}
+	return canonicaliseNode(node).render(), nil
+}
+
+// canonicaliseNode rewrites the node in-place into canonical form and returns the
+// (possibly different) root.
+func canonicaliseNode(n *selNode) *selNode {
+	switch n.kind {
+	case selAnd, selOr:
+	case selNot:
+		operand := canonicaliseNode(n.operands[0])
+		if operand.kind == selNot {
+			// !!x is equivalent to x.
+			return operand.operands[0]
+		}
+		n.operands[0] = operand
+		return n
+	default:
+		return n
+	}
+
+	// && or ||: flatten nested operators of the same type, remove duplicates and sort
+	// the operands into a stable order.
+	var flattened []*selNode
+	for _, operand := range n.operands {
+		operand = canonicaliseNode(operand)
+		if operand.kind == n.kind {
+			flattened = append(flattened, operand.operands...)
+		} else {
+			flattened = append(flattened, operand)
+		}
+	}
+	if n.kind == selAnd {
+		flattened = removeImpliedHasTerms(flattened)
+	}
+	renderedToNode := make(map[string]*selNode, len(flattened))
+	rendered := make([]string, 0, len(flattened))
+	for _, operand := range flattened {
+		r := operand.render()
+		if _, ok := renderedToNode[r]; ok {
+			continue
+		}
+		renderedToNode[r] = operand
+		rendered = append(rendered, r)
+	}
+	sort.Strings(rendered)
+	if len(rendered) == 1 {
+		return renderedToNode[rendered[0]]
+	}
+	n.operands = n.operands[:0]
+	for _, r := range rendered {
+		n.operands = append(n.operands, renderedToNode[r])
+	}
+	return n
+}
+
+// removeImpliedHasTerms removes has(x) terms from the operands of an && where another
+// operand already requires label x to be present, for example x == "a".
+func removeImpliedHasTerms(operands []*selNode) []*selNode {
+	requiredLabels := map[string]bool{}
+	for _, operand := range operands {
+		if operand.kind == selEq || operand.kind == selIn {
+			requiredLabels[operand.label] = true
+		}
+	}
+	if len(requiredLabels) == 0 {
+		return operands
+	}
+	filtered := operands[:0]
+	for _, operand := range operands {
+		if operand.kind == selHas && requiredLabels[operand.label] {
+			continue
+		}
+		filtered = append(filtered, operand)
+	}
+	return filtered
+}
+
+// render renders the node in the same form as libcalico-go's Selector.String().
+func (n *selNode) render() string {
+	switch n.kind {
+	case selAll:
+		return "all()"
+	case selHas:
+		return "has(" + n.label + ")"
+	case selEq:
+		return n.label + " == " + quoteSelectorValue(n.values[0])
+	case selNe:
+		return n.label + " != " + quoteSelectorValue(n.values[0])
+	case selIn:
+		return n.label + " in " + renderStringSet(n.values)
+	case selNotIn:
+		return n.label + " not in " + renderStringSet(n.values)
+	case selNot:
+		return "!" + n.operands[0].render()
+	}
+	sep := " && "
+	if n.kind == selOr {
+		sep = " || "
+	}
+	parts := make([]string, len(n.operands))
+	for i, operand := range n.operands {
+		parts[i] = operand.render()
+	}
+	return "(" + strings.Join(parts, sep) + ")"
+}
+
+func renderStringSet(values []string) string {
+	quoted := make([]string, len(values))
+	for i, value := range values {
+		quoted[i] = quoteSelectorValue(value)
+	}
+	return "{" + strings.Join(quoted, ", ") + "}"
+}
+
+// quoteSelectorValue quotes a string literal.  Selector literals have no escapes, so a
+// value that contains a double quote is single-quoted.
+func quoteSelectorValue(value string) string {
+	if strings.Contains(value, `"`) {
+		return "'" + value + "'"
+	}
+	return `"` + value + `"`
+}
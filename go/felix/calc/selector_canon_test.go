@@ -0,0 +1,84 @@
+// Copyright (c) 2016 Tigera, Inc. All rights reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package calc_test
+
+import (
+	. "github.com/projectcalico/felix/go/felix/calc"
+
+	. "github.com/onsi/ginkgo"
+	. "github.com/onsi/ginkgo/extensions/table"
+	. "github.com/onsi/gomega"
+	"github.com/projectcalico/libcalico-go/lib/backend/model"
+	"github.com/projectcalico/libcalico-go/lib/selector"
+)
+
+func canonicalId(selStr string) string {
+	sel, err := selector.Parse(selStr)
+	Expect(err).NotTo(HaveOccurred())
+	return CanonicaliseSelector(sel).UniqueId()
+}
+
+var _ = DescribeTable("CanonicaliseSelector should map equivalent selectors to the same ID",
+	func(a, b string) {
+		Expect(canonicalId(a)).To(Equal(canonicalId(b)))
+	},
+	Entry("whitespace", "a=='b'&&c=='d'", "a == 'b' && c == 'd'"),
+	Entry("quoting", `a == "b"`, "a == 'b'"),
+	Entry("reordered &&", "a == 'b' && c == 'd'", "c == 'd' && a == 'b'"),
+	Entry("reordered ||", "a == 'b' || c == 'd'", "c == 'd' || a == 'b'"),
+	Entry("nested &&", "(a == 'b' && c == 'd') && e == 'f'", "a == 'b' && (e == 'f' && c == 'd')"),
+	Entry("duplicate term", "a == 'b' && a == 'b'", "a == 'b'"),
+	Entry("implied has() with ==", "has(x) && x == 'a'", "x == 'a'"),
+	Entry("implied has() with in", "x in {'a', 'b'} && has(x)", "x in {'a', 'b'}"),
+	Entry("double negation", "!!has(x)", "has(x)"),
+	Entry("operators in string literals", "a == '&& b' && c == 'd'", "c == 'd' && a == '&& b'"),
+	Entry("reordered set", "x in {'b', 'a'}", "x in {'a', 'b'}"),
+	Entry("nested ||", "(a == 'b' || c == 'd') && has(e)", "has(e) && (c == 'd' || a == 'b')"),
+)
+
+var _ = DescribeTable("CanonicaliseSelector should keep distinct selectors apart",
+	func(a, b string) {
+		Expect(canonicalId(a)).NotTo(Equal(canonicalId(b)))
+	},
+	Entry("different values", "a == 'b'", "a == 'c'"),
+	Entry("has() not implied by !=", "has(x) && x != 'a'", "x != 'a'"),
+	Entry("has() of a different label", "has(y) && x == 'a'", "x == 'a'"),
+	Entry("&& vs ||", "a == 'b' && c == 'd'", "a == 'b' || c == 'd'"),
+	Entry("single negation", "!has(x)", "has(x)"),
+	Entry("has() not implied by not in", "has(x) && x not in {'a'}", "x not in {'a'}"),
+	Entry("has() implied for a different label than the value", "has(x) && y == 'x'", "y == 'x'"),
+)
+
+var _ = Describe("RuleScanner selector deduplication", func() {
+	It("should give equivalent selectors the same IP set", func() {
+		rs, ur := newHookedRulesScanner()
+		rs.OnPolicyActive(model.PolicyKey{Name: "pol1"}, &model.Policy{
+			InboundRules: []model.Rule{{SrcSelector: "has(x) && x == 'a' && b == 'c'"}},
+		})
+		rs.OnPolicyActive(model.PolicyKey{Name: "pol2"}, &model.Policy{
+			InboundRules: []model.Rule{{SrcSelector: "b == 'c' && x == 'a'"}},
+		})
+		Expect(ur.activeSelectors.Len()).To(Equal(1))
+		pol1IDs := ur.activeRules[model.PolicyKey{Name: "pol1"}].InboundRules[0].SrcIPSetIDs
+		pol2IDs := ur.activeRules[model.PolicyKey{Name: "pol2"}].InboundRules[0].SrcIPSetIDs
+		Expect(pol1IDs).To(Equal(pol2IDs))
+
+		By("keeping the IP set active until the last user goes away")
+		rs.OnPolicyInactive(model.PolicyKey{Name: "pol1"})
+		Expect(ur.activeSelectors.Len()).To(Equal(1))
+		rs.OnPolicyInactive(model.PolicyKey{Name: "pol2"})
+		Expect(ur.activeSelectors.Len()).To(Equal(0))
+	})
+})
@@ -25,6 +25,7 @@ import (
 	"os"
 	"reflect"
 	"regexp"
+	"sort"
 	"strconv"
 	"strings"
 	"time"
@@ -85,6 +86,10 @@ func (source Source) Local() bool {
 
 // Config contains the best, parsed config values loaded from the various sources.
 // We use tags to control the parsing and validation.
+//
+// Parameters flagged as "reloadable" can be changed in the datastore without
+// restarting Felix; their consumers re-read them as they are used.  A change to any
+// other parameter causes Felix to restart.  See RestartRequiredChanges().
 type Config struct {
 	// Configuration parameters.
 
@@ -105,10 +110,10 @@ type Config struct {
 	IgnoreLooseRPF bool `config:"bool;false"`
 
 	StartupCleanupDelay       int `config:"int;30"`
-	PeriodicResyncInterval    int `config:"int;3600"`
-	HostInterfacePollInterval int `config:"int;10"`
+	PeriodicResyncInterval    int `config:"int;3600;reloadable"`
+	HostInterfacePollInterval int `config:"int;10;reloadable"`
 
-	IptablesRefreshInterval int `config:"int;60"`
+	IptablesRefreshInterval int `config:"int;60;reloadable"`
 
 	MetadataAddr string `config:"hostname;127.0.0.1;die-on-fail"`
 	MetadataPort int    `config:"int(0,65535);8775;die-on-fail"`
@@ -121,21 +126,45 @@ type Config struct {
 	LogFilePath           string `config:"file;/var/log/calico/felix.log;die-on-fail"`
 	EtcdDriverLogFilePath string `config:"file;/var/log/calico/felix-etcd.log"`
 
-	LogSeverityFile   string `config:"oneof(DEBUG,INFO,WARNING,ERROR,CRITICAL);INFO"`
-	LogSeverityScreen string `config:"oneof(DEBUG,INFO,WARNING,ERROR,CRITICAL);INFO"`
-	LogSeveritySys    string `config:"oneof(DEBUG,INFO,WARNING,ERROR,CRITICAL);INFO"`
+	LogSeverityFile   string `config:"oneof(DEBUG,INFO,WARNING,ERROR,CRITICAL);INFO;reloadable"`
+	LogSeverityScreen string `config:"oneof(DEBUG,INFO,WARNING,ERROR,CRITICAL);INFO;reloadable"`
+	LogSeveritySys    string `config:"oneof(DEBUG,INFO,WARNING,ERROR,CRITICAL);INFO;reloadable"`
+
+	DriverCaptureFile          string `config:"file;"`
+	DriverCaptureMaxFileSizeMB int    `config:"int;100;non-zero"`
+	DriverCaptureBackupCount   int    `config:"int;5"`
+
+	ProfilingEnabled              bool   `config:"bool;false"`
+	ProfilingDir                  string `config:"file;/tmp"`
+	ProfilingSampleIntervalMillis int    `config:"int;10;non-zero"`
+
+	TraceBufferSize int    `config:"int;100000;non-zero"`
+	TraceBufferDir  string `config:"file;/tmp"`
+
+	MultiProcessDataplane    bool   `config:"bool;false"`
+	ChainGenerationProcesses int    `config:"int;0"`
+	DataplaneBackend         string `config:"oneof(iptables,nftables);iptables"`
+	WarmRestartDir           string `config:"file;"`
 
 	IpInIpEnabled    bool   `config:"bool;false"`
 	IpInIpMtu        int    `config:"int;1440;non-zero"`
 	IpInIpTunnelAddr net.IP `config:"ipv4;"`
 
-	ReportingIntervalSecs int `config:"int;30"`
-	ReportingTTLSecs      int `config:"int;90"`
+	ReportingIntervalSecs int `config:"int;30;reloadable"`
+	ReportingTTLSecs      int `config:"int;90;reloadable"`
 
-	EndpointReportingEnabled   bool    `config:"bool;false"`
-	EndpointReportingDelaySecs float64 `config:"float;1.0"`
+	EndpointReportingEnabled        bool    `config:"bool;false"`
+	EndpointReportingDelaySecs      float64 `config:"float;1.0"`
+	EndpointReportingBatchSize      int     `config:"int(1,100000);100"`
+	EndpointReportingMaxConcurrency int     `config:"int(1,1000);10"`
 
-	MaxIpsetSize int `config:"int;1048576;non-zero"`
+	EndpointWorkerMode string `config:"oneof(actor,batched);actor"`
+	IpsetEngineMode    string `config:"oneof(actor,consolidated);actor"`
+
+	MaxIpsetSize int `config:"int;1048576;non-zero,reloadable"`
+
+	ReferenceLingerSecs       int `config:"int;0"`
+	ReferenceLingerMaxObjects int `config:"int;1000"`
 
 	IptablesMarkMask uint32 `config:"mark-bitmask;0xff000000;non-zero,die-on-fail"`
 
@@ -175,9 +204,54 @@ func (config *Config) UpdateFrom(rawData map[string]string, source Source) (chan
 	return
 }
 
+// Copy returns a copy of the config, which can be updated without affecting this one.
+func (config *Config) Copy() *Config {
+	cp := *config
+	// The raw config maps are replaced rather than modified when the config is
+	// updated so it's safe to share them.
+	cp.sourceToRawConfig = make(map[Source]map[string]string)
+	for source, rawConfig := range config.sourceToRawConfig {
+		cp.sourceToRawConfig[source] = rawConfig
+	}
+	return &cp
+}
+
+// WithResolvedValues returns a copy of the config, updated with the resolved raw values
+// from a ConfigUpdate, as returned by RawValues() on the calculation graph's copy of the
+// config.  Values from local sources always take precedence over the datastore, so the
+// remaining resolved values replace the datastore sources.
+func (config *Config) WithResolvedValues(resolved map[string]string) (*Config, error) {
+	localNames := make(map[string]bool)
+	for source, rawConfig := range config.sourceToRawConfig {
+		if !source.Local() {
+			continue
+		}
+		for rawName := range rawConfig {
+			localNames[strings.ToLower(rawName)] = true
+		}
+	}
+	datastoreValues := make(map[string]string)
+	for name, value := range resolved {
+		if !localNames[strings.ToLower(name)] {
+			datastoreValues[name] = value
+		}
+	}
+	cp := config.Copy()
+	cp.sourceToRawConfig[DatastorePerHost] = map[string]string{}
+	_, err := cp.UpdateFrom(datastoreValues, DatastoreGlobal)
+	return cp, err
+}
+
 func (config *Config) resolve() (changed bool, err error) {
 	newRawValues := make(map[string]string)
 	nameToSource := make(map[string]Source)
+	// Start the reloadable parameters from their defaults, so that deleting one from
+	// the datastore reverts it.  A change to any other parameter causes a restart.
+	for _, param := range knownParams {
+		if param.GetMetadata().Reloadable {
+			param.setDefault(config)
+		}
+	}
 	for _, source := range SourcesInDescendingOrder {
 	valueLoop:
 		for rawName, rawValue := range config.sourceToRawConfig[source] {
@@ -407,6 +481,9 @@ func loadParams() {
 		if strings.Index(flags, "local") > -1 {
 			metadata.Local = true
 		}
+		if strings.Index(flags, "reloadable") > -1 {
+			metadata.Reloadable = true
+		}
 
 		if defaultStr != "" {
 			if strings.Index(flags, "skip-default-validation") > -1 {
@@ -431,6 +508,44 @@ func (config *Config) RawValues() map[string]string {
 	return config.rawValues
 }
 
+// RestartRequiredChanges compares two sets of resolved raw config values, as returned
+// by RawValues(), and returns the sorted names of the parameters that differ and that
+// can't be changed without restarting Felix.  Parameters that we don't know about
+// (for example, those only used by the dataplane driver's plugins) are assumed to
+// require a restart.
+func RestartRequiredChanges(oldValues, newValues map[string]string) []string {
+	if knownParams == nil {
+		loadParams()
+	}
+	names := []string{}
+	checkParam := func(name string) {
+		oldValue, oldOK := oldValues[name]
+		newValue, newOK := newValues[name]
+		if oldOK == newOK && oldValue == newValue {
+			return
+		}
+		if param, ok := knownParams[strings.ToLower(name)]; ok && param.GetMetadata().Reloadable {
+			log.WithFields(log.Fields{
+				"name":     name,
+				"oldValue": oldValue,
+				"newValue": newValue,
+			}).Info("Reloadable config parameter changed")
+			return
+		}
+		names = append(names, name)
+	}
+	for name := range oldValues {
+		checkParam(name)
+	}
+	for name := range newValues {
+		if _, ok := oldValues[name]; !ok {
+			checkParam(name)
+		}
+	}
+	sort.Strings(names)
+	return names
+}
+
 func New() *Config {
 	if knownParams == nil {
 		loadParams()
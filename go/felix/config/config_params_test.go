@@ -17,6 +17,7 @@ package config_test
 import (
 	. "github.com/projectcalico/felix/go/felix/config"
 
+	. "github.com/onsi/ginkgo"
 	. "github.com/onsi/ginkgo/extensions/table"
 	. "github.com/onsi/gomega"
 	"net"
@@ -94,6 +95,29 @@ var _ = DescribeTable("Config parsing",
 	Entry("LogSeveritySys", "LogSeveritySys", "error", "ERROR"),
 	Entry("LogSeveritySys", "LogSeveritySys", "critical", "CRITICAL"),
 
+	Entry("DriverCaptureFile", "DriverCaptureFile",
+		"/tmp/felix.cap", "/tmp/felix.cap"),
+	Entry("DriverCaptureMaxFileSizeMB", "DriverCaptureMaxFileSizeMB",
+		"10", int(10)),
+	Entry("DriverCaptureBackupCount", "DriverCaptureBackupCount",
+		"0", int(0)),
+
+	Entry("ProfilingEnabled", "ProfilingEnabled", "true", true),
+	Entry("ProfilingDir", "ProfilingDir",
+		"/var/tmp/profiles", "/var/tmp/profiles"),
+	Entry("ProfilingSampleIntervalMillis", "ProfilingSampleIntervalMillis",
+		"5", int(5)),
+
+	Entry("TraceBufferSize", "TraceBufferSize", "1000", int(1000)),
+	Entry("TraceBufferDir", "TraceBufferDir",
+		"/var/tmp/traces", "/var/tmp/traces"),
+
+	Entry("MultiProcessDataplane", "MultiProcessDataplane", "true", true),
+	Entry("ChainGenerationProcesses", "ChainGenerationProcesses", "4", 4),
+	Entry("DataplaneBackend", "DataplaneBackend", "nftables", "nftables"),
+	Entry("WarmRestartDir", "WarmRestartDir",
+		"/var/lib/calico", "/var/lib/calico"),
+
 	Entry("IpInIpEnabled", "IpInIpEnabled", "true", true),
 	Entry("IpInIpEnabled", "IpInIpEnabled", "y", true),
 	Entry("IpInIpEnabled", "IpInIpEnabled", "True", true),
@@ -111,8 +135,18 @@ var _ = DescribeTable("Config parsing",
 		"yes", true),
 	Entry("EndpointReportingDelaySecs", "EndpointReportingDelaySecs",
 		"10", float64(10)),
+	Entry("EndpointReportingBatchSize", "EndpointReportingBatchSize",
+		"20", int(20)),
+	Entry("EndpointReportingMaxConcurrency", "EndpointReportingMaxConcurrency",
+		"2", int(2)),
+	Entry("EndpointWorkerMode", "EndpointWorkerMode",
+		"batched", "batched"),
+	Entry("IpsetEngineMode", "IpsetEngineMode",
+		"consolidated", "consolidated"),
 
 	Entry("MaxIpsetSize", "MaxIpsetSize", "12345", int(12345)),
+	Entry("ReferenceLingerSecs", "ReferenceLingerSecs", "30", int(30)),
+	Entry("ReferenceLingerMaxObjects", "ReferenceLingerMaxObjects", "500", int(500)),
 	Entry("IptablesMarkMask", "IptablesMarkMask", "0xf0f0", uint32(0xf0f0)),
 
 	Entry("PrometheusMetricsEnabled", "PrometheusMetricsEnabled", "true", true),
@@ -121,3 +155,83 @@ var _ = DescribeTable("Config parsing",
 	Entry("FailsafeInboundHostPorts", "FailsafeInboundHostPorts", "1,2,3,4", []int{1, 2, 3, 4}),
 	Entry("FailsafeOutboundHostPorts", "FailsafeOutboundHostPorts", "1,2,3,4", []int{1, 2, 3, 4}),
 )
+
+var _ = DescribeTable("RestartRequiredChanges",
+	func(oldValues, newValues map[string]string, expected []string) {
+		Expect(RestartRequiredChanges(oldValues, newValues)).To(Equal(expected))
+	},
+
+	Entry("no change",
+		map[string]string{"LogSeverityScreen": "INFO", "IpInIpEnabled": "true"},
+		map[string]string{"LogSeverityScreen": "INFO", "IpInIpEnabled": "true"},
+		[]string{}),
+	Entry("reloadable param changed",
+		map[string]string{"LogSeverityScreen": "INFO", "IpInIpEnabled": "true"},
+		map[string]string{"LogSeverityScreen": "DEBUG", "IpInIpEnabled": "true"},
+		[]string{}),
+	Entry("reloadable params added and removed",
+		map[string]string{"MaxIpsetSize": "1000"},
+		map[string]string{"ReportingIntervalSecs": "10"},
+		[]string{}),
+	Entry("restart-required param changed",
+		map[string]string{"LogSeverityScreen": "INFO", "IpInIpEnabled": "true"},
+		map[string]string{"LogSeverityScreen": "DEBUG", "IpInIpEnabled": "false"},
+		[]string{"IpInIpEnabled"}),
+	Entry("startup cleanup delay changed",
+		map[string]string{"StartupCleanupDelay": "30"},
+		map[string]string{"StartupCleanupDelay": "5"},
+		[]string{"StartupCleanupDelay"}),
+	Entry("restart-required param removed",
+		map[string]string{"IpInIpMtu": "1400", "InterfacePrefix": "tap"},
+		map[string]string{},
+		[]string{"InterfacePrefix", "IpInIpMtu"}),
+	Entry("unknown param added",
+		map[string]string{},
+		map[string]string{"PluginParam": "foo"},
+		[]string{"PluginParam"}),
+)
+
+var _ = Describe("Config reloading", func() {
+	var config *Config
+
+	BeforeEach(func() {
+		config = New()
+		config.UpdateFrom(map[string]string{"LogSeverityScreen": "WARNING"},
+			EnvironmentVariable)
+		config.UpdateFrom(map[string]string{"ReportingTTLSecs": "10"},
+			DatastoreGlobal)
+	})
+
+	It("should revert a deleted reloadable parameter to its default", func() {
+		Expect(config.ReportingTTLSecs).To(Equal(10))
+		changed, err := config.UpdateFrom(map[string]string{}, DatastoreGlobal)
+		Expect(err).NotTo(HaveOccurred())
+		Expect(changed).To(BeTrue())
+		Expect(config.ReportingTTLSecs).To(Equal(90))
+	})
+
+	It("should fall back to a lower-priority source when a parameter is deleted", func() {
+		config.UpdateFrom(map[string]string{"ReportingTTLSecs": "20"},
+			DatastorePerHost)
+		Expect(config.ReportingTTLSecs).To(Equal(20))
+		config.UpdateFrom(map[string]string{}, DatastorePerHost)
+		Expect(config.ReportingTTLSecs).To(Equal(10))
+	})
+
+	It("should apply resolved values to a copy", func() {
+		newConfig, err := config.WithResolvedValues(map[string]string{
+			"LogSeverityScreen": "WARNING",
+			"ReportingTTLSecs":  "20",
+		})
+		Expect(err).NotTo(HaveOccurred())
+		Expect(newConfig.ReportingTTLSecs).To(Equal(20))
+		Expect(newConfig.LogSeverityScreen).To(Equal("WARNING"))
+		Expect(config.ReportingTTLSecs).To(Equal(10))
+
+		newConfig, err = newConfig.WithResolvedValues(map[string]string{
+			"LogSeverityScreen": "WARNING",
+		})
+		Expect(err).NotTo(HaveOccurred())
+		Expect(newConfig.ReportingTTLSecs).To(Equal(90))
+	})
+})
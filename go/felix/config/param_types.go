@@ -40,6 +40,7 @@ type Metadata struct {
 	NonZero           bool
 	DieOnParseFailure bool
 	Local             bool
+	Reloadable        bool
 }
 
 func (m *Metadata) GetMetadata() *Metadata {
@@ -33,6 +33,7 @@ import (
 	"github.com/projectcalico/libcalico-go/lib/backend"
 	bapi "github.com/projectcalico/libcalico-go/lib/backend/api"
 	"github.com/projectcalico/libcalico-go/lib/backend/model"
+	"github.com/prometheus/client_golang/prometheus"
 	"github.com/prometheus/client_golang/prometheus/promhttp"
 	"io"
 	"net/http"
@@ -40,10 +41,27 @@ import (
 	"os/exec"
 	"os/signal"
 	"reflect"
+	"sync"
 	"syscall"
 	"time"
 )
 
+var (
+	seqNoSentGauge = prometheus.NewGauge(prometheus.GaugeOpts{
+		Name: "felix_dataplane_sent_seq_no",
+		Help: "Sequence number of the last message sent to the dataplane driver.",
+	})
+	seqNoProgrammedGauge = prometheus.NewGauge(prometheus.GaugeOpts{
+		Name: "felix_dataplane_programmed_seq_no",
+		Help: "Highest sequence number that the dataplane driver has fully programmed.",
+	})
+)
+
+func init() {
+	prometheus.MustRegister(seqNoSentGauge)
+	prometheus.MustRegister(seqNoProgrammedGauge)
+}
+
 const usage = `Felix, the Calico per-host daemon.
 
 Usage:
@@ -210,6 +228,7 @@ configRetry:
 	// do the dynamic calculation of ipset memberships and active policies
 	// etc.
 	asyncCalcGraph := calc.NewAsyncCalcGraph(configParams, felixConn.ToDataplane)
+	felixConn.asyncCalcGraph = asyncCalcGraph
 
 	if configParams.UsageReportingEnabled {
 		// Usage reporting enabled, add stats collector to graph and
@@ -255,6 +274,8 @@ configRetry:
 			felixConn.datastore,
 			delay,
 			delay*180,
+			configParams.EndpointReportingBatchSize,
+			configParams.EndpointReportingMaxConcurrency,
 		)
 		felixConn.statusReporter.Start()
 	}
@@ -426,7 +447,10 @@ type ipUpdate struct {
 }
 
 type DataplaneConn struct {
+	// config is replaced, rather than modified, when reloadable parameters change.
+	// Access it via Config().
 	config                     *config.Config
+	configLock                 sync.Mutex
 	ToDataplane                chan interface{}
 	StatusUpdatesFromDataplane chan interface{}
 	InSync                     chan bool
@@ -435,6 +459,7 @@ type DataplaneConn struct {
 	felixWriter                io.Writer
 	datastore                  bapi.Client
 	statusReporter             *statusrep.EndpointStatusReporter
+	asyncCalcGraph             *calc.AsyncCalcGraph
 
 	datastoreInSync bool
 
@@ -510,6 +535,10 @@ func (fc *DataplaneConn) readMessagesFromDataplane() {
 			if fc.statusReporter != nil {
 				fc.StatusUpdatesFromDataplane <- msg.HostEndpointStatusRemove
 			}
+		case *proto.FromDataplane_DataplaneCapabilities:
+			fc.handleDataplaneCapabilities(msg.DataplaneCapabilities)
+		case *proto.FromDataplane_DataplaneProgressUpdate:
+			fc.handleDataplaneProgressUpdate(msg.DataplaneProgressUpdate)
 		default:
 			log.Warningf("XXXX Unknown message from felix: %#v", msg)
 		}
@@ -517,17 +546,31 @@ func (fc *DataplaneConn) readMessagesFromDataplane() {
 	}
 }
 
+func (fc *DataplaneConn) handleDataplaneCapabilities(msg *proto.DataplaneCapabilities) {
+	log.WithField("capabilities", *msg).Info("Received dataplane driver capabilities")
+	if msg.PackedIpSetMembers {
+		fc.asyncCalcGraph.EnablePackedIPSetMembers()
+	}
+}
+
+func (fc *DataplaneConn) handleDataplaneProgressUpdate(msg *proto.DataplaneProgressUpdate) {
+	log.WithField("seqNo", msg.HighestProgrammedSequenceNumber).Debug(
+		"Dataplane driver progress update")
+	seqNoProgrammedGauge.Set(float64(msg.HighestProgrammedSequenceNumber))
+}
+
 func (fc *DataplaneConn) handleProcessStatusUpdate(msg *proto.ProcessStatusUpdate) {
 	log.Debugf("Status update from dataplane driver: %v", *msg)
+	configParams := fc.Config()
 	statusReport := model.StatusReport{
 		Timestamp:     msg.IsoTimestamp,
 		UptimeSeconds: msg.Uptime,
 		FirstUpdate:   !fc.firstStatusReportSent,
 	}
 	kv := model.KVPair{
-		Key:   model.ActiveStatusReportKey{Hostname: fc.config.FelixHostname},
+		Key:   model.ActiveStatusReportKey{Hostname: configParams.FelixHostname},
 		Value: &statusReport,
-		TTL:   time.Duration(fc.config.ReportingTTLSecs) * time.Second,
+		TTL:   time.Duration(configParams.ReportingTTLSecs) * time.Second,
 	}
 	_, err := fc.datastore.Apply(&kv)
 	if err != nil {
@@ -536,7 +579,7 @@ func (fc *DataplaneConn) handleProcessStatusUpdate(msg *proto.ProcessStatusUpdat
 		fc.firstStatusReportSent = true
 	}
 	kv = model.KVPair{
-		Key:   model.LastStatusReportKey{Hostname: fc.config.FelixHostname},
+		Key:   model.LastStatusReportKey{Hostname: configParams.FelixHostname},
 		Value: &statusReport,
 	}
 	_, err = fc.datastore.Apply(&kv)
@@ -550,7 +593,7 @@ func (fc *DataplaneConn) sendMessagesToDataplaneDriver() {
 		fc.shutDownProcess("Failed to send messages to dataplane")
 	}()
 
-	var config map[string]string
+	var lastConfig map[string]string
 	for {
 		msg := <-fc.ToDataplane
 		switch msg := msg.(type) {
@@ -562,20 +605,27 @@ func (fc *DataplaneConn) sendMessagesToDataplaneDriver() {
 			}
 		case *proto.ConfigUpdate:
 			logCxt := log.WithFields(log.Fields{
-				"old": config,
+				"old": lastConfig,
 				"new": msg.Config,
 			})
 			logCxt.Info("Possible config update")
-			if config != nil && !reflect.DeepEqual(msg.Config, config) {
-				logCxt.Warn("Felix configuration changed. Need to restart.")
-				fc.shutDownProcess("config changed")
-			} else if config == nil {
+			if lastConfig == nil {
 				logCxt.Info("Config resolved.")
-				config = make(map[string]string)
-				for k, v := range msg.Config {
-					config[k] = v
+			} else if !reflect.DeepEqual(msg.Config, lastConfig) {
+				restartParams := config.RestartRequiredChanges(lastConfig, msg.Config)
+				if len(restartParams) > 0 {
+					logCxt.WithField("params", restartParams).Warn(
+						"Felix configuration changed. Need to restart.")
+					fc.shutDownProcess("config changed")
+				} else {
+					logCxt.Info("Only reloadable config changed, applying it without restart.")
+					fc.reloadConfig(msg.Config)
 				}
 			}
+			lastConfig = make(map[string]string)
+			for k, v := range msg.Config {
+				lastConfig[k] = v
+			}
 		case *calc.DatastoreNotReady:
 			log.Warn("Datastore became unready, need to restart.")
 			fc.shutDownProcess("datastore became unready")
@@ -584,6 +634,31 @@ func (fc *DataplaneConn) sendMessagesToDataplaneDriver() {
 	}
 }
 
+// Config returns the current config.  The returned Config must not be modified.
+func (fc *DataplaneConn) Config() *config.Config {
+	fc.configLock.Lock()
+	defer fc.configLock.Unlock()
+	return fc.config
+}
+
+// reloadConfig applies a change to reloadable config parameters.  It builds a new
+// Config from the resolved values in the ConfigUpdate and swaps it in; parameters
+// that are read via Config() as they are used, such as ReportingTTLSecs, pick up the
+// new values.  The ConfigUpdate is then passed on to the dataplane driver, which
+// applies its own reloadable parameters.
+func (fc *DataplaneConn) reloadConfig(resolved map[string]string) {
+	newConfig, err := fc.Config().WithResolvedValues(resolved)
+	if err != nil {
+		log.WithError(err).Error("Failed to apply reloaded config, need to restart.")
+		fc.shutDownProcess("failed to reload config")
+		return
+	}
+	fc.configLock.Lock()
+	fc.config = newConfig
+	fc.configLock.Unlock()
+	logutils.UpdateLogLevels(newConfig)
+}
+
 func (fc *DataplaneConn) shutDownProcess(reason string) {
 	// Send a failure report to the managed shutdown thread then give it
 	// a few seconds to do the shutdown.
@@ -599,6 +674,7 @@ func (fc *DataplaneConn) marshalToDataplane(msg interface{}) {
 	envelope := &proto.ToDataplane{
 		SequenceNumber: fc.nextSeqNumber,
 	}
+	seqNoSentGauge.Set(float64(fc.nextSeqNumber))
 	fc.nextSeqNumber += 1
 	switch msg := msg.(type) {
 	case *proto.ConfigUpdate:
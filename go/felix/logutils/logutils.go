@@ -29,6 +29,7 @@ import (
 	"sort"
 	"strings"
 	"sync"
+	"sync/atomic"
 )
 
 // logrusToSyslogLevel maps logrus.Level to the matching syslog level used by
@@ -78,6 +79,14 @@ func ConfigureEarlyLogging() {
 	log.Infof("Early screen log level set to %v", logLevelScreen)
 }
 
+// Hooks created by ConfigureLogging.  We keep hold of them so that UpdateLogLevels can
+// adjust their levels if the config changes.  nil if the target is disabled.
+var (
+	screenHook *StreamHook
+	fileHook   *StreamHook
+	syslogHook *LeveledHook
+)
+
 // ConfigureLogging uses the resolved configuration to complete the logging
 // configuration.  It creates hooks for the relevant logging targets and
 // attaches them to logrus.
@@ -87,18 +96,10 @@ func ConfigureLogging(configParams *config.Config) {
 	logLevelFile := safeParseLogLevel(configParams.LogSeverityFile)
 	logLevelSyslog := safeParseLogLevel(configParams.LogSeveritySys)
 
-	// Work out the most verbose level that is being logged.
-	mostVerboseLevel := logLevelScreen
-	if logLevelFile > mostVerboseLevel {
-		mostVerboseLevel = logLevelFile
-	}
-	if logLevelSyslog > mostVerboseLevel {
-		mostVerboseLevel = logLevelScreen
-	}
 	// Disable all more-verbose levels using the global setting, this
 	// ensures that debug logs are filtered as early as possible in the
 	// pipeline.
-	log.SetLevel(mostVerboseLevel)
+	log.SetLevel(mostVerboseLevel(logLevelScreen, logLevelFile, logLevelSyslog))
 
 	// Disable logrus' default output, which only supports a single
 	// destination at the global log level.
@@ -106,16 +107,13 @@ func ConfigureLogging(configParams *config.Config) {
 
 	// Screen target.
 	if configParams.LogSeverityScreen != "" {
-		screenLevels := filterLevels(logLevelScreen)
-		log.AddHook(&StreamHook{
-			writer: os.Stdout,
-			levels: screenLevels,
-		})
+		screenHook = &StreamHook{writer: os.Stdout}
+		screenHook.SetMaxLevel(logLevelScreen)
+		log.AddHook(screenHook)
 	}
 
 	// File target.
 	if configParams.LogSeverityFile != "" {
-		fileLevels := filterLevels(logLevelFile)
 		if err := os.MkdirAll(path.Dir(configParams.LogFilePath), 0755); err != nil {
 			log.WithError(err).Fatal("Failed to create log dir")
 		}
@@ -123,10 +121,9 @@ func ConfigureLogging(configParams *config.Config) {
 		if err != nil {
 			log.WithError(err).Fatal("Failed to open log file")
 		}
-		log.AddHook(&StreamHook{
-			writer: rotAwareFile,
-			levels: fileLevels,
-		})
+		fileHook = &StreamHook{writer: rotAwareFile}
+		fileHook.SetMaxLevel(logLevelFile)
+		log.AddHook(fileHook)
 	}
 
 	if configParams.LogSeveritySys != "" {
@@ -144,25 +141,47 @@ func ConfigureLogging(configParams *config.Config) {
 		if hook, err := logrus_syslog.NewSyslogHook(net, addr, priority, tag); err != nil {
 			log.WithError(err).WithField("level", configParams.LogSeveritySys).Error("Failed to connect to syslog")
 		} else {
-			syslogLevels := filterLevels(logLevelSyslog)
-			levHook := &LeveledHook{
-				hook:   hook,
-				levels: syslogLevels,
-			}
-			log.AddHook(levHook)
+			syslogHook = &LeveledHook{hook: hook}
+			syslogHook.SetMaxLevel(logLevelSyslog)
+			log.AddHook(syslogHook)
 		}
 	}
 }
 
-// filterLevels returns all the logrus.Level values <= maxLevel.
-func filterLevels(maxLevel log.Level) []log.Level {
-	levels := []log.Level{}
-	for _, l := range log.AllLevels {
-		if l <= maxLevel {
-			levels = append(levels, l)
+// UpdateLogLevels applies changed log severities to the hooks created by
+// ConfigureLogging, without reopening any of the targets.  A target that was
+// disabled at start of day stays disabled until Felix restarts.
+func UpdateLogLevels(configParams *config.Config) {
+	logLevelScreen := safeParseLogLevel(configParams.LogSeverityScreen)
+	logLevelFile := safeParseLogLevel(configParams.LogSeverityFile)
+	logLevelSyslog := safeParseLogLevel(configParams.LogSeveritySys)
+
+	if screenHook != nil {
+		screenHook.SetMaxLevel(logLevelScreen)
+	}
+	if fileHook != nil {
+		fileHook.SetMaxLevel(logLevelFile)
+	}
+	if syslogHook != nil {
+		syslogHook.SetMaxLevel(logLevelSyslog)
+	}
+	log.SetLevel(mostVerboseLevel(logLevelScreen, logLevelFile, logLevelSyslog))
+	log.WithFields(log.Fields{
+		"screen": logLevelScreen,
+		"file":   logLevelFile,
+		"syslog": logLevelSyslog,
+	}).Info("Updated log levels")
+}
+
+// mostVerboseLevel returns the most verbose of the given levels.
+func mostVerboseLevel(levels ...log.Level) log.Level {
+	mostVerbose := log.PanicLevel
+	for _, l := range levels {
+		if l > mostVerbose {
+			mostVerbose = l
 		}
 	}
-	return levels
+	return mostVerbose
 }
 
 // Formatter is our custom log formatter, which mimics the style used by the
@@ -242,19 +261,38 @@ func shouldSkipFrame(frame runtime.Frame) bool {
 		strings.LastIndex(frame.File, "entry.go") > 0
 }
 
+// levelFilter is embedded in our hooks to allow their level to be changed after
+// they have been added to logrus, which only calls Levels() once, when the hook is
+// added.  The hooks register for all levels and drop entries above maxLevel.
+type levelFilter struct {
+	maxLevel uint32
+}
+
+func (f *levelFilter) Levels() []log.Level {
+	return log.AllLevels
+}
+
+func (f *levelFilter) SetMaxLevel(maxLevel log.Level) {
+	atomic.StoreUint32(&f.maxLevel, uint32(maxLevel))
+}
+
+func (f *levelFilter) shouldFire(level log.Level) bool {
+	return uint32(level) <= atomic.LoadUint32(&f.maxLevel)
+}
+
 // StreamHook is a logrus Hook that writes to a stream when fired.
-// It supports configuration of log levels at which is fires.
+// It supports configuration of the maximum log level at which it fires.
 type StreamHook struct {
+	levelFilter
 	mu     sync.Mutex
 	writer io.Writer
-	levels []log.Level
-}
-
-func (h *StreamHook) Levels() []log.Level {
-	return h.levels
 }
 
 func (h *StreamHook) Fire(entry *log.Entry) (err error) {
+	if !h.shouldFire(entry.Level) {
+		return
+	}
+
 	var serialized []byte
 	if serialized, err = entry.Logger.Formatter.Format(entry); err != nil {
 		return
@@ -268,15 +306,14 @@ func (h *StreamHook) Fire(entry *log.Entry) (err error) {
 }
 
 type LeveledHook struct {
-	hook   log.Hook
-	levels []log.Level
-}
-
-func (h *LeveledHook) Levels() []log.Level {
-	return h.levels
+	levelFilter
+	hook log.Hook
 }
 
 func (h *LeveledHook) Fire(entry *log.Entry) error {
+	if !h.shouldFire(entry.Level) {
+		return nil
+	}
 	return h.hook.Fire(entry)
 }
 
@@ -39,9 +39,12 @@
 // ensures that the driver has the configuration before it receives any
 // updates.
 //
-// Note: the main process doesn't currently support any subsequent config
-// updates.  If the config is updated after the process is running, it will
-// exit, so that the init system can restart it.
+// If the config is updated after the process is running, the main process
+// checks which parameters changed.  If any of them is not flagged as
+// reloadable (see the config package), it exits, so that the init system can
+// restart it.  Otherwise, it applies the change itself and sends a further
+// ConfigUpdate with the complete new configuration; the driver is expected to
+// apply the reloadable parameters that it uses without restarting.
 //
 // Resync and updates
 //
@@ -61,6 +64,19 @@
 // performance, IP set updates are communicated as an initial IPSetUpdate,
 // followed by a sequence of IPSetDeltaUpdate messages.
 //
+// Optional features
+//
+// At start of day, the driver may send a DataplaneCapabilities message to
+// tell the main process which optional protocol features it supports.  The
+// main process carries on sending its updates while it waits for that message
+// so the driver must be prepared to receive the basic encoding for any
+// messages that were sent before the capabilities were received.
+//
+// Currently, the only optional feature is the packed encoding of IP set
+// members, where the members of IPSetUpdate and IPSetDeltaUpdate messages
+// are sent as a byte array of fixed-width addresses per IP version rather
+// than as a list of strings.
+//
 // Graceful restart
 //
 // During the resync, the dataplane driver is likely to have an incomplete
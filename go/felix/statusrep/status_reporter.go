@@ -15,15 +15,43 @@
 package statusrep
 
 import (
+	"container/heap"
+	"time"
+
 	log "github.com/Sirupsen/logrus"
 	"github.com/projectcalico/felix/go/felix/jitter"
 	"github.com/projectcalico/felix/go/felix/proto"
 	"github.com/projectcalico/felix/go/felix/set"
 	"github.com/projectcalico/libcalico-go/lib/backend/model"
 	"github.com/projectcalico/libcalico-go/lib/errors"
-	"time"
+	"github.com/prometheus/client_golang/prometheus"
+)
+
+// maxRetryBackoff caps the exponential backoff applied to an endpoint status
+// after repeated failures to write it.
+const maxRetryBackoff = 30 * time.Second
+
+var (
+	statusBacklogGauge = prometheus.NewGauge(prometheus.GaugeOpts{
+		Name: "felix_endpoint_status_backlog",
+		Help: "Number of endpoint statuses waiting to be written to the datastore.",
+	})
+	statusWriteLatency = prometheus.NewSummary(prometheus.SummaryOpts{
+		Name: "felix_endpoint_status_write_seconds",
+		Help: "Time taken to write (or delete) an endpoint status in the datastore.",
+	})
+	statusWriteFailures = prometheus.NewCounter(prometheus.CounterOpts{
+		Name: "felix_endpoint_status_write_failures",
+		Help: "Number of failed endpoint status writes.",
+	})
 )
 
+func init() {
+	prometheus.MustRegister(statusBacklogGauge)
+	prometheus.MustRegister(statusWriteLatency)
+	prometheus.MustRegister(statusWriteFailures)
+}
+
 type EndpointStatusReporter struct {
 	hostname           string
 	endpointUpdates    <-chan interface{}
@@ -39,6 +67,75 @@ type EndpointStatusReporter struct {
 	resyncTickerC      <-chan time.Time
 	rateLimitTicker    stoppable
 	rateLimitTickerC   <-chan time.Time
+
+	// writeBatchSize is both the number of write tokens added to the bucket on
+	// each rate-limit tick and the capacity of the bucket.  Each datastore
+	// write consumes one token.
+	writeBatchSize      int
+	writeTokens         int
+	maxConcurrentWrites int
+	// writesInFlight contains the IDs that have a write in progress.  They
+	// stay in activeDirtyIDs until the write succeeds.
+	writesInFlight set.Set
+	// writeResults receives the result of each write.  It has room for a
+	// result from every in-flight write so that the writers never block.
+	writeResults chan writeResult
+	// minRetryBackoff is the delay before retrying a failed write; it doubles
+	// with each consecutive failure for the same endpoint.
+	minRetryBackoff time.Duration
+	statIDToRetry   map[model.Key]*retryState
+	// retryQueue holds the IDs that are backing off after a failed write,
+	// ordered by their next attempt.  While backing off, an ID is not in
+	// activeDirtyIDs.
+	retryQueue retryHeap
+}
+
+type writeResult struct {
+	statID model.Key
+	status string
+	err    error
+}
+
+type retryState struct {
+	statID      model.Key
+	numFailures int
+	nextAttempt time.Time
+	// index is the position of the state in the retryQueue, or -1 if the
+	// ID isn't backing off.
+	index int
+}
+
+// retryHeap is a container/heap of retryStates, ordered by next attempt.
+type retryHeap []*retryState
+
+func (h retryHeap) Len() int {
+	return len(h)
+}
+
+func (h retryHeap) Less(i, j int) bool {
+	return h[i].nextAttempt.Before(h[j].nextAttempt)
+}
+
+func (h retryHeap) Swap(i, j int) {
+	h[i], h[j] = h[j], h[i]
+	h[i].index = i
+	h[j].index = j
+}
+
+func (h *retryHeap) Push(x interface{}) {
+	retry := x.(*retryState)
+	retry.index = len(*h)
+	*h = append(*h, retry)
+}
+
+func (h *retryHeap) Pop() interface{} {
+	old := *h
+	n := len(old)
+	retry := old[n-1]
+	old[n-1] = nil
+	retry.index = -1
+	*h = old[:n-1]
+	return retry
 }
 
 func NewEndpointStatusReporter(hostname string,
@@ -46,7 +143,9 @@ func NewEndpointStatusReporter(hostname string,
 	inSync <-chan bool,
 	datastore datastore,
 	reportingDelay time.Duration,
-	resyncInterval time.Duration) *EndpointStatusReporter {
+	resyncInterval time.Duration,
+	writeBatchSize int,
+	maxConcurrentWrites int) *EndpointStatusReporter {
 
 	resyncSchedulingTicker := jitter.NewTicker(resyncInterval, resyncInterval/10)
 	updateRateLimitTicker := jitter.NewTicker(reportingDelay, reportingDelay/10)
@@ -62,6 +161,9 @@ func NewEndpointStatusReporter(hostname string,
 		updateRateLimitTicker.C,
 		reportingDelay,
 		resyncInterval,
+		writeBatchSize,
+		maxConcurrentWrites,
+		reportingDelay,
 	)
 }
 
@@ -76,22 +178,37 @@ func newEndpointStatusReporterWithTickerChans(hostname string,
 	rateLimitTicker stoppable,
 	rateLimitTickerChan <-chan time.Time,
 	reportingDelay time.Duration,
-	resyncInterval time.Duration) *EndpointStatusReporter {
+	resyncInterval time.Duration,
+	writeBatchSize int,
+	maxConcurrentWrites int,
+	minRetryBackoff time.Duration) *EndpointStatusReporter {
+	if writeBatchSize < 1 {
+		writeBatchSize = 1
+	}
+	if maxConcurrentWrites < 1 {
+		maxConcurrentWrites = 1
+	}
 	return &EndpointStatusReporter{
-		hostname:           hostname,
-		endpointUpdates:    endpointUpdates,
-		datastore:          datastore,
-		inSync:             inSync,
-		stop:               make(chan bool),
-		epStatusIDToStatus: make(map[model.Key]string),
-		queuedDirtyIDs:     set.New(),
-		activeDirtyIDs:     set.New(),
-		resyncTicker:       resyncTicker,
-		resyncTickerC:      resyncTickerChan,
-		rateLimitTicker:    rateLimitTicker,
-		rateLimitTickerC:   rateLimitTickerChan,
-		reportingDelay:     reportingDelay,
-		resyncInterval:     resyncInterval,
+		hostname:            hostname,
+		endpointUpdates:     endpointUpdates,
+		datastore:           datastore,
+		inSync:              inSync,
+		stop:                make(chan bool),
+		epStatusIDToStatus:  make(map[model.Key]string),
+		queuedDirtyIDs:      set.New(),
+		activeDirtyIDs:      set.New(),
+		resyncTicker:        resyncTicker,
+		resyncTickerC:       resyncTickerChan,
+		rateLimitTicker:     rateLimitTicker,
+		rateLimitTickerC:    rateLimitTickerChan,
+		reportingDelay:      reportingDelay,
+		resyncInterval:      resyncInterval,
+		writeBatchSize:      writeBatchSize,
+		maxConcurrentWrites: maxConcurrentWrites,
+		writesInFlight:      set.New(),
+		writeResults:        make(chan writeResult, maxConcurrentWrites),
+		minRetryBackoff:     minRetryBackoff,
+		statIDToRetry:       make(map[model.Key]*retryState),
 	}
 }
 
@@ -115,28 +232,38 @@ func (esr *EndpointStatusReporter) Start() {
 // its processing is divided into two phases.  In the first phase, it waits on
 // its various input channels and updates its cached state.  In the second
 // phase, it works to bring the datastore into sync.  Datastore updates are
-// rate-limited and jittered to coalesce flapping status updates and to avoid
-// thundering herd issues.
+// rate-limited by a token bucket, which is refilled on each jittered tick,
+// to coalesce flapping status updates and to avoid thundering herd issues.
+// The writes run in background goroutines, which report back on the
+// writeResults channel, so the loop keeps handling updates while they're in
+// progress.
 func (esr *EndpointStatusReporter) loopHandlingEndpointStatusUpdates() {
 	log.Infof("Starting endpoint status reporter loop with resync "+
-		"interval %v, report rate limit: 1/%v", esr.resyncInterval,
-		esr.reportingDelay)
+		"interval %v, report rate limit: %v/%v, max concurrent writes: %v",
+		esr.resyncInterval, esr.writeBatchSize, esr.reportingDelay,
+		esr.maxConcurrentWrites)
 	datamodelInSync := false
 	resyncRequested := false
 
 	for {
-		updatesAllowed := false
+		tickOccurred := false
 		select {
 		case <-esr.stop:
 			log.Info("Stopping endpoint status reporter")
 			esr.resyncTicker.Stop()
 			esr.rateLimitTicker.Stop()
-			break
+			return
 		case <-esr.resyncTickerC:
 			log.Debug("Endpoint status resync tick: scheduling cleanup")
 			resyncRequested = true
 		case <-esr.rateLimitTickerC:
-			updatesAllowed = true
+			tickOccurred = true
+			esr.writeTokens += esr.writeBatchSize
+			if esr.writeTokens > esr.writeBatchSize {
+				esr.writeTokens = esr.writeBatchSize
+			}
+		case result := <-esr.writeResults:
+			esr.handleWriteResult(result)
 		case inSync := <-esr.inSync:
 			log.Debug("Datamodel in sync, enabling status resync")
 			datamodelInSync = datamodelInSync || inSync
@@ -180,7 +307,8 @@ func (esr *EndpointStatusReporter) loopHandlingEndpointStatusUpdates() {
 					delete(esr.epStatusIDToStatus, statID)
 				}
 				if !esr.activeDirtyIDs.Contains(statID) &&
-					!esr.queuedDirtyIDs.Contains(statID) {
+					!esr.queuedDirtyIDs.Contains(statID) &&
+					!esr.isBackingOff(statID) {
 					// Add the update into the queued set so that
 					// we delay its initial update.  That prevent
 					// flapping at start of day.
@@ -199,47 +327,144 @@ func (esr *EndpointStatusReporter) loopHandlingEndpointStatusUpdates() {
 			resyncRequested = false
 		}
 
-		if updatesAllowed {
-			if esr.activeDirtyIDs.Len() > 0 {
-				// Not throttled and there's at least one update
-				// pending.  Choose an arbitrary update from the dirty
-				// set.
-				log.WithField("numDirtyEndpoints", esr.activeDirtyIDs.Len()).Debug(
-					"Unthrottled and updates pending")
-				var statID model.Key
-				esr.activeDirtyIDs.Iter(func(item interface{}) error {
-					statID = item.(model.Key)
-					return set.StopIteration
-				})
-				// Then try to write the update to the datastore.
-				// Note: the update could be a deletion, in which case
-				// the read from the cache wil return nil.
-				err := esr.writeEndpointStatus(statID,
-					esr.epStatusIDToStatus[statID])
-				if err != nil {
-					log.WithError(err).Warn(
-						"Failed to write endpoint status; is datastore up?")
-				} else {
-					// Success, remove the status from the dirty set.
-					log.WithField("statID", statID).Debug("Write successful")
-					esr.activeDirtyIDs.Discard(statID)
-				}
-			}
-			if esr.queuedDirtyIDs.Len() > 0 {
-				// Now copy the queued statuses to the main dirty set.
-				// Doing this after the attempt to write above means that
-				// endpoints always spend at least one interval in the
-				// queued set.
-				log.WithField("numQueuedUpdates", esr.queuedDirtyIDs.Len()).Debug(
-					"Copying queued set to dirty set")
-				esr.queuedDirtyIDs.Iter(func(item interface{}) error {
-					esr.activeDirtyIDs.Add(item)
-					return nil
-				})
-				esr.queuedDirtyIDs = set.New()
-			}
+		esr.requeueDueRetries(time.Now())
+		if esr.writeTokens > 0 &&
+			esr.activeDirtyIDs.Len() > esr.writesInFlight.Len() &&
+			esr.writesInFlight.Len() < esr.maxConcurrentWrites {
+			// There's at least one update pending that isn't already
+			// being written, we have tokens to spend on it and room
+			// for another write.
+			log.WithFields(log.Fields{
+				"numDirtyEndpoints": esr.activeDirtyIDs.Len(),
+				"numWritesInFlight": esr.writesInFlight.Len(),
+				"tokens":            esr.writeTokens,
+			}).Debug("Unthrottled and updates pending")
+			esr.startWrites()
 		}
+		if tickOccurred && esr.queuedDirtyIDs.Len() > 0 {
+			// Now copy the queued statuses to the main dirty set.
+			// Doing this after the attempt to write above means that
+			// endpoints always spend at least one interval in the
+			// queued set.
+			log.WithField("numQueuedUpdates", esr.queuedDirtyIDs.Len()).Debug(
+				"Copying queued set to dirty set")
+			esr.queuedDirtyIDs.Iter(func(item interface{}) error {
+				esr.markDirty(item.(model.Key))
+				return nil
+			})
+			esr.queuedDirtyIDs = set.New()
+		}
+		statusBacklogGauge.Set(float64(esr.activeDirtyIDs.Len() +
+			esr.queuedDirtyIDs.Len() + esr.retryQueue.Len()))
+	}
+}
+
+// startWrites starts writing dirty statuses to the datastore, spending one
+// token per write, until it runs out of tokens or there are
+// maxConcurrentWrites writes in flight.  Since the dirty set is keyed on
+// endpoint and an endpoint with a write in flight is skipped, each endpoint
+// has at most one write in flight.
+func (esr *EndpointStatusReporter) startWrites() {
+	var batch []model.Key
+	esr.activeDirtyIDs.Iter(func(item interface{}) error {
+		if len(batch) >= esr.writeTokens ||
+			esr.writesInFlight.Len()+len(batch) >= esr.maxConcurrentWrites {
+			return set.StopIteration
+		}
+		if esr.writesInFlight.Contains(item) {
+			return nil
+		}
+		batch = append(batch, item.(model.Key))
+		return nil
+	})
+	for _, statID := range batch {
+		esr.writeTokens--
+		esr.writesInFlight.Add(statID)
+		// Look up the status here, since the cache is owned by this
+		// goroutine.  Note: the update could be a deletion, in which case
+		// the read from the cache will return "".
+		go esr.writeInBackground(statID, esr.epStatusIDToStatus[statID])
+	}
+}
+
+func (esr *EndpointStatusReporter) writeInBackground(statID model.Key, status string) {
+	startTime := time.Now()
+	err := esr.writeEndpointStatus(statID, status)
+	statusWriteLatency.Observe(time.Since(startTime).Seconds())
+	esr.writeResults <- writeResult{statID: statID, status: status, err: err}
+}
+
+// handleWriteResult updates the dirty set once a write has finished.  A failed
+// write is retried after an exponential backoff.
+func (esr *EndpointStatusReporter) handleWriteResult(result writeResult) {
+	statID := result.statID
+	esr.writesInFlight.Discard(statID)
+	if result.err != nil {
+		statusWriteFailures.Inc()
+		backoff := esr.scheduleRetry(statID)
+		log.WithError(result.err).WithFields(log.Fields{
+			"statID":  statID,
+			"backoff": backoff,
+		}).Warn("Failed to write endpoint status; is datastore up?")
+		return
+	}
+	delete(esr.statIDToRetry, statID)
+	if esr.epStatusIDToStatus[statID] != result.status {
+		// The status changed while we were writing it; leave it dirty so
+		// that we write the new status.
+		log.WithField("statID", statID).Debug(
+			"Write successful but status has changed")
+		return
+	}
+	// Success, remove the status from the dirty set.
+	log.WithField("statID", statID).Debug("Write successful")
+	esr.activeDirtyIDs.Discard(statID)
+}
+
+// scheduleRetry moves the given ID from the dirty set to the retry queue.
+// Returns the backoff.
+func (esr *EndpointStatusReporter) scheduleRetry(statID model.Key) time.Duration {
+	retry := esr.statIDToRetry[statID]
+	if retry == nil {
+		retry = &retryState{statID: statID, index: -1}
+		esr.statIDToRetry[statID] = retry
+	}
+	retry.numFailures++
+	backoff := esr.minRetryBackoff
+	for ii := 1; ii < retry.numFailures && backoff < maxRetryBackoff; ii++ {
+		backoff *= 2
+	}
+	if backoff > maxRetryBackoff {
+		backoff = maxRetryBackoff
+	}
+	retry.nextAttempt = time.Now().Add(backoff)
+	esr.activeDirtyIDs.Discard(statID)
+	heap.Push(&esr.retryQueue, retry)
+	return backoff
+}
+
+// requeueDueRetries moves the IDs whose backoff has expired from the retry
+// queue back to the dirty set.
+func (esr *EndpointStatusReporter) requeueDueRetries(now time.Time) {
+	for esr.retryQueue.Len() > 0 && !esr.retryQueue[0].nextAttempt.After(now) {
+		retry := heap.Pop(&esr.retryQueue).(*retryState)
+		log.WithField("statID", retry.statID).Debug("Retrying endpoint status write")
+		esr.activeDirtyIDs.Add(retry.statID)
+	}
+}
+
+func (esr *EndpointStatusReporter) isBackingOff(statID model.Key) bool {
+	retry := esr.statIDToRetry[statID]
+	return retry != nil && retry.index >= 0
+}
+
+// markDirty adds the given ID to the dirty set, unless it is backing off, in
+// which case its retry will write its latest status.
+func (esr *EndpointStatusReporter) markDirty(statID model.Key) {
+	if esr.isBackingOff(statID) {
+		return
 	}
+	esr.activeDirtyIDs.Add(statID)
 }
 
 func (esr *EndpointStatusReporter) attemptResync() {
@@ -254,7 +479,7 @@ func (esr *EndpointStatusReporter) attemptResync() {
 	for _, kv := range kvs {
 		if kv.Value == nil {
 			// Parse error, needs refresh.
-			esr.activeDirtyIDs.Add(kv.Key)
+			esr.markDirty(kv.Key)
 		} else {
 			status := kv.Value.(*model.WorkloadEndpointStatus).Status
 			if status != esr.epStatusIDToStatus[kv.Key] {
@@ -263,7 +488,7 @@ func (esr *EndpointStatusReporter) attemptResync() {
 					"datastoreState": status,
 					"desiredState":   esr.epStatusIDToStatus[kv.Key],
 				}).Info("Found out-of-sync workload endpoint status")
-				esr.activeDirtyIDs.Add(kv.Key)
+				esr.markDirty(kv.Key)
 			}
 		}
 	}
@@ -279,7 +504,7 @@ func (esr *EndpointStatusReporter) attemptResync() {
 	for _, kv := range kvs {
 		if kv.Value == nil {
 			// Parse error, needs refresh.
-			esr.activeDirtyIDs.Add(kv.Key)
+			esr.markDirty(kv.Key)
 		} else {
 			status := kv.Value.(*model.HostEndpointStatus).Status
 			if status != esr.epStatusIDToStatus[kv.Key] {
@@ -288,7 +513,7 @@ func (esr *EndpointStatusReporter) attemptResync() {
 					"datastoreState": status,
 					"desiredState":   esr.epStatusIDToStatus[kv.Key],
 				}).Infof("Found out-of-sync host endpoint status")
-				esr.activeDirtyIDs.Add(kv.Key)
+				esr.markDirty(kv.Key)
 			}
 		}
 	}
@@ -15,7 +15,13 @@
 package statusrep
 
 import (
+	"container/heap"
 	"errors"
+	"fmt"
+	"reflect"
+	"sync"
+	"time"
+
 	log "github.com/Sirupsen/logrus"
 	. "github.com/onsi/ginkgo"
 	. "github.com/onsi/gomega"
@@ -23,9 +29,6 @@ import (
 	"github.com/projectcalico/felix/go/felix/proto"
 	"github.com/projectcalico/libcalico-go/lib/backend/model"
 	calierrors "github.com/projectcalico/libcalico-go/lib/errors"
-	"reflect"
-	"sync"
-	"time"
 )
 
 const hostname = "localhostname"
@@ -141,6 +144,9 @@ var _ = Describe("Status", func() {
 			rateLimitTickerChan,
 			1*time.Second,
 			2*time.Second,
+			1, // Write batch size.
+			1, // Max concurrent writes.
+			0, // Retry backoff.
 		)
 		esr.Start()
 		log.Info("Started EndpointStatusReporter")
@@ -263,11 +269,10 @@ var _ = Describe("Status", func() {
 				Expect(datastore.numKVs()).To(Equal(4))
 				// Rate limit tick should trigger cleanup.
 				rateLimitTickerChan <- time.Now()
-				inSyncChan <- true
-				Expect(datastore.numKVs()).To(Equal(3))
+				Eventually(datastore.numKVs).Should(Equal(3))
+				Consistently(datastore.numKVs, "50ms").Should(Equal(3))
 				rateLimitTickerChan <- time.Now()
-				inSyncChan <- true
-				Expect(datastore.numKVs()).To(Equal(2))
+				Eventually(datastore.numKVs).Should(Equal(2))
 			}, 1)
 
 			It("with concurrent datastore changes, it should handle key not found", func() {
@@ -287,7 +292,8 @@ var _ = Describe("Status", func() {
 				rateLimitTickerChan <- time.Now()
 				rateLimitTickerChan <- time.Now()
 				// But it should only try each delete once.
-				Expect(datastore.NumDeletes()).To(Equal(2))
+				Eventually(datastore.NumDeletes).Should(Equal(2))
+				Consistently(datastore.NumDeletes, "50ms").Should(Equal(2))
 			}, 1)
 
 			Describe("with an error on the first 2 List() calls", func() {
@@ -325,11 +331,12 @@ var _ = Describe("Status", func() {
 					resyncTickerChan <- time.Now()
 					rateLimitTickerChan <- time.Now() // Triggers first delete.
 					rateLimitTickerChan <- time.Now() // Triggers second.
-					inSyncChan <- false               // Wait for next loop
+					Eventually(datastore.NumDeletes).Should(Equal(2))
 					Expect(datastore.numKVs()).To(Equal(4),
 						"datastore should still contain all original keys")
 					// Send in timer ticks to finish retries.
 					rateLimitTickerChan <- time.Now()
+					Eventually(datastore.numKVs).Should(Equal(3))
 					rateLimitTickerChan <- time.Now()
 					Eventually(datastore.numKVs).Should(Equal(2))
 				})
@@ -428,6 +435,8 @@ var _ = Describe("Non-mocked EndpointStatusReporter", func() {
 			datastore,
 			10*time.Second,  // Rate limit.
 			100*time.Second, // Resync interval.
+			10,              // Write batch size.
+			5,               // Max concurrent writes.
 		)
 	})
 	It("correctly initialises resync ticker", func() {
@@ -444,6 +453,115 @@ var _ = Describe("Non-mocked EndpointStatusReporter", func() {
 	})
 })
 
+var _ = Describe("Batched EndpointStatusReporter", func() {
+	var esr *EndpointStatusReporter
+	var inSyncChan chan bool
+	var datastore *mockDatastore
+	var resyncTickerChan, rateLimitTickerChan chan time.Time
+
+	BeforeEach(func() {
+		inSyncChan = make(chan bool)
+		datastore = newMockDatastore()
+		for i := 0; i < 5; i++ {
+			datastore.kvs[model.WorkloadEndpointStatusKey{
+				Hostname:       hostname,
+				OrchestratorID: "orch",
+				WorkloadID:     fmt.Sprintf("wl%d", i),
+				EndpointID:     "epid",
+			}] = &wlEPUp
+		}
+		resyncTickerChan = make(chan time.Time)
+		rateLimitTickerChan = make(chan time.Time)
+		esr = newEndpointStatusReporterWithTickerChans(
+			hostname,
+			make(chan interface{}),
+			inSyncChan,
+			datastore,
+			&mockStoppable{},
+			resyncTickerChan,
+			&mockStoppable{},
+			rateLimitTickerChan,
+			1*time.Second,
+			2*time.Second,
+			3,                   // Write batch size.
+			2,                   // Max concurrent writes.
+			50*time.Millisecond, // Retry backoff.
+		)
+		esr.Start()
+		inSyncChan <- true
+		// Kick off the resync, which marks all the endpoints dirty.
+		resyncTickerChan <- time.Now()
+	})
+	AfterEach(func() {
+		esr.Stop()
+	})
+
+	It("should write a batch of statuses per tick", func() {
+		rateLimitTickerChan <- time.Now()
+		Eventually(datastore.numKVs).Should(Equal(2))
+		Consistently(datastore.NumDeletes, "50ms").Should(Equal(3))
+		rateLimitTickerChan <- time.Now()
+		Eventually(datastore.numKVs).Should(Equal(0))
+		Expect(datastore.NumDeletes()).To(Equal(5))
+	})
+
+	It("should keep handling updates while writes are in progress", func() {
+		datastore.mutex.Lock()
+		rateLimitTickerChan <- time.Now() // Starts writes, which block.
+		// The loop isn't waiting for the writes.
+		inSyncChan <- true
+		datastore.mutex.Unlock()
+		Eventually(datastore.numKVs).Should(Equal(2))
+	})
+
+	Describe("with errors on the first 3 Delete() calls", func() {
+		BeforeEach(func() {
+			datastore.mutex.Lock()
+			defer datastore.mutex.Unlock()
+			datastore.DeleteErrs = []error{
+				errors.New("datastore FAIL"),
+				errors.New("datastore FAIL"),
+				errors.New("datastore FAIL"),
+			}
+		})
+		It("should back off before retrying the failed writes", func() {
+			rateLimitTickerChan <- time.Now() // First batch fails.
+			Eventually(datastore.NumDeletes).Should(Equal(3))
+			Expect(datastore.numKVs()).To(Equal(5))
+			rateLimitTickerChan <- time.Now() // Writes the other two.
+			Eventually(datastore.numKVs).Should(Equal(3))
+			rateLimitTickerChan <- time.Now() // Failed writes still backing off.
+			inSyncChan <- true
+			Expect(datastore.numKVs()).To(Equal(3))
+			Expect(datastore.NumDeletes()).To(Equal(5))
+			time.Sleep(60 * time.Millisecond)
+			rateLimitTickerChan <- time.Now() // Retries.
+			Eventually(datastore.numKVs).Should(Equal(0))
+		})
+	})
+})
+
+var _ = Describe("retryHeap", func() {
+	It("should pop the earliest retry first", func() {
+		now := time.Now()
+		var h retryHeap
+		for _, offset := range []int{3, 1, 4, 2} {
+			heap.Push(&h, &retryState{
+				nextAttempt: now.Add(time.Duration(offset) * time.Second),
+			})
+		}
+		var offsets []time.Duration
+		for h.Len() > 0 {
+			retry := heap.Pop(&h).(*retryState)
+			Expect(retry.index).To(Equal(-1))
+			offsets = append(offsets, retry.nextAttempt.Sub(now))
+		}
+		Expect(offsets).To(Equal([]time.Duration{
+			1 * time.Second, 2 * time.Second, 3 * time.Second, 4 * time.Second,
+		}))
+	})
+})
+
 type mockDatastore struct {
 	mutex                           sync.Mutex
 	kvs                             map[model.Key]interface{}
@@ -248,9 +248,9 @@ def complete_logging(logfile=None,
     logging is available as early in execution as possible, i.e. before the
     config file has been parsed.
 
-    This function must only be called once, after
+    This function must be called after
     :meth:`default_logging() <calico.common.default_logging>`
-    has been called.
+    has been called.  It may be called again to change the log levels.
 
     The xyz_level parameters may be a valid logging level DEBUG/INFO/... or
     None to disable that log entirely.  Note: the config module supports
@@ -258,8 +258,9 @@ def complete_logging(logfile=None,
     """
     root_logger = logging.getLogger()
 
-    # If default_logging got called already, we'll have some loggers in place.
-    # Update their levels.
+    # If default_logging or an earlier call to this function set up some
+    # loggers already, update their levels.  Note: WatchedFileHandler is a
+    # subclass of StreamHandler so it must be checked first.
     file_handler = None
     for handler in root_logger.handlers[:]:
         if isinstance(handler, logging.handlers.SysLogHandler):
@@ -267,17 +268,17 @@ def complete_logging(logfile=None,
                 root_logger.removeHandler(handler)
             else:
                 handler.setLevel(syslog_level)
-        elif isinstance(handler, logging.StreamHandler):
-            if stream_level is None:
-                root_logger.removeHandler(handler)
-            else:
-                handler.setLevel(stream_level)
         elif isinstance(handler, logging.handlers.WatchedFileHandler):
             file_handler = handler
             if file_level is None:
                 root_logger.removeHandler(handler)
             else:
                 handler.setLevel(file_level)
+        elif isinstance(handler, logging.StreamHandler):
+            if stream_level is None:
+                root_logger.removeHandler(handler)
+            else:
+                handler.setLevel(stream_level)
 
     # If we've been given a log file, log to file as well.
     if logfile and file_level is not None:
@@ -110,8 +110,16 @@ import traceback
 import weakref
 
 from gevent.event import AsyncResult
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import (
+    CounterMetricFamily, GaugeMetricFamily, REGISTRY
+)
 from calico.felix import futils
 from calico.felix.futils import StatCounter
+from calico.felix.tracebuffer import (
+    dump_before_exit, trace_buffer, EVENT_MSG_START, EVENT_BATCH_START,
+    EVENT_FINISH_BATCH, EVENT_BATCH_END, EVENT_BATCH_SPLIT
+)
 
 _log = logging.getLogger(__name__)
 
@@ -127,6 +135,40 @@ actor_storage = gevent.local.local()
 
 # Global diagnostic counters.
 _stats = StatCounter("Actor framework counters")
+# Handles for the counters that we increment for every message.
+_stat_msgs_created = _stats.stat("Messages created")
+_stat_msgs_ok = _stats.stat("Messages executed OK")
+_stat_msgs_exc = _stats.stat("Messages executed with exception")
+_stat_msgs_completed = _stats.stat("Messages completed")
+_stat_batches = _stats.stat("Batches processed")
+
+# Scheduling metrics, labelled by actor class.  (Not by Actor.name, which
+# is different for each instance.)
+_msg_wait_histogram = Histogram(
+    "felix_actor_msg_wait_seconds",
+    "Time that the oldest message in each batch spent on an actor's "
+    "queue before the batch was processed.",
+    ["actor_class"],
+)
+_batch_size_histogram = Histogram(
+    "felix_actor_batch_size",
+    "Number of messages in each batch that an actor processes.",
+    ["actor_class"],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float("inf")),
+)
+_finish_batch_histogram = Histogram(
+    "felix_actor_finish_batch_seconds",
+    "Time taken by an actor's _finish_msg_batch().",
+    ["actor_class"],
+)
+_split_batch_counter = Counter(
+    "felix_actor_split_batches",
+    "Number of batches that an actor split in order to retry.",
+    ["actor_class"],
+)
+
+# All the Actors that have been created, for the queue depth gauge.
+_all_actors = weakref.WeakSet()
 
 
 _time_buckets = collections.defaultdict(lambda: 0)
@@ -190,6 +232,12 @@ class Actor(object):
 
     def __init__(self, qualifier=None, time_bucket=None):
         self._event_queue = collections.deque()
+        _all_actors.add(self)
+        class_name = self.__class__.__name__
+        self._msg_wait_hist = _msg_wait_histogram.labels(class_name)
+        self._batch_size_hist = _batch_size_histogram.labels(class_name)
+        self._finish_batch_hist = _finish_batch_histogram.labels(class_name)
+        self._split_batch_counter = _split_batch_counter.labels(class_name)
 
         # Set to True when the main loop is actively processing the input
         # queue or has been scheduled to do so.  Set to False when the loop
@@ -291,6 +339,7 @@ class Actor(object):
         actor_storage.class_name = self.__class__.__name__
         actor_storage.name = self.name
         actor_storage.msg_id = None
+        actor_storage.traces = None
         _log.info("Main loop for actor %s started.", self)
         try:
             self._on_actor_started()
@@ -342,6 +391,15 @@ class Actor(object):
             batches.append(batch)
 
         num_splits = 0
+        now = monotonic_time() if tracing_enabled() else None
+        for batch in batches:
+            self._batch_size_hist.observe(len(batch))
+            if now is not None and batch[0].enqueue_time is not None:
+                # Messages are queued in order so the first message in the
+                # batch waited longest; observing it alone keeps this to
+                # one histogram update per batch rather than one per
+                # message.
+                self._msg_wait_hist.observe(now - batch[0].enqueue_time)
         while batches:
             # Process the first batch on our queue of batches.  Invariant:
             # we'll either process this batch to completion and discard it or
@@ -353,13 +411,18 @@ class Actor(object):
             batch = self._start_msg_batch(batch)
             assert batch is not None, "_start_msg_batch() should return batch."
             results = []  # Will end up same length as batch.
+            trace_buffer.record(EVENT_BATCH_START, self.name, None,
+                                len(batch))
             for msg in batch:
                 _log.debug("Message %s recd by %s from %s, queue length %d",
                            msg, msg.recipient, msg.caller,
                            len(self._event_queue))
+                trace_buffer.record(EVENT_MSG_START, self.name, msg.name,
+                                    msg.msg_id)
                 self._current_msg = msg
                 actor_storage.msg_id = msg.msg_id
                 actor_storage.msg_name = msg.name
+                actor_storage.traces = msg.traces
                 try:
                     # Actually execute the per-message method and record its
                     # result.
@@ -367,18 +430,25 @@ class Actor(object):
                 except BaseException as e:
                     _log.exception("Exception processing %s", msg)
                     results.append(ResultOrExc(None, e))
-                    _stats.increment("Messages executed with exception")
+                    _stat_msgs_exc.value += 1
                 else:
                     results.append(ResultOrExc(result, None))
-                    _stats.increment("Messages executed OK")
+                    _stat_msgs_ok.value += 1
                 finally:
                     self._current_msg = None
                     actor_storage.msg_id = None
                     actor_storage.msg_name = None
+                    actor_storage.traces = None
+            finish_start = monotonic_time()
             try:
                 # Give subclass a chance to post-process the batch.
                 _log.debug("Finishing message batch of length %s", len(batch))
+                trace_buffer.record(EVENT_FINISH_BATCH, self.name, None,
+                                    len(batch))
                 actor_storage.msg_name = "<finish batch>"
+                # The batch's side effects may be deferred to here so
+                # attribute them to all the traces in the batch.
+                actor_storage.traces = _batch_traces(batch)
                 self._finish_msg_batch(batch, results)
             except SplitBatchAndRetry:
                 # The subclass couldn't process the batch as is (probably
@@ -386,9 +456,12 @@ class Actor(object):
                 # message caused the problem).  Split the batch into two and
                 # re-run it.
                 _log.warn("Splitting batch to retry.")
+                trace_buffer.record(EVENT_BATCH_SPLIT, self.name, None,
+                                    len(batch))
                 self.__split_batch(batch, batches)
                 num_splits += 1  # For diags.
                 _stats.increment("Split batches")
+                self._split_batch_counter.inc()
                 continue
             except BaseException as e:
                 # Most-likely a bug.  Report failure to all callers.
@@ -399,6 +472,11 @@ class Actor(object):
                 _log.debug("Finished message batch successfully")
             finally:
                 actor_storage.msg_name = None
+                actor_storage.traces = None
+                trace_buffer.record(EVENT_BATCH_END, self.name, None,
+                                    len(batch))
+                self._finish_batch_hist.observe(monotonic_time() -
+                                                finish_start)
 
             # Batch complete and finalized, set all the results.
             assert len(batch) == len(results)
@@ -408,9 +486,14 @@ class Actor(object):
                         future.set_exception(exc)
                     else:
                         future.set(result)
-                    _stats.increment("Messages completed")
-
-            _stats.increment("Batches processed")
+                    _stat_msgs_completed.value += 1
+                if msg.traces:
+                    # Any messages that we sent on behalf of these traces
+                    # have taken their own references by now.
+                    for trace in msg.traces:
+                        trace.release()
+
+            _stat_batches.value += 1
         if num_splits > 0:
             _log.warn("Split batches complete. Number of splits: %s",
                       num_splits)
@@ -533,6 +616,15 @@ def wait_and_check(async_results):
 next_message_id = random.randint(0, sys.maxint)
 
 
+def _format_msg_id(msg_id):
+    """
+    :returns the string form of the given message ID, as used in logs.
+    """
+    if msg_id is None:
+        return "None"
+    return "M%016x" % msg_id
+
+
 class Message(object):
     """
     Message passed to an actor.
@@ -540,6 +632,10 @@ class Message(object):
     __slots__ = ("msg_id", "method", "results", "caller", "name",
                  "needs_own_batch", "recipient")
 
+    # Only set on TracedMessages.
+    traces = None
+    enqueue_time = None
+
     def __init__(self, msg_id,  method, results, caller_path, recipient,
                  needs_own_batch):
         self.msg_id = msg_id
@@ -549,13 +645,68 @@ class Message(object):
         self.name = method.func.__name__
         self.needs_own_batch = needs_own_batch
         self.recipient = recipient
-        _stats.increment("Messages created")
+        _stat_msgs_created.value += 1
 
     def __str__(self):
-        data = ("%s (%s)" % (self.msg_id, self.name))
+        data = ("%s (%s)" % (_format_msg_id(self.msg_id), self.name))
         return data
 
 
+class TracedMessage(Message):
+    """
+    Message that records when it was queued and carries the UpdateTraces
+    (see felix.tracing) of the update(s) that led to it.  Used in place of
+    Message while tracing is enabled.
+    """
+    __slots__ = ("traces", "enqueue_time")
+
+    def __init__(self, msg_id,  method, results, caller_path, recipient,
+                 needs_own_batch):
+        super(TracedMessage, self).__init__(msg_id, method, results,
+                                            caller_path, recipient,
+                                            needs_own_batch)
+        self.enqueue_time = monotonic_time()
+        # The message holds a reference to each of its traces until it has
+        # been processed.
+        self.traces = getattr(actor_storage, "traces", None)
+        if self.traces:
+            for trace in self.traces:
+                trace.add_ref()
+
+
+# Class of the messages that actor_message() queues; see
+# set_tracing_enabled().
+_message_cls = Message
+
+
+def set_tracing_enabled(enabled):
+    """
+    Turns on (or off) the recording of each message's queueing delay and
+    the propagation of UpdateTraces from message to message.  Off by
+    default because both cost something on every message.
+    """
+    global _message_cls
+    _message_cls = TracedMessage if enabled else Message
+
+
+def tracing_enabled():
+    return _message_cls is TracedMessage
+
+
+def _batch_traces(batch):
+    """
+    :returns the traces of all the messages in the batch, or None if none
+        of them are traced.
+    """
+    traces = None
+    for msg in batch:
+        if msg.traces:
+            if traces is None:
+                traces = set()
+            traces.update(msg.traces)
+    return traces
+
+
 def actor_message(needs_own_batch=False):
     """
     Decorator: turns a method into an Actor message.
@@ -578,6 +729,9 @@ def actor_message(needs_own_batch=False):
     """
     def decorator(fn):
         method_name = fn.__name__
+        # Cache of Stat handles for the sends of this message, keyed on
+        # (async, caller name, recipient class).
+        send_stats = {}
 
         @functools.wraps(fn)
         def queue_fn(self, *args, **kwargs):
@@ -595,8 +749,10 @@ def actor_message(needs_own_batch=False):
                 try:
                     caller_name = "%s.%s" % (actor_storage.class_name,
                                              actor_storage.msg_name)
-                    caller = "%s (processing %s)" % (actor_storage.name,
-                                                     actor_storage.msg_id)
+                    caller = "%s (processing %s)" % (
+                        actor_storage.name,
+                        _format_msg_id(actor_storage.msg_id)
+                    )
                 except AttributeError:
                     caller_name = calling_path
                     caller = calling_path
@@ -614,21 +770,27 @@ def actor_message(needs_own_batch=False):
                 # WARNING: only use stable values in the stat name.
                 # For example, Actor.name can be different for every actor,
                 # resulting in leak if we use that.
-                _stats.increment(
-                    "%s message %s --[%s]-> %s" %
-                    ("ASYNC" if async else "BLOCKING",
-                     caller_name,
-                     method_name,
-                     self.__class__.__name__)
-                )
+                stat_key = (async, caller_name, self.__class__)
+                try:
+                    send_stat = send_stats[stat_key]
+                except KeyError:
+                    send_stat = send_stats[stat_key] = _stats.stat(
+                        "%s message %s --[%s]-> %s" %
+                        ("ASYNC" if async else "BLOCKING",
+                         caller_name,
+                         method_name,
+                         self.__class__.__name__)
+                    )
+                send_stat.value += 1
 
             # async must be specified, unless on the same actor.
             assert async_set, "Cross-actor event calls must specify async arg."
 
             # Allocate a message ID.  We rely on there being no yield point
-            # here for thread safety.
+            # here for thread safety.  It's only formatted as a string
+            # ("M%016x") when logged.
             global next_message_id
-            msg_id = "M%016x" % next_message_id
+            msg_id = next_message_id
             if next_message_id == sys.maxint:
                 next_message_id = 0
             else:
@@ -636,15 +798,15 @@ def actor_message(needs_own_batch=False):
 
             if not on_same_greenlet and not async:
                 _stats.increment("Blocking calls started")
-                _log.debug("BLOCKING CALL: [%s] %s -> %s", msg_id,
+                _log.debug("BLOCKING CALL: [M%016x] %s -> %s", msg_id,
                            calling_path, method_name)
 
             # OK, so build the message and put it on the queue.
             partial = functools.partial(fn, self, *args, **kwargs)
             result = TrackedAsyncResult((calling_path, caller,
                                          self.name, method_name))
-            msg = Message(msg_id, partial, [result], caller, self.name,
-                          needs_own_batch=needs_own_batch)
+            msg = _message_cls(msg_id, partial, [result], caller, self.name,
+                               needs_own_batch=needs_own_batch)
 
             _log.debug("Message %s sent by %s to %s, queue length %d",
                        msg, caller, self.name, len(self._event_queue))
@@ -661,7 +823,8 @@ def actor_message(needs_own_batch=False):
                     raise
                 finally:
                     _stats.increment("Blocking calls completed")
-                    _log.debug("BLOCKING CALL COMPLETE: [%s] %s -> %s = %r",
+                    _log.debug("BLOCKING CALL COMPLETE: [M%016x] %s -> %s "
+                               "= %r",
                                msg_id, calling_path, method_name,
                                blocking_result)
                 return blocking_result
@@ -687,14 +850,56 @@ def dump_actor_diags(log):
     log.info("Current ref index: %s", _ref_idx)
     log.info("Number of tracked messages outstanding: %s",
              len(_tracked_refs_by_idx))
-    for bucket, time in _time_buckets.items():
+    for bucket, secs in _time_buckets.items():
         count = _time_bucket_counts[bucket]
-        per_instance = time / count
+        per_instance = secs / count
         log.info("Time spent in % 28s: \t%.3fs %.3fms (%s)",
-                 bucket, time, per_instance*1000, count)
+                 bucket, secs, per_instance*1000, count)
 futils.register_diags("Actor framework", dump_actor_diags)
 
 
+class ActorStatsCollector(object):
+    """
+    Prometheus collector for the actor framework's stats that are cheaper to
+    calculate at scrape time than to keep up to date: the queue depth of
+    each class of actor and the CPU time and switch counts of each greenlet
+    time bucket (including the Hub's).
+    """
+    def collect(self):
+        queue_depth = GaugeMetricFamily(
+            "felix_actor_queue_depth",
+            "Number of messages queued for each class of actor.",
+            labels=["actor_class"]
+        )
+        depths = collections.defaultdict(lambda: 0)
+        for actor in list(_all_actors):
+            depths[actor.__class__.__name__] += len(actor._event_queue)
+        for class_name, depth in depths.iteritems():
+            queue_depth.add_metric([class_name], depth)
+        yield queue_depth
+
+        cpu = CounterMetricFamily(
+            "felix_greenlet_cpu_seconds",
+            "CPU time used by each greenlet time bucket; the **Hub** bucket "
+            "is the time spent in the gevent Hub.",
+            labels=["bucket"]
+        )
+        switches = CounterMetricFamily(
+            "felix_greenlet_switches",
+            "Number of times that each greenlet time bucket was switched "
+            "out.",
+            labels=["bucket"]
+        )
+        for bucket, secs in _time_buckets.items():
+            cpu.add_metric([bucket], secs)
+            switches.add_metric([bucket], _time_bucket_counts[bucket])
+        yield cpu
+        yield switches
+
+
+REGISTRY.register(ActorStatsCollector())
+
+
 class ExceptionTrackingWeakRef(weakref.ref):
     """
     Specialised weak reference with a slot to hold an exception
@@ -788,4 +993,5 @@ def _exit(rc):
 
     This function is mainly here to be mocked out in UTs.
     """
+    dump_before_exit()  # pragma nocover
     os._exit(rc)  # pragma nocover
@@ -23,10 +23,11 @@ Configuration parsing for the dataplane driver.
 """
 from numbers import Number
 
+import copy
+import importlib
 import logging
 import socket
 
-import pkg_resources
 import re
 
 from calico import common
@@ -38,6 +39,19 @@ log = logging.getLogger(__name__)
 
 FELIX_IPT_GENERATOR_PLUGIN_NAME = "calico.felix.iptables_generator"
 
+# Plugins that ship with Felix, as registered in setup.py, mapped from
+# (entry point, flavor) to "module:attribute".  We load these directly
+# rather than via pkg_resources, which scans every installed distribution
+# when it is imported and so slows down start of day.
+BUILTIN_PLUGINS = {
+    (FELIX_IPT_GENERATOR_PLUGIN_NAME, "default"):
+        "calico.felix.plugins.fiptgenerator:FelixIptablesGenerator",
+}
+
+# Cache of plugins that we've already loaded, keyed on (entry point,
+# flavor).
+_plugin_cache = {}
+
 # Convert log level names into python log levels.
 LOGLEVELS = {"none":      None,
              "debug":     logging.DEBUG,
@@ -74,16 +88,20 @@ class ConfigParameter(object):
     """
     def __init__(self, name, description, default, value_is_int=False,
                  value_is_bool=False, value_is_int_list=False,
-                 value_is_str_list=False):
+                 value_is_str_list=False, reloadable=False):
         """
         Create a configuration parameter.
         :param str description: Description for logging
         :param str default: Default value
         :param bool value_is_int: Integer value?
+        :param bool reloadable: Can the parameter be changed without
+               restarting Felix?
         """
         self.description = description
         self.name = name
+        self.default = default
         self.value = default
+        self.reloadable = reloadable
         self.value_is_int = value_is_int
         self.value_is_bool = value_is_bool
         self.value_is_int_list = value_is_int_list
@@ -159,6 +177,9 @@ class Config(object):
         """
         self.parameters = {}
         self.plugins = {}
+        # Copy of the raw config most recently passed to update_from() or
+        # reload_from(), used to spot which parameters have changed.
+        self._raw_config = {}
 
         self.add_parameter("FelixHostname", "Felix compute host hostname",
                            socket.gethostname())
@@ -168,14 +189,14 @@ class Config(object):
                            30, value_is_int=True)
         self.add_parameter("PeriodicResyncInterval",
                            "How often to do cleanups, seconds",
-                           60 * 60, value_is_int=True)
+                           60 * 60, value_is_int=True, reloadable=True)
         self.add_parameter("HostInterfacePollInterval",
                            "How often (in seconds) to poll for updates to "
                            "host endpoint IP addresses, or 0 to disable.", 10,
-                           value_is_int=True)
+                           value_is_int=True, reloadable=True)
         self.add_parameter("IptablesRefreshInterval",
                            "How often to refresh iptables state, in seconds",
-                           60, value_is_int=True)
+                           60, value_is_int=True, reloadable=True)
         self.add_parameter("MetadataAddr", "Metadata IP address or hostname",
                            "127.0.0.1")
         self.add_parameter("MetadataPort", "Metadata Port",
@@ -206,11 +227,62 @@ class Config(object):
         self.add_parameter("LogFilePath",
                            "Path to log file", "/var/log/calico/felix.log")
         self.add_parameter("LogSeverityFile",
-                           "Log severity for logging to file", "INFO")
+                           "Log severity for logging to file", "INFO",
+                           reloadable=True)
         self.add_parameter("LogSeveritySys",
-                           "Log severity for logging to syslog", "ERROR")
+                           "Log severity for logging to syslog", "ERROR",
+                           reloadable=True)
         self.add_parameter("LogSeverityScreen",
-                           "Log severity for logging to screen", "ERROR")
+                           "Log severity for logging to screen", "ERROR",
+                           reloadable=True)
+        self.add_parameter("DriverCaptureFile",
+                           "Path of a file to capture the messages from the "
+                           "datastore driver to, for later replay, or 'none' "
+                           "to disable capture.",
+                           "none")
+        self.add_parameter("DriverCaptureMaxFileSizeMB",
+                           "Size at which the driver capture file is rotated",
+                           100, value_is_int=True)
+        self.add_parameter("DriverCaptureBackupCount",
+                           "Number of rotated driver capture files to keep",
+                           5, value_is_int=True)
+        self.add_parameter("ProfilingEnabled",
+                           "Whether to run the sampling profiler from start "
+                           "of day.  (SIGUSR2 starts and stops it.)",
+                           False, value_is_bool=True)
+        self.add_parameter("ProfilingDir",
+                           "Directory to write sampling profiler output to",
+                           "/tmp")
+        self.add_parameter("ProfilingSampleIntervalMillis",
+                           "Interval between sampling profiler samples, in "
+                           "milliseconds of CPU time",
+                           10, value_is_int=True)
+        self.add_parameter("TraceBufferSize",
+                           "Number of records in the in-memory trace buffer "
+                           "of hot-path events",
+                           100000, value_is_int=True)
+        self.add_parameter("TraceBufferDir",
+                           "Directory to write the trace buffer to on "
+                           "SIGUSR1 or when Felix dies",
+                           "/tmp")
+        self.add_parameter("MultiProcessDataplane",
+                           "Program the IPv4 and IPv6 dataplanes from "
+                           "separate worker processes",
+                           False, value_is_bool=True)
+        self.add_parameter("ChainGenerationProcesses",
+                           "Number of worker processes to generate iptables "
+                           "chains in, or 0 to generate them in-process",
+                           0, value_is_int=True)
+        self.add_parameter("DataplaneBackend",
+                           "How the dataplane is programmed.  'iptables' "
+                           "uses iptables and ipsets; 'nftables' programs "
+                           "Felix's own nftables tables with nft.",
+                           "iptables")
+        self.add_parameter("WarmRestartDir",
+                           "Directory to keep a snapshot of the programmed "
+                           "dataplane in, so that Felix only rewrites what "
+                           "has changed when it restarts, or 'none'",
+                           "none")
         self.add_parameter("IpInIpEnabled",
                            "IP-in-IP device support enabled", False,
                            value_is_bool=True)
@@ -222,20 +294,45 @@ class Config(object):
                            "none")
         self.add_parameter("ReportingIntervalSecs",
                            "Status reporting interval in seconds",
-                           30, value_is_int=True)
+                           30, value_is_int=True, reloadable=True)
         self.add_parameter("ReportingTTLSecs",
                            "Status report time to live in seconds",
-                           90, value_is_int=True)
+                           90, value_is_int=True, reloadable=True)
         self.add_parameter("EndpointReportingEnabled",
                            "Whether Felix should report per-endpoint status "
                            "into etcd",
                            False, value_is_bool=True)
+        self.add_parameter("EndpointWorkerMode",
+                           "How local endpoints are processed.  'actor' "
+                           "runs a separate actor per endpoint; 'batched' "
+                           "processes all endpoints on the endpoint "
+                           "manager's greenlet, programming their chains "
+                           "in a single batch.",
+                           "actor")
+        self.add_parameter("IpsetEngineMode",
+                           "How tag and selector ipsets are programmed.  "
+                           "'actor' runs a separate actor per ipset; "
+                           "'consolidated' has the ipset manager track all "
+                           "the ipsets itself and write each batch of "
+                           "changes with a single ipset restore.",
+                           "actor")
         self.add_parameter("MaxIpsetSize",
                            "Maximum size of the ipsets that Felix uses to "
                            "represent profile tag memberships.  Should be set "
                            "to a value larger than the expected number of "
                            "IP addresses using a single tag.",
-                           2**20, value_is_int=True)
+                           2**20, value_is_int=True, reloadable=True)
+        self.add_parameter("ReferenceLingerSecs",
+                           "How long to keep ipsets and profile chains "
+                           "that are no longer referenced before removing "
+                           "them, in case they are referenced again.  0 "
+                           "removes them immediately.",
+                           0, value_is_int=True)
+        self.add_parameter("ReferenceLingerMaxObjects",
+                           "Maximum number of unreferenced ipsets or profile "
+                           "chains (per IP version) to keep alive during "
+                           "the ReferenceLingerSecs period.",
+                           1000, value_is_int=True)
         self.add_parameter("IptablesMarkMask",
                            "Mask that Felix selects its IPTables Mark bits "
                            "from.  Should be a 32 bit hexadecimal number with "
@@ -321,6 +418,25 @@ class Config(object):
         self.LOGLEVFILE = self.parameters["LogSeverityFile"].value
         self.LOGLEVSYS = self.parameters["LogSeveritySys"].value
         self.LOGLEVSCR = self.parameters["LogSeverityScreen"].value
+        self.DRIVER_CAPTURE_FILE = \
+            self.parameters["DriverCaptureFile"].value
+        self.DRIVER_CAPTURE_MAX_BYTES = \
+            self.parameters["DriverCaptureMaxFileSizeMB"].value * 1024 * 1024
+        self.DRIVER_CAPTURE_BACKUP_COUNT = \
+            self.parameters["DriverCaptureBackupCount"].value
+        self.PROFILING_ENABLED = self.parameters["ProfilingEnabled"].value
+        self.PROFILING_DIR = self.parameters["ProfilingDir"].value
+        self.PROFILING_SAMPLE_INTERVAL = \
+            self.parameters["ProfilingSampleIntervalMillis"].value / 1000.0
+        self.TRACE_BUFFER_SIZE = self.parameters["TraceBufferSize"].value
+        self.TRACE_BUFFER_DIR = self.parameters["TraceBufferDir"].value
+        self.MULTI_PROCESS_DATAPLANE = \
+            self.parameters["MultiProcessDataplane"].value
+        self.CHAIN_GENERATION_PROCESSES = \
+            self.parameters["ChainGenerationProcesses"].value
+        self.DATAPLANE_BACKEND = \
+            self.parameters["DataplaneBackend"].value.lower()
+        self.WARM_RESTART_DIR = self.parameters["WarmRestartDir"].value
         self.IP_IN_IP_ENABLED = self.parameters["IpInIpEnabled"].value
         self.IP_IN_IP_MTU = self.parameters["IpInIpMtu"].value
         self.IP_IN_IP_ADDR = self.parameters["IpInIpTunnelAddr"].value
@@ -328,7 +444,15 @@ class Config(object):
             self.parameters["ReportingIntervalSecs"].value
         self.REPORT_ENDPOINT_STATUS = \
             self.parameters["EndpointReportingEnabled"].value
+        self.ENDPOINT_WORKER_MODE = \
+            self.parameters["EndpointWorkerMode"].value.lower()
+        self.IPSET_ENGINE_MODE = \
+            self.parameters["IpsetEngineMode"].value.lower()
         self.MAX_IPSET_SIZE = self.parameters["MaxIpsetSize"].value
+        self.REFERENCE_LINGER_SECS = \
+            self.parameters["ReferenceLingerSecs"].value
+        self.REFERENCE_LINGER_MAX_OBJECTS = \
+            self.parameters["ReferenceLingerMaxObjects"].value
         self.IPTABLES_GENERATOR_PLUGIN = \
             self.parameters["IptablesGeneratorPlugin"].value
         self.IPTABLES_MARK_MASK =\
@@ -382,6 +506,14 @@ class Config(object):
                          parameter.description,
                          parameter.value)
 
+    @property
+    def raw_config(self):
+        """
+        :returns: a copy of the raw config most recently passed to
+            update_from() or reload_from().
+        """
+        return dict(self._raw_config)
+
     def update_from(self, config_dict):
         """
         Report configuration parameters read from etcd to the config
@@ -392,6 +524,7 @@ class Config(object):
         :raises ConfigException
         """
         log.debug("Updating with config: %s", config_dict)
+        self._raw_config = dict(config_dict)
 
         for name, parameter in self.parameters.iteritems():
             if name in config_dict:
@@ -419,6 +552,60 @@ class Config(object):
 
         self._finish_update(final=True)
 
+    def reload_from(self, config_dict):
+        """
+        Applies an updated set of configuration parameters, as sent by the
+        driver after the initial call to update_from().
+
+        Only parameters flagged as reloadable can be changed this way.  If
+        any other parameter has changed, nothing is applied and the names of
+        the offending parameters are returned; the caller is expected to
+        restart Felix.  Consumers of reloadable parameters re-read them from
+        this object as they use them.
+
+        The new values are parsed and validated on a copy of this object,
+        which replaces its contents only if they're all valid.
+
+        :param config_dict: Dictionary of config parameters
+        :returns list: Sorted names of changed parameters that require a
+                 restart, or an empty list if there are none.
+        :raises ConfigException: if any of the new values is invalid, in
+                which case the old config is kept.
+        """
+        changed = [name for name in self.parameters
+                   if config_dict.get(name) != self._raw_config.get(name)]
+        restart_required = sorted(name for name in changed
+                                  if not self.parameters[name].reloadable)
+        if restart_required:
+            log.warning("Parameters changed that require a restart: %s",
+                        restart_required)
+            return restart_required
+        if not changed:
+            log.info("No parameters changed")
+            return []
+
+        new_config = copy.copy(self)
+        new_config.parameters = dict(
+            (name, copy.copy(parameter))
+            for name, parameter in self.parameters.iteritems()
+        )
+        # Plugins only use parameters that can't be reloaded, so they don't
+        # need to see the change.
+        new_config.plugins = {}
+        for name in changed:
+            parameter = new_config.parameters[name]
+            if name in config_dict:
+                parameter.set(config_dict[name])
+            else:
+                log.info("Parameter %s removed, reverting to default %r",
+                         name, parameter.default)
+                parameter.value = parameter.default
+        new_config._raw_config = dict(config_dict)
+        new_config._finish_update(final=True)
+        new_config.plugins = self.plugins
+        self.__dict__ = new_config.__dict__
+        return []
+
     def _validate_cfg(self, final=True):
         """
         Firewall that the config is not invalid. Called twice to let plugins
@@ -451,6 +638,34 @@ class Config(object):
         if self.LOGFILE.lower() == "none":
             self.LOGFILE = None
 
+        if self.DRIVER_CAPTURE_FILE.lower() in ("none", ""):
+            self.DRIVER_CAPTURE_FILE = None
+
+        if self.DRIVER_CAPTURE_MAX_BYTES <= 0:
+            log.warning("Driver capture file size is non-positive, "
+                        "defaulting to 100MB.")
+            self.DRIVER_CAPTURE_MAX_BYTES = 100 * 1024 * 1024
+
+        if self.DRIVER_CAPTURE_BACKUP_COUNT < 0:
+            log.warning("Driver capture backup count is negative, "
+                        "defaulting to 0.")
+            self.DRIVER_CAPTURE_BACKUP_COUNT = 0
+
+        if self.PROFILING_SAMPLE_INTERVAL <= 0:
+            log.warning("Profiling sample interval is non-positive, "
+                        "defaulting to 10ms.")
+            self.PROFILING_SAMPLE_INTERVAL = 0.01
+
+        if self.TRACE_BUFFER_SIZE <= 0:
+            log.warning("Trace buffer size is non-positive, defaulting to "
+                        "100000 records.")
+            self.TRACE_BUFFER_SIZE = 100000
+
+        if self.CHAIN_GENERATION_PROCESSES < 0:
+            log.warning("Number of chain generation processes is negative, "
+                        "defaulting to 0.")
+            self.CHAIN_GENERATION_PROCESSES = 0
+
         if self.METADATA_IP.lower() == "none":
             # Metadata is not required.
             self.METADATA_IP = None
@@ -500,6 +715,24 @@ class Config(object):
                         "defaulting to 10s.")
             self.HOST_IF_POLL_INTERVAL_SECS = 10
 
+        if self.ENDPOINT_WORKER_MODE not in ("actor", "batched"):
+            log.warning("Unknown EndpointWorkerMode %s, defaulting to "
+                        "'actor'.", self.ENDPOINT_WORKER_MODE)
+            self.ENDPOINT_WORKER_MODE = "actor"
+
+        if self.IPSET_ENGINE_MODE not in ("actor", "consolidated"):
+            log.warning("Unknown IpsetEngineMode %s, defaulting to "
+                        "'actor'.", self.IPSET_ENGINE_MODE)
+            self.IPSET_ENGINE_MODE = "actor"
+
+        if self.DATAPLANE_BACKEND not in ("iptables", "nftables"):
+            log.warning("Unknown DataplaneBackend %s, defaulting to "
+                        "'iptables'.", self.DATAPLANE_BACKEND)
+            self.DATAPLANE_BACKEND = "iptables"
+
+        if self.WARM_RESTART_DIR.lower() in ("none", ""):
+            self.WARM_RESTART_DIR = None
+
         if self.MAX_IPSET_SIZE <= 0:
             log.warning("Max ipset size is non-positive, defaulting to 2^20.")
             self.MAX_IPSET_SIZE = 2**20
@@ -588,6 +821,43 @@ def _load_plugin(plugin_entry_point, flavor):
         returns the function mapped by the entry point.   Otherwise this
         function raises ImportError.
     """
+    key = (plugin_entry_point, flavor)
+    if key not in _plugin_cache:
+        _plugin_cache[key] = (_load_builtin_plugin(key) or
+                              _load_registered_plugin(plugin_entry_point,
+                                                      flavor))
+    return _plugin_cache[key]
+
+
+def _load_builtin_plugin(key):
+    """
+    Loads one of Felix's own plugins without going via pkg_resources.
+
+    :return: The function mapped by the entry point or None if there is
+        no such built-in plugin or it failed to load.
+    """
+    if key not in BUILTIN_PLUGINS:
+        return None
+    module_name, attr_name = BUILTIN_PLUGINS[key].split(":")
+    try:
+        entry_point = getattr(importlib.import_module(module_name), attr_name)
+    except Exception:
+        log.warn("Failed to load built-in plugin %s; falling back to "
+                 "registered plugins", key, exc_info=True)
+        return None
+    log.info("Successfully loaded built-in %s plugin: %s", *key)
+    return entry_point
+
+
+def _load_registered_plugin(plugin_entry_point, flavor):
+    """
+    Loads a plugin that has been registered with pkg_resources.
+
+    :return: The function mapped by the entry point.
+    :raises ImportError if no such plugin can be loaded.
+    """
+    # pkg_resources is slow to import so we only import it if we need to.
+    import pkg_resources
     for v in pkg_resources.iter_entry_points(plugin_entry_point, flavor):
         try:
             entry_point = v.load()
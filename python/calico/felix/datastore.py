@@ -19,6 +19,8 @@ felix.datastore
 Our API to etcd.  Contains function to synchronize felix with etcd
 as well as reporting our status into etcd.
 """
+from collections import defaultdict
+import hashlib
 import logging
 import os
 import random
@@ -30,12 +32,22 @@ from calico.datamodel_v1 import (
     ENDPOINT_STATUS_DOWN, ENDPOINT_STATUS_UP,
     TieredPolicyId, HostEndpointId, EndpointId)
 from calico.felix import felixbackend_pb2
-from calico.felix.actor import Actor, actor_message, TimedGreenlet
+from calico.felix.actor import (
+    Actor, actor_message, actor_storage, TimedGreenlet, tracing_enabled
+)
+from calico.felix.config import ConfigException
 from calico.felix.futils import (
     logging_exceptions, iso_utc_timestamp, IPV4,
     IPV6, StatCounter
 )
 from calico.felix.protocol import *
+from calico.felix.tracebuffer import dump_before_exit
+from calico.felix.tracing import SequenceTracker
+from calico.felix.records import (
+    WorkloadEndpointRecord, HostEndpointRecord, TierRecord, RuleRecord,
+    ProfileRulesRecord, InternPool, intern_str, intern_str_tuple,
+    intern_tuple, intern_record
+)
 from calico.monotonic import monotonic_time
 from gevent.event import Event
 from google.protobuf.descriptor import FieldDescriptor
@@ -51,6 +63,50 @@ MAX_EVENTS_BEFORE_YIELD = 200
 
 # Global diagnostic counters.
 _stats = StatCounter("Etcd counters")
+# Per-message-type counters.
+_msg_stats = {
+    MSG_TYPE_IPSET_DELTA: _stats.stat("IP set delta messages"),
+    MSG_TYPE_IPSET_REMOVED: _stats.stat("IP set removed messages"),
+    MSG_TYPE_IPSET_UPDATE: _stats.stat("IP set added messages"),
+    MSG_TYPE_WL_EP_UPDATE: _stats.stat("Workload endpoint update messages"),
+    MSG_TYPE_WL_EP_REMOVE: _stats.stat("Workload endpoint remove messages"),
+    MSG_TYPE_HOST_EP_UPDATE: _stats.stat("Host endpoint update messages"),
+    MSG_TYPE_HOST_EP_REMOVE: _stats.stat("Host endpoint update remove"),
+    MSG_TYPE_HOST_METADATA_UPDATE:
+        _stats.stat("Host endpoint update messages"),
+    MSG_TYPE_HOST_METADATA_REMOVE:
+        _stats.stat("Host endpoint remove messages"),
+    MSG_TYPE_IPAM_POOL_UPDATE: _stats.stat("IPAM pool update messagess"),
+    MSG_TYPE_IPAM_POOL_REMOVE: _stats.stat("IPAM pool remove messages"),
+    MSG_TYPE_POLICY_UPDATE: _stats.stat("Policy update messages"),
+    MSG_TYPE_POLICY_REMOVED: _stats.stat("Policy update messages"),
+    MSG_TYPE_PROFILE_UPDATE: _stats.stat("Profile update messages"),
+    MSG_TYPE_PROFILE_REMOVED: _stats.stat("Profile update messages"),
+    MSG_TYPE_CONFIG_UPDATE: _stats.stat("Config loaded messages"),
+    MSG_TYPE_IN_SYNC: _stats.stat("Status messages"),
+}
+
+# Resource type that we use to label the latency of each type of message
+# from the driver.
+RESOURCE_TYPE_BY_MSG_TYPE = {
+    MSG_TYPE_CONFIG_UPDATE: "config",
+    MSG_TYPE_IN_SYNC: "in_sync",
+    MSG_TYPE_IPSET_UPDATE: "ipset",
+    MSG_TYPE_IPSET_DELTA: "ipset",
+    MSG_TYPE_IPSET_REMOVED: "ipset",
+    MSG_TYPE_WL_EP_UPDATE: "workload_endpoint",
+    MSG_TYPE_WL_EP_REMOVE: "workload_endpoint",
+    MSG_TYPE_HOST_EP_UPDATE: "host_endpoint",
+    MSG_TYPE_HOST_EP_REMOVE: "host_endpoint",
+    MSG_TYPE_HOST_METADATA_UPDATE: "host_metadata",
+    MSG_TYPE_HOST_METADATA_REMOVE: "host_metadata",
+    MSG_TYPE_IPAM_POOL_UPDATE: "ipam_pool",
+    MSG_TYPE_IPAM_POOL_REMOVE: "ipam_pool",
+    MSG_TYPE_POLICY_UPDATE: "policy",
+    MSG_TYPE_POLICY_REMOVED: "policy",
+    MSG_TYPE_PROFILE_UPDATE: "profile",
+    MSG_TYPE_PROFILE_REMOVED: "profile",
+}
 
 
 class DatastoreAPI(Actor):
@@ -125,15 +181,21 @@ class DatastoreAPI(Actor):
         return self._reader.configured
 
     @actor_message()
-    def start_watch(self, splitter):
+    def start_watch(self, splitter, hosts_ipset=None):
         """
         Starts watching etcd for changes.  Implicitly loads the config
         if it hasn't been loaded yet.
+
+        :param splitter: UpdateSplitter (or stand-in) to send updates to.
+        :param hosts_ipset: if not None, replaces the hosts IP set that
+            was passed to the constructor.
         """
         assert self._reader.load_config.is_set(), (
             "load_config() should be called before start_watch()."
         )
         self._reader.splitter = splitter
+        if hosts_ipset is not None:
+            self._reader.hosts_ipset = hosts_ipset
         self._reader.begin_polling.set()
 
     @actor_message()
@@ -189,10 +251,28 @@ class DatastoreReader(TimedGreenlet):
         self.splitter = None
         # Next-hop IP addresses of our hosts, if populated in etcd.
         self.ipv4_by_hostname = {}
+        # Number of hosts with each of those IPs.  An IP is only removed from
+        # the hosts ipset once no host is using it.
+        self._host_count_by_ipv4 = defaultdict(int)
+        # IDs of the IP sets that we've sent members to each IP version's
+        # managers for.  A full update with no members for an IP version is
+        # only passed on if it needs to clear members that we sent before.
+        self._ipset_ids_with_members = {IPV4: set(), IPV6: set()}
         # Forces a resync after the current poll if set.  Safe to set from
         # another thread.  Automatically reset to False after the resync is
         # triggered.
         self.resync_requested = False
+        # Digest of the last payload that we saw for each endpoint, profile
+        # and policy, used to skip updates that don't change anything.
+        self._payload_digests = {}
+        # Bounded cache of converted payloads, keyed on the conversion
+        # function and the payload's digest.
+        self._converted_payloads = InternPool()
+        # Traces each update through to the dataplane and tells the driver
+        # how far through the sequence of updates we've got.
+        self._seq_tracker = SequenceTracker(
+            on_progress=self._on_seq_no_programmed
+        )
         # True if we've been shut down.
         self.killed = False
         # Stats.
@@ -227,6 +307,33 @@ class DatastoreReader(TimedGreenlet):
 
     def _dispatch_msg_from_driver(self, msg_type, msg, seq_no):
         _log.debug("Dispatching message (%s) of type: %s", seq_no, msg_type)
+        if tracing_enabled():
+            # Messages that we send to other actors while handling this one
+            # inherit its trace; it completes once they have all been
+            # processed.
+            trace = self._seq_tracker.start_trace(
+                seq_no, RESOURCE_TYPE_BY_MSG_TYPE.get(msg_type, "unknown")
+            )
+            actor_storage.traces = (trace,)
+            try:
+                self._dispatch_traced_msg(msg_type, msg)
+            finally:
+                actor_storage.traces = None
+                trace.release()
+        else:
+            self._dispatch_traced_msg(msg_type, msg)
+        self.msgs_processed += 1
+        if self.msgs_processed % MAX_EVENTS_BEFORE_YIELD == 0:
+            # Yield to ensure that other actors make progress.  (gevent only
+            # yields for us if the socket would block.)  The sleep must be
+            # non-zero to work around gevent issue where we could be
+            # immediately rescheduled.
+            gevent.sleep(0.000001)
+
+    def _on_seq_no_programmed(self, seq_no):
+        self._datastore_writer.on_seq_no_programmed(seq_no, async=True)
+
+    def _dispatch_traced_msg(self, msg_type, msg):
         if msg_type not in {MSG_TYPE_CONFIG_UPDATE,
                             MSG_TYPE_INIT,
                             MSG_TYPE_IN_SYNC}:
@@ -234,99 +341,92 @@ class DatastoreReader(TimedGreenlet):
                 _log.info("Non-init message, waiting for begin_polling flag")
             self.begin_polling.wait()
 
+        msg_stat = _msg_stats.get(msg_type)
+        if msg_stat is not None:
+            msg_stat.value += 1
         if msg_type == MSG_TYPE_IPSET_DELTA:
-            _stats.increment("IP set delta messages")
             self._on_ipset_delta_msg_from_driver(msg)
         elif msg_type == MSG_TYPE_IPSET_REMOVED:
-            _stats.increment("IP set removed messages")
             self._on_ipset_removed_msg_from_driver(msg)
         elif msg_type == MSG_TYPE_IPSET_UPDATE:
-            _stats.increment("IP set added messages")
             self._on_ipset_update_msg_from_driver(msg)
         elif msg_type == MSG_TYPE_WL_EP_UPDATE:
-            _stats.increment("Workload endpoint update messages")
             self.on_wl_endpoint_update(msg)
         elif msg_type == MSG_TYPE_WL_EP_REMOVE:
-            _stats.increment("Workload endpoint remove messages")
             self.on_wl_endpoint_remove(msg)
         elif msg_type == MSG_TYPE_HOST_EP_UPDATE:
-            _stats.increment("Host endpoint update messages")
             self.on_host_ep_update(msg)
         elif msg_type == MSG_TYPE_HOST_EP_REMOVE:
-            _stats.increment("Host endpoint update remove")
             self.on_host_ep_remove(msg)
         elif msg_type == MSG_TYPE_HOST_METADATA_UPDATE:
-            _stats.increment("Host endpoint update messages")
             self.on_host_meta_update(msg)
         elif msg_type == MSG_TYPE_HOST_METADATA_REMOVE:
-            _stats.increment("Host endpoint remove messages")
             self.on_host_meta_remove(msg)
         elif msg_type == MSG_TYPE_IPAM_POOL_UPDATE:
-            _stats.increment("IPAM pool update messagess")
             self.on_ipam_pool_update(msg)
         elif msg_type == MSG_TYPE_IPAM_POOL_REMOVE:
-            _stats.increment("IPAM pool remove messages")
             self.on_ipam_pool_remove(msg)
         elif msg_type == MSG_TYPE_POLICY_UPDATE:
-            _stats.increment("Policy update messages")
             self.on_tiered_policy_update(msg)
         elif msg_type == MSG_TYPE_POLICY_REMOVED:
-            _stats.increment("Policy update messages")
             self.on_tiered_policy_remove(msg)
         elif msg_type == MSG_TYPE_PROFILE_UPDATE:
-            _stats.increment("Profile update messages")
             self.on_prof_rules_update(msg)
         elif msg_type == MSG_TYPE_PROFILE_REMOVED:
-            _stats.increment("Profile update messages")
             self.on_prof_rules_remove(msg)
         elif msg_type == MSG_TYPE_CONFIG_UPDATE:
-            _stats.increment("Config loaded messages")
             self._on_config_update(msg)
         elif msg_type == MSG_TYPE_IN_SYNC:
-            _stats.increment("Status messages")
             self._on_in_sync(msg)
         else:
             _log.error("Unexpected message %r %s", msg_type, msg)
             raise RuntimeError("Unexpected message %s" % msg)
-        self.msgs_processed += 1
-        if self.msgs_processed % MAX_EVENTS_BEFORE_YIELD == 0:
-            # Yield to ensure that other actors make progress.  (gevent only
-            # yields for us if the socket would block.)  The sleep must be
-            # non-zero to work around gevent issue where we could be
-            # immediately rescheduled.
-            gevent.sleep(0.000001)
 
     def _on_config_update(self, msg):
         """
         Called when we receive a config loaded message from the driver.
 
-        This message is expected once per resync, when the config is
-        pre-loaded by the driver.
+        This message is expected once at start of day, when the config is
+        pre-loaded by the driver, and again whenever the config changes.
 
         On the first call, responds to the driver synchronously with a
         config response.
 
-        If the config has changed since a previous call, triggers Felix
-        to die.
+        On later calls, applies any changes to reloadable parameters.  If a
+        parameter that can't be reloaded has changed, triggers Felix to die.
         """
         global_config = dict(msg.config)
         host_config = dict(msg.config)
         _log.info("Config loaded by driver: %s", msg.config)
         if self.configured.is_set():
-            # We've already been configured.  We don't yet support
-            # dynamic config update so instead we check if the config
-            # has changed and die if it has.
+            # We've already been configured.  Check whether any of the
+            # changes require a restart; if not, they've been applied.
             _log.info("Checking configuration for changes...")
             if (host_config != self.last_host_config or
                     global_config != self.last_global_config):
-                _log.warning("Felix configuration has changed, "
-                             "felix must restart.")
                 _log.info("Old host config: %s", self.last_host_config)
                 _log.info("New host config: %s", host_config)
                 _log.info("Old global config: %s",
                           self.last_global_config)
                 _log.info("New global config: %s", global_config)
-                die_and_restart()
+                try:
+                    restart_params = self._config.reload_from(host_config)
+                except ConfigException:
+                    _log.exception("Invalid config update, keeping the old "
+                                   "config.")
+                else:
+                    if restart_params:
+                        _log.warning("Felix configuration has changed, "
+                                     "felix must restart.  Changed "
+                                     "parameters: %s", restart_params)
+                        die_and_restart()
+                    _log.info("Reloadable configuration updated")
+                    # Our config object has been updated in place; the
+                    # splitter wakes anything that needs to react to the
+                    # change and passes it on to any worker processes.
+                    self.splitter.on_config_reloaded(host_config)
+                    self.last_host_config = host_config.copy()
+                    self.last_global_config = global_config.copy()
         else:
             # First time loading the config.  Report it to the config
             # object.  Take copies because report_etcd_config is
@@ -335,10 +435,25 @@ class DatastoreReader(TimedGreenlet):
             self.last_global_config = global_config.copy()
             self._config.update_from(msg.config)
             _log.info("Config loaded: %s", self._config.__dict__)
+            if self._config.DRIVER_CAPTURE_FILE:
+                self._start_capture()
             self.configured.set()
         self._datastore_writer.on_config_resolved(async=True)
         _log.info("Config loaded by driver: %s", msg.config)
 
+    def _start_capture(self):
+        """
+        Starts capturing the messages from the driver, for later replay.
+        """
+        capture = FrameCapture(self._config.DRIVER_CAPTURE_FILE,
+                               self._config.DRIVER_CAPTURE_MAX_BYTES,
+                               self._config.DRIVER_CAPTURE_BACKUP_COUNT)
+        try:
+            self._msg_reader.start_capture(capture)
+        except (IOError, OSError):
+            _log.exception("Failed to open driver capture file %s, not "
+                           "capturing.", self._config.DRIVER_CAPTURE_FILE)
+
     def _on_in_sync(self, msg):
         """
         Called when we receive a status update from the driver.
@@ -363,13 +478,36 @@ class DatastoreReader(TimedGreenlet):
         self.begin_polling.wait()  # Make sure splitter is set.
         self._been_in_sync = True
         self.splitter.on_datamodel_in_sync()
-        self._update_hosts_ipset()
+        # Send the complete set once.  After this, hosts_ipset only receives
+        # deltas, which it batches up and applies incrementally.
+        self.hosts_ipset.replace_members(
+            frozenset(self._host_count_by_ipv4),
+            async=True
+        )
 
     def _on_ipset_update_msg_from_driver(self, msg):
-        self.splitter.on_ipset_update(msg.id,
-                                      msg.members or [])
+        if msg.packed_v4_members or msg.packed_v6_members:
+            # Packed encoding, the members are already split by IP version.
+            members_by_type = {
+                IPV4: unpack_ips(msg.packed_v4_members, IPV4),
+                IPV6: unpack_ips(msg.packed_v6_members, IPV6),
+            }
+        else:
+            members_by_type = _split_ips_by_type(msg.members or [])
+        for ip_type, ids_with_members in \
+                self._ipset_ids_with_members.iteritems():
+            if members_by_type.get(ip_type):
+                ids_with_members.add(msg.id)
+            elif msg.id in ids_with_members:
+                ids_with_members.discard(msg.id)
+                members_by_type[ip_type] = ()
+            else:
+                members_by_type.pop(ip_type, None)
+        self.splitter.on_ipset_update(msg.id, members_by_type)
 
     def _on_ipset_removed_msg_from_driver(self, msg):
+        for ids_with_members in self._ipset_ids_with_members.itervalues():
+            ids_with_members.discard(msg.id)
         self.splitter.on_ipset_removed(msg.id)
 
     def _on_ipset_delta_msg_from_driver(self, msg):
@@ -382,9 +520,26 @@ class DatastoreReader(TimedGreenlet):
             _log.info("Processed %s IP updates from driver "
                       "%.1f/s", self.ip_upd_count, 1000.0 / delta)
             self.last_ip_upd_log_time = now
-        self.splitter.on_ipset_delta_update(msg.id,
-                                            msg.added_members or [],
-                                            msg.removed_members or [])
+        if (msg.packed_added_v4_members or msg.packed_added_v6_members or
+                msg.packed_removed_v4_members or
+                msg.packed_removed_v6_members):
+            added_by_type = {
+                IPV4: unpack_ips(msg.packed_added_v4_members, IPV4),
+                IPV6: unpack_ips(msg.packed_added_v6_members, IPV6),
+            }
+            removed_by_type = {
+                IPV4: unpack_ips(msg.packed_removed_v4_members, IPV4),
+                IPV6: unpack_ips(msg.packed_removed_v6_members, IPV6),
+            }
+        else:
+            added_by_type = _split_ips_by_type(msg.added_members or [])
+            removed_by_type = _split_ips_by_type(msg.removed_members or [])
+        for ip_type, ids_with_members in \
+                self._ipset_ids_with_members.iteritems():
+            if added_by_type.get(ip_type):
+                ids_with_members.add(msg.id)
+        self.splitter.on_ipset_delta_update(msg.id, added_by_type,
+                                            removed_by_type)
 
     def on_wl_endpoint_update(self, msg):
         """Handler for endpoint updates, passes the update to the splitter.
@@ -396,16 +551,12 @@ class DatastoreReader(TimedGreenlet):
         combined_id = WloadEndpointId(hostname, orchestrator, workload_id,
                                       endpoint_id)
         _log.debug("Endpoint %s updated", combined_id)
+        endpoint = self._convert_if_changed(combined_id, msg.endpoint,
+                                            convert_pb_wl_endpoint)
+        if endpoint is None:
+            _stats.increment("Unchanged endpoint updates skipped")
+            return
         _stats.increment("Endpoint created/updated")
-        endpoint = {
-            "state": msg.endpoint.state,
-            "name": msg.endpoint.name,
-            "mac": msg.endpoint.mac or None,
-            "profile_ids": msg.endpoint.profile_ids,
-            "ipv4_nets": msg.endpoint.ipv4_nets,
-            "ipv6_nets": msg.endpoint.ipv6_nets,
-            "tiers": convert_pb_tiers(msg.endpoint.tiers),
-        }
         self.splitter.on_endpoint_update(combined_id, endpoint)
 
     def on_wl_endpoint_remove(self, msg):
@@ -419,6 +570,7 @@ class DatastoreReader(TimedGreenlet):
                                       endpoint_id)
         _log.debug("Endpoint %s removed", combined_id)
         _stats.increment("Endpoint removed")
+        self._payload_digests.pop(combined_id, None)
         self.splitter.on_endpoint_update(combined_id, None)
 
     def on_host_ep_update(self, msg):
@@ -427,14 +579,12 @@ class DatastoreReader(TimedGreenlet):
         endpoint_id = msg.id.endpoint_id
         combined_id = HostEndpointId(hostname, endpoint_id)
         _log.debug("Host endpoint %s updated", combined_id)
+        endpoint = self._convert_if_changed(combined_id, msg.endpoint,
+                                            convert_pb_host_endpoint)
+        if endpoint is None:
+            _stats.increment("Unchanged host endpoint updates skipped")
+            return
         _stats.increment("Host endpoint created/updated")
-        endpoint = {
-            "name": msg.endpoint.name or None,
-            "profile_ids": msg.endpoint.profile_ids,
-            "expected_ipv4_addrs": msg.endpoint.expected_ipv4_addrs,
-            "expected_ipv6_addrs": msg.endpoint.expected_ipv6_addrs,
-            "tiers": convert_pb_tiers(msg.endpoint.tiers),
-        }
         self.splitter.on_host_ep_update(combined_id, endpoint)
 
     def on_host_ep_remove(self, msg):
@@ -444,18 +594,20 @@ class DatastoreReader(TimedGreenlet):
         combined_id = HostEndpointId(hostname, endpoint_id)
         _log.debug("Host endpoint %s removed", combined_id)
         _stats.increment("Host endpoint removed")
+        self._payload_digests.pop(combined_id, None)
         self.splitter.on_host_ep_update(combined_id, None)
 
     def on_prof_rules_update(self, msg):
         """Handler for rules updates, passes the update to the splitter."""
         profile_id = msg.id.name
         _log.debug("Rules for %s set", profile_id)
-        _stats.increment("Rules created/updated")
         profile_id = intern(profile_id.encode("utf8"))
-        rules = {
-            "inbound_rules": convert_pb_rules(msg.profile.inbound_rules),
-            "outbound_rules": convert_pb_rules(msg.profile.outbound_rules),
-        }
+        rules = self._convert_if_changed(profile_id, msg.profile,
+                                         convert_pb_profile_rules)
+        if rules is None:
+            _stats.increment("Unchanged rules updates skipped")
+            return
+        _stats.increment("Rules created/updated")
         self.splitter.on_rules_update(profile_id, rules)
 
     def on_prof_rules_remove(self, msg):
@@ -464,31 +616,68 @@ class DatastoreReader(TimedGreenlet):
         _log.debug("Rules for %s set", profile_id)
         _stats.increment("Rules created/updated")
         profile_id = intern(profile_id.encode("utf8"))
+        self._payload_digests.pop(profile_id, None)
         self.splitter.on_rules_update(profile_id, None)
 
     def on_tiered_policy_update(self, msg):
         _log.debug("Rules for %s/%s set", msg.id.tier, msg.id.name)
-        _stats.increment("Tiered rules created/updated")
         policy_id = TieredPolicyId(msg.id.tier, msg.id.name)
-        rules = {
-            "inbound_rules": convert_pb_rules(msg.policy.inbound_rules),
-            "outbound_rules": convert_pb_rules(msg.policy.outbound_rules),
-        }
+        rules = self._convert_if_changed(policy_id, msg.policy,
+                                         convert_pb_profile_rules)
+        if rules is None:
+            _stats.increment("Unchanged tiered rules updates skipped")
+            return
+        _stats.increment("Tiered rules created/updated")
         self.splitter.on_rules_update(policy_id, rules)
 
     def on_tiered_policy_remove(self, msg):
         _log.debug("Rules for %s/%s set", msg.id.tier, msg.id.name)
         _stats.increment("Tiered rules created/updated")
         policy_id = TieredPolicyId(msg.id.tier, msg.id.name)
+        self._payload_digests.pop(policy_id, None)
         self.splitter.on_rules_update(policy_id, None)
 
+    def _convert_if_changed(self, resource_id, pb_payload, convert):
+        """
+        Converts the protobuf payload of an update unless it is identical
+        to the last payload that we saw for the same resource.  That's
+        common when the calculation graph resyncs with the datastore and
+        resends updates for resources that haven't changed.
+
+        :param resource_id: ID of the endpoint, profile or policy.
+        :param pb_payload: protobuf message to convert.
+        :param convert: function used to convert the payload.
+        :returns: the converted payload or None if it is unchanged.
+        """
+        digest = hashlib.sha1(pb_payload.SerializeToString()).digest()
+        if self._payload_digests.get(resource_id) == digest:
+            _log.debug("Payload for %s is unchanged", resource_id)
+            return None
+        cache_key = (convert, digest)
+        converted = self._converted_payloads.get(cache_key)
+        if converted is None:
+            converted = self._converted_payloads.add(cache_key,
+                                                     convert(pb_payload))
+        else:
+            _stats.increment("Conversion cache hits")
+        # Only record the digest once the conversion has succeeded, so that
+        # a payload that failed to convert is retried if it's resent.
+        self._payload_digests[resource_id] = digest
+        return converted
+
     def on_host_meta_update(self, msg):
         if not self._config.IP_IN_IP_ENABLED:
             _log.debug("Ignoring update to host IP because IP-in-IP disabled")
             return
         _stats.increment("Host IP created/updated")
+        old_ip = self.ipv4_by_hostname.get(msg.hostname)
+        if old_ip == msg.ipv4_addr:
+            _log.debug("IP of host %s unchanged", msg.hostname)
+            return
         self.ipv4_by_hostname[msg.hostname] = msg.ipv4_addr
-        self._update_hosts_ipset()
+        self._add_host_ip(msg.ipv4_addr)
+        if old_ip is not None:
+            self._remove_host_ip(old_ip)
 
     def on_host_meta_remove(self, msg):
         if not self._config.IP_IN_IP_ENABLED:
@@ -496,17 +685,21 @@ class DatastoreReader(TimedGreenlet):
                        "disabled")
             return
         _stats.increment("Host IP removed")
-        if self.ipv4_by_hostname.pop(msg.hostname, None):
-            self._update_hosts_ipset()
-
-    def _update_hosts_ipset(self):
-        if not self._been_in_sync:
-            _log.debug("Deferring update to hosts ipset until we're in-sync")
-            return
-        self.hosts_ipset.replace_members(
-            frozenset(self.ipv4_by_hostname.values()),
-            async=True
-        )
+        old_ip = self.ipv4_by_hostname.pop(msg.hostname, None)
+        if old_ip is not None:
+            self._remove_host_ip(old_ip)
+
+    def _add_host_ip(self, ip):
+        self._host_count_by_ipv4[ip] += 1
+        if self._host_count_by_ipv4[ip] == 1 and self._been_in_sync:
+            self.hosts_ipset.add_members([ip], async=True)
+
+    def _remove_host_ip(self, ip):
+        self._host_count_by_ipv4[ip] -= 1
+        if self._host_count_by_ipv4[ip] == 0:
+            del self._host_count_by_ipv4[ip]
+            if self._been_in_sync:
+                self.hosts_ipset.remove_members([ip], async=True)
 
     def on_ipam_pool_update(self, msg):
         _stats.increment("IPAM pool created/updated")
@@ -540,6 +733,17 @@ class DatastoreWriter(Actor):
         self._dirty_endpoints = set()
         self._reporting_allowed = True
         self._status_reporting_greenlet = None
+        # Highest fully-programmed sequence number, and the value that we
+        # last reported to the driver.
+        self._programmed_seq_no = None
+        self._reported_seq_no = None
+
+    def _on_actor_started(self):
+        # Tell the driver which optional protocol features we support.  It
+        # may send us messages in the basic encoding until it receives this.
+        envelope = felixbackend_pb2.FromDataplane()
+        envelope.dataplane_capabilities.packed_ip_set_members = True
+        self._writer.send_message(envelope)
 
     @logging_exceptions
     def _periodically_report_status(self):
@@ -559,6 +763,13 @@ class DatastoreWriter(Actor):
         gevent.sleep(sleep_time)
 
         while True:
+            # Re-read the interval each time around in case the config has
+            # been reloaded.
+            interval = self._config.REPORTING_INTERVAL_SECS
+            if interval <= 0:
+                _log.info("Status reporting disabled by config update.")
+                self._status_reporting_greenlet = None
+                return
             self.update_felix_status(async=True)
             # Jitter by 10% of interval.
             jitter = random.random() * 0.1 * interval
@@ -570,7 +781,10 @@ class DatastoreWriter(Actor):
         # Config now fully resolved, inform the driver.
         self.config_resolved = True
 
-        if self._config.REPORTING_INTERVAL_SECS > 0:
+        # We get called again after each config reload; only start the
+        # reporting greenlet if it's newly enabled.
+        if (self._config.REPORTING_INTERVAL_SECS > 0 and
+                self._status_reporting_greenlet is None):
             self._status_reporting_greenlet = TimedGreenlet(
                 self._periodically_report_status
             )
@@ -601,12 +815,30 @@ class DatastoreWriter(Actor):
         payload.uptime = uptime
         self._writer.send_message(envelope)
 
+    @actor_message()
+    def on_seq_no_programmed(self, seq_no):
+        """
+        Records that all the messages from the driver up to and including
+        seq_no have been fully programmed.  Reported to the driver at the
+        end of the batch.
+        """
+        self._programmed_seq_no = seq_no
+
     def _mark_endpoint_dirty(self, endpoint_id):
         assert isinstance(endpoint_id, EndpointId)
         _log.debug("Marking endpoint %s dirty", endpoint_id)
         self._dirty_endpoints.add(endpoint_id)
 
     def _finish_msg_batch(self, batch, results):
+        if self._programmed_seq_no != self._reported_seq_no:
+            _stats.increment("Progress reports")
+            envelope = felixbackend_pb2.FromDataplane()
+            payload = envelope.dataplane_progress_update
+            payload.highest_programmed_sequence_number = \
+                self._programmed_seq_no
+            self._writer.send_message(envelope)
+            self._reported_seq_no = self._programmed_seq_no
+
         if not self.config_resolved:
             _log.debug("Still waiting for config, skipping endpoint status "
                        "updates")
@@ -683,16 +915,78 @@ def combine_statuses(status_a, status_b):
         return {"status": ENDPOINT_STATUS_UP}
 
 
+def _split_ips_by_type(ips):
+    """
+    Splits a list of IP addresses into a dict mapping IP version to the
+    addresses of that version.
+    """
+    ips_by_type = {IPV4: [], IPV6: []}
+    for ip in ips:
+        ips_by_type[IPV6 if ":" in ip else IPV4].append(ip)
+    return ips_by_type
+
+
+def convert_pb_wl_endpoint(pb_endpoint):
+    """
+    :param pb_endpoint: felixbackend_pb2.WorkloadEndpoint
+    :returns: WorkloadEndpointRecord.  Unlike the protobuf, the record
+        doesn't keep the message alive.
+    """
+    return WorkloadEndpointRecord([
+        ("state", intern_str(pb_endpoint.state)),
+        ("name", intern_str(pb_endpoint.name)),
+        ("mac", intern_str(pb_endpoint.mac) or None),
+        ("profile_ids", intern_str_tuple(pb_endpoint.profile_ids)),
+        # The nets are unique to each endpoint so there's no point in
+        # interning them.
+        ("ipv4_nets", tuple(n.encode("utf8") for n in pb_endpoint.ipv4_nets)),
+        ("ipv6_nets", tuple(n.encode("utf8") for n in pb_endpoint.ipv6_nets)),
+        ("tiers", convert_pb_tiers(pb_endpoint.tiers)),
+    ])
+
+
+def convert_pb_host_endpoint(pb_endpoint):
+    """
+    :param pb_endpoint: felixbackend_pb2.HostEndpoint
+    :returns: HostEndpointRecord.
+    """
+    return HostEndpointRecord([
+        ("name", intern_str(pb_endpoint.name) or None),
+        ("profile_ids", intern_str_tuple(pb_endpoint.profile_ids)),
+        ("expected_ipv4_addrs",
+         tuple(a.encode("utf8") for a in pb_endpoint.expected_ipv4_addrs)),
+        ("expected_ipv6_addrs",
+         tuple(a.encode("utf8") for a in pb_endpoint.expected_ipv6_addrs)),
+        ("tiers", convert_pb_tiers(pb_endpoint.tiers)),
+    ])
+
+
 def convert_pb_tiers(tiers):
-    dict_tiers = []
-    for pb_tier in tiers:
-        d_tier = {"name": pb_tier.name, "policies": pb_tier.policies}
-        dict_tiers.append(d_tier)
-    return dict_tiers
+    return intern_tuple(
+        intern_record(TierRecord, [
+            ("name", intern_str(pb_tier.name)),
+            ("policies", intern_str_tuple(pb_tier.policies)),
+        ])
+        for pb_tier in tiers
+    )
+
+
+def convert_pb_profile_rules(pb_profile):
+    """
+    :param pb_profile: felixbackend_pb2.Profile or Policy.
+    :returns: ProfileRulesRecord.
+    """
+    return ProfileRulesRecord([
+        ("inbound_rules", convert_pb_rules(pb_profile.inbound_rules)),
+        ("outbound_rules", convert_pb_rules(pb_profile.outbound_rules)),
+    ])
 
 
 def convert_pb_rules(pb_rules):
-    dict_rules = []
+    """
+    :returns: interned tuple of interned RuleRecords.
+    """
+    rules = []
     for pb_rule in pb_rules:
         _log.debug("Converting protobuf rule: %r type: %s",
                    pb_rule, pb_rule.__class__)
@@ -715,7 +1009,9 @@ def convert_pb_rules(pb_rules):
             elif stem.endswith("protocol"):
                 value = convert_pb_protocol(value)
             elif stem.endswith("ip_set_ids"):
-                value = list(value)
+                value = intern_str_tuple(value)
+            elif isinstance(value, unicode):
+                value = intern_str(value)
 
             if stem == "icmp_type_code":
                 # Special case: ICMP is represented by an object, unpack it.
@@ -724,13 +1020,13 @@ def convert_pb_rules(pb_rules):
             else:
                 d_rule[dict_name] = value
 
-        dict_rules.append(d_rule)
-    return dict_rules
+        rules.append(intern_record(RuleRecord, d_rule.iteritems()))
+    return intern_tuple(rules)
 
 
 def convert_pb_ports(pb_ports):
     _log.debug("Converting ports: %s", pb_ports)
-    return map(convert_port, pb_ports)
+    return intern_tuple(convert_port(p) for p in pb_ports)
 
 
 def convert_port(pb_port):
@@ -744,7 +1040,7 @@ def convert_pb_protocol(pb_proto):
     if pb_proto.HasField("number"):
         return pb_proto.number
     else:
-        return pb_proto.name
+        return intern_str(pb_proto.name)
 
 
 def die_and_restart():
@@ -752,6 +1048,7 @@ def die_and_restart():
     # churning the config.  This prevents our upstart/systemd jobs from giving
     # up on us.
     gevent.sleep(2)
+    dump_before_exit()
     # Use a failure code to tell systemd that we expect to be restarted.  We
     # use os._exit() because it is bullet-proof.
     os._exit(1)
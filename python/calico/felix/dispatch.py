@@ -21,6 +21,7 @@ per-endpoint chains.
 """
 from collections import defaultdict
 import logging
+from calico.felix import offload
 from calico.felix.actor import Actor, actor_message, wait_and_check
 from calico.felix.frules import (
     CHAIN_TO_PREFIX, CHAIN_FROM_PREFIX, interface_to_chain_suffix,
@@ -54,6 +55,12 @@ class _DispatchChains(Actor):
         self.chain_from_leaf = self.chain_names["from_leaf"]
         self.ifaces = set()
         self.programmed_leaf_chains = set()
+        # When the chains are calculated in the pool, the worker keeps its
+        # own copy of our interfaces.  We send it the snapshot, or the
+        # interfaces added and removed since our last update.
+        self._send_snapshot = True
+        self._ifaces_added = set()
+        self._ifaces_removed = set()
         self._dirty = False
         self._datamodel_in_sync = False
 
@@ -67,6 +74,9 @@ class _DispatchChains(Actor):
         """
         _log.info("Applying dispatch chains snapshot.")
         self.ifaces = set(ifaces)  # Take a copy.
+        self._send_snapshot = True
+        self._ifaces_added.clear()
+        self._ifaces_removed.clear()
         # Always reprogram the chain, even if it's empty.  This makes sure that
         # we resync and it stops the iptables layer from marking our chain as
         # missing.
@@ -92,6 +102,8 @@ class _DispatchChains(Actor):
             return
 
         self.ifaces.add(iface_name)
+        self._ifaces_added.add(iface_name)
+        self._ifaces_removed.discard(iface_name)
         self._dirty = True
 
     @actor_message()
@@ -111,6 +123,8 @@ class _DispatchChains(Actor):
                 'Attempted to remove unmanaged interface %s', iface_name
             )
         else:
+            self._ifaces_removed.add(iface_name)
+            self._ifaces_added.discard(iface_name)
             self._dirty = True
 
     def _finish_msg_batch(self, batch, results):
@@ -273,7 +287,21 @@ class _DispatchChains(Actor):
         """
         _log.info("%s Updating dispatch chain, num entries: %s", self,
                   len(self.ifaces))
-        update = self._calculate_update(self.ifaces)
+        if offload.pool_running():
+            if self._send_snapshot:
+                snapshot, added, removed = self.ifaces, (), ()
+            else:
+                snapshot = None
+                added, removed = self._ifaces_added, self._ifaces_removed
+            update = offload.submit(offload.DISPATCH_UPDATE,
+                                    self.__class__.__name__,
+                                    self.ip_version,
+                                    snapshot, added, removed).get()
+            self._send_snapshot = False
+            self._ifaces_added = set()
+            self._ifaces_removed = set()
+        else:
+            update = self._calculate_update(self.ifaces)
         to_delete, deps, updates, new_leaf_chains = update
         futures = [
             self.iptables_updater.rewrite_chains(updates, deps,
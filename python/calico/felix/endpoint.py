@@ -23,6 +23,7 @@ from collections import OrderedDict, defaultdict
 import logging
 
 import gevent
+from gevent.event import Event
 import sys
 from netaddr.ip.sets import IPSet
 
@@ -31,11 +32,13 @@ from calico.common import nat_key
 from calico.datamodel_v1 import (
     ENDPOINT_STATUS_UP, ENDPOINT_STATUS_DOWN, ENDPOINT_STATUS_ERROR,
     WloadEndpointId, ResolvedHostEndpointId, TieredPolicyId)
-from calico.felix import devices, futils
+from calico.felix import devices, futils, offload
 from calico.felix.actor import actor_message, TimedGreenlet
 from calico.felix.futils import FailedSystemCall
 from calico.felix.futils import IPV4, IP_TYPE_TO_VERSION
-from calico.felix.refcount import ReferenceManager, RefCountedActor, RefHelper
+from calico.felix.refcount import (
+    ReferenceManager, RefCountedActor, RefHelper, CREATED
+)
 from calico.felix.profilerules import RulesManager
 from calico.felix.frules import interface_to_chain_suffix
 
@@ -94,7 +97,16 @@ class EndpointManager(ReferenceManager):
         self.pol_ids_by_ep_id = MultiDict()
         self.endpoints_with_dirty_policy = set()
 
+        # In "batched" EndpointWorkerMode, rather than creating an actor for
+        # each endpoint, we create LocalEndpointState objects and process
+        # them ourselves.  Set of LocalEndpointStates with pending updates.
+        self._batched_endpoints = config.ENDPOINT_WORKER_MODE == "batched"
+        self.dirty_endpoint_states = set()
+
         self._data_model_in_sync = False
+        # Set by on_config_reloaded() to wake the interface poll greenlet
+        # while polling is disabled.
+        self._config_reloaded = Event()
         self._iface_poll_greenlet = TimedGreenlet(self._interface_poll_loop)
         self._iface_poll_greenlet.link_exception(self._on_worker_died)
 
@@ -107,25 +119,76 @@ class EndpointManager(ReferenceManager):
         Overrides ReferenceManager._create()
         """
         if isinstance(combined_id, WloadEndpointId):
-            return WorkloadEndpoint(self.config,
-                                    combined_id,
-                                    self.ip_type,
-                                    self.iptables_updater,
-                                    self.workload_disp_chains,
-                                    self.rules_mgr,
-                                    self.fip_manager,
-                                    self.status_reporter)
+            cls = (WorkloadEndpointState if self._batched_endpoints
+                   else WorkloadEndpoint)
+            disp_chains = self.workload_disp_chains
         elif isinstance(combined_id, ResolvedHostEndpointId):
-            return HostEndpoint(self.config,
-                                combined_id,
-                                self.ip_type,
-                                self.iptables_updater,
-                                self.host_disp_chains,
-                                self.rules_mgr,
-                                self.fip_manager,
-                                self.status_reporter)
+            cls = (HostEndpointState if self._batched_endpoints
+                   else HostEndpoint)
+            disp_chains = self.host_disp_chains
         else:
             raise RuntimeError("Unknown ID type: %s" % combined_id)
+        args = [self.config,
+                combined_id,
+                self.ip_type,
+                self.iptables_updater,
+                disp_chains,
+                self.rules_mgr,
+                self.fip_manager,
+                self.status_reporter]
+        if self._batched_endpoints:
+            args.append(self)
+        return cls(*args)
+
+    def _finish_msg_batch(self, batch, results):
+        """
+        In batched EndpointWorkerMode, processes all the endpoints that were
+        updated by this batch, programming all their chains with a single
+        rewrite_chains() call.
+        """
+        super(EndpointManager, self)._finish_msg_batch(batch, results)
+        if not self.dirty_endpoint_states:
+            return
+        _log.debug("Processing %s dirty endpoints",
+                   len(self.dirty_endpoint_states))
+        dirty_states = [ep for ep in self.dirty_endpoint_states
+                        if ep._start_batch()]
+        self.dirty_endpoint_states = set()
+
+        # Combine the chain updates for all the endpoints that need them.
+        # Each endpoint owns its own chains so the updates don't overlap.
+        # Submit all the calculations before waiting for any of them so
+        # that they can run in parallel if the chain generation pool is
+        # running.
+        eps_to_program = [ep for ep in dirty_states
+                          if ep._needs_chain_update]
+        results = [ep._submit_endpoint_updates() for ep in eps_to_program]
+        updates = {}
+        deps = {}
+        for result in results:
+            ep_updates, ep_deps = result.get()
+            updates.update(ep_updates)
+            deps.update(ep_deps)
+        if eps_to_program:
+            _log.info("Programming chains for %s endpoints",
+                      len(eps_to_program))
+            try:
+                self.iptables_updater.rewrite_chains(updates, deps,
+                                                     async=False)
+            except FailedSystemCall:
+                # Fall back to programming the endpoints one at a time so
+                # that one bad endpoint doesn't hold up the others.
+                _log.exception("Failed to program chains for batch of "
+                               "endpoints; retrying individually.")
+            else:
+                for ep in eps_to_program:
+                    ep._on_chains_programmed()
+
+        for ep in dirty_states:
+            # Handles any endpoints that failed above as well as chain
+            # removals.
+            ep._sync_chains()
+            ep._finish_batch()
 
     @actor_message()
     def on_tier_data_update(self, tier, data):
@@ -261,6 +324,11 @@ class EndpointManager(ReferenceManager):
         :param dict[str]|NoneType endpoint: Dictionary of all endpoint
             data or None if the endpoint is to be deleted.
         """
+        if (endpoint is not None and
+                endpoint == self.endpoints_by_id.get(endpoint_id)):
+            # Share the data that we (and the endpoint) already hold rather
+            # than keeping an equal copy alive.
+            endpoint = self.endpoints_by_id[endpoint_id]
         if self._is_starting_or_live(endpoint_id):
             # Local endpoint thread is running; tell it of the change.
             _log.info("Update for live endpoint %s", endpoint_id)
@@ -314,6 +382,14 @@ class EndpointManager(ReferenceManager):
                 ep = self.objects_by_id[endpoint_id]
                 ep.on_interface_update(iface_up, async=True)
 
+    @actor_message()
+    def on_config_reloaded(self, raw_config):
+        """
+        Called when reloadable config has changed, in case it re-enables
+        interface polling.
+        """
+        self._config_reloaded.set()
+
     def _interface_poll_loop(self):
         """Greenlet: Polls host endpoints for changes to their IP addresses.
 
@@ -321,17 +397,26 @@ class EndpointManager(ReferenceManager):
         message.
 
         If polling is disabled, then it reads the interfaces once and then
-        stops.
+        waits for a config reload to re-enable polling.
         """
-        known_interfaces = {}
+        known_interfaces = self._poll_interfaces({})
+        enabled = None
         while True:
+            # Clear before reading the config so that we can't miss a
+            # reload.
+            self._config_reloaded.clear()
+            poll_interval = self.config.HOST_IF_POLL_INTERVAL_SECS
+            if (poll_interval > 0) != enabled:
+                enabled = poll_interval > 0
+                if not enabled:
+                    _log.info("Host interface polling disabled. Changes to "
+                              "host endpoint IPs will be ignored until it "
+                              "is re-enabled.")
+            if not enabled:
+                self._config_reloaded.wait()
+                continue
+            gevent.sleep(poll_interval)
             known_interfaces = self._poll_interfaces(known_interfaces)
-            if self.config.HOST_IF_POLL_INTERVAL_SECS <= 0:
-                _log.info("Host interface polling disabled, stopping after "
-                          "initial read. Further changes to host endpoint "
-                          "IPs will be ignored.")
-                break
-            gevent.sleep(self.config.HOST_IF_POLL_INTERVAL_SECS)
 
     def _poll_interfaces(self, known_interfaces):
         """Does a single poll of the host interfaces, looking for IP changes.
@@ -520,24 +605,29 @@ class EndpointManager(ReferenceManager):
         sys.exit(1)
 
 
-class LocalEndpoint(RefCountedActor):
+class _LocalEndpointLogic(object):
+    """
+    The endpoint state machine, shared by the LocalEndpoint actors and the
+    lightweight LocalEndpointState objects that the EndpointManager drives
+    directly in "batched" EndpointWorkerMode.
 
-    def __init__(self, config, combined_id, ip_type, iptables_updater,
-                 dispatch_chains, rules_manager, fip_manager, status_reporter):
-        """
-        Controls a single local endpoint.
+    Subclasses must call _init_endpoint_state() to set up the state.
+    """
+    __slots__ = ()
 
+    def _init_endpoint_state(self, config, combined_id, ip_type,
+                             iptables_updater, dispatch_chains, rules_manager,
+                             fip_manager, status_reporter, ref_actor):
+        """
         :param combined_id: EndpointId for this endpoint.
         :param ip_type: IP type for this endpoint (IPv4 or IPv6)
         :param iptables_updater: IptablesUpdater to use
         :param dispatch_chains: DispatchChains to use
         :param rules_manager: RulesManager to use
         :param fip_manager: FloatingIPManager to use
+        :param ref_actor: Actor whose queue we use to receive profile
+               reference callbacks.
         """
-        super(LocalEndpoint, self).__init__(qualifier="%s(%s)" %
-                                             (combined_id.endpoint, ip_type))
-        assert isinstance(rules_manager, RulesManager)
-
         self.config = config
         self.iptables_generator = config.plugins["iptables_generator"]
 
@@ -552,7 +642,7 @@ class LocalEndpoint(RefCountedActor):
         self.fip_manager = fip_manager
 
         # Helper for acquiring/releasing profiles.
-        self._rules_ref_helper = RefHelper(self, rules_manager,
+        self._rules_ref_helper = RefHelper(ref_actor, rules_manager,
                                            self._on_profiles_ready)
 
         # List of global policies that we care about.
@@ -611,29 +701,18 @@ class LocalEndpoint(RefCountedActor):
                 self.endpoint and
                 self.endpoint.get("state", "active") == "active")
 
-    @actor_message()
-    def on_endpoint_update(self, endpoint, force_reprogram=False):
-        """
-        Called when this endpoint has received an update.
-        :param dict[str]|NoneType endpoint: endpoint parameter dictionary.
-        """
+    def _on_endpoint_update(self, endpoint, force_reprogram):
         _log.info("%s updated: %s", self, endpoint)
         assert not self._unreferenced, "Update after being unreferenced"
 
-        # Store off the update, to be handled in _finish_msg_batch.
+        # Store off the update, to be handled at the end of the batch.
         self._pending_endpoint = endpoint
         self._endpoint_update_pending = True
         if force_reprogram:
             self._iptables_in_sync = False
             self._device_in_sync = False
 
-    @actor_message()
-    def on_tiered_policy_update(self, pols_by_tier):
-        """Called to update the ordered set of tiered policies that apply.
-
-        :param OrderedDict pols_by_tier: Ordered mapping from tier name to
-               list of policies to apply in that tier.
-        """
+    def _on_tiered_policy_update(self, pols_by_tier):
         _log.debug("New policy IDs for %s: %s", self.combined_id,
                    pols_by_tier)
         # if pols_by_tier != self._pol_ids_by_tier:
@@ -641,25 +720,17 @@ class LocalEndpoint(RefCountedActor):
         #     self._iptables_in_sync = False
         #     self._profile_ids_dirty = True
 
-    @actor_message()
-    def on_interface_update(self, iface_up):
-        """
-        Actor event to report that the interface is either up or changed.
-        """
+    def _on_interface_update(self, iface_up):
         _log.info("Endpoint %s received interface kick: %s",
                   self.combined_id, iface_up)
         assert not self._unreferenced, "Interface kick after unreference"
 
-        # Use a flag so that we coalesce any duplicate updates in
-        # _finish_msg_batch.
+        # Use a flag so that we coalesce any duplicate updates at the end of
+        # the batch.
         self._device_in_sync = False
         self._device_is_up = iface_up
 
-    @actor_message()
-    def on_unreferenced(self):
-        """
-        Overrides RefCountedActor:on_unreferenced.
-        """
+    def _on_unreferenced(self):
         _log.info("%s now unreferenced, cleaning up", self)
         assert not self._unreferenced, "Duplicate on_unreferenced() call"
 
@@ -667,16 +738,23 @@ class LocalEndpoint(RefCountedActor):
         assert self.endpoint is None or (self._pending_endpoint is None and
                                          self._endpoint_update_pending)
 
-        # Defer the processing to _finish_msg_batch.
+        # Defer the processing to the end of the batch.
         self._unreferenced = True
 
-    def _finish_msg_batch(self, batch, results):
+    def _start_batch(self):
+        """
+        First phase of processing a batch of updates: applies the pending
+        updates to our state, working out whether the dataplane is out of
+        sync.
+
+        :returns: False if the batch should be ignored.
+        """
         if self._cleaned_up:
             # This can occur if we get a callback from a profile via the
             # RefHelper after we've already been deleted.
-            _log.warn("_finish_msg_batch() called after being unreferenced,"
-                      "ignoring.  Batch: %s", batch)
-            return
+            _log.warn("Batch of updates received after being unreferenced,"
+                      "ignoring.")
+            return False
 
         if self._endpoint_update_pending:
             # Copy the pending update into our data structures.  May work out
@@ -687,7 +765,17 @@ class LocalEndpoint(RefCountedActor):
         if self._profile_ids_dirty:
             _log.debug("Profile references need updating")
             self._update_profile_references()
+        return True
 
+    @property
+    def _needs_chain_update(self):
+        return not self._iptables_in_sync and self._admin_up
+
+    def _sync_chains(self):
+        """
+        Second phase of processing a batch: brings our iptables chains in
+        sync.
+        """
         if not self._iptables_in_sync:
             # Try to update iptables, if successful, will set the
             # _iptables_in_sync flag.
@@ -701,6 +789,11 @@ class LocalEndpoint(RefCountedActor):
                 _log.info("%s is not 'active', removing chains.", self)
                 self._remove_chains()
 
+    def _finish_batch(self):
+        """
+        Final phase of processing a batch: configures the device, cleans up
+        and reports our status.
+        """
         if not self._device_in_sync and self._iface_name:
             # Try to update the device configuration.  If successful, will set
             # the _device_in_sync flag.
@@ -925,14 +1018,9 @@ class LocalEndpoint(RefCountedActor):
         self._profile_ids_dirty = False
 
     def _update_chains(self):
-        updates, deps = self._endpoint_updates()
+        updates, deps = self._submit_endpoint_updates().get()
         try:
             self.iptables_updater.rewrite_chains(updates, deps, async=False)
-            self.fip_manager.update_endpoint(
-                self.combined_id,
-                self.endpoint.get(self.nat_key, None),
-                async=True
-            )
         except FailedSystemCall:
             _log.exception("Failed to program chains for %s. Removing.", self)
             try:
@@ -945,10 +1033,28 @@ class LocalEndpoint(RefCountedActor):
                 _log.exception("Failed to remove chains after original "
                                "failure")
         else:
-            self._iptables_in_sync = True
-            self._chains_programmed = True
+            self._on_chains_programmed()
+
+    def _on_chains_programmed(self):
+        """
+        Called once the chains calculated by _submit_endpoint_updates()
+        have been written to the dataplane.
+        """
+        self.fip_manager.update_endpoint(
+            self.combined_id,
+            self.endpoint.get(self.nat_key, None),
+            async=True
+        )
+        self._iptables_in_sync = True
+        self._chains_programmed = True
+
+    def _submit_endpoint_updates(self):
+        """
+        Submits the calculation of our chains to the chain generation
+        pool, or runs it inline if the pool isn't running.
 
-    def _endpoint_updates(self):
+        :returns: AsyncResult for a tuple of updates and deps.
+        """
         raise NotImplementedError()  # pragma: no cover
 
     def _remove_chains(self):
@@ -1006,7 +1112,133 @@ class LocalEndpoint(RefCountedActor):
                  self._iface_name or "unknown"))
 
 
-class WorkloadEndpoint(LocalEndpoint):
+class LocalEndpoint(_LocalEndpointLogic, RefCountedActor):
+
+    def __init__(self, config, combined_id, ip_type, iptables_updater,
+                 dispatch_chains, rules_manager, fip_manager, status_reporter):
+        """
+        Controls a single local endpoint.
+
+        :param combined_id: EndpointId for this endpoint.
+        :param ip_type: IP type for this endpoint (IPv4 or IPv6)
+        :param iptables_updater: IptablesUpdater to use
+        :param dispatch_chains: DispatchChains to use
+        :param rules_manager: RulesManager to use
+        :param fip_manager: FloatingIPManager to use
+        """
+        super(LocalEndpoint, self).__init__(qualifier="%s(%s)" %
+                                             (combined_id.endpoint, ip_type))
+        assert isinstance(rules_manager, RulesManager)
+        self._init_endpoint_state(config, combined_id, ip_type,
+                                  iptables_updater, dispatch_chains,
+                                  rules_manager, fip_manager, status_reporter,
+                                  self)
+
+    @actor_message()
+    def on_endpoint_update(self, endpoint, force_reprogram=False):
+        """
+        Called when this endpoint has received an update.
+        :param dict[str]|NoneType endpoint: endpoint parameter dictionary.
+        """
+        self._on_endpoint_update(endpoint, force_reprogram)
+
+    @actor_message()
+    def on_tiered_policy_update(self, pols_by_tier):
+        """Called to update the ordered set of tiered policies that apply.
+
+        :param OrderedDict pols_by_tier: Ordered mapping from tier name to
+               list of policies to apply in that tier.
+        """
+        self._on_tiered_policy_update(pols_by_tier)
+
+    @actor_message()
+    def on_interface_update(self, iface_up):
+        """
+        Actor event to report that the interface is either up or changed.
+        """
+        self._on_interface_update(iface_up)
+
+    @actor_message()
+    def on_unreferenced(self):
+        """
+        Overrides RefCountedActor:on_unreferenced.
+        """
+        self._on_unreferenced()
+
+    def _finish_msg_batch(self, batch, results):
+        if not self._start_batch():
+            return
+        self._sync_chains()
+        self._finish_batch()
+
+
+class LocalEndpointState(_LocalEndpointLogic):
+    """
+    Lightweight equivalent of LocalEndpoint, used in "batched"
+    EndpointWorkerMode.  Rather than running its own greenlet, it records
+    updates and marks itself dirty; the EndpointManager then processes all
+    its dirty endpoints at the end of its own batch, writing all their
+    chains with a single rewrite_chains() call.
+
+    Implements the subset of the RefCountedActor interface that the
+    EndpointManager uses.
+    """
+    __slots__ = (
+        # Owned by the ReferenceManager.
+        "_manager", "_id", "ref_mgmt_state", "ref_count",
+        # Endpoint state; see _init_endpoint_state().
+        "config", "iptables_generator", "combined_id", "ip_type",
+        "iptables_updater", "dispatch_chains", "rules_mgr",
+        "status_reporter", "fip_manager", "_rules_ref_helper",
+        "_pol_ids_by_tier", "_explicit_profile_ids", "_pending_endpoint",
+        "_endpoint_update_pending", "_mac_changed", "_removed_ips",
+        "endpoint", "_mac", "_iface_name", "_suffix", "_chains_programmed",
+        "_iptables_in_sync", "_device_in_sync", "_profile_ids_dirty",
+        "_device_is_up", "_last_status", "_unreferenced",
+        "_added_to_dispatch_chains", "_cleaned_up",
+    )
+
+    def __init__(self, config, combined_id, ip_type, iptables_updater,
+                 dispatch_chains, rules_manager, fip_manager, status_reporter,
+                 endpoint_manager):
+        self._manager = None
+        self._id = None
+        self.ref_mgmt_state = CREATED
+        self.ref_count = 0
+        self._init_endpoint_state(config, combined_id, ip_type,
+                                  iptables_updater, dispatch_chains,
+                                  rules_manager, fip_manager, status_reporter,
+                                  endpoint_manager)
+
+    def start(self):
+        # Nothing to do, we're driven by the EndpointManager.
+        pass
+
+    def _mark_dirty(self):
+        self._manager.dirty_endpoint_states.add(self)
+
+    def on_endpoint_update(self, endpoint, force_reprogram=False,
+                           async=True):
+        self._on_endpoint_update(endpoint, force_reprogram)
+        self._mark_dirty()
+
+    def on_tiered_policy_update(self, pols_by_tier, async=True):
+        self._on_tiered_policy_update(pols_by_tier)
+
+    def on_interface_update(self, iface_up, async=True):
+        self._on_interface_update(iface_up)
+        self._mark_dirty()
+
+    def on_unreferenced(self, async=True):
+        self._on_unreferenced()
+        self._mark_dirty()
+
+    def _notify_cleanup_complete(self):
+        self._manager.on_object_cleanup_complete(self._id, self, async=True)
+
+
+class _WorkloadEndpointLogic(_LocalEndpointLogic):
+    __slots__ = ()
 
     def _configure_interface(self):
         """
@@ -1055,7 +1287,7 @@ class WorkloadEndpoint(LocalEndpoint):
                              self.combined_id, e)
         else:
             _log.info("Interface %s configured", self._iface_name)
-            super(WorkloadEndpoint, self)._configure_interface()
+            super(_WorkloadEndpointLogic, self)._configure_interface()
 
     def _deconfigure_interface(self):
         """
@@ -1074,25 +1306,46 @@ class WorkloadEndpoint(LocalEndpoint):
                                self._iface_name, self.combined_id)
         else:
             _log.info("Interface %s deconfigured", self._iface_name)
-            super(WorkloadEndpoint, self)._deconfigure_interface()
+            super(_WorkloadEndpointLogic, self)._deconfigure_interface()
 
-    def _endpoint_updates(self):
-        updates, deps = self.iptables_generator.endpoint_updates(
+    def _submit_endpoint_updates(self):
+        return offload.generate_chains(
+            self.iptables_generator,
+            "endpoint_updates",
             IP_TYPE_TO_VERSION[self.ip_type],
             self.combined_id.endpoint,
             self._suffix,
             self._mac,
             self.endpoint["profile_ids"],
             self._pol_ids_by_tier)
-        return updates, deps
 
 
-class HostEndpoint(LocalEndpoint):
-    def _endpoint_updates(self):
-        return self.iptables_generator.host_endpoint_updates(
+class _HostEndpointLogic(_LocalEndpointLogic):
+    __slots__ = ()
+
+    def _submit_endpoint_updates(self):
+        return offload.generate_chains(
+            self.iptables_generator,
+            "host_endpoint_updates",
             ip_version=IP_TYPE_TO_VERSION[self.ip_type],
             endpoint_id=self.combined_id.endpoint,
             suffix=self._suffix,
             profile_ids=self.endpoint["profile_ids"],
             pol_ids_by_tier=self._pol_ids_by_tier,
         )
+
+
+class WorkloadEndpoint(_WorkloadEndpointLogic, LocalEndpoint):
+    pass
+
+
+class HostEndpoint(_HostEndpointLogic, LocalEndpoint):
+    pass
+
+
+class WorkloadEndpointState(_WorkloadEndpointLogic, LocalEndpointState):
+    __slots__ = ()
+
+
+class HostEndpointState(_HostEndpointLogic, LocalEndpointState):
+    __slots__ = ()
@@ -43,6 +43,7 @@ import functools
 import logging
 import os
 import signal
+import sys
 
 import gevent
 from gevent.fileobject import FileObject
@@ -51,6 +52,9 @@ from prometheus_client import MetricsHandler
 from calico import common
 from calico.felix import devices
 from calico.felix import futils
+from calico.felix import offload
+from calico.felix import warmrestart
+from calico.felix.actor import set_tracing_enabled
 from calico.felix.fiptables import IptablesUpdater
 from calico.felix.dispatch import (HostEndpointDispatchChains,
                                    WorkloadDispatchChains)
@@ -65,6 +69,12 @@ from calico.felix.ipsets import IpsetManager, IpsetActor, HOSTS_IPSET_V4
 from calico.felix.masq import MasqueradeManager
 from calico.felix.fipmanager import FloatingIPManager
 from calico.felix.datastore import DatastoreAPI
+from calico.felix.multiprocess import (
+    WORKER_ARG, DataplaneWorker, ForwardingSplitter, HostsIpsetForwarder,
+    FrontEndConnection
+)
+from calico.felix.profiler import SamplingProfiler
+from calico.felix.tracebuffer import dump_before_exit, trace_buffer
 
 _log = logging.getLogger(__name__)
 
@@ -76,6 +86,7 @@ def _main_greenlet():
     """
     try:
         _log.info("Connecting to etcd to get our configuration.")
+        # Placeholder until the dataplanes exist; replaced by start_watch().
         hosts_ipset_v4 = IpsetActor(HOSTS_IPSET_V4)
 
         monitored_items = []
@@ -99,6 +110,15 @@ def _main_greenlet():
         config_loaded = datastore.load_config(async=False)
         config_loaded.wait()
 
+        # Size the trace buffer of hot-path events.  This discards the
+        # handful of records made while loading config.
+        trace_buffer.dump_dir = config.TRACE_BUFFER_DIR
+        if config.TRACE_BUFFER_SIZE != trace_buffer.size:
+            trace_buffer.resize(config.TRACE_BUFFER_SIZE)
+        # Update traces and actor queueing delays only feed the Prometheus
+        # metrics, and they cost something on every message.
+        set_tracing_enabled(config.PROM_METRICS_ENABLED)
+
         # Ensure the Kernel's global options are correctly configured for
         # Calico.
         devices.configure_global_kernel_config(config)
@@ -116,51 +136,6 @@ def _main_greenlet():
             stats_server.start()
             monitored_items.append(stats_server)
 
-        v4_filter_updater = IptablesUpdater("filter", ip_version=4,
-                                            config=config)
-        v4_nat_updater = IptablesUpdater("nat", ip_version=4, config=config)
-        v4_ipset_mgr = IpsetManager(IPV4, config)
-        v4_masq_manager = MasqueradeManager(IPV4, v4_nat_updater)
-        v4_rules_manager = RulesManager(config,
-                                        4,
-                                        v4_filter_updater,
-                                        v4_ipset_mgr)
-        v4_ep_dispatch_chains = WorkloadDispatchChains(
-            config, 4, v4_filter_updater)
-        v4_if_dispatch_chains = HostEndpointDispatchChains(
-            config, 4, v4_filter_updater)
-        v4_fip_manager = FloatingIPManager(config, 4, v4_nat_updater)
-        v4_ep_manager = EndpointManager(config,
-                                        IPV4,
-                                        v4_filter_updater,
-                                        v4_ep_dispatch_chains,
-                                        v4_if_dispatch_chains,
-                                        v4_rules_manager,
-                                        v4_fip_manager,
-                                        datastore.write_api)
-
-        cleanup_updaters = [v4_filter_updater, v4_nat_updater]
-        cleanup_ip_mgrs = [v4_ipset_mgr]
-        managers = [v4_ipset_mgr,
-                    v4_rules_manager,
-                    v4_ep_manager,
-                    v4_masq_manager,
-                    v4_nat_updater]
-
-        actors_to_start = [
-            hosts_ipset_v4,
-
-            v4_filter_updater,
-            v4_nat_updater,
-            v4_ipset_mgr,
-            v4_masq_manager,
-            v4_rules_manager,
-            v4_ep_dispatch_chains,
-            v4_if_dispatch_chains,
-            v4_ep_manager,
-            v4_fip_manager,
-        ]
-
         # Determine if ipv6 is enabled using the config option.
         if config.IPV6_SUPPORT == "true":
             v6_enabled = True
@@ -170,97 +145,36 @@ def _main_greenlet():
         else:
             v6_enabled = False
             ipv6_reason = "Ipv6Support is 'false'"
-
-        if v6_enabled:
-            v6_raw_updater = IptablesUpdater("raw", ip_version=6, config=config)
-            v6_filter_updater = IptablesUpdater("filter", ip_version=6,
-                                                config=config)
-            v6_nat_updater = IptablesUpdater("nat", ip_version=6, config=config)
-            v6_ipset_mgr = IpsetManager(IPV6, config)
-            v6_rules_manager = RulesManager(config,
-                                            6,
-                                            v6_filter_updater,
-                                            v6_ipset_mgr)
-            v6_ep_dispatch_chains = WorkloadDispatchChains(
-                config, 6, v6_filter_updater)
-            v6_if_dispatch_chains = HostEndpointDispatchChains(
-                config, 6, v6_filter_updater)
-            v6_fip_manager = FloatingIPManager(config, 6, v6_nat_updater)
-            v6_ep_manager = EndpointManager(config,
-                                            IPV6,
-                                            v6_filter_updater,
-                                            v6_ep_dispatch_chains,
-                                            v6_if_dispatch_chains,
-                                            v6_rules_manager,
-                                            v6_fip_manager,
-                                            datastore.write_api)
-            cleanup_updaters.append(v6_filter_updater)
-            cleanup_ip_mgrs.append(v6_ipset_mgr)
-            managers += [v6_ipset_mgr,
-                         v6_rules_manager,
-                         v6_ep_manager,
-                         v6_raw_updater,
-                         v6_nat_updater]
-            actors_to_start += [
-                v6_raw_updater,
-                v6_filter_updater,
-                v6_nat_updater,
-                v6_ipset_mgr,
-                v6_rules_manager,
-                v6_ep_dispatch_chains,
-                v6_if_dispatch_chains,
-                v6_ep_manager,
-                v6_fip_manager,
-            ]
-        else:
-            # Keep the linter happy.
+        if not v6_enabled:
             _log.warn("IPv6 support disabled: %s.", ipv6_reason)
-            v6_filter_updater = None
-            v6_nat_updater = None
-            v6_raw_updater = None
-            v6_if_dispatch_chains = None
-
-        cleanup_mgr = CleanupManager(config, cleanup_updaters, cleanup_ip_mgrs)
-        managers.append(cleanup_mgr)
-        update_splitter = UpdateSplitter(managers)
-        iface_watcher = InterfaceWatcher(update_splitter)
-        actors_to_start += [
-            cleanup_mgr,
-            iface_watcher,
-        ]
-
-        _log.info("Starting actors.")
-        for actor in actors_to_start:
-            actor.start()
-
-        monitored_items += [actor.greenlet for actor in actors_to_start]
-
-        # Try to ensure that the nf_conntrack_netlink kernel module is present.
-        # This works around an issue[1] where the first call to the "conntrack"
-        # command fails while waiting for the module to load.
-        # [1] https://github.com/projectcalico/felix/issues/986
-        load_nf_conntrack()
-
-        # Install the global rules before we start polling for updates.
-        _log.info("Installing global rules.")
-        # Dispatch chain needs to make its configuration before we insert the
-        # top-level chains.
-        v4_if_dispatch_chains.configure_iptables(async=False)
-        install_global_rules(config, v4_filter_updater, v4_nat_updater,
-                             ip_version=4)
-        if v6_enabled:
-            # Dispatch chain needs to make its configuration before we insert
-            # the top-level chains.
-            v6_if_dispatch_chains.configure_iptables(async=False)
-            install_global_rules(config, v6_filter_updater, v6_nat_updater,
-                                 ip_version=6, raw_updater=v6_raw_updater)
-
-        # Start polling for updates. These kicks make the actors poll
-        # indefinitely.
-        _log.info("Starting polling for interface and etcd updates.")
-        f = iface_watcher.watch_interfaces(async=True)
-        monitored_items.append(f)
-        datastore.start_watch(update_splitter, async=True)
+        ip_versions = [4, 6] if v6_enabled else [4]
+
+        if config.MULTI_PROCESS_DATAPLANE:
+            # Program the dataplane for each IP version in its own worker
+            # process.  This process just forwards the updates from the
+            # driver to them.
+            _log.info("Starting dataplane worker processes.")
+            workers = [DataplaneWorker(ip_version, datastore.write_api)
+                       for ip_version in ip_versions]
+            for worker in workers:
+                worker.start(config.raw_config)
+                monitored_items.append(worker.greenlet)
+            update_splitter = ForwardingSplitter(workers)
+            # The hosts IP set is IPv4-only.
+            hosts_ipset = HostsIpsetForwarder(workers[0])
+            actors_to_start = []
+        else:
+            dataplanes = [Dataplane(config, ip_version, datastore.write_api)
+                          for ip_version in ip_versions]
+            hosts_ipset = dataplanes[0].hosts_ipset
+            update_splitter, actors_to_start, items = _start_dataplanes(
+                config, dataplanes, hosts_ipset
+            )
+            monitored_items += items
+
+        # Start polling for updates.
+        _log.info("Starting polling for etcd updates.")
+        datastore.start_watch(update_splitter, hosts_ipset, async=True)
 
         # Register a SIG_USR handler to trigger a diags dump.
         def dump_top_level_actors(log):
@@ -270,11 +184,17 @@ def _main_greenlet():
         futils.register_diags("Top-level actors", dump_top_level_actors)
         futils.register_process_statistics()
         try:
-            gevent.signal(signal.SIGUSR1, functools.partial(futils.dump_diags))
+            gevent.signal(signal.SIGUSR1, dump_diags_and_trace_buffer)
         except AttributeError:
             # It doesn't matter too much if we fail to do this.
             _log.warning("Unable to install diag dump handler")
             pass
+        # And a SIGUSR2 handler to start and stop the sampling profiler.
+        profiler = SamplingProfiler(config.PROFILING_DIR,
+                                    config.PROFILING_SAMPLE_INTERVAL)
+        gevent.signal(signal.SIGUSR2, profiler.toggle)
+        if config.PROFILING_ENABLED:
+            profiler.start()
         gevent.signal(signal.SIGTERM, functools.partial(shut_down, datastore))
         gevent.signal(signal.SIGINT, functools.partial(shut_down, datastore))
 
@@ -296,6 +216,222 @@ def _main_greenlet():
         raise
 
 
+def _worker_main_greenlet(ip_version):
+    """
+    The root of our tree of greenlets in a dataplane worker process, which
+    programs the dataplane for one IP version on behalf of the front-end
+    process.
+    """
+    try:
+        _log.info("Starting IPv%s dataplane worker.", ip_version)
+        # The front end sends us communication pipes as FD 3 and 4.
+        pipe_from_front_end = FileObject(os.fdopen(3, 'rb', -1), 'rb')
+        pipe_to_front_end = FileObject(os.fdopen(4, 'wb', -1), 'wb')
+        front_end = FrontEndConnection(pipe_from_front_end,
+                                       pipe_to_front_end)
+
+        config = Config()
+        config.update_from(front_end.read_config())
+        trace_buffer.dump_dir = config.TRACE_BUFFER_DIR
+        if config.TRACE_BUFFER_SIZE != trace_buffer.size:
+            trace_buffer.resize(config.TRACE_BUFFER_SIZE)
+        # Update traces and actor queueing delays only feed the Prometheus
+        # metrics, and they cost something on every message.
+        set_tracing_enabled(config.PROM_METRICS_ENABLED)
+
+        dataplane = Dataplane(config, ip_version, front_end)
+        hosts_ipset = dataplane.hosts_ipset
+        front_end.start()
+        update_splitter, actors, monitored_items = _start_dataplanes(
+            config, [dataplane], hosts_ipset
+        )
+        monitored_items.append(front_end.greenlet)
+        monitored_items.append(
+            front_end.start_reading(config, update_splitter, hosts_ipset)
+        )
+
+        # Wait for something to fail.
+        _log.info("All worker actors started, waiting on failures...")
+        stopped_greenlet = next(gevent.iwait(monitored_items))
+        try:
+            stopped_greenlet.get()
+        except Exception:
+            _log.exception("Greenlet failed: %s", stopped_greenlet)
+            raise
+        else:
+            _log.error("Greenlet %s unexpectedly returned.", stopped_greenlet)
+            raise AssertionError("Greenlet unexpectedly returned")
+    except:
+        _log.exception("Exception killing worker main greenlet")
+        raise
+
+
+class Dataplane(object):
+    """
+    The actors that program the dataplane for one IP version.
+    """
+    def __init__(self, config, ip_version, status_reporter):
+        self.config = config
+        self.ip_version = ip_version
+        ip_type = IPV4 if ip_version == 4 else IPV6
+        # Passed to the actors that program chains and ipsets, like the
+        # config.  None if warm restart is disabled.
+        self.warm_restart = warmrestart.create(config, ip_version)
+        if config.DATAPLANE_BACKEND == "nftables":
+            from calico.felix import nftables
+            updater_cls = nftables.NftablesUpdater
+            ipset_mgr_cls = nftables.NftSetManager
+            ep_dispatch_cls = nftables.NftWorkloadDispatchChains
+            if_dispatch_cls = nftables.NftHostEndpointDispatchChains
+            masq_manager_cls = nftables.NftMasqueradeManager
+            self.hosts_set = nftables.HOSTS_SET_V4
+        else:
+            updater_cls = IptablesUpdater
+            ipset_mgr_cls = IpsetManager
+            ep_dispatch_cls = WorkloadDispatchChains
+            if_dispatch_cls = HostEndpointDispatchChains
+            masq_manager_cls = MasqueradeManager
+            self.hosts_set = HOSTS_IPSET_V4
+        if ip_version == 4:
+            # The IP-in-IP hosts IP set is IPv4-only.
+            self.hosts_ipset = IpsetActor(self.hosts_set,
+                                          warm_restart=self.warm_restart)
+        else:
+            self.hosts_ipset = None
+        if ip_version == 6:
+            self.raw_updater = updater_cls("raw", ip_version=6,
+                                           config=config,
+                                           warm_restart=self.warm_restart)
+        else:
+            self.raw_updater = None
+        self.filter_updater = updater_cls("filter", ip_version=ip_version,
+                                          config=config,
+                                          warm_restart=self.warm_restart)
+        self.nat_updater = updater_cls("nat", ip_version=ip_version,
+                                       config=config,
+                                       warm_restart=self.warm_restart)
+        ipset_mgr = ipset_mgr_cls(ip_type, config,
+                                  warm_restart=self.warm_restart)
+        rules_manager = RulesManager(config,
+                                     ip_version,
+                                     self.filter_updater,
+                                     ipset_mgr)
+        ep_dispatch_chains = ep_dispatch_cls(
+            config, ip_version, self.filter_updater)
+        self.if_dispatch_chains = if_dispatch_cls(
+            config, ip_version, self.filter_updater)
+        fip_manager = FloatingIPManager(config, ip_version, self.nat_updater)
+        ep_manager = EndpointManager(config,
+                                     ip_type,
+                                     self.filter_updater,
+                                     ep_dispatch_chains,
+                                     self.if_dispatch_chains,
+                                     rules_manager,
+                                     fip_manager,
+                                     status_reporter)
+
+        self.managers = [ipset_mgr,
+                         rules_manager,
+                         ep_manager]
+        self.actors = [self.filter_updater,
+                       self.nat_updater,
+                       ipset_mgr]
+        if ip_version == 4:
+            masq_manager = masq_manager_cls(IPV4, self.nat_updater)
+            self.managers.append(masq_manager)
+            self.actors.append(masq_manager)
+            self.cleanup_updaters = [self.filter_updater, self.nat_updater]
+        else:
+            self.managers.append(self.raw_updater)
+            self.actors.insert(0, self.raw_updater)
+            self.cleanup_updaters = [self.filter_updater]
+        self.managers += [self.filter_updater, self.nat_updater]
+        self.actors += [rules_manager,
+                        ep_dispatch_chains,
+                        self.if_dispatch_chains,
+                        ep_manager,
+                        fip_manager]
+        self.cleanup_ip_mgrs = [ipset_mgr]
+
+    def install_global_rules(self):
+        # Dispatch chain needs to make its configuration before we insert the
+        # top-level chains.
+        self.if_dispatch_chains.configure_iptables(async=False)
+        install_global_rules(self.config, self.filter_updater,
+                             self.nat_updater, ip_version=self.ip_version,
+                             raw_updater=self.raw_updater,
+                             hosts_ipset=self.hosts_set)
+
+
+def _start_dataplanes(config, dataplanes, hosts_ipset):
+    """
+    Starts the actors of the given Dataplanes, installs the global rules
+    and starts watching interfaces.
+
+    :param hosts_ipset: IpsetActor for the IP-in-IP hosts IP set, or None
+        if this process doesn't program the IPv4 dataplane.
+    :returns: tuple of the UpdateSplitter that fans out updates to the
+        dataplanes, the actors that were started and a list of items to
+        monitor for failure.
+    """
+    managers = []
+    actors = [hosts_ipset] if hosts_ipset is not None else []
+    cleanup_updaters = []
+    cleanup_ip_mgrs = []
+    for dataplane in dataplanes:
+        managers += dataplane.managers
+        actors += dataplane.actors
+        cleanup_updaters += dataplane.cleanup_updaters
+        cleanup_ip_mgrs += dataplane.cleanup_ip_mgrs
+
+    cleanup_mgr = CleanupManager(config, cleanup_updaters, cleanup_ip_mgrs)
+    managers.append(cleanup_mgr)
+    update_splitter = UpdateSplitter(managers)
+    iface_watcher = InterfaceWatcher(update_splitter)
+    actors += [
+        cleanup_mgr,
+        iface_watcher,
+    ]
+
+    # Start the chain generation workers, if enabled, before the actors
+    # that use them.
+    monitored_items = offload.start_pool(config)
+
+    # Load the warm restart snapshots before the iptables updaters load
+    # their chains.
+    for dataplane in dataplanes:
+        if dataplane.warm_restart is not None:
+            monitored_items += dataplane.warm_restart.start()
+
+    _log.info("Starting actors.")
+    for actor in actors:
+        actor.start()
+
+    monitored_items += [actor.greenlet for actor in actors]
+
+    # Try to ensure that the nf_conntrack_netlink kernel module is present.
+    # This works around an issue[1] where the first call to the "conntrack"
+    # command fails while waiting for the module to load.
+    # [1] https://github.com/projectcalico/felix/issues/986
+    load_nf_conntrack()
+
+    # Install the global rules before we start polling for updates.
+    _log.info("Installing global rules.")
+    for dataplane in dataplanes:
+        dataplane.install_global_rules()
+
+    # Start polling for interface updates.  This kick makes the actor poll
+    # indefinitely.
+    _log.info("Starting polling for interface updates.")
+    monitored_items.append(iface_watcher.watch_interfaces(async=True))
+    return update_splitter, actors, monitored_items
+
+
+def dump_diags_and_trace_buffer():
+    futils.dump_diags()
+    trace_buffer.dump()
+
+
 def shut_down(etcd_api):
     _log.info("Shutting down due to signal")
     try:
@@ -311,12 +447,25 @@ def shut_down(etcd_api):
 def main():
     # Initialise the logging with default parameters.
     common.default_logging(gevent_in_use=True)
+    if len(sys.argv) > 1 and sys.argv[1] == offload.POOL_WORKER_ARG:
+        offload.worker_main()
+        return
+    if len(sys.argv) > 2 and sys.argv[1] == WORKER_ARG:
+        main_greenlet = functools.partial(_worker_main_greenlet,
+                                          int(sys.argv[2]))
+    else:
+        main_greenlet = _main_greenlet
     try:
-        gevent.spawn(_main_greenlet).join()  # Should never return
+        gevent.spawn(main_greenlet).join()  # Should never return
     except Exception:
         # Make absolutely sure that we exit by asking the OS to terminate our
         # process.  We don't want to let a stray background thread keep us
         # alive.
         _log.exception("Felix exiting due to exception")
+        dump_before_exit()
         os._exit(1)
         raise  # Unreachable but keeps the linter happy about the broad except.
+
+
+if __name__ == "__main__":
+    main()
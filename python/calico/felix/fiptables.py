@@ -27,15 +27,21 @@ import itertools
 import re
 
 from gevent import subprocess
+from gevent.event import Event
 import gevent
 import sys
 
-from calico.felix import futils
+from calico.felix import futils, warmrestart
 from calico.felix.actor import (
     Actor, actor_message, ResultOrExc, SplitBatchAndRetry
 )
 from calico.felix.frules import FELIX_PREFIX
-from calico.felix.futils import FailedSystemCall, StatCounter
+from calico.felix.futils import (
+    FailedSystemCall, StatCounter, INPUT_LINES_BUCKETS, INPUT_BYTES_BUCKETS
+)
+from calico.felix.tracing import mark_programmed
+from calico.monotonic import monotonic_time
+from prometheus_client import Counter, Histogram
 
 _log = logging.getLogger(__name__)
 
@@ -43,6 +49,36 @@ _correlators = ("ipt-%s" % ii for ii in itertools.count())
 MAX_IPT_RETRIES = 10
 MAX_IPT_BACKOFF = 0.2
 
+_IPT_LABELS = ["ip_version", "table"]
+_restore_histogram = Histogram(
+    "felix_iptables_restore_seconds",
+    "Time taken to apply an iptables-restore transcript, including retries.",
+    _IPT_LABELS,
+)
+_restore_lines_histogram = Histogram(
+    "felix_iptables_restore_input_lines",
+    "Number of lines of input passed to iptables-restore.",
+    _IPT_LABELS,
+    buckets=INPUT_LINES_BUCKETS,
+)
+_restore_bytes_histogram = Histogram(
+    "felix_iptables_restore_input_bytes",
+    "Number of bytes of input passed to iptables-restore.",
+    _IPT_LABELS,
+    buckets=INPUT_BYTES_BUCKETS,
+)
+_restore_attempts = Counter(
+    "felix_iptables_restore_attempts",
+    "Attempts to run iptables-restore, by outcome.  Retries are caused by "
+    "COMMIT conflicts with other processes that are updating the table.",
+    _IPT_LABELS + ["outcome"],
+)
+_batch_histogram = Histogram(
+    "felix_iptables_batch_seconds",
+    "Time taken to apply a batch of updates to an iptables table.",
+    _IPT_LABELS,
+)
+
 
 class IptablesUpdater(Actor):
     """
@@ -116,11 +152,11 @@ class IptablesUpdater(Actor):
 
     """
 
-    def __init__(self, table, config, ip_version=4):
+    def __init__(self, table, config, ip_version=4, warm_restart=None):
         super(IptablesUpdater, self).__init__(qualifier="v%d-%s" %
                                                         (ip_version, table))
         self.table = table
-        self.refresh_interval = config.REFRESH_INTERVAL
+        self._config = config
         self.iptables_generator = config.plugins["iptables_generator"]
         self.ip_version = ip_version
         if ip_version == 4:
@@ -132,6 +168,15 @@ class IptablesUpdater(Actor):
             self._restore_cmd = "ip6tables-restore"
             self._save_cmd = "ip6tables-save"
             self._iptables_cmd = "ip6tables"
+        labels = (str(ip_version), table)
+        self._restore_time = _restore_histogram.labels(*labels)
+        self._restore_lines = _restore_lines_histogram.labels(*labels)
+        self._restore_bytes = _restore_bytes_histogram.labels(*labels)
+        self._batch_time = _batch_histogram.labels(*labels)
+        self._restore_labels = labels
+        self._warm_restart = warm_restart
+        """The Dataplane's WarmRestart, or None if warm restart is
+        disabled."""
 
         self._chains_in_dataplane = None
         """
@@ -181,12 +226,19 @@ class IptablesUpdater(Actor):
         self._reset_batched_work()
         self._load_chain_names_from_iptables(async=True)
 
-        # Optionally, start periodic refresh timer.
-        if self.refresh_interval > 0:
-            _log.info("Periodic iptables refresh enabled, starting "
-                      "resync greenlet")
-            refresh_greenlet = gevent.spawn(self._periodic_refresh)
-            refresh_greenlet.link_exception(self._on_worker_died)
+        # Set by on_config_reloaded() to wake the periodic refresh greenlet
+        # while the refresh is disabled.
+        self._config_reloaded = Event()
+        # Start the periodic refresh timer.  The refresh interval is
+        # reloadable so we start it even if the refresh is disabled for now.
+        refresh_greenlet = gevent.spawn(self._periodic_refresh)
+        refresh_greenlet.link_exception(self._on_worker_died)
+
+    @property
+    def refresh_interval(self):
+        # Read through to the config, which may be reloaded while we're
+        # running.
+        return self._config.REFRESH_INTERVAL
 
     @property
     def _explicitly_prog_chains(self):
@@ -213,6 +265,8 @@ class IptablesUpdater(Actor):
                                                   self.table])
         self._chains_in_dataplane = _extract_our_chains(self.table,
                                                         raw_ipt_output)
+        if self._warm_restart is not None:
+            self._warm_restart.on_chains_loaded(self.table, raw_ipt_output)
 
     def _get_unreferenced_chains(self):
         """
@@ -492,10 +546,24 @@ class IptablesUpdater(Actor):
             self.refresh_iptables()
 
     def _periodic_refresh(self):
+        enabled = None
         while True:
+            # Clear before reading the config so that we can't miss a
+            # reload.
+            self._config_reloaded.clear()
+            refresh_interval = self.refresh_interval
+            if (refresh_interval > 0) != enabled:
+                enabled = refresh_interval > 0
+                _log.info("Periodic iptables refresh %s",
+                          "enabled" if enabled else "disabled")
+            if not enabled:
+                # Wait for a config reload to re-enable it.
+                self._config_reloaded.wait()
+                continue
             # Jitter our sleep times by 20%.
-            gevent.sleep(self.refresh_interval * (1 + random.random() * 0.2))
-            self.refresh_iptables(async=True)
+            gevent.sleep(refresh_interval * (1 + random.random() * 0.2))
+            if self.refresh_interval > 0:
+                self.refresh_iptables(async=True)
 
     def _on_worker_died(self, watch_greenlet):
         """
@@ -505,6 +573,14 @@ class IptablesUpdater(Actor):
         _log.critical("Worker greenlet died: %s; exiting.", watch_greenlet)
         sys.exit(1)
 
+    @actor_message()
+    def on_config_reloaded(self, raw_config):
+        """
+        Called when reloadable config has changed, in case it re-enables
+        the periodic refresh.
+        """
+        self._config_reloaded.set()
+
     @actor_message()
     def refresh_iptables(self):
         """
@@ -528,6 +604,9 @@ class IptablesUpdater(Actor):
             except NothingToDo:
                 _log.info("%s no updates in this batch.", self)
             else:
+                if self._warm_restart is not None:
+                    self._warm_restart.mark_dirty(self.table,
+                                                  self._txn.affected_chains)
                 self._execute_iptables(input_lines)
                 _log.info("%s Successfully processed iptables updates.", self)
                 self._chains_in_dataplane.update(self._txn.affected_chains)
@@ -558,6 +637,7 @@ class IptablesUpdater(Actor):
             # If we fail due to a stray reference from an orphan chain, we
             # should catch them on the next cleanup().
             self._delete_best_effort(self._txn.chains_to_delete)
+            self._record_for_warm_restart(self._txn.affected_chains)
             for c in self._completion_callbacks:
                 c(None)
             if self._txn.refresh:
@@ -580,6 +660,7 @@ class IptablesUpdater(Actor):
             self._stats.increment("Batches finished")
 
         end = time.time()
+        self._batch_time.observe(end - start)
         _log.debug("Batch time: %.2f %s", end - start, len(batch))
 
     def _delete_best_effort(self, chains):
@@ -634,6 +715,36 @@ class IptablesUpdater(Actor):
         else:
             self._execute_iptables(input_lines, fail_log_level=logging.WARNING)
             self._chains_in_dataplane -= set(chains)
+            if self._warm_restart is not None:
+                for chain in chains:
+                    self._warm_restart.forget(self.table, chain)
+
+    def _record_for_warm_restart(self, chains):
+        """
+        Records the contents of the given chains, which we've just written,
+        for the warm restart snapshot.
+        """
+        if self._warm_restart is None:
+            return
+        for chain in chains:
+            contents = self._programmed_chain_contents.get(chain)
+            if contents is None:
+                # Stubbed out or deleted, not worth recording.
+                self._warm_restart.forget(self.table, chain)
+            else:
+                self._warm_restart.record(self.table, chain,
+                                          warmrestart.digest(contents))
+
+    def _unchanged_since_restart(self, chain, chain_updates):
+        """
+        :returns: True if the chain was already programmed with the given
+            contents before we restarted.
+        """
+        return (self._warm_restart is not None and
+                not self._txn.refresh and
+                self._warm_restart.unchanged_since_restart(
+                    self.table, chain, warmrestart.digest(chain_updates)
+                ))
 
     def _update_indexes(self):
         """
@@ -689,6 +800,11 @@ class IptablesUpdater(Actor):
 
         # Now add the actual chain updates.
         for chain, chain_updates in self._txn.updates.iteritems():
+            if self._unchanged_since_restart(chain, chain_updates):
+                _log.debug("Chain %s unchanged since restart, skipping",
+                           chain)
+                self._stats.increment("Chain rewrites skipped after restart")
+                continue
             modified_chains.add(chain)
             input_lines.extend(chain_updates)
 
@@ -751,9 +867,12 @@ class IptablesUpdater(Actor):
         backoff = 0.01
         num_tries = 0
         success = False
+        start = monotonic_time()
         while not success:
             input_str = "\n".join(input_lines) + "\n"
             _log.debug("%s input:\n%s", self._restore_cmd, input_str)
+            self._restore_lines.observe(len(input_lines))
+            self._restore_bytes.observe(len(input_str))
 
             # Run iptables-restore in noflush mode so that it doesn't
             # blow away all the tables we're not touching.
@@ -771,6 +890,7 @@ class IptablesUpdater(Actor):
                                   "%.2fs", self._iptables_cmd, backoff)
                         self._stats.increment("iptables commit failure "
                                               "(retryable)")
+                        self._count_attempt("retry")
                         gevent.sleep(backoff)
                         if backoff > MAX_IPT_BACKOFF:
                             backoff = MAX_IPT_BACKOFF
@@ -787,6 +907,7 @@ class IptablesUpdater(Actor):
                             input_str)
                         self._stats.increment("iptables commit failure "
                                               "(out of retries)")
+                        self._count_attempt("out_of_retries")
                 else:
                     _log.log(
                         fail_log_level,
@@ -797,11 +918,19 @@ class IptablesUpdater(Actor):
                         self._restore_cmd, detail, e.stdout, e.stderr,
                         input_str)
                     self._stats.increment("iptables non-retryable failure")
+                    self._count_attempt("failure")
+                self._restore_time.observe(monotonic_time() - start)
                 raise
             else:
                 self._stats.increment("iptables success")
+                self._count_attempt("success")
+                self._restore_time.observe(monotonic_time() - start)
+                mark_programmed()
                 success = True
 
+    def _count_attempt(self, outcome):
+        _restore_attempts.labels(*(self._restore_labels + (outcome,))).inc()
+
     def _missing_chain_stub_rules(self, chain_name):
         """
         :return: List of rule fragments to replace the given chain with a
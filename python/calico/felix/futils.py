@@ -21,7 +21,6 @@ felix.futils
 
 Felix utilities.
 """
-import collections
 import functools
 import hashlib
 import inspect
@@ -30,16 +29,20 @@ import os
 import re
 import sys
 import types
+import weakref
 import gc
-import urllib3
 from datetime import datetime
 import gevent.lock
 from gevent import subprocess
 from gevent.subprocess import Popen, check_output, CalledProcessError
 import tempfile
-import pkg_resources
-from posix_spawn import posix_spawnp, FileActions
-from prometheus_client import Gauge
+from prometheus_client import Histogram
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+
+from calico.felix.tracebuffer import (
+    trace_buffer, EVENT_SUBPROCESS_START, EVENT_SUBPROCESS_END
+)
+from calico.monotonic import monotonic_time
 
 try:
     import resource
@@ -72,6 +75,23 @@ _call_semaphore = gevent.lock.Semaphore(MAX_CONCURRENT_CALLS)
 
 DEFAULT_TRUNC_LENGTH = 1000
 
+# Histogram buckets for the sizes of the transcripts that we feed to
+# iptables-restore and ipset restore.
+INPUT_LINES_BUCKETS = (1, 10, 100, 1000, 10000, 100000, float("inf"))
+INPUT_BYTES_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000,
+                       float("inf"))
+
+_cmd_wait_histogram = Histogram(
+    "felix_cmd_wait_seconds",
+    "Time spent waiting for a slot to run a command.",
+    ["command"],
+)
+_cmd_duration_histogram = Histogram(
+    "felix_cmd_duration_seconds",
+    "Wall-clock time taken to run a command.",
+    ["command"],
+)
+
 
 class FailedSystemCall(Exception):
     def __init__(self,
@@ -130,7 +150,9 @@ if getattr(sys, "frozen", False):
     # skip it.
     gevent_version = None  # pragma: no cover
 else:
-    gevent_version = pkg_resources.get_distribution("gevent").parsed_version
+    # We avoid pkg_resources here since importing it scans all the
+    # installed distributions, which is slow at start of day.
+    gevent_version = gevent.version_info
 
 
 class SpawnedProcess(Popen):
@@ -144,7 +166,7 @@ class SpawnedProcess(Popen):
     """
 
     if (gevent_version is not None and
-            gevent_version < pkg_resources.parse_version("1.1a1")):
+            gevent_version < (1, 1)):
         # gevent 1.0.
         def _execute_child(self, args, executable, preexec_fn, close_fds,
                            cwd, env, universal_newlines,
@@ -230,6 +252,19 @@ class SpawnedProcess(Popen):
         if executable is None:
             executable = args[0]
 
+        # Later versions of gevent use -1, rather than None, for the pipes
+        # that aren't in use.
+        (p2cread, p2cwrite,
+         c2pread, c2pwrite,
+         errread, errwrite) = [None if fd == -1 else fd
+                               for fd in (p2cread, p2cwrite,
+                                          c2pread, c2pwrite,
+                                          errread, errwrite)]
+
+        # Imported here, rather than at start of day, because it loads a
+        # native extension, which is slow.
+        from posix_spawn import posix_spawnp, FileActions
+
         self._loop.install_sigchld()
 
         # The FileActions object is an ordered list of FD operations for
@@ -340,13 +375,23 @@ def check_call(args, input_str=None):
                MAX_CONCURRENT_CALLS)
 
     stdin = subprocess.PIPE if input_str is not None else None
+    command = os.path.basename(args[0])
 
+    wait_start = monotonic_time()
     with _call_semaphore:
+        start = monotonic_time()
+        _cmd_wait_histogram.labels(command).observe(start - wait_start)
         proc = SpawnedProcess(args,
                               stdin=stdin,
                               stdout=subprocess.PIPE,
                               stderr=subprocess.PIPE)
+        trace_buffer.record(EVENT_SUBPROCESS_START, command, None, proc.pid)
         stdout, stderr = proc.communicate(input=input_str)
+        trace_buffer.record(EVENT_SUBPROCESS_END, command, None,
+                            proc.returncode)
+        _cmd_duration_histogram.labels(command).observe(
+            monotonic_time() - start
+        )
 
     retcode = proc.returncode
     _log.debug("Process finished with RC=%s: %s.", retcode, args)
@@ -419,24 +464,51 @@ def sanitize_name(name):
     return re.sub(r'[^a-zA-Z0-9]', '_', name)
 
 
+class Stat(object):
+    """
+    Handle on a single counter in a StatCounter.
+
+    Hot code paths should look up their handles once and then increment
+    the value directly (handle.value += 1).
+    """
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+
+# All the StatCounters that are still in use, for StatCounterCollector.
+_stat_counters = weakref.WeakSet()
+
+
 class StatCounter(object):
     def __init__(self, name):
         self.name = name
-        self.stats = collections.defaultdict(lambda: 0)
-        # We duplicate the stats to Prometheus gauges.
-        self.prom_gauges = {}
+        self._stats = {}
         register_diags(name, self._dump)
+        _stat_counters.add(self)
+
+    def stat(self, stat):
+        """
+        :returns the Stat handle for the given counter, creating it if
+            needed.
+        """
+        try:
+            return self._stats[stat]
+        except KeyError:
+            handle = self._stats[stat] = Stat()
+            return handle
 
     def increment(self, stat, by=1):
-        self.stats[stat] += by
-        # Update the associated Prometheus gauge.
-        if stat not in self.prom_gauges:
-            gauge = Gauge(sanitize_name("felix_" + self.name + " " + stat),
-                          "%s: %s" % (self.name, stat))
-            self.prom_gauges[stat] = gauge
-        else:
-            gauge = self.prom_gauges[stat]
-        gauge.inc(by)
+        self.stat(stat).value += by
+
+    @property
+    def stats(self):
+        """
+        :returns a dict mapping counter name to value.
+        """
+        return dict((name, handle.value)
+                    for name, handle in self._stats.items())
 
     def _dump(self, log):
         stats_copy = self.stats.items()
@@ -444,6 +516,33 @@ class StatCounter(object):
             log.info("%s: %s", name, stat)
 
 
+class StatCounterCollector(object):
+    """
+    Prometheus collector that exports each StatCounter counter as a gauge
+    at scrape time, so that incrementing a counter doesn't have to touch
+    Prometheus.
+    """
+    def collect(self):
+        gauges = {}
+        for counter in list(_stat_counters):
+            for stat, handle in counter._stats.items():
+                gauge_name = sanitize_name("felix_" + counter.name + " " +
+                                           stat)
+                if gauge_name not in gauges:
+                    gauges[gauge_name] = [
+                        "%s: %s" % (counter.name, stat), 0
+                    ]
+                # Several StatCounters can share a name; add them up.
+                gauges[gauge_name][1] += handle.value
+        for gauge_name, (doc, value) in sorted(gauges.items()):
+            gauge = GaugeMetricFamily(gauge_name, doc)
+            gauge.add_metric([], value)
+            yield gauge
+
+
+REGISTRY.register(StatCounterCollector())
+
+
 def register_process_statistics():
     """
     Called once to register a stats handler for process-specific information.
@@ -654,6 +753,8 @@ def report_usage_and_get_warnings(calico_version, hostname, cluster_guid, cluste
     """
     _log.info("report_usage_and_get_warnings calico_version=%s, hostname=%s, guid=%s, size=%s, cluster_type=%s", calico_version, hostname, cluster_guid, cluster_size, cluster_type)
     try:
+        # Only needed here so we import it lazily, to speed up start-up.
+        import urllib3
         url = 'https://usage.projectcalico.org/UsageCheck/calicoVersionCheck'
 
         urllib3.disable_warnings()
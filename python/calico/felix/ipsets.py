@@ -21,17 +21,37 @@ IP sets management functions.
 """
 
 from collections import defaultdict
+import functools
 from itertools import chain
 import logging
 
-from calico.felix import futils
+import gevent
+
+from calico.felix import futils, warmrestart
 from calico.calcollections import SetDelta
-from calico.felix.futils import IPV4, IPV6, FailedSystemCall
+from calico.felix.futils import (
+    IPV4, IPV6, FailedSystemCall, INPUT_LINES_BUCKETS, INPUT_BYTES_BUCKETS
+)
 from calico.felix.actor import actor_message, Actor
-from calico.felix.refcount import ReferenceManager, RefCountedActor
+from calico.felix.tracing import mark_programmed
+from calico.felix.refcount import (ReferenceManager, RefCountedActor,
+                                    CREATED, STARTING)
+from prometheus_client import Histogram
 
 _log = logging.getLogger(__name__)
 
+# The time taken by ipset restore is recorded by futils.check_call().
+_restore_lines_histogram = Histogram(
+    "felix_ipset_restore_input_lines",
+    "Number of lines of input passed to ipset restore.",
+    buckets=INPUT_LINES_BUCKETS,
+)
+_restore_bytes_histogram = Histogram(
+    "felix_ipset_restore_input_bytes",
+    "Number of bytes of input passed to ipset restore.",
+    buckets=INPUT_BYTES_BUCKETS,
+)
+
 FELIX_PFX = "felix-"
 
 # Historic prefixes that any previous version of felix has used, for cleanup
@@ -50,6 +70,8 @@ ALL_FELIX_PREFIXES = {
 }
 
 DEFAULT_IPSET_SIZE = 2**20
+# Delay before the IpsetManager retries ipsets that it failed to program.
+RETRY_DELAY_SECS = 5
 DUMMY_PROFILE = "dummy"
 
 # Number of chars we have left over in the ipset name after we take out the
@@ -62,16 +84,23 @@ class IpsetManager(ReferenceManager):
     # we're under heavy churn.
     batch_delay = 0.05
 
-    def __init__(self, ip_type, config):
+    def __init__(self, ip_type, config, warm_restart=None):
         """
         Manages all the ipsets for tags for either IPv4 or IPv6.
 
         :param ip_type: IP type (IPV4 or IPV6)
+        :param warm_restart: the Dataplane's WarmRestart, or None if warm
+            restart is disabled.
         """
-        super(IpsetManager, self).__init__(qualifier=ip_type)
+        super(IpsetManager, self).__init__(
+            qualifier=ip_type,
+            linger_secs=config.REFERENCE_LINGER_SECS,
+            max_lingering_objects=config.REFERENCE_LINGER_MAX_OBJECTS,
+        )
 
         self.ip_type = ip_type
         self._config = config
+        self._warm_restart = warm_restart
 
         self._pre_calc_ipsets_by_id = defaultdict(set)
         self._pre_calc_added_ips_by_id = defaultdict(set)
@@ -82,14 +111,35 @@ class IpsetManager(ReferenceManager):
         # values.
         self._datamodel_in_sync = False
 
+        # In "consolidated" IpsetEngineMode, rather than creating an actor
+        # per ipset, we hand out lightweight IpsetHandles and program all
+        # the ipsets ourselves, writing each batch of changes with a single
+        # "ipset restore".
+        self._consolidated = config.IPSET_ENGINE_MODE == "consolidated"
+        # IDs of the IpsetHandles that need a full rewrite.
+        self._handles_to_rewrite = set()
+        # IpsetHandles that are no longer referenced and need to be
+        # destroyed.
+        self._handles_to_destroy = set()
+        # True if we've scheduled a retry of ipsets that we failed to
+        # program.
+        self._retry_scheduled = False
+        # Names of the ipsets that exist in the dataplane, or None if we
+        # need to (re)load them.  Only used in consolidated mode.
+        self._existing_ipset_names = None
+
     def _create(self, ipset_id):
         _log.info("Creating ipset for pre-calculated selector %s",
                   ipset_id)
         ipset_name = ipset_id[:MAX_NAME_LENGTH]
+        if self._consolidated:
+            return IpsetHandle(ipset_name, self.ip_type,
+                               max_elem=self._config.MAX_IPSET_SIZE)
         active_ipset = RefCountedIpsetActor(
             ipset_name,
             self.ip_type,
-            max_elem=self._config.MAX_IPSET_SIZE
+            max_elem=self._config.MAX_IPSET_SIZE,
+            warm_restart=self._warm_restart
         )
         return active_ipset
 
@@ -109,16 +159,32 @@ class IpsetManager(ReferenceManager):
         # unreferenced before _finish_msg_batch() is called.
         assert self._is_starting_or_live(ipset_id)
         assert self._datamodel_in_sync
+        if self._consolidated:
+            # We'll program the ipset, and then notify that it's ready, in
+            # _finish_msg_batch().
+            self._handles_to_rewrite.add(ipset_id)
+            return
         active_ipset = self.objects_by_id[ipset_id]
         members = frozenset(self._pre_calc_ipsets_by_id.get(ipset_id, set()))
         active_ipset.replace_members(members, async=True)
 
+    @actor_message()
+    def on_handle_unreferenced(self, handle):
+        """
+        Sent by an IpsetHandle when the ReferenceManager discards it.  Its
+        ipset is destroyed in _finish_msg_batch().
+        """
+        self._handles_to_destroy.add(handle)
+
     def _update_dirty_active_ipsets(self):
         """
         Updates the members of any live TagIpsets that are dirty.
 
         Clears the index of dirty TagIpsets as a side-effect.
         """
+        if self._consolidated:
+            self._update_dirty_ipset_handles()
+            return
         # Add in the pre-calculated IPs from the etcd driver.
         _log.debug("Incorporating pre-calculated ipsets")
         for sel_id, added_ips in self._pre_calc_added_ips_by_id.iteritems():
@@ -150,6 +216,186 @@ class IpsetManager(ReferenceManager):
         if num_updates > 0:
             _log.info("Sent %s updates to updated tags", num_updates) #uncovered
 
+    def _update_dirty_ipset_handles(self):
+        """
+        Consolidated-mode equivalent of _update_dirty_active_ipsets().
+
+        Incorporates the pre-calculated deltas and then writes all the
+        pending rewrites, deltas and deletions with a single
+        "ipset restore".  If that fails, falls back to rewriting each
+        affected ipset individually.
+        """
+        # Apply the deltas to our member sets, recording only the changes
+        # that actually modify a set so that the "add"/"del" lines below
+        # can't fail on duplicates.
+        added_ips_by_id = {}
+        removed_ips_by_id = {}
+        for ipset_id, removed_ips in self._pre_calc_removed_ips_by_id.iteritems():
+            members = self._pre_calc_ipsets_by_id.get(ipset_id)
+            if not members:
+                continue
+            removed_ips = removed_ips & members
+            if removed_ips:
+                members.difference_update(removed_ips)
+                removed_ips_by_id[ipset_id] = removed_ips
+            if not members:
+                del self._pre_calc_ipsets_by_id[ipset_id]
+        for ipset_id, added_ips in self._pre_calc_added_ips_by_id.iteritems():
+            members = self._pre_calc_ipsets_by_id.get(ipset_id, set())
+            added_ips = added_ips - members
+            if added_ips:
+                members.update(added_ips)
+                self._pre_calc_ipsets_by_id[ipset_id] = members
+                added_ips_by_id[ipset_id] = added_ips
+        self._pre_calc_removed_ips_by_id.clear()
+        self._pre_calc_added_ips_by_id.clear()
+
+        # Handles that we've never managed to program can't be updated
+        # incrementally; they need a full rewrite.
+        for ipset_id in chain(added_ips_by_id, removed_ips_by_id):
+            if (self._is_starting_or_live(ipset_id) and
+                    not self.objects_by_id[ipset_id].programmed):
+                self._handles_to_rewrite.add(ipset_id)
+
+        if not (self._handles_to_rewrite or self._handles_to_destroy or
+                added_ips_by_id or removed_ips_by_id):
+            return
+
+        if self._existing_ipset_names is None:
+            self._existing_ipset_names = set(list_ipset_names())
+        existing_names = self._existing_ipset_names
+
+        input_lines = []
+        rewritten_handles = []
+        updated_handles = []
+        for ipset_id in self._handles_to_rewrite:
+            if not self._is_starting_or_live(ipset_id):
+                # Discarded before we got to program it.
+                continue
+            handle = self.objects_by_id[ipset_id]
+            members = self._pre_calc_ipsets_by_id.get(ipset_id, ())
+            rewritten_handles.append(handle)
+            if self._handle_too_big(handle, members):
+                continue
+            input_lines += handle.ipset.rewrite_cmds(members, existing_names)
+            handle.programmed = True
+            self._maybe_yield()
+        for ipset_id in set(added_ips_by_id) | set(removed_ips_by_id):
+            if (ipset_id in self._handles_to_rewrite or
+                    not self._is_starting_or_live(ipset_id)):
+                continue
+            handle = self.objects_by_id[ipset_id]
+            members = self._pre_calc_ipsets_by_id.get(ipset_id, ())
+            if self._handle_too_big(handle, members):
+                continue
+            updated_handles.append(handle)
+            input_lines += handle.ipset.changes_cmds(
+                added_ips_by_id.get(ipset_id, ()),
+                removed_ips_by_id.get(ipset_id, ()),
+            )
+            self._maybe_yield()
+        destroyed_handles = self._handles_to_destroy
+        for handle in destroyed_handles:
+            if handle.ipset_name in existing_names:
+                input_lines.append("destroy %s" % handle.ipset_name)
+
+        # IDs of the handles that we failed to program and need to retry.
+        failed_ids = set()
+        if input_lines:
+            _log.info("Writing %d ipset restore lines for %d rewritten, "
+                      "%d updated and %d deleted ipsets", len(input_lines),
+                      len(rewritten_handles), len(updated_handles),
+                      len(destroyed_handles))
+            try:
+                restore_ipsets(input_lines)
+            except FailedSystemCall as e:
+                _log.error("Failed to apply batch of ipset changes, falling "
+                           "back to rewriting ipsets individually. RC=%s, "
+                           "err=%s", e.retcode, e.stderr)
+                self._existing_ipset_names = None
+                failed_ids = self._rewrite_handles_individually(
+                    chain(rewritten_handles, updated_handles)
+                )
+                for handle in destroyed_handles:
+                    # Best effort; the next cleanup removes any leftovers.
+                    handle.ipset.delete()
+            else:
+                for handle in rewritten_handles:
+                    if handle.programmed:
+                        existing_names.add(handle.ipset.set_name)
+                        existing_names.discard(handle.ipset.temp_set_name)
+                for handle in destroyed_handles:
+                    existing_names.discard(handle.ipset_name)
+
+        for handle in rewritten_handles:
+            if (handle.ref_mgmt_state == STARTING and
+                    handle.ipset_id not in failed_ids):
+                # Like the RefCountedIpsetActor, we report ready even if the
+                # ipset was too big to program.
+                self.on_object_startup_complete(handle.ipset_id, handle,
+                                                async=True)
+        for handle in destroyed_handles:
+            self.on_object_cleanup_complete(handle.ipset_id, handle,
+                                            async=True)
+        # Failed handles stay dirty so that we retry them.
+        self._handles_to_rewrite = failed_ids
+        self._handles_to_destroy = set()
+        if failed_ids:
+            self._schedule_retry()
+
+    def _handle_too_big(self, handle, members):
+        """
+        :returns: True, after logging an error and marking the handle as
+            unprogrammed, if members won't fit in the handle's ipset.
+        """
+        if len(members) <= handle.ipset.max_elem:
+            return False
+        _log.error("ipset %s exceeds maximum size %s.  ipset will "
+                   "not be updated until size drops below %s.",
+                   handle.ipset_name, handle.ipset.max_elem,
+                   handle.ipset.max_elem)
+        handle.programmed = False
+        return True
+
+    def _rewrite_handles_individually(self, handles):
+        """
+        Fallback for when a batched "ipset restore" fails.  Rewrites the
+        ipset of each handle that fits in its ipset with its own atomic
+        swap.
+
+        :returns: set of the IDs of the handles that we failed to rewrite.
+        """
+        failed_ids = set()
+        for handle in handles:
+            if not handle.programmed:
+                # Too big to program.
+                continue
+            members = self._pre_calc_ipsets_by_id.get(handle.ipset_id, set())
+            try:
+                handle.ipset.replace_members(frozenset(members))
+            except FailedSystemCall as e:
+                _log.error("Failed to rewrite ipset %s, will retry. RC=%s, "
+                           "err=%s", handle.ipset_name, e.retcode, e.stderr)
+                handle.programmed = False
+                failed_ids.add(handle.ipset_id)
+            self._maybe_yield()
+        return failed_ids
+
+    def _schedule_retry(self):
+        if not self._retry_scheduled:
+            self._retry_scheduled = True
+            gevent.spawn_later(RETRY_DELAY_SECS,
+                               functools.partial(self._retry_failed_ipsets,
+                                                 async=True))
+
+    @actor_message()
+    def _retry_failed_ipsets(self):
+        """
+        Timer callback.  The failed ipsets are rewritten by
+        _finish_msg_batch().
+        """
+        self._retry_scheduled = False
+
     @actor_message()
     def on_datamodel_in_sync(self):
         if not self._datamodel_in_sync:
@@ -157,6 +403,23 @@ class IpsetManager(ReferenceManager):
             self._datamodel_in_sync = True
             self._maybe_start_all()
 
+    def _whitelisted_ipset_names(self):
+        """
+        :returns: set of names of the ipsets that are in use, or may be
+            about to be used, by our live and stopping ipsets.
+        """
+        whitelist = set()
+        live_ipsets = self.objects_by_id.itervalues()
+        # stopping_objects_by_id is a dict of sets of RefCountedIpsetActor
+        # objects, chain them together.
+        stopping_ipsets = chain.from_iterable(
+            self.stopping_objects_by_id.itervalues())
+        for ipset in chain(live_ipsets, stopping_ipsets):
+            # Ask the ipset for all the names it may use and whitelist.
+            whitelist.update(ipset.owned_ipset_names())
+        _log.debug("Whitelisted ipsets: %s", whitelist)
+        return whitelist
+
     @actor_message()
     def cleanup(self):
         """
@@ -175,16 +438,7 @@ class IpsetManager(ReferenceManager):
                     print "matched"
                     felix_ipsets.add(ipset)
 
-        whitelist = set()
-        live_ipsets = self.objects_by_id.itervalues()
-        # stopping_objects_by_id is a dict of sets of RefCountedIpsetActor
-        # objects, chain them together.
-        stopping_ipsets = chain.from_iterable(
-            self.stopping_objects_by_id.itervalues())
-        for ipset in chain(live_ipsets, stopping_ipsets):
-            # Ask the ipset for all the names it may use and whitelist.
-            whitelist.update(ipset.owned_ipset_names())
-        _log.debug("Whitelisted ipsets: %s", whitelist)
+        whitelist = self._whitelisted_ipset_names()
         print "Whitelisted ipsets: %s" % whitelist
         ipsets_to_delete = felix_ipsets - whitelist
         _log.debug("Deleting ipsets: %s", ipsets_to_delete)
@@ -202,21 +456,26 @@ class IpsetManager(ReferenceManager):
                 _log.info("ipsets to delete: %s", ipsets_to_delete)
 
     @actor_message()
-    def on_ipset_update(self, ipset_id, members): #uncovered
+    def on_ipset_update(self, ipset_id, members):
+        """
+        Replaces the members of an IP set.
+
+        :param members: iterable of the IP set's members of our IP version.
+               The UpdateSplitter only sends us members of our IP version.
+        """
         _log.debug("IP set %s now active.", ipset_id)
         filtered_members = self._pre_calc_ipsets_by_id[ipset_id]
         filtered_members.clear()
-        for ip in members:
-            if (":" in ip) != (self.ip_type == IPV6):
-                # Skip IPs of incorrect type.
-                continue
-            filtered_members.add(ip)
+        filtered_members.update(members)
         if not filtered_members:
             self._pre_calc_ipsets_by_id.pop(ipset_id)
         self._pre_calc_added_ips_by_id.pop(ipset_id, None)
         self._pre_calc_removed_ips_by_id.pop(ipset_id, None)
 
         if self._is_starting_or_live(ipset_id):
+            if self._consolidated:
+                self._handles_to_rewrite.add(ipset_id)
+                return
             ipset = self.objects_by_id[ipset_id]
             ipset.replace_members(frozenset(filtered_members), async=True)
 
@@ -229,30 +488,28 @@ class IpsetManager(ReferenceManager):
         self._pre_calc_removed_ips_by_id.pop(ipset_id, None)
 
         if self._is_starting_or_live(ipset_id):
+            if self._consolidated:
+                self._handles_to_rewrite.add(ipset_id)
+                return
             ipset = self.objects_by_id[ipset_id]
             ipset.replace_members(frozenset(), async=True)
 
     @actor_message()
-    def on_ipset_delta_update(self, ipset_id, added_ips, removed_ips): #uncovered
-        skipped = 0
-        processed = 0
-        for ip in added_ips:
-            if (":" in ip) != (self.ip_type == IPV6):
-                # Skip IPs of incorrect type.
-                skipped += 1
-                continue
-            processed += 1
-            self._pre_calc_added_ips_by_id[ipset_id].add(ip)
-            self._pre_calc_removed_ips_by_id[ipset_id].discard(ip)
-        for ip in removed_ips:
-            if (":" in ip) != (self.ip_type == IPV6):
-                # Skip IPs of incorrect type.
-                skipped += 1
-                continue
-            processed += 1
-            self._pre_calc_added_ips_by_id[ipset_id].discard(ip)
-            self._pre_calc_removed_ips_by_id[ipset_id].add(ip)
-        _log.debug("Processed %s IP updates, %s skipped", processed, skipped)
+    def on_ipset_delta_update(self, ipset_id, added_ips, removed_ips):
+        """
+        Records incremental changes to the members of an IP set.  They are
+        applied in _finish_msg_batch().
+
+        :param added_ips: iterable of added members of our IP version.
+        :param removed_ips: iterable of removed members of our IP version.
+        """
+        pre_calc_added = self._pre_calc_added_ips_by_id[ipset_id]
+        pre_calc_removed = self._pre_calc_removed_ips_by_id[ipset_id]
+        pre_calc_added.update(added_ips)
+        pre_calc_removed.difference_update(added_ips)
+        pre_calc_added.difference_update(removed_ips)
+        pre_calc_removed.update(removed_ips)
+        _log.debug("Processed %s IP updates", len(added_ips) + len(removed_ips))
 
     def _finish_msg_batch(self, batch, results):
         """
@@ -273,18 +530,24 @@ class IpsetActor(Actor):
     Batches up updates to minimise the number of actual dataplane updates.
     """
 
-    def __init__(self, ipset, qualifier=None):
+    def __init__(self, ipset, qualifier=None, warm_restart=None):
         """
         :param Ipset ipset: Ipset object to wrap.
         :param str qualifier: Actor qualifier string for logging.
+        :param warm_restart: the Dataplane's WarmRestart, or None if warm
+            restart is disabled.
         """
         super(IpsetActor, self).__init__(qualifier=qualifier)
 
         self._ipset = ipset
+        self._warm_restart = warm_restart
         # Members - which entries should be in the ipset.
         self.members = None
         # SetDelta, used to track a sequence of changes.
         self.changes = None
+        # XOR of the hashes of the members, only tracked if warm restart is
+        # enabled.
+        self._members_digest = 0
 
         self._force_reprogram = True
         self.stopped = False
@@ -320,6 +583,8 @@ class IpsetActor(Actor):
         self.members = set(members)
         self._force_reprogram = True  # Force a full rewrite of the set.
         self.changes = SetDelta(self.members)  # Any changes now obsolete.
+        if self._warm_restart is not None:
+            self._members_digest = warmrestart.members_digest(self.members)
 
     @actor_message()
     def add_members(self, new_members):
@@ -357,12 +622,20 @@ class IpsetActor(Actor):
                        self._ipset.max_elem)
             return
 
+        if self._warm_restart is not None:
+            for member in chain(self.changes.added_entries,
+                                self.changes.removed_entries):
+                self._members_digest ^= warmrestart.member_hash(member)
+
         if not self._force_reprogram:
             # Just an incremental update, try to apply it as a delta.
             if not self.changes.empty:
                 _log.debug("Normal update, attempting to apply as a delta:"
                            "added=%s, removed=%s", self.changes.added_entries,
                            self.changes.removed_entries)
+                if self._warm_restart is not None:
+                    self._warm_restart.mark_dirty(warmrestart.IPSETS_KEY,
+                                                  [self.ipset_name])
                 try:
                     self._ipset.apply_changes(self.changes.added_entries,
                                               self.changes.removed_entries)
@@ -377,15 +650,35 @@ class IpsetActor(Actor):
         self.changes.apply_and_reset()
 
         if self._force_reprogram:
-            # Initial update or post-failure, completely replace the ipset's
-            # contents with an atomic swap.
-            _log.debug("Replacing content of ipset %s with %s", self,
-                       self.members)
-            self._ipset.replace_members(self.members)
-            _log.info("Completed force-rewrite of ipset %s", self)
+            if (self._warm_restart is not None and
+                    self._warm_restart.unchanged_since_restart(
+                        warmrestart.IPSETS_KEY, self.ipset_name,
+                        self._warm_restart_digest())):
+                _log.info("ipset %s unchanged since restart, skipping "
+                          "rewrite", self)
+            else:
+                # Initial update or post-failure, completely replace the
+                # ipset's contents with an atomic swap.
+                _log.debug("Replacing content of ipset %s with %s", self,
+                           self.members)
+                if self._warm_restart is not None:
+                    self._warm_restart.mark_dirty(warmrestart.IPSETS_KEY,
+                                                  [self.ipset_name])
+                self._ipset.replace_members(self.members)
+                _log.info("Completed force-rewrite of ipset %s", self)
             self._force_reprogram = False
+        if self._warm_restart is not None:
+            # We can compare an ipset's digest with ipset save directly.
+            ipset_digest = self._warm_restart_digest()
+            self._warm_restart.record(warmrestart.IPSETS_KEY,
+                                      self.ipset_name, ipset_digest,
+                                      saved=ipset_digest)
         _log.debug("Finished syncing %s to kernel", self.name)
 
+    def _warm_restart_digest(self):
+        return warmrestart.ipset_digest(self._members_digest,
+                                        self._ipset.max_elem)
+
 
 class RefCountedIpsetActor(IpsetActor, RefCountedActor):
     """
@@ -393,19 +686,24 @@ class RefCountedIpsetActor(IpsetActor, RefCountedActor):
     selector.
     """
 
-    def __init__(self, name_stem, ip_type, max_elem=DEFAULT_IPSET_SIZE):
+    def __init__(self, name_stem, ip_type, max_elem=DEFAULT_IPSET_SIZE,
+                 ipset=None, warm_restart=None):
         """
         :param str name_stem: ipset name suffix. The name of the ipset is
                derived from this value.
         :param ip_type: One of the constants, futils.IPV4 or futils.IPV6
+        :param ipset: Optional object to program in place of the tag's
+               Ipset, with the same interface.
+        :param warm_restart: the Dataplane's WarmRestart, or None if warm
+               restart is disabled.
         """
         self.name_stem = name_stem
-        suffix = tag_to_ipset_name(ip_type, name_stem)
-        tmpname = tag_to_ipset_name(ip_type, name_stem, tmp=True)
-        family = "inet" if ip_type == IPV4 else "inet6"
         # Helper class, used to do atomic rewrites of ipsets.
-        ipset = Ipset(suffix, tmpname, family, "hash:ip", max_elem=max_elem)
-        super(RefCountedIpsetActor, self).__init__(ipset, qualifier=suffix)
+        if ipset is None:
+            ipset = _tag_ipset(name_stem, ip_type, max_elem)
+        super(RefCountedIpsetActor, self).__init__(ipset,
+                                                   qualifier=ipset.set_name,
+                                                   warm_restart=warm_restart)
 
         # Notified ready?
         self.notified_ready = False
@@ -415,6 +713,8 @@ class RefCountedIpsetActor(IpsetActor, RefCountedActor):
         # Mark the object as stopped so that we don't accidentally recreate
         # the ipset in _finish_msg_batch.
         self.stopped = True
+        if self._warm_restart is not None:
+            self._warm_restart.forget(warmrestart.IPSETS_KEY, self.ipset_name)
         try:
             self._ipset.delete()
         finally:
@@ -433,6 +733,68 @@ class RefCountedIpsetActor(IpsetActor, RefCountedActor):
         return self.__class__.__name__ + "<%s,%s>" % (self._id, self.name)
 
 
+class IpsetHandle(object):
+    """
+    Lightweight stand-in for a RefCountedIpsetActor, used in "consolidated"
+    IpsetEngineMode.
+
+    The IpsetManager programs the ipset itself; the handle only carries
+    the ipset's names and the state that the ReferenceManager needs in
+    order to reference-count it.
+    """
+    __slots__ = ("_manager", "_id", "ref_mgmt_state", "ref_count", "ipset",
+                 "programmed")
+
+    def __init__(self, name_stem, ip_type, max_elem=DEFAULT_IPSET_SIZE):
+        # These fields are owned by the ReferenceManager.
+        self._manager = None
+        self._id = None
+        self.ref_mgmt_state = CREATED
+        self.ref_count = 0
+
+        self.ipset = _tag_ipset(name_stem, ip_type, max_elem)
+        # True if the ipset in the dataplane is in sync with the manager's
+        # members, so that it can be updated incrementally.
+        self.programmed = False
+
+    @property
+    def ipset_name(self):
+        return self.ipset.set_name
+
+    def owned_ipset_names(self):
+        """
+        :return: set of name of ipsets that this handle owns.  The sets may
+                 or may not be present.
+        """
+        return set([self.ipset.set_name, self.ipset.temp_set_name])
+
+    def start(self):
+        # Nothing to do, the IpsetManager programs the ipset.
+        pass
+
+    @property
+    def ipset_id(self):
+        return self._id
+
+    def on_unreferenced(self, async=None):
+        self._manager.on_handle_unreferenced(self, async=True)
+
+    def __str__(self):
+        return self.__class__.__name__ + "<%s,%s>" % (self._id,
+                                                      self.ipset_name)
+
+
+def _tag_ipset(name_stem, ip_type, max_elem):
+    """
+    :returns: a new Ipset for the tag or selector with the given
+        (possibly shortened) ID.
+    """
+    family = "inet" if ip_type == IPV4 else "inet6"
+    return Ipset(tag_to_ipset_name(ip_type, name_stem),
+                 tag_to_ipset_name(ip_type, name_stem, tmp=True),
+                 family, "hash:ip", max_elem=max_elem)
+
+
 class Ipset(object):
     """
     (Synchronous) wrapper around an ipset, supporting atomic rewrites.
@@ -484,13 +846,45 @@ class Ipset(object):
 
         :raises FailedSystemCall if the update fails.
         """
+        input_lines = self.changes_cmds(added_entries, removed_entries)
+        _log.info("Making %d changes to ipset %s",
+                  len(input_lines), self.set_name)
+        self._exec_and_commit(input_lines)
+
+    def changes_cmds(self, added_entries, removed_entries):
+        """
+        :returns a list of ipset restore lines that apply the given changes
+            to the members of the ipset.
+        """
         input_lines = ["del %s %s" % (self.set_name, m)
                        for m in removed_entries]
         input_lines += ["add %s %s" % (self.set_name, m)
                         for m in added_entries]
-        _log.info("Making %d changes to ipset %s",
-                  len(input_lines), self.set_name)
-        self._exec_and_commit(input_lines)
+        return input_lines
+
+    def rewrite_cmds(self, members, existing_names):
+        """
+        Equivalent of replace_members() for use in a larger ipset restore
+        transcript.
+
+        :param members: iterable of the ipset's new members.
+        :param existing_names: set of the names of the ipsets that exist.
+        :returns a list of ipset restore lines that atomically rewrite the
+            ipset with the new members.
+        """
+        input_lines = []
+        if self.temp_set_name in existing_names:
+            # Left over from a failed rewrite, it may have different
+            # parameters, so remove it rather than trying to re-use it.
+            input_lines.append("destroy %s" % self.temp_set_name)
+        if self.set_name not in existing_names:
+            input_lines.append(self._create_cmd(self.set_name))
+        input_lines.append(self._create_cmd(self.temp_set_name))
+        input_lines += ["add %s %s" % (self.temp_set_name, m)
+                        for m in members]
+        input_lines.append("swap %s %s" % (self.set_name, self.temp_set_name))
+        input_lines.append("destroy %s" % self.temp_set_name)
+        return input_lines
 
     def replace_members(self, members):
         """
@@ -545,9 +939,7 @@ class Ipset(object):
         Executes the the given lines of "ipset restore" input and
         follows them with a COMMIT call.
         """
-        input_lines.append("COMMIT")
-        input_str = "\n".join(input_lines) + "\n"
-        futils.check_call(["ipset", "restore"], input_str=input_str)
+        restore_ipsets(input_lines)
 
     def _create_cmd(self, name):
         """
@@ -590,6 +982,21 @@ def tag_to_ipset_name(ip_type, tag, tmp=False):
     return name
 
 
+def restore_ipsets(input_lines):
+    """
+    Executes the the given lines of "ipset restore" input and follows them
+    with a COMMIT call.
+
+    :raises FailedSystemCall if the restore fails.
+    """
+    input_lines.append("COMMIT")
+    input_str = "\n".join(input_lines) + "\n"
+    _restore_lines_histogram.observe(len(input_lines))
+    _restore_bytes_histogram.observe(len(input_str))
+    futils.check_call(["ipset", "restore"], input_str=input_str)
+    mark_programmed()
+
+
 def list_ipset_names():
     """
     List all names of ipsets. Note that this is *not* the same as the ipset
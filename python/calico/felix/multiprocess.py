@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.multiprocess
+~~~~~~~~~~~~~~~~~~
+
+Support for programming the IPv4 and IPv6 dataplanes from separate worker
+processes, so that they can make use of separate cores.
+
+The front-end process owns the connection to the datastore driver.  In
+place of the UpdateSplitter, it uses a ForwardingSplitter, which forwards
+each update over a pipe to the DataplaneWorker for each IP version.  Each
+worker process runs the usual dataplane actors behind its own
+UpdateSplitter; its FrontEndConnection makes the forwarded calls and
+reports endpoint statuses and the worker's progress back to the front
+end.
+
+Frames on the pipes are pickled tuples, each prefixed with its length.
+The first element of each tuple is the frame type:
+
+* front end to worker: ("config", raw_config), ("reload_config",
+  raw_config) and ("call", target, method_name, args, kwargs, seq_no),
+  where target is SPLITTER or HOSTS_IPSET.
+* worker to front end: ("endpoint_status", endpoint_id, ip_type, status)
+  and ("programmed", seq_no).
+
+The sequence numbers in the call frames are local to each worker.  The
+worker traces each call through its actors and reports the highest
+sequence number for which all the calls are fully programmed.  Until then,
+the front end holds a reference to the UpdateTraces of the driver messages
+on whose behalf it made each call, so the driver is only told that a
+message is programmed once all the workers have programmed it.
+"""
+import collections
+import cPickle as pickle
+import fcntl
+import logging
+import os
+import struct
+import sys
+
+import gevent
+from gevent import subprocess
+from gevent.fileobject import FileObject
+
+from calico.felix.actor import (
+    Actor, actor_message, actor_storage, tracing_enabled
+)
+from calico.felix.config import ConfigException
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.tracing import SequenceTracker
+from calico.monotonic import monotonic_time
+
+_log = logging.getLogger(__name__)
+
+# Command-line argument that tells Felix to run as a dataplane worker.
+WORKER_ARG = "dataplane-worker"
+
+# Targets of the calls forwarded to the workers.
+SPLITTER = "splitter"
+HOSTS_IPSET = "hosts_ipset"
+
+# Number of calls that the worker makes before yielding to its actors.
+MAX_CALLS_BEFORE_YIELD = 200
+
+_LENGTH = struct.Struct("<Q")
+
+# Highest FD that we close in the worker process, in addition to the ones
+# that we know we opened.
+MAX_FD = 1024
+
+
+def write_frame(f, frame):
+    data = pickle.dumps(frame, pickle.HIGHEST_PROTOCOL)
+    f.write(_LENGTH.pack(len(data)) + data)
+    f.flush()
+
+
+def read_frame(f):
+    """
+    :returns: the next frame from the given file.
+    :raises EOFError: if the file is closed, even part way through a frame.
+    """
+    length, = _LENGTH.unpack(_read_exactly(f, _LENGTH.size))
+    return pickle.loads(_read_exactly(f, length))
+
+
+def _read_exactly(f, num_bytes):
+    chunks = []
+    remaining = num_bytes
+    while remaining:
+        chunk = f.read(remaining)
+        if not chunk:
+            raise EOFError("Pipe closed")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return "".join(chunks)
+
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def worker_cmd(*args):
+    """
+    :returns: the command to run Felix with the given arguments.
+    """
+    if getattr(sys, "frozen", False):
+        # We're running under pyinstaller, re-run this executable.
+        cmd = [sys.argv[0]]
+    else:
+        cmd = [sys.executable, "-m", "calico.felix.felix"]
+    return cmd + list(args)
+
+
+def spawn_worker(cmd, stdout=None, stderr=None):
+    """
+    Starts a worker process, passing it pipes as FD 3 and 4, the same way
+    that Felix gets its pipes from the driver.
+
+    :param stdout: where to send the worker's stdout, as for Popen; by
+        default, it shares ours.
+    :param stderr: where to send the worker's stderr, likewise.
+
+    :returns: tuple of the Popen object, and gevent-friendly files for
+        writing to and reading from the worker.
+    """
+    to_worker_r, to_worker_w = os.pipe()
+    from_worker_r, from_worker_w = os.pipe()
+    for fd in (to_worker_r, to_worker_w, from_worker_r, from_worker_w):
+        _set_cloexec(fd)
+
+    def move_fds():
+        # Copy the pipes above FD 4 first in case they are FD 3 or 4.
+        # dup2() clears the close-on-exec flag on the final copies.
+        from_parent = fcntl.fcntl(to_worker_r, fcntl.F_DUPFD, 5)
+        to_parent = fcntl.fcntl(from_worker_w, fcntl.F_DUPFD, 5)
+        os.dup2(from_parent, 3)
+        os.dup2(to_parent, 4)
+        os.closerange(5, MAX_FD)
+
+    process = subprocess.Popen(cmd, preexec_fn=move_fds,
+                               stdout=stdout, stderr=stderr)
+    os.close(to_worker_r)
+    os.close(from_worker_w)
+    # The FileObjects own the FDs; closing one closes its FD exactly once.
+    to_worker = FileObject(to_worker_w, "wb")
+    from_worker = FileObject(from_worker_r, "rb")
+    return process, to_worker, from_worker
+
+
+class DataplaneWorker(object):
+    """
+    The front end's handle on the worker process that programs the
+    dataplane for one IP version.
+
+    Only used from the DatastoreReader's greenlet, apart from the greenlet
+    that reads from the worker.
+    """
+    def __init__(self, ip_version, datastore_writer):
+        self.ip_version = ip_version
+        self.ip_type = IPV4 if ip_version == 4 else IPV6
+        self._datastore_writer = datastore_writer
+        self._process = None
+        self._to_worker = None
+        self._from_worker = None
+        # Greenlet that reads from the worker; it returns if the worker
+        # exits.
+        self.greenlet = None
+        self._next_seq_no = 0
+        # (seq_no, traces) for the calls that the worker has yet to report
+        # programmed, in the order that we sent them.
+        self._pending = collections.deque()
+
+    def worker_cmd(self):
+        return worker_cmd(WORKER_ARG, str(self.ip_version))
+
+    def start(self, raw_config):
+        """
+        Starts the worker process and sends it the config.
+
+        :param raw_config: the config dict that we loaded from the driver.
+        """
+        cmd = self.worker_cmd()
+        _log.info("Starting IPv%s dataplane worker: %s", self.ip_version, cmd)
+        self._process, self._to_worker, self._from_worker = \
+            spawn_worker(cmd)
+        write_frame(self._to_worker, ("config", raw_config))
+        self.greenlet = gevent.spawn(self._loop_reading_from_worker)
+
+    def send_call(self, target, method_name, args, kwargs=None):
+        """
+        Asks the worker to call the given method of the given target.
+
+        The call is made on behalf of the traces of the message that we're
+        processing; we hold on to them until the worker reports the call
+        programmed.
+        """
+        self._next_seq_no += 1
+        seq_no = self._next_seq_no
+        traces = getattr(actor_storage, "traces", None)
+        if traces:
+            for trace in traces:
+                trace.add_ref()
+            self._pending.append((seq_no, traces))
+        write_frame(self._to_worker,
+                    ("call", target, method_name, args, kwargs or {}, seq_no))
+
+    def reload_config(self, raw_config):
+        write_frame(self._to_worker, ("reload_config", raw_config))
+
+    def _loop_reading_from_worker(self):
+        while True:
+            try:
+                frame = read_frame(self._from_worker)
+            except EOFError:
+                _log.critical("IPv%s dataplane worker closed its pipe, "
+                              "exit code %s", self.ip_version,
+                              self._process.poll())
+                return
+            if frame[0] == "endpoint_status":
+                _, endpoint_id, ip_type, status = frame
+                self._datastore_writer.on_endpoint_status_changed(
+                    endpoint_id, ip_type, status, async=True
+                )
+            elif frame[0] == "programmed":
+                self._on_programmed(frame[1])
+            else:
+                _log.error("Unexpected frame from worker: %r", frame)
+                raise RuntimeError("Unexpected frame %r" % (frame,))
+
+    def _on_programmed(self, seq_no):
+        # We can't tell which of the calls resulted in a dataplane commit
+        # so the programming latency is measured to the worker's report.
+        now = monotonic_time()
+        while self._pending and self._pending[0][0] <= seq_no:
+            _, traces = self._pending.popleft()
+            for trace in traces:
+                trace.programmed_time = now
+                trace.release()
+
+    def __str__(self):
+        return "DataplaneWorker(IPv%s)" % self.ip_version
+
+
+class ForwardingSplitter(object):
+    """
+    Stands in for the UpdateSplitter in the front-end process, forwarding
+    updates to the dataplane workers.
+
+    IP set members are only sent to the worker for their IP version.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+
+    def _forward(self, method_name, *args):
+        for worker in self.workers:
+            worker.send_call(SPLITTER, method_name, args)
+
+    def on_datamodel_in_sync(self):
+        self._forward("on_datamodel_in_sync")
+
+    def on_rules_update(self, profile_id, rules):
+        self._forward("on_rules_update", profile_id, rules)
+
+    def on_endpoint_update(self, endpoint_id, endpoint):
+        self._forward("on_endpoint_update", endpoint_id, endpoint)
+
+    def on_host_ep_update(self, combined_id, iface_data):
+        self._forward("on_host_ep_update", combined_id, iface_data)
+
+    def on_ipam_pool_updated(self, pool_id, pool):
+        self._forward("on_ipam_pool_updated", pool_id, pool)
+
+    def on_ipset_update(self, ipset_id, members_by_type):
+        for worker in self.workers:
+            if worker.ip_type not in members_by_type:
+                continue
+            members = members_by_type[worker.ip_type]
+            worker.send_call(SPLITTER, "on_ipset_update",
+                             (ipset_id, {worker.ip_type: members}))
+
+    def on_ipset_removed(self, ipset_id):
+        self._forward("on_ipset_removed", ipset_id)
+
+    def on_ipset_delta_update(self, ipset_id, added_by_type,
+                              removed_by_type):
+        for worker in self.workers:
+            added_ips = added_by_type.get(worker.ip_type, ())
+            removed_ips = removed_by_type.get(worker.ip_type, ())
+            if not added_ips and not removed_ips:
+                continue
+            worker.send_call(SPLITTER, "on_ipset_delta_update",
+                             (ipset_id,
+                              {worker.ip_type: added_ips},
+                              {worker.ip_type: removed_ips}))
+
+    def on_config_reloaded(self, raw_config):
+        """
+        Called when reloadable config has changed.  Each worker has its own
+        copy of the config so it needs to apply the change too.
+        """
+        for worker in self.workers:
+            worker.reload_config(raw_config)
+
+
+class HostsIpsetForwarder(object):
+    """
+    Stands in for the IP-in-IP hosts IpsetActor in the front-end process,
+    forwarding updates to the IPv4 worker, which owns the IP set.
+    """
+    def __init__(self, worker):
+        self.worker = worker
+
+    def replace_members(self, members, async=None):
+        self.worker.send_call(HOSTS_IPSET, "replace_members", (members,),
+                              {"async": True})
+
+    def add_members(self, new_members, async=None):
+        self.worker.send_call(HOSTS_IPSET, "add_members", (new_members,),
+                              {"async": True})
+
+    def remove_members(self, removed_members, async=None):
+        self.worker.send_call(HOSTS_IPSET, "remove_members",
+                              (removed_members,), {"async": True})
+
+
+class FrontEndConnection(Actor):
+    """
+    A dataplane worker's connection to the front-end process.
+
+    Reads the calls from the front end and makes them, tracing each through
+    the worker's actors.  Stands in for the DatastoreWriter as the status
+    reporter of the EndpointManager, forwarding endpoint statuses to the
+    front end along with the worker's progress.
+    """
+    def __init__(self, pipe_from_front_end, pipe_to_front_end):
+        super(FrontEndConnection, self).__init__()
+        self._from_front_end = pipe_from_front_end
+        self._to_front_end = pipe_to_front_end
+        self._config = None
+        self._targets = {}
+        # Greenlet that reads from the front end; it returns if the front
+        # end exits.
+        self.reader_greenlet = None
+        self._seq_tracker = SequenceTracker(
+            on_progress=self._on_seq_no_programmed
+        )
+        self.calls_processed = 0
+        # Endpoint statuses and progress to send at the end of the batch.
+        self._endpoint_statuses = collections.OrderedDict()
+        self._programmed_seq_no = None
+        self._reported_seq_no = None
+
+    def read_config(self):
+        """
+        Reads the config frame, which the front end sends first.  Must be
+        called before start_reading().
+
+        :returns: the config dict that the front end loaded from the
+            driver.
+        """
+        frame = read_frame(self._from_front_end)
+        if frame[0] != "config":
+            raise RuntimeError("Expected config from front end, got %r" %
+                               (frame,))
+        return frame[1]
+
+    def start_reading(self, config, splitter, hosts_ipset):
+        """
+        Starts making the calls from the front end.
+
+        :param Config config: the config object, updated if reloadable
+            config changes.
+        :param splitter: UpdateSplitter for the worker's managers.
+        :param hosts_ipset: IpsetActor for the IP-in-IP hosts IP set, or
+            None if this worker doesn't program the IPv4 dataplane.
+        :returns: the greenlet that reads from the front end.
+        """
+        self._config = config
+        self._targets = {SPLITTER: splitter, HOSTS_IPSET: hosts_ipset}
+        self.reader_greenlet = gevent.spawn(self._loop_reading_from_front_end)
+        return self.reader_greenlet
+
+    def _loop_reading_from_front_end(self):
+        while True:
+            try:
+                frame = read_frame(self._from_front_end)
+            except EOFError:
+                _log.critical("The front-end process closed its pipe, "
+                              "worker must exit.")
+                return
+            if frame[0] == "call":
+                _, target, method_name, args, kwargs, seq_no = frame
+                self._dispatch_call(target, method_name, args, kwargs,
+                                    seq_no)
+            elif frame[0] == "reload_config":
+                self._reload_config(frame[1])
+            else:
+                _log.error("Unexpected frame from front end: %r", frame)
+                raise RuntimeError("Unexpected frame %r" % (frame,))
+
+    def _reload_config(self, raw_config):
+        # The front end only sends us config that it has applied itself, and
+        # it restarts Felix if a parameter that can't be reloaded has
+        # changed.
+        try:
+            self._config.reload_from(raw_config)
+        except ConfigException:
+            _log.exception("Invalid config update, keeping the old config.")
+        else:
+            self._targets[SPLITTER].on_config_reloaded(raw_config)
+
+    def _dispatch_call(self, target, method_name, args, kwargs, seq_no):
+        _log.debug("Dispatching call (%s) %s.%s", seq_no, target,
+                   method_name)
+        method = getattr(self._targets[target], method_name)
+        if tracing_enabled():
+            trace = self._seq_tracker.start_trace(seq_no, method_name)
+            actor_storage.traces = (trace,)
+            try:
+                method(*args, **kwargs)
+            finally:
+                actor_storage.traces = None
+                trace.release()
+        else:
+            method(*args, **kwargs)
+        self.calls_processed += 1
+        if self.calls_processed % MAX_CALLS_BEFORE_YIELD == 0:
+            # Yield to ensure that the actors make progress.  The sleep must
+            # be non-zero to work around gevent issue where we could be
+            # immediately rescheduled.
+            gevent.sleep(0.000001)
+
+    def _on_seq_no_programmed(self, seq_no):
+        self.on_seq_no_programmed(seq_no, async=True)
+
+    @actor_message()
+    def on_endpoint_status_changed(self, endpoint_id, ip_type, status):
+        self._endpoint_statuses[(endpoint_id, ip_type)] = status
+
+    @actor_message()
+    def on_seq_no_programmed(self, seq_no):
+        """
+        Records that all the calls from the front end up to and including
+        seq_no have been fully programmed.  Reported to the front end at
+        the end of the batch.
+        """
+        self._programmed_seq_no = seq_no
+
+    def _finish_msg_batch(self, batch, results):
+        # Send the statuses first so that they reach the front end before
+        # the calls that caused them are reported as programmed.
+        for (endpoint_id, ip_type), status in \
+                self._endpoint_statuses.iteritems():
+            write_frame(self._to_front_end,
+                        ("endpoint_status", endpoint_id, ip_type, status))
+        self._endpoint_statuses.clear()
+        if self._programmed_seq_no != self._reported_seq_no:
+            write_frame(self._to_front_end,
+                        ("programmed", self._programmed_seq_no))
+            self._reported_seq_no = self._programmed_seq_no
@@ -0,0 +1,825 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.nftables
+~~~~~~~~~~~~~~
+
+nftables dataplane backend, used instead of iptables and ipsets if
+DataplaneBackend is "nftables".
+
+Each iptables table that Felix uses ("filter", "nat" and, for IPv6,
+"raw") is replaced by an nftables table of Felix's own, for example
+"ip felix-filter".  Felix owns the whole table, including the base
+chains that hook into the kernel, so it never has to edit rules that
+belong to anyone else.
+
+The NftablesUpdater is a drop-in replacement for the IptablesUpdater.  It
+keeps the same chain and dependency contract, and the same batching, but
+translates the iptables rule fragments that the rest of Felix generates
+into nft rules and applies each batch as a single, atomic "nft -f"
+transaction.  Only the fragment forms that Felix generates are
+translated; see translate_fragment().
+
+Other differences from the iptables dataplane:
+
+* Tag and selector IP sets are nft sets in the filter table, programmed
+  by the NftSetManager.
+
+* The workload and host endpoint dispatch chains use a named verdict map
+  keyed on interface name, rather than a prefix tree of chains.  The
+  kernel looks up the endpoint's chain in a single hash lookup, and
+  adding or removing an endpoint adds or removes a single map element.
+"""
+from collections import defaultdict
+import logging
+import re
+import shlex
+
+from calico.felix import futils
+from calico.felix.actor import actor_message
+from calico.felix.dispatch import (HostEndpointDispatchChains,
+                                   WorkloadDispatchChains)
+from calico.felix.fiptables import IptablesUpdater, NothingToDo
+from calico.felix.frules import (CHAIN_FROM_PREFIX, CHAIN_TO_PREFIX,
+                                 FELIX_PREFIX, interface_to_chain_suffix)
+from calico.felix.futils import FailedSystemCall, IPV4
+from calico.felix.ipsets import (
+    IpsetManager, RefCountedIpsetActor, HOSTS_IPSET_V4, MAX_NAME_LENGTH,
+    DEFAULT_IPSET_SIZE, ALL_FELIX_PREFIXES, tag_to_ipset_name
+)
+from calico.felix.masq import (MasqueradeManager, ALL_POOLS_SET_NAME,
+                               MASQ_POOLS_SET_NAME)
+from calico.felix.tracing import mark_programmed
+from calico.monotonic import monotonic_time
+
+_log = logging.getLogger(__name__)
+
+# The nft binary.  Overridden by the tests.
+NFT_CMD = "nft"
+
+NFT_FAMILY = {4: "ip", 6: "ip6"}
+TABLE_PREFIX = "felix-"
+
+# The base chains that we create in each of our tables, by iptables table
+# name: (name, type, hook, priority).  The priorities are those of the
+# equivalent iptables tables.
+BASE_CHAINS = {
+    "raw": [
+        ("PREROUTING", "filter", "prerouting", -300),
+        ("OUTPUT", "filter", "output", -300),
+    ],
+    "nat": [
+        ("PREROUTING", "nat", "prerouting", -100),
+        ("OUTPUT", "nat", "output", -100),
+        ("POSTROUTING", "nat", "postrouting", 100),
+    ],
+    "filter": [
+        ("INPUT", "filter", "input", 0),
+        ("FORWARD", "filter", "forward", 0),
+        ("OUTPUT", "filter", "output", 0),
+    ],
+}
+
+# nft names for the iptables LOG target's numeric log levels.
+_LOG_LEVELS = ["emerg", "alert", "crit", "err", "warn", "notice", "info",
+               "debug"]
+
+# Parameters of the iptables match modules that we translate.  Any other
+# module is rejected.
+_MATCH_MODULES = frozenset(["conntrack", "mark", "comment", "set", "multiport",
+                            "icmp", "icmp6", "mac", "addrtype", "rpfilter",
+                            "tcp", "udp"])
+
+_BLOCK_RE = re.compile(r'^\s*(table|chain|set|map) (?:\S+ )?"?([^\s"]+)"? \{')
+_REF_RE = re.compile(r'\b(?:jump|goto) "?([^\s,;{}"]+)')
+
+
+class UnsupportedFragment(Exception):
+    """
+    Raised if an iptables fragment uses a form that we can't translate.
+    """
+    pass
+
+
+def translate_fragment(fragment, ip_version):
+    """
+    Translates an iptables rule fragment, as passed to rewrite_chains()
+    or ensure_rule_inserted(), into an nft rule.
+
+    In addition to iptables' own options, supports "--in-interface-vmap
+    <map>" and "--out-interface-vmap <map>", which dispatch on the
+    interface name via the named verdict map.
+
+    :param str fragment: fragment, for example
+        "--append felix-INPUT --protocol tcp --dport 80 --jump ACCEPT".
+        The leading "--append" is optional.
+    :returns tuple[str,str]: the name of the chain and the nft rule.
+    :raises UnsupportedFragment: if the fragment can't be translated.
+    """
+    try:
+        tokens = shlex.split(fragment)
+    except ValueError as e:
+        raise UnsupportedFragment("Failed to parse %r: %s" % (fragment, e))
+    if tokens and tokens[0] in ("--append", "-A"):
+        tokens.pop(0)
+    if not tokens or tokens[0].startswith("-"):
+        raise UnsupportedFragment("No chain in %r" % fragment)
+    chain = tokens.pop(0)
+    ip = NFT_FAMILY[ip_version]
+
+    matches = []
+    statements = []
+    comment = None
+    target = None
+    goto = False
+    target_opts = {}
+    protocol = None
+    negated = False
+
+    def next_token():
+        if not tokens:
+            raise UnsupportedFragment("Missing value in %r" % fragment)
+        return tokens.pop(0)
+
+    while tokens:
+        opt = tokens.pop(0)
+        if opt == "!":
+            negated = True
+            continue
+        op = "!= " if negated else ""
+        negated = False
+        if opt in ("--match", "-m"):
+            module = next_token()
+            if module not in _MATCH_MODULES:
+                raise UnsupportedFragment("Unsupported match %r in %r" %
+                                          (module, fragment))
+            if module == "rpfilter":
+                # The rpfilter match has no mandatory options.
+                invert = bool(tokens) and tokens[0] == "--invert"
+                if invert:
+                    tokens.pop(0)
+                matches.append("fib saddr . iif oif %s" %
+                               ("missing" if invert else "exists"))
+        elif opt in ("--protocol", "-p"):
+            protocol = next_token()
+            nft_proto = "ipv6-icmp" if protocol == "icmpv6" else protocol
+            matches.append("meta l4proto %s%s" % (op, nft_proto))
+        elif opt in ("--source", "-s", "--destination", "-d"):
+            field = "saddr" if opt in ("--source", "-s") else "daddr"
+            matches.append("%s %s %s%s" % (ip, field, op, next_token()))
+        elif opt in ("--in-interface", "-i", "--out-interface", "-o"):
+            field = "iifname" if opt in ("--in-interface", "-i") else "oifname"
+            iface = next_token()
+            if iface.endswith("+"):
+                iface = iface[:-1] + "*"
+            matches.append('%s %s"%s"' % (field, op, iface))
+        elif opt in ("--in-interface-vmap", "--out-interface-vmap"):
+            field = "iifname" if opt == "--in-interface-vmap" else "oifname"
+            target = "vmap"
+            matches.append("%s vmap @%s" % (field, next_token()))
+        elif opt == "--ctstate":
+            matches.append("ct state %s%s" % (op, next_token().lower()))
+        elif opt == "--mark":
+            value = next_token()
+            if "/" in value:
+                value, mask = value.split("/")
+                matches.append("meta mark and %s %s %s" %
+                               (mask, "!=" if op else "==", value))
+            else:
+                matches.append("meta mark %s%s" % (op, value))
+        elif opt == "--comment":
+            comment = next_token()
+        elif opt == "--match-set":
+            set_name = next_token()
+            direction = next_token()
+            if direction not in ("src", "dst"):
+                raise UnsupportedFragment("Unsupported set match %r in %r" %
+                                          (direction, fragment))
+            field = "saddr" if direction == "src" else "daddr"
+            matches.append("%s %s %s@%s" % (ip, field, op, set_name))
+        elif opt in ("--dport", "--sport", "--destination-port",
+                     "--source-port", "--destination-ports",
+                     "--source-ports"):
+            if protocol not in ("tcp", "udp"):
+                raise UnsupportedFragment("Port match without TCP/UDP "
+                                          "protocol in %r" % fragment)
+            field = "sport" if opt.startswith("--s") else "dport"
+            ports = next_token().replace(":", "-").split(",")
+            if len(ports) == 1:
+                ports_str = ports[0]
+            else:
+                ports_str = "{ %s }" % ", ".join(ports)
+            matches.append("%s %s %s%s" % (protocol, field, op, ports_str))
+        elif opt in ("--icmp-type", "--icmpv6-type"):
+            proto = "icmp" if opt == "--icmp-type" else "icmpv6"
+            value = next_token()
+            if "/" in value:
+                if op:
+                    raise UnsupportedFragment("Negated ICMP type and code "
+                                              "in %r" % fragment)
+                icmp_type, icmp_code = value.split("/")
+                matches.append("%s type %s" % (proto, icmp_type))
+                matches.append("%s code %s" % (proto, icmp_code))
+            else:
+                matches.append("%s type %s%s" % (proto, op, value))
+        elif opt == "--mac-source":
+            matches.append("ether saddr %s%s" % (op, next_token().lower()))
+        elif opt == "--src-type":
+            addr_type = next_token().lower()
+            if tokens and tokens[0] == "--limit-iface-out":
+                tokens.pop(0)
+                lookup = "fib saddr . oif type"
+            else:
+                lookup = "fib saddr type"
+            matches.append("%s %s%s" % (lookup, op, addr_type))
+        elif opt in ("--jump", "-j", "--goto", "-g"):
+            target = next_token()
+            goto = opt in ("--goto", "-g")
+        elif opt in ("--set-mark", "--log-prefix", "--log-level",
+                     "--to-destination", "--to-source"):
+            target_opts[opt] = next_token()
+        else:
+            raise UnsupportedFragment("Unsupported option %r in %r" %
+                                      (opt, fragment))
+
+    if target is None or target == "vmap":
+        # No verdict, or the verdict comes from the map.
+        pass
+    elif goto:
+        statements.append("goto %s" % target)
+    elif target in ("ACCEPT", "DROP", "RETURN"):
+        statements.append(target.lower())
+    elif target == "MARK":
+        value = target_opts.get("--set-mark")
+        if value is None:
+            raise UnsupportedFragment("MARK without --set-mark in %r" %
+                                      fragment)
+        if "/" in value:
+            value, mask = value.split("/")
+            if int(value, 0) & ~int(mask, 0):
+                raise UnsupportedFragment("Mark value outside mask in %r" %
+                                          fragment)
+            statements.append("meta mark set meta mark and 0x%08x or %s" %
+                              (~int(mask, 0) & 0xffffffff, value))
+        else:
+            statements.append("meta mark set %s" % value)
+    elif target == "LOG":
+        log = "log"
+        if "--log-prefix" in target_opts:
+            log += ' prefix "%s"' % target_opts["--log-prefix"]
+        if "--log-level" in target_opts:
+            log += " level %s" % _LOG_LEVELS[int(target_opts["--log-level"])]
+        statements.append(log)
+    elif target == "DNAT":
+        statements.append("dnat to %s" % target_opts["--to-destination"])
+    elif target == "SNAT":
+        statements.append("snat to %s" % target_opts["--to-source"])
+    elif target == "MASQUERADE":
+        statements.append("masquerade")
+    elif target.startswith("-") or target.isupper():
+        raise UnsupportedFragment("Unsupported target %r in %r" %
+                                  (target, fragment))
+    else:
+        statements.append("jump %s" % target)
+
+    if comment is not None:
+        statements.append('comment "%s"' % comment.replace('"', "'"))
+    return chain, " ".join(matches + statements)
+
+
+class NftablesUpdater(IptablesUpdater):
+    """
+    Actor that owns one of Felix's nftables tables.  Has the same API as
+    the IptablesUpdater, which it reuses for batching and dependency
+    tracking, and adds rewrite_dispatch_chains() for the verdict maps
+    used by the dispatch chains.
+
+    Each batch is applied with one "nft -f" transaction, which nft
+    applies atomically.  As for iptables, chains that are no longer
+    needed are deleted, on a best-effort basis, in a second transaction.
+
+    Since Felix owns the base chains, ensure_rule_inserted() and
+    ensure_rule_removed() rewrite the base chain in question from the
+    rules that we've been asked to insert.  There are no other rules to
+    move above, so a rule that is already present keeps its position.
+    """
+
+    def __init__(self, table, config, ip_version=4, warm_restart=None):
+        self.nft_family = NFT_FAMILY[ip_version]
+        self.nft_table = TABLE_PREFIX + table
+        self._base_chains = BASE_CHAINS[table]
+        # Rules that we've been asked to insert, by base chain, most
+        # recently inserted first.
+        self._base_chain_fragments = defaultdict(list)
+        # Contents of the verdict maps that we've programmed: map name to
+        # dict from interface name to verdict.
+        self._map_contents = {}
+        # Per-batch updates to the verdict maps.
+        self._pending_maps = {}
+        super(NftablesUpdater, self).__init__(table, config,
+                                              ip_version=ip_version,
+                                              warm_restart=warm_restart)
+        self._restore_cmd = NFT_CMD
+
+    @property
+    def _table_spec(self):
+        return "%s %s" % (self.nft_family, self.nft_table)
+
+    def _reset_batched_work(self):
+        super(NftablesUpdater, self)._reset_batched_work()
+        self._pending_maps = {}
+
+    @actor_message(needs_own_batch=True)
+    def _load_chain_names_from_iptables(self):
+        """
+        Creates our table, if needed, and loads the set of (our) chains
+        that already exist in it.
+
+        Populates self._chains_in_dataplane.
+        """
+        _log.debug("Loading chain names for nftables table %s",
+                   self._table_spec)
+        self._stats.increment("Refreshed chain list")
+        self._execute_iptables(self._table_setup_lines())
+        chains, _, _ = _parse_nft_listing(self._list_table())
+        self._chains_in_dataplane = set(c for c in chains
+                                        if c.startswith(FELIX_PREFIX))
+
+    def _get_unreferenced_chains(self):
+        chains, _, refs = _parse_nft_listing(self._list_table())
+        return set(c for c in chains
+                   if c.startswith(FELIX_PREFIX) and not refs.get(c))
+
+    def _list_table(self):
+        return futils.check_call([NFT_CMD, "list", "table", self.nft_family,
+                                  self.nft_table]).stdout
+
+    @actor_message()
+    def rewrite_dispatch_chains(self, update_calls_by_chain, dependent_chains,
+                                verdicts_by_map, callback=None):
+        """
+        Like rewrite_chains(), but also replaces the contents of the given
+        verdict maps in the same transaction.  Only the map elements that
+        have changed are written.
+
+        :param verdicts_by_map: map from map name to a dict from interface
+               name to verdict, e.g. {"felix-TO-ENDPOINT":
+               {"tap1234": "goto felix-to-1234"}}.  The chains that the
+               verdicts refer to should be included in dependent_chains.
+        """
+        for map_name, verdicts in verdicts_by_map.iteritems():
+            self._pending_maps[map_name] = dict(verdicts)
+        self.rewrite_chains(update_calls_by_chain, dependent_chains,
+                            callback=callback)
+
+    def _update_indexes(self):
+        super(NftablesUpdater, self)._update_indexes()
+        self._map_contents.update(self._pending_maps)
+
+    def _calculate_ipt_modify_input(self):
+        try:
+            ipt_lines = super(NftablesUpdater,
+                              self)._calculate_ipt_modify_input()
+        except NothingToDo:
+            ipt_lines = []
+        map_decls, map_elements = self._calculate_map_input()
+        if not ipt_lines and not map_elements:
+            raise NothingToDo()
+        # The maps must exist before the rules that use them and the
+        # chains must exist before the map elements that refer to them.
+        return (self._table_setup_lines() + map_decls +
+                self._translate_transcript(ipt_lines) + map_elements)
+
+    def _calculate_ipt_delete_input(self, chains):
+        ipt_lines = super(NftablesUpdater,
+                          self)._calculate_ipt_delete_input(chains)
+        return self._translate_transcript(ipt_lines)
+
+    def _calculate_ipt_stub_input(self, chains):
+        ipt_lines = super(NftablesUpdater,
+                          self)._calculate_ipt_stub_input(chains)
+        return self._translate_transcript(ipt_lines)
+
+    def _calculate_map_input(self):
+        """
+        :returns tuple[list,list]: nft lines that declare the maps that
+            are updated in this batch, and the lines that update their
+            elements.
+        """
+        maps = dict(self._pending_maps)
+        if self._txn.refresh:
+            for map_name, verdicts in self._map_contents.iteritems():
+                maps.setdefault(map_name, verdicts)
+        decls = []
+        elements = []
+        for map_name, verdicts in sorted(maps.iteritems()):
+            decls.append("add map %s %s { type ifname : verdict ; }" %
+                         (self._table_spec, map_name))
+            old_verdicts = self._map_contents.get(map_name)
+            if old_verdicts is None or self._txn.refresh:
+                # First write, or resync: the map may hold left-over
+                # elements.
+                elements.append("flush map %s %s" %
+                                (self._table_spec, map_name))
+                old_verdicts = {}
+            removed = sorted(i for i, v in old_verdicts.iteritems()
+                             if verdicts.get(i) != v)
+            added = sorted(i for i, v in verdicts.iteritems()
+                           if old_verdicts.get(i) != v)
+            if removed:
+                elements.append("delete element %s %s { %s }" % (
+                    self._table_spec, map_name,
+                    ", ".join('"%s"' % i for i in removed)
+                ))
+            if added:
+                elements.append("add element %s %s { %s }" % (
+                    self._table_spec, map_name,
+                    ", ".join('"%s" : %s' % (i, verdicts[i]) for i in added)
+                ))
+        return decls, elements
+
+    def _table_setup_lines(self):
+        """
+        :returns: nft lines that create our table and its base chains if
+            they don't exist.
+        """
+        lines = ["add table %s" % self._table_spec]
+        for name, chain_type, hook, priority in self._base_chains:
+            lines.append("add chain %s %s { type %s hook %s priority %s ; "
+                         "policy accept ; }" %
+                         (self._table_spec, name, chain_type, hook, priority))
+        return lines
+
+    def _translate_transcript(self, input_lines):
+        """
+        Translates an iptables-restore transcript, as generated by the
+        IptablesUpdater, into nft lines.
+        """
+        nft_lines = []
+        for line in input_lines:
+            if line.startswith("*") or line == "COMMIT":
+                continue
+            elif line.startswith(":"):
+                # iptables-restore creates the chain, or flushes it if it
+                # already exists.
+                chain = line[1:].split()[0]
+                nft_lines.append("add chain %s %s" % (self._table_spec,
+                                                      chain))
+                nft_lines.append("flush chain %s %s" % (self._table_spec,
+                                                        chain))
+            elif line.startswith("--flush "):
+                nft_lines.append("flush chain %s %s" % (self._table_spec,
+                                                        line.split()[1]))
+            elif line.startswith("--delete-chain "):
+                nft_lines.append("delete chain %s %s" % (self._table_spec,
+                                                         line.split()[1]))
+            else:
+                nft_lines.extend(self._rule_lines(line))
+        return nft_lines
+
+    def _rule_lines(self, fragment):
+        """
+        :returns: nft lines that add the rule for the given fragment to the
+            end of its chain.  If the fragment can't be translated, the
+            rule is replaced with a drop rule.
+        """
+        try:
+            chain, rule = translate_fragment(fragment, self.ip_version)
+        except UnsupportedFragment:
+            # Defensive: isolate the failure to this rule, in the same way
+            # that the iptables generator does for rules that it fails to
+            # parse.
+            _log.exception("Failed to translate fragment %r", fragment)
+            self._stats.increment("Untranslatable fragments")
+            chain = fragment.split()[1]
+            return [
+                "add rule %s %s %s" % ((self._table_spec,) +
+                                       translate_fragment(f, self.ip_version))
+                for f in self.iptables_generator.drop_rules(
+                    self.ip_version, chain, None, "ERROR failed to translate "
+                                                  "rule")
+            ]
+        return ["add rule %s %s %s" % (self._table_spec, chain, rule)]
+
+    def _base_chain_lines(self, chain):
+        lines = ["flush chain %s %s" % (self._table_spec, chain)]
+        for fragment in self._base_chain_fragments[chain]:
+            lines.extend(self._rule_lines(fragment))
+        return lines
+
+    def _insert_rule(self, rule_fragment, log_level=logging.INFO):
+        chain = rule_fragment.split()[0]
+        assert chain in [c[0] for c in self._base_chains], \
+            "Can only insert rules into base chains, not %s" % chain
+        fragments = self._base_chain_fragments[chain]
+        if rule_fragment not in fragments:
+            _log.log(log_level, "Inserting rule %r", rule_fragment)
+            fragments.insert(0, rule_fragment)
+        self._execute_iptables(self._table_setup_lines() +
+                               self._base_chain_lines(chain))
+
+    def _remove_rule(self, rule_fragment, log_level=logging.INFO):
+        chain = rule_fragment.split()[0]
+        fragments = self._base_chain_fragments[chain]
+        _log.log(log_level, "Ensuring rule is not present %r", rule_fragment)
+        if rule_fragment in fragments:
+            fragments.remove(rule_fragment)
+        self._execute_iptables(self._table_setup_lines() +
+                               self._base_chain_lines(chain))
+
+    def _execute_iptables(self, input_lines, fail_log_level=logging.ERROR):
+        """
+        Runs the given nft lines as a single nft transaction.  nft applies
+        the whole transaction or none of it, so there is nothing to retry.
+
+        :raises FailedSystemCall: if nft rejects the transaction.
+        """
+        input_str = "\n".join(input_lines) + "\n"
+        _log.debug("nft input:\n%s", input_str)
+        self._restore_lines.observe(len(input_lines))
+        self._restore_bytes.observe(len(input_str))
+        start = monotonic_time()
+        try:
+            futils.check_call([NFT_CMD, "-f", "/dev/stdin"],
+                              input_str=input_str)
+        except FailedSystemCall as e:
+            _log.log(fail_log_level,
+                     "nft failed.\nOutput:\n%s\nError:\n%s\n"
+                     "Input was:\n%s", e.stdout, e.stderr, input_str)
+            self._stats.increment("nft failure")
+            self._count_attempt("failure")
+            raise
+        else:
+            self._stats.increment("nft success")
+            self._count_attempt("success")
+            mark_programmed()
+        finally:
+            self._restore_time.observe(monotonic_time() - start)
+
+
+class NftSet(object):
+    """
+    (Synchronous) wrapper around a set in one of our nftables tables.
+
+    Stands in for an ipsets.Ipset, so it can be programmed by the
+    IpsetActor.  Every update is a single nft transaction so, unlike an
+    ipset, the set can be rewritten atomically without a temporary set.
+    """
+    def __init__(self, set_name, ip_type, table="filter",
+                 ipset_type="hash:ip", max_elem=DEFAULT_IPSET_SIZE):
+        self.set_name = set_name
+        self.temp_set_name = set_name
+        self.ip_version = 4 if ip_type == IPV4 else 6
+        self.table_spec = "%s %s%s" % (NFT_FAMILY[self.ip_version],
+                                       TABLE_PREFIX, table)
+        # hash:net ipsets hold CIDRs, which need an interval set.
+        self.interval = ipset_type == "hash:net"
+        self.max_elem = max_elem
+
+    def exists(self, temp_set=False):
+        try:
+            futils.check_call([NFT_CMD, "list", "set"] +
+                              self.table_spec.split() + [self.set_name])
+        except FailedSystemCall:
+            return False
+        else:
+            return True
+
+    def ensure_exists(self):
+        """
+        Creates the set iff it does not exist.
+        """
+        self._execute(self._create_lines())
+
+    def apply_changes(self, added_entries, removed_entries):
+        """
+        Update the set with changes to members.  The set must exist.
+
+        :raises FailedSystemCall if the update fails.
+        """
+        lines = []
+        if removed_entries:
+            lines.append("delete element %s %s { %s }" %
+                         (self.table_spec, self.set_name,
+                          ", ".join(removed_entries)))
+        if added_entries:
+            lines.append("add element %s %s { %s }" %
+                         (self.table_spec, self.set_name,
+                          ", ".join(added_entries)))
+        _log.info("Making %d changes to nft set %s",
+                  len(added_entries) + len(removed_entries), self.set_name)
+        if lines:
+            self._execute(lines)
+
+    def replace_members(self, members):
+        """
+        Atomically rewrites the set with the new members.
+
+        Creates the set if it does not exist.
+        """
+        _log.info("Rewriting nft set %s with %d members", self.set_name,
+                  len(members))
+        assert isinstance(members, (set, frozenset))
+        assert len(members) <= self.max_elem
+        lines = self._create_lines()
+        lines.append("flush set %s %s" % (self.table_spec, self.set_name))
+        if members:
+            lines.append("add element %s %s { %s }" %
+                         (self.table_spec, self.set_name,
+                          ", ".join(sorted(members))))
+        self._execute(lines)
+
+    def delete(self):
+        """
+        Deletes the set.  This is done on a best-effort basis.
+        """
+        _log.debug("Delete nft set %s if it exists", self.set_name)
+        futils.call_silent([NFT_CMD, "delete", "set"] +
+                           self.table_spec.split() + [self.set_name])
+
+    def _create_lines(self):
+        addr_type = "ipv4_addr" if self.ip_version == 4 else "ipv6_addr"
+        flags = "flags interval ; " if self.interval else ""
+        return [
+            "add table %s" % self.table_spec,
+            "add set %s %s { type %s ; %ssize %s ; }" %
+            (self.table_spec, self.set_name, addr_type, flags, self.max_elem),
+        ]
+
+    def _execute(self, lines):
+        futils.check_call([NFT_CMD, "-f", "/dev/stdin"],
+                          input_str="\n".join(lines) + "\n")
+        mark_programmed()
+
+    def __str__(self):
+        return self.__class__.__name__ + "<%s>" % self.set_name
+
+
+# nft equivalent of ipsets.HOSTS_IPSET_V4.
+HOSTS_SET_V4 = NftSet(HOSTS_IPSET_V4.set_name, IPV4)
+
+
+class NftSetManager(IpsetManager):
+    """
+    IpsetManager that programs each tag or selector IP set as a set in our
+    filter table.
+
+    Each set is programmed by its own actor, as in the "actor"
+    IpsetEngineMode.
+    """
+    def __init__(self, ip_type, config, warm_restart=None):
+        super(NftSetManager, self).__init__(ip_type, config,
+                                            warm_restart=warm_restart)
+        if self._consolidated:
+            _log.warning("IpsetEngineMode 'consolidated' is not supported "
+                         "with the nftables backend; using 'actor'.")
+            self._consolidated = False
+
+    def _create(self, ipset_id):
+        _log.info("Creating nft set for pre-calculated selector %s",
+                  ipset_id)
+        name_stem = ipset_id[:MAX_NAME_LENGTH]
+        nft_set = NftSet(tag_to_ipset_name(self.ip_type, name_stem),
+                         self.ip_type,
+                         max_elem=self._config.MAX_IPSET_SIZE)
+        return RefCountedIpsetActor(name_stem,
+                                    self.ip_type,
+                                    max_elem=self._config.MAX_IPSET_SIZE,
+                                    ipset=nft_set)
+
+    @actor_message()
+    def cleanup(self):
+        """
+        Clean up left-over sets that existed at start-of-day.
+        """
+        _log.info("Cleaning up left-over nft sets.")
+        table_spec = HOSTS_SET_V4.table_spec.split()[1]
+        family = "ip" if self.ip_type == IPV4 else "ip6"
+        try:
+            listing = futils.check_call([NFT_CMD, "list", "table", family,
+                                         table_spec]).stdout
+        except FailedSystemCall:
+            _log.info("Table doesn't exist, nothing to clean up.")
+            return
+        _, sets, _ = _parse_nft_listing(listing)
+        felix_sets = set(s for s in sets
+                         if any(s.startswith(p)
+                                for p in ALL_FELIX_PREFIXES[self.ip_type]))
+        sets_to_delete = felix_sets - self._whitelisted_ipset_names()
+        _log.debug("Deleting nft sets: %s", sets_to_delete)
+        for set_name in sets_to_delete:
+            try:
+                futils.check_call([NFT_CMD, "delete", "set", family,
+                                   table_spec, set_name])
+            except FailedSystemCall:
+                _log.exception("Failed to clean up dead nft set %s, will "
+                               "retry on next cleanup.", set_name)
+
+
+class NftMasqueradeManager(MasqueradeManager):
+    """
+    MasqueradeManager that keeps the IPAM pools in sets in our nat table.
+    """
+    def __init__(self, ip_type, iptables_mgr):
+        super(NftMasqueradeManager, self).__init__(ip_type, iptables_mgr)
+        self._all_pools_ipset = NftSet(ALL_POOLS_SET_NAME, ip_type,
+                                       table="nat", ipset_type="hash:net")
+        self._masq_pools_ipset = NftSet(MASQ_POOLS_SET_NAME, ip_type,
+                                        table="nat", ipset_type="hash:net")
+
+
+class _VerdictMapDispatchMixin(object):
+    """
+    Replaces the prefix tree of dispatch chains with a single rule in each
+    root chain that looks up the interface in a verdict map.  The maps are
+    named after their root chains.
+
+    Must be mixed in ahead of a _DispatchChains subclass that uses an
+    NftablesUpdater.
+    """
+    def _calculate_vmap_update(self, ifaces):
+        """
+        :returns tuple: chain updates dict, chain dependency dict, verdict
+            maps dict, as passed to rewrite_dispatch_chains().
+        """
+        updates = {}
+        deps = {}
+        verdicts_by_map = {}
+        for root, vmap_opt, prefix, direction in [
+                (self.chain_from_root, "--in-interface-vmap",
+                 CHAIN_FROM_PREFIX, "From"),
+                (self.chain_to_root, "--out-interface-vmap",
+                 CHAIN_TO_PREFIX, "To")]:
+            targets = dict(
+                (iface, prefix + interface_to_chain_suffix(self.config, iface))
+                for iface in ifaces
+            )
+            updates[root] = ["--append %s %s %s" % (root, vmap_opt, root)]
+            updates[root].extend(self.end_of_chain_rules(root, direction))
+            deps[root] = set(targets.itervalues())
+            verdicts_by_map[root] = dict((iface, "goto " + chain)
+                                         for iface, chain
+                                         in targets.iteritems())
+        return updates, deps, verdicts_by_map
+
+    def _reprogram_chains(self):
+        """
+        Rewrites the root chains and updates the verdict maps.
+
+        Synchronous, doesn't return until the maps are in place.
+        """
+        _log.info("%s Updating dispatch maps, num entries: %s", self,
+                  len(self.ifaces))
+        updates, deps, verdicts_by_map = self._calculate_vmap_update(
+            self.ifaces
+        )
+        self.iptables_updater.rewrite_dispatch_chains(updates, deps,
+                                                      verdicts_by_map,
+                                                      async=False)
+
+
+class NftWorkloadDispatchChains(_VerdictMapDispatchMixin,
+                                WorkloadDispatchChains):
+    pass
+
+
+class NftHostEndpointDispatchChains(_VerdictMapDispatchMixin,
+                                    HostEndpointDispatchChains):
+    pass
+
+
+def _parse_nft_listing(output):
+    """
+    Parses the output from "nft list table".
+
+    :returns tuple: set of chain names, set of set names and dict mapping
+        chain name to the number of rules and map elements that refer to
+        it.
+    """
+    chains = set()
+    sets = set()
+    refs = defaultdict(int)
+    for line in output.splitlines():
+        m = _BLOCK_RE.match(line)
+        if m:
+            kind, name = m.groups()
+            if kind == "chain":
+                chains.add(name)
+            elif kind == "set":
+                sets.add(name)
+            continue
+        for target in _REF_RE.findall(line):
+            refs[target] += 1
+    return chains, sets, refs
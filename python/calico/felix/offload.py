@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.offload
+~~~~~~~~~~~~~
+
+Optional pool of worker processes that generate iptables chains.
+
+Generating the chains for a big profile, or for many endpoints at once,
+is pure CPU work.  On the gevent loop it stalls every other actor until it
+is done.  If ChainGenerationProcesses is non-zero, Felix starts that many
+worker processes and the actors submit the work to them.  The submitting
+actor waits cooperatively for the result, so the other actors keep
+running.  With several workers, independent chains are generated in
+parallel.
+
+If the pool isn't running, the work is done inline, as before.
+
+Each worker loads the same config, and hence the same iptables generator
+plugin, as Felix.  Tasks and their results are sent over the workers'
+pipes in the frames from felix.multiprocess:
+
+* Felix to worker: ("config", raw_config), then ("call", task, args,
+  kwargs) for each task.
+* worker to Felix: ("result", value) or ("error", exception) for each
+  task, in order.
+"""
+import collections
+import cPickle as pickle
+import logging
+import os
+
+import gevent
+import gevent.lock
+from gevent.event import AsyncResult
+
+from calico.felix.multiprocess import (
+    read_frame, write_frame, spawn_worker, worker_cmd
+)
+
+_log = logging.getLogger(__name__)
+
+# Command-line argument that tells Felix to run as a pool worker.
+POOL_WORKER_ARG = "chain-generator"
+
+# Tasks.  The iptables generator's methods are called by name; the
+# dispatch chains are calculated by DISPATCH_UPDATE.
+GENERATOR_TASKS = frozenset(["profile_updates",
+                             "endpoint_updates",
+                             "host_endpoint_updates"])
+DISPATCH_UPDATE = "dispatch_update"
+
+# The pool, if it has been started.
+_pool = None
+
+
+class ChainGenerationPool(object):
+    """
+    Pool of worker processes that run tasks.  Each task goes to the
+    worker with the fewest tasks outstanding.
+    """
+    def __init__(self, num_workers):
+        self._workers = [_PoolWorker(n) for n in xrange(num_workers)]
+
+    def start(self, raw_config):
+        """
+        Starts the worker processes.
+
+        :returns: the greenlets that read from the workers; each returns
+            if its worker exits.
+        """
+        for worker in self._workers:
+            worker.start(raw_config)
+        return [worker.greenlet for worker in self._workers]
+
+    def submit(self, task, *args, **kwargs):
+        """
+        :returns: an AsyncResult for the result of the task.
+        """
+        worker = min(self._workers, key=lambda w: len(w.pending))
+        return worker.submit(task, args, kwargs)
+
+
+class _PoolWorker(object):
+    def __init__(self, index):
+        self.index = index
+        self._process = None
+        self._to_worker = None
+        self._from_worker = None
+        self.greenlet = None
+        # AsyncResults for the tasks that we've sent, in order.
+        self.pending = collections.deque()
+        # Stops tasks submitted by different actors from interleaving
+        # their frames.
+        self._write_lock = gevent.lock.Semaphore()
+
+    def start(self, raw_config):
+        cmd = worker_cmd(POOL_WORKER_ARG)
+        _log.info("Starting chain generation worker %s: %s", self.index, cmd)
+        self._process, self._to_worker, self._from_worker = \
+            spawn_worker(cmd)
+        write_frame(self._to_worker, ("config", raw_config))
+        self.greenlet = gevent.spawn(self._loop_reading_from_worker)
+
+    def submit(self, task, args, kwargs):
+        result = AsyncResult()
+        with self._write_lock:
+            self.pending.append(result)
+            write_frame(self._to_worker, ("call", task, args, kwargs))
+        return result
+
+    def _loop_reading_from_worker(self):
+        while True:
+            try:
+                frame = read_frame(self._from_worker)
+            except EOFError:
+                _log.critical("Chain generation worker %s closed its pipe, "
+                              "exit code %s", self.index,
+                              self._process.poll())
+                exc = RuntimeError("Chain generation worker exited")
+                while self.pending:
+                    self.pending.popleft().set_exception(exc)
+                return
+            result = self.pending.popleft()
+            if frame[0] == "result":
+                result.set(frame[1])
+            else:
+                result.set_exception(frame[1])
+
+
+def start_pool(config):
+    """
+    Starts the pool if config.CHAIN_GENERATION_PROCESSES is non-zero.
+
+    :returns: the greenlets to monitor for failure.
+    """
+    global _pool
+    if not config.CHAIN_GENERATION_PROCESSES:
+        return []
+    assert _pool is None, "Pool already started"
+    _log.info("Starting %s chain generation workers",
+              config.CHAIN_GENERATION_PROCESSES)
+    _pool = ChainGenerationPool(config.CHAIN_GENERATION_PROCESSES)
+    return _pool.start(config.raw_config)
+
+
+def pool_running():
+    return _pool is not None
+
+
+def submit(task, *args, **kwargs):
+    """
+    Submits a task to the pool, which must be running.
+
+    :returns: an AsyncResult for the result of the task.
+    """
+    return _pool.submit(task, *args, **kwargs)
+
+
+def generate_chains(generator, method_name, *args, **kwargs):
+    """
+    Calls the given method of the iptables generator, in the pool if it's
+    running.
+
+    :param generator: the iptables generator plugin.
+    :param method_name: one of GENERATOR_TASKS.
+    :returns: an AsyncResult for the result of the method.
+    """
+    if _pool is not None:
+        return _pool.submit(method_name, *args, **kwargs)
+    result = AsyncResult()
+    try:
+        result.set(getattr(generator, method_name)(*args, **kwargs))
+    except Exception as e:
+        result.set_exception(e)
+    return result
+
+
+def _dispatch_update(dispatch_chains, config, cls_name, ip_version,
+                     snapshot, added, removed):
+    """
+    Runs a DISPATCH_UPDATE task in a worker.
+
+    The worker keeps the interfaces and programmed leaf chains of each
+    dispatch chains object, so Felix only sends the interfaces that have
+    changed, or a snapshot of all of them after a resync.
+
+    :param dispatch_chains: dict of the worker's dispatch chains objects,
+        by class name and IP version.  They're never started.
+    :param snapshot: set of all the interfaces, or None to apply the
+        added and removed interfaces to the ones we already have.
+    """
+    # Imported here to avoid an import cycle; the pool is used from the
+    # dispatch module.
+    from calico.felix import dispatch
+    key = (cls_name, ip_version)
+    chains = dispatch_chains.get(key)
+    if chains is None:
+        cls = getattr(dispatch, cls_name)
+        chains = cls(config, ip_version, None)
+        dispatch_chains[key] = chains
+    if snapshot is not None:
+        chains.ifaces = set(snapshot)
+    chains.ifaces.update(added)
+    chains.ifaces.difference_update(removed)
+    result = chains._calculate_update(chains.ifaces)
+    chains.programmed_leaf_chains = result[3]
+    return result
+
+
+def worker_main():
+    """
+    Main loop of a pool worker process.  Runs tasks until Felix closes
+    its pipe.
+    """
+    # Imported here to avoid import cycles; the pool is used from the
+    # dispatch module.
+    from calico.felix.config import Config
+
+    from_felix = os.fdopen(3, "rb", -1)
+    to_felix = os.fdopen(4, "wb", -1)
+    frame = read_frame(from_felix)
+    assert frame[0] == "config", "Expected config, got %r" % (frame,)
+    config = Config()
+    config.update_from(frame[1])
+    generator = config.plugins["iptables_generator"]
+    # Dispatch chains objects, by class name and IP version, used to
+    # calculate the dispatch chains.
+    dispatch_chains = {}
+
+    while True:
+        try:
+            _, task, args, kwargs = read_frame(from_felix)
+        except EOFError:
+            _log.info("Felix closed its pipe, exiting")
+            return
+        try:
+            if task in GENERATOR_TASKS:
+                result = getattr(generator, task)(*args, **kwargs)
+            elif task == DISPATCH_UPDATE:
+                result = _dispatch_update(dispatch_chains, config, *args)
+            else:
+                raise ValueError("Unknown task %r" % task)
+        except Exception as e:
+            _log.exception("Task %s failed", task)
+            try:
+                write_frame(to_felix, ("error", e))
+            except (pickle.PicklingError, TypeError):
+                write_frame(to_felix, ("error", RuntimeError(str(e))))
+        else:
+            write_frame(to_felix, ("result", result))
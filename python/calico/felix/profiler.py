@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.profiler
+~~~~~~~~~~~~~~
+
+Greenlet-aware sampling profiler.
+
+cProfile doesn't cope with hundreds of greenlets switching in and out, so
+instead we sample: an interval timer (ITIMER_PROF, which counts the CPU
+time used by the process) raises SIGPROF and the signal handler records
+the stack of whichever greenlet was running, tagged with the name of the
+actor and the message that it was processing.  Stacks are written out in
+the "folded" format used by flamegraph.pl:
+
+    <actor>;<message>;<outermost frame>;...;<innermost frame> <count>
+
+The profiler is started and stopped by SIGUSR2, or at start of day if
+ProfilingEnabled is set.  While it is running, it rewrites its output file
+in ProfilingDir every DUMP_INTERVAL seconds, and once more when stopped.
+"""
+import collections
+import logging
+import os
+import signal
+import time
+
+import gevent
+
+from calico.felix.actor import actor_storage, TimedGreenlet
+from calico.felix.futils import logging_exceptions
+
+_log = logging.getLogger(__name__)
+
+# Interval at which the samples collected so far are written out.
+DUMP_INTERVAL = 60
+
+
+class SamplingProfiler(object):
+    def __init__(self, output_dir, sample_interval=0.01):
+        """
+        :param output_dir: Directory to write the folded stacks to.
+        :param sample_interval: Interval between samples, in seconds of CPU
+            time.
+        """
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.filename = None
+        self.running = False
+        # Maps (actor name, message name, tuple of code objects, innermost
+        # first) to number of samples.
+        self._samples = collections.defaultdict(lambda: 0)
+        self._dump_greenlet = None
+
+    def start(self):
+        if self.running:
+            return
+        self._samples.clear()
+        self.filename = os.path.join(
+            self.output_dir,
+            "felix-%s-%s.folded" % (os.getpid(),
+                                    time.strftime("%Y%m%dT%H%M%S"))
+        )
+        _log.info("Starting sampling profiler, writing to %s", self.filename)
+        signal.signal(signal.SIGPROF, self._on_sigprof)
+        # Restart any system calls that the signal interrupts rather than
+        # failing them with EINTR.
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.sample_interval,
+                         self.sample_interval)
+        self.running = True
+        self._dump_greenlet = TimedGreenlet(self._periodically_dump)
+        self._dump_greenlet.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.running = False
+        if self._dump_greenlet is not None:
+            self._dump_greenlet.kill(block=False)
+            self._dump_greenlet = None
+        self.dump()
+        _log.info("Stopped sampling profiler; profile written to %s",
+                  self.filename)
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _on_sigprof(self, signum, frame):
+        """
+        Signal handler: records a sample of the current stack.
+
+        Runs in whichever greenlet was interrupted so it must not block or
+        switch.
+        """
+        code = []
+        while frame is not None:
+            code.append(frame.f_code)
+            frame = frame.f_back
+        current = gevent.getcurrent()
+        if current is gevent.get_hub():
+            name = "**Hub**"
+            msg_name = None
+        else:
+            name = getattr(actor_storage, "name", None)
+            if name is None:
+                name = getattr(current, "time_bucket", None)
+            msg_name = getattr(actor_storage, "msg_name", None)
+        self._samples[(name, msg_name, tuple(code))] += 1
+
+    @logging_exceptions
+    def _periodically_dump(self):
+        while True:
+            gevent.sleep(DUMP_INTERVAL)
+            self.dump()
+
+    def dump(self):
+        """
+        Writes all the samples so far to the output file, replacing its
+        previous contents.
+        """
+        if self.filename is None:
+            return
+        tmp_filename = self.filename + ".tmp"
+        try:
+            with open(tmp_filename, "w") as f:
+                for line in self.folded_stacks():
+                    f.write(line + "\n")
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError):
+            _log.exception("Failed to write profile to %s", self.filename)
+
+    def folded_stacks(self):
+        """
+        :returns a list of lines of folded stacks, with their sample counts.
+        """
+        counts = collections.defaultdict(lambda: 0)
+        for (name, msg_name, code), count in self._samples.items():
+            frames = [name or "<unknown>"]
+            if msg_name is not None:
+                frames.append(msg_name)
+            frames.extend(_describe_code(c) for c in reversed(code))
+            counts[";".join(frames)] += count
+        return ["%s %s" % (stack, count)
+                for stack, count in sorted(counts.items())]
+
+
+def _describe_code(code):
+    return "%s (%s:%s)" % (code.co_name,
+                           os.path.basename(code.co_filename),
+                           code.co_firstlineno)
@@ -20,6 +20,7 @@ ProfileRules actor, handles local profile chains.
 """
 import logging
 
+from calico.felix import offload
 from calico.felix.actor import actor_message
 from calico.felix.futils import FailedSystemCall
 from calico.felix.refcount import ReferenceManager, RefCountedActor, RefHelper
@@ -37,7 +38,11 @@ class RulesManager(ReferenceManager):
     before their Actors are deleted.
     """
     def __init__(self, config, ip_version, iptables_updater, ipset_manager):
-        super(RulesManager, self).__init__(qualifier="v%d" % ip_version)
+        super(RulesManager, self).__init__(
+            qualifier="v%d" % ip_version,
+            linger_secs=config.REFERENCE_LINGER_SECS,
+            max_lingering_objects=config.REFERENCE_LINGER_MAX_OBJECTS,
+        )
         self.iptables_generator = config.plugins["iptables_generator"]
         self.ip_version = ip_version
         self.iptables_updater = iptables_updater
@@ -200,10 +205,10 @@ class ProfileRules(RefCountedActor):
                 new_tags_and_sels = extract_tags_and_selectors_from_profile(
                     self._pending_profile
                 )
-                for tag_or_sel in new_tags_and_sels:
-                    _log.debug("Requesting ipset for tag %s", tag_or_sel)
-                    # Note: acquire_ref() is a no-op if already acquired.
-                    self._ipset_refs.acquire_ref(tag_or_sel)
+                _log.debug("Requesting ipsets for tags/selectors %s",
+                           new_tags_and_sels)
+                # Note: acquire_refs() ignores refs that are already acquired.
+                self._ipset_refs.acquire_refs(new_tags_and_sels)
 
                 self._dirty = True
                 self._profile = self._pending_profile
@@ -270,13 +275,15 @@ class ProfileRules(RefCountedActor):
         _log.info("Updating chains for profile %s", self.id)
         _log.debug("Profile %s: %s", self.id, self._profile)
 
-        updates, deps = self.iptables_generator.profile_updates(
+        updates, deps = offload.generate_chains(
+            self.iptables_generator,
+            "profile_updates",
             self.id,
             self._pending_profile,
             self.ip_version,
             tag_to_ipset=tag_or_sel_to_ip_set_name,
             selector_to_ipset=tag_or_sel_to_ip_set_name,
-            comment_tag=self.id)
+            comment_tag=self.id).get()
 
         _log.debug("Queueing programming for rules %s: %s", self.id,
                    updates)
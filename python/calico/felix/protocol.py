@@ -21,11 +21,15 @@ Protocol constants for Felix <-> Driver protocol.
 import logging
 import errno
 import os
+import socket
 import struct
+import time
 from io import BytesIO
 import select
 
 from calico.felix import felixbackend_pb2
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.tracebuffer import trace_buffer, EVENT_DRIVER_MSG
 
 _log = logging.getLogger(__name__)
 
@@ -155,14 +159,28 @@ __all__ = [
     'MSG_TYPE_WL_ENDPOINT_STATUS_REMOVE',
     'MSG_TYPE_WL_EP_REMOVE',
     'MSG_TYPE_WL_EP_UPDATE',
+    'FrameCapture',
     'MessageReader',
     'MessageWriter',
     'SocketClosed',
     'WriteFailed',
+    'read_capture',
+    'unpack_ips',
 ]
 
 FLUSH_THRESHOLD = 200
 
+# Header of each frame in a capture file: the time that the frame was read
+# and its length.
+_CAPTURE_HEADER = struct.Struct("<dQ")
+
+# Address family and width in bytes of the addresses in a packed IP set
+# member list.
+_PACKED_IP_FORMATS = {
+    IPV4: (socket.AF_INET, 4),
+    IPV6: (socket.AF_INET6, 16),
+}
+
 
 class SocketClosed(Exception):
     """The socket was unexpectedly closed by the other end."""
@@ -236,6 +254,19 @@ class MessageReader(object):
         self._pipe = pipe
         self._current_msg_type = None
         self._buf = ""
+        # FrameCapture that we tee the frames to, if capture is enabled.
+        self._capture = None
+        # (time, data) of the most recent config update frame, which each
+        # capture file starts with.
+        self._config_frame = None
+
+    def start_capture(self, capture):
+        """
+        Starts teeing the frames that we read to the given FrameCapture,
+        starting with the most recent config update.
+        """
+        capture.start(self._config_frame)
+        self._capture = capture
 
     def new_messages(self):
         """
@@ -261,13 +292,22 @@ class MessageReader(object):
                        length)
             self._read(length - len(self._buf))
 
+        read_time = time.time()
         envelope = felixbackend_pb2.ToDataplane()
         envelope.ParseFromString(self._buf)
-        self._buf = ""
         _log.debug("Received message: envelope = %s", envelope)
         message_type = envelope.WhichOneof("payload")
+        if message_type == MSG_TYPE_CONFIG_UPDATE:
+            self._config_frame = (read_time, self._buf)
+        if self._capture is not None:
+            if message_type == MSG_TYPE_CONFIG_UPDATE:
+                self._capture.header_frame = self._config_frame
+            self._capture.write(read_time, self._buf)
+        self._buf = ""
         payload = getattr(envelope, message_type)
         _log.debug("Payload: %s", payload)
+        trace_buffer.record(EVENT_DRIVER_MSG, "MessageReader", message_type,
+                            envelope.sequence_number)
         yield message_type, payload, envelope.sequence_number
 
     def _read(self, num_bytes):
@@ -289,3 +329,119 @@ class MessageReader(object):
             _log.error("Socket closed by other end.")
             raise SocketClosed()
         self._buf += data
+
+
+class FrameCapture(object):
+    """
+    Writes the frames that a MessageReader reads to a capture file, along
+    with the time that each one was read, so that they can be replayed
+    later by utils/replay-driver-capture.py.
+
+    Each frame is written as a "<dQ" header (time and length) followed by
+    the serialized ToDataplane message.  When the file would exceed
+    max_bytes, it is rotated in the same way as logging's
+    RotatingFileHandler: <filename> is renamed to <filename>.1 and so on, up
+    to backup_count files.  Each file starts with the most recent config
+    update, so that it can be replayed on its own.
+
+    Capture is best-effort: if a write fails, we log and stop capturing
+    rather than bringing down Felix.
+    """
+    def __init__(self, filename, max_bytes, backup_count):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        # (time, data) of the frame that each file starts with.
+        self.header_frame = None
+        self._file = None
+        self._file_size = 0
+        self.failed = False
+
+    def start(self, header_frame):
+        _log.info("Capturing driver messages to %s", self.filename)
+        self.header_frame = header_frame
+        self._open()
+
+    def write(self, read_time, data):
+        if self.failed:
+            return
+        try:
+            if (self._file_size > 0 and
+                    self._file_size + _CAPTURE_HEADER.size + len(data) >
+                    self.max_bytes):
+                self._rotate()
+            self._write_frame(read_time, data)
+            self._file.flush()
+        except (IOError, OSError):
+            _log.exception("Failed to write to capture file %s, disabling "
+                           "capture.", self.filename)
+            self.failed = True
+
+    def _write_frame(self, read_time, data):
+        self._file.write(_CAPTURE_HEADER.pack(read_time, len(data)))
+        self._file.write(data)
+        self._file_size += _CAPTURE_HEADER.size + len(data)
+
+    def _open(self):
+        self._file = open(self.filename, "wb")
+        self._file_size = 0
+        if self.header_frame is not None:
+            self._write_frame(*self.header_frame)
+
+    def _rotate(self):
+        self._file.close()
+        if self.backup_count > 0:
+            for i in xrange(self.backup_count - 1, 0, -1):
+                src = "%s.%d" % (self.filename, i)
+                if os.path.exists(src):
+                    os.rename(src, "%s.%d" % (self.filename, i + 1))
+            os.rename(self.filename, self.filename + ".1")
+        self._open()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_capture(filename):
+    """
+    Generator: reads a file written by FrameCapture.
+
+    :returns: iterator over (time, data) tuples, where data is a serialized
+        ToDataplane message.
+    """
+    with open(filename, "rb") as f:
+        while True:
+            header = f.read(_CAPTURE_HEADER.size)
+            if not header:
+                return
+            if len(header) < _CAPTURE_HEADER.size:
+                _log.warning("Capture file %s ends with a partial frame",
+                             filename)
+                return
+            read_time, length = _CAPTURE_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                _log.warning("Capture file %s ends with a partial frame",
+                             filename)
+                return
+            yield read_time, data
+
+
+def unpack_ips(packed, ip_type):
+    """
+    Decodes a packed list of IP set members, as sent by the driver once we've
+    told it that we support that encoding.
+
+    :param str packed: Concatenated, fixed-width addresses in network order.
+    :param ip_type: IPV4 or IPV6; the type of all the addresses.
+    :returns list[str]: The addresses, formatted as strings.
+    """
+    family, width = _PACKED_IP_FORMATS[ip_type]
+    if len(packed) % width != 0:
+        raise ValueError("Packed %s members have bad length %s" %
+                         (ip_type, len(packed)))
+    inet_ntop = socket.inet_ntop
+    return [inet_ntop(family, packed[i:i + width])
+            for i in xrange(0, len(packed), width)]
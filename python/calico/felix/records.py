@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.records
+~~~~~~~~~~~~~
+
+Compact, immutable representations of the endpoint and rule data that we
+receive from the datastore driver.
+
+Records store their fields in __slots__ rather than a per-object dict but
+they implement the read-only dict interface so they can be used wherever
+the dicts that they replace were used.  Keys that weren't supplied are
+absent, just as they would be from a sparse dict.
+
+Values that tend to be repeated across many records (profile ID lists,
+tiers, rules and the strings inside them) are interned so that equal
+values share a single object.
+"""
+import collections
+import logging
+
+_log = logging.getLogger(__name__)
+
+# Maximum number of values in each intern pool before it is emptied.
+MAX_INTERN_POOL_SIZE = 2**16
+
+
+class InternPool(object):
+    """
+    Pool of interned values, keyed by a hashable key.
+
+    Tuples can't be weakly referenced so, rather than using a
+    WeakValueDictionary, the pool holds its values strongly and is simply
+    emptied when it grows too large.  Values that were already handed out
+    remain shared; only new values miss out on sharing with them.
+    """
+    def __init__(self, max_size=MAX_INTERN_POOL_SIZE):
+        self.max_size = max_size
+        self._values = {}
+
+    def get(self, key):
+        return self._values.get(key)
+
+    def add(self, key, value):
+        if len(self._values) >= self.max_size:
+            _log.info("Intern pool reached %s entries, emptying it",
+                      len(self._values))
+            self._values.clear()
+        self._values[key] = value
+        return value
+
+    def __len__(self):
+        return len(self._values)
+
+
+_tuples = InternPool()
+_records = InternPool()
+
+
+def intern_str(value):
+    """
+    :returns: an interned str for the given str or unicode object (which
+        is encoded as UTF-8).  None is passed through.
+    """
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        value = value.encode("utf8")
+    return intern(value)
+
+
+def intern_tuple(values):
+    """
+    :returns: an interned tuple containing the given (hashable) values.
+    """
+    value = tuple(values)
+    interned = _tuples.get(value)
+    if interned is None:
+        interned = _tuples.add(value, value)
+    return interned
+
+
+def intern_str_tuple(values):
+    """
+    :returns: an interned tuple of interned strs for the given iterable of
+        str or unicode objects.
+    """
+    return intern_tuple(intern_str(v) for v in values)
+
+
+def _slot_name(key):
+    return "not_" + key[1:] if key.startswith("!") else key
+
+
+def _key_name(slot):
+    return "!" + slot[4:] if slot.startswith("not_") else slot
+
+
+class _Record(object):
+    """
+    Base class for the immutable records.  Subclasses list their fields in
+    __slots__; negated rule keys, such as "!src_net", are stored in slots
+    with a "not_" prefix.
+
+    Implements the read-only dict interface itself, rather than deriving
+    from collections.Mapping, because, in Python 2, the ABCs don't declare
+    __slots__ so every instance would get a __dict__.
+    """
+    __slots__ = ()
+
+    def __init__(self, items):
+        """
+        :param items: iterable of (key, value) pairs.  Keys must be fields
+            of the record.
+        """
+        for key, value in items:
+            object.__setattr__(self, _slot_name(key), value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, _slot_name(key))
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for slot in self.__slots__:
+            if hasattr(self, slot):
+                yield _key_name(slot)
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.iteritems())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(tuple(self.iteritems()))
+
+    def replace(self, **changes):
+        """
+        :returns: a copy of this record with the given fields replaced.
+            Only usable for fields that don't need a "not_" prefix.
+        """
+        items = dict(self)
+        items.update(changes)
+        return self.__class__(items.iteritems())
+
+    def copy(self):
+        """
+        :returns: a mutable dict copy of this record.
+        """
+        return dict(self)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, dict(self))
+
+    def __reduce__(self):
+        # Records are immutable so the default pickling, which sets the
+        # slots after creating the object, doesn't work.  Re-intern them
+        # when they're unpickled instead.
+        return intern_record, (self.__class__, tuple(self.iteritems()))
+
+
+collections.Mapping.register(_Record)
+
+
+class WorkloadEndpointRecord(_Record):
+    __slots__ = ("state", "name", "mac", "profile_ids", "ipv4_nets",
+                 "ipv6_nets", "tiers")
+
+
+class HostEndpointRecord(_Record):
+    __slots__ = ("name", "profile_ids", "expected_ipv4_addrs",
+                 "expected_ipv6_addrs", "tiers")
+
+
+class TierRecord(_Record):
+    __slots__ = ("name", "policies")
+
+
+class RuleRecord(_Record):
+    __slots__ = (
+        "action", "ip_version", "log_prefix",
+        "protocol", "src_net", "src_ports", "dst_net", "dst_ports",
+        "icmp_type", "icmp_code", "src_ip_set_ids", "dst_ip_set_ids",
+        "not_protocol", "not_src_net", "not_src_ports", "not_dst_net",
+        "not_dst_ports", "not_icmp_type", "not_icmp_code",
+        "not_src_ip_set_ids", "not_dst_ip_set_ids",
+    )
+
+
+class ProfileRulesRecord(_Record):
+    __slots__ = ("inbound_rules", "outbound_rules")
+
+
+def intern_record(record_cls, items):
+    """
+    :param record_cls: record class to create.
+    :param items: iterable of (key, value) pairs; the values must be
+        hashable.
+    :returns: an interned record of the given class with the given items.
+    """
+    key = (record_cls, tuple(sorted(items)))
+    record = _records.get(key)
+    if record is None:
+        record = _records.add(key, record_cls(key[1]))
+    return record
@@ -17,10 +17,17 @@ import functools
 
 import logging
 import weakref
+
+import gevent
+
 from calico.felix.actor import Actor, actor_message
+from calico.felix.futils import StatCounter
+from calico.monotonic import monotonic_time
 
 _log = logging.getLogger(__name__)
 
+_stats = StatCounter("Reference manager counters")
+
 # States that a reference-counted actor can be in.
 
 # Initial state, created but not yet started.  May stay in this state if
@@ -48,13 +55,30 @@ class ReferenceManager(Actor):
 
     Users who obtain a reference through get_and_incref() must stop
     using the reference before calling decref().
+
+    If a linger period is configured, objects whose reference count hits
+    zero are kept alive (and kept up to date by the subclass) for that
+    long before they are cleaned up.  If they are re-referenced in the
+    meantime, they are handed straight back to the referrer without
+    having to be rebuilt.  At most max_lingering_objects objects are kept
+    in that state; beyond that, the least-recently used one is cleaned up.
     """
 
-    def __init__(self, qualifier=None):
+    def __init__(self, qualifier=None, linger_secs=0,
+                 max_lingering_objects=0):
         super(ReferenceManager, self).__init__(qualifier=qualifier)
         self.objects_by_id = {}
         self.stopping_objects_by_id = collections.defaultdict(set)
         self.pending_ref_callbacks = collections.defaultdict(set)
+        self.pending_bulk_requests = collections.defaultdict(set)
+
+        self._linger_secs = linger_secs
+        self._max_lingering_objects = max_lingering_objects
+        # OrderedDict mapping the ID of each unreferenced-but-live object to
+        # the monotonic time at which it should be cleaned up.  Since the
+        # linger period is fixed, the oldest entry is always first.
+        self._lingering_deadlines = collections.OrderedDict()
+        self._linger_timer_scheduled = False
 
     @actor_message()
     def get_and_incref(self, object_id, callback=None):
@@ -63,6 +87,36 @@ class ReferenceManager(Actor):
         :param object_id: opaque ID of the Actor to retrieve, must be hashable.
         :param callback: callback, receives the object_id and object as args.
         """
+        if callback:
+            self.pending_ref_callbacks[object_id].add(callback)
+        self._incref(object_id)
+        # Depending on state of object, may need to immediately call back.
+        self._maybe_notify_referrers(object_id)
+
+    @actor_message()
+    def update_refs(self, added_ids, removed_ids, callback=None):
+        """
+        Bulk equivalent of get_and_incref() and decref(): acquires a
+        reference to each of the objects in added_ids and returns the
+        references to the objects in removed_ids in a single message.
+
+        :param added_ids: set of IDs of the objects to acquire.
+        :param removed_ids: set of IDs of the objects to decref.
+        :param callback: callback, called once, when all the objects in
+               added_ids are live, with a dict mapping object ID to object.
+        """
+        for object_id in added_ids:
+            self._incref(object_id)
+        for object_id in removed_ids:
+            self._decref(object_id)
+        if callback and added_ids:
+            request = _BulkRefRequest(added_ids, callback)
+            for object_id in added_ids:
+                self.pending_bulk_requests[object_id].add(request)
+            for object_id in added_ids:
+                self._maybe_notify_referrers(object_id)
+
+    def _incref(self, object_id):
         _log.debug("Request for object %s", object_id)
         assert object_id is not None
 
@@ -78,17 +132,18 @@ class ReferenceManager(Actor):
             _log.info("%s object with id %s existed with ref count %d in "
                       "state %s; increffing it.", self.name, object_id,
                       obj.ref_count, obj.ref_mgmt_state)
+            if self._lingering_deadlines.pop(object_id, None) is not None:
+                _log.info("%s object with id %s revived from linger cache",
+                          self.name, object_id)
+                _stats.increment("%s linger hits" % self.name)
+                _stats.increment("%s lingering objects" % self.name, by=-1)
 
-        if callback:
-            self.pending_ref_callbacks[object_id].add(callback)
         obj.ref_count += 1
         _log.debug("Reference count for %s object %s is %d",
                    self.name, object_id, obj.ref_count)
 
-        # Depending on state of object, may need to start it or immediately
-        # call back.
+        # Depending on state of object, may need to start it.
         self._maybe_start(object_id)
-        self._maybe_notify_referrers(object_id)
 
     @actor_message()
     def on_object_startup_complete(self, object_id, obj):
@@ -122,6 +177,9 @@ class ReferenceManager(Actor):
         Return a reference and garbage-collect the backing actor if it is no
         longer referenced elsewhere.
         """
+        self._decref(object_id)
+
+    def _decref(self, object_id):
         assert object_id in self.objects_by_id
         obj = self.objects_by_id[object_id]
         obj.ref_count -= 1
@@ -130,15 +188,74 @@ class ReferenceManager(Actor):
                    self.name, object_id, obj.ref_count)
         if obj.ref_count == 0:
             _log.debug("No more references to object with id %s", object_id)
-            if obj.ref_mgmt_state == CREATED:
-                _log.debug("%s was never started, discarding", obj)
+            if (obj.ref_mgmt_state != CREATED and
+                    self._linger_secs > 0 and
+                    self._max_lingering_objects > 0):
+                self._start_lingering(object_id)
             else:
-                _log.debug("%s is running, cleaning it up", obj)
-                obj.ref_mgmt_state = STOPPING
-                obj.on_unreferenced(async=True)
-                self.stopping_objects_by_id[object_id].add(obj)
-            self.objects_by_id.pop(object_id)
-            self.pending_ref_callbacks.pop(object_id, None)
+                self._discard_object(object_id)
+
+    def _start_lingering(self, object_id):
+        """
+        Keeps the unreferenced object with the given ID alive for the linger
+        period, evicting the least-recently used lingering object if the
+        cache is full.
+        """
+        _log.debug("Object %s is running, keeping it for %ss in case it is "
+                   "referenced again", object_id, self._linger_secs)
+        self._lingering_deadlines[object_id] = (monotonic_time() +
+                                                self._linger_secs)
+        _stats.increment("%s lingering objects" % self.name)
+        while len(self._lingering_deadlines) > self._max_lingering_objects:
+            lru_id, _ = self._lingering_deadlines.popitem(last=False)
+            _log.info("Linger cache full, evicting object %s", lru_id)
+            self._evict_lingering_object(lru_id)
+        if not self._linger_timer_scheduled:
+            self._schedule_linger_timer(self._linger_secs)
+
+    def _schedule_linger_timer(self, delay):
+        self._linger_timer_scheduled = True
+        gevent.spawn_later(delay,
+                           functools.partial(self._expire_lingering_objects,
+                                             async=True))
+
+    @actor_message()
+    def _expire_lingering_objects(self):
+        """
+        Timer callback, cleans up the lingering objects whose linger period
+        has expired and reschedules itself for the next one.
+        """
+        self._linger_timer_scheduled = False
+        now = monotonic_time()
+        while self._lingering_deadlines:
+            object_id, deadline = next(self._lingering_deadlines.iteritems())
+            if deadline > now:
+                self._schedule_linger_timer(deadline - now)
+                break
+            _log.info("Linger period expired for object %s", object_id)
+            del self._lingering_deadlines[object_id]
+            self._evict_lingering_object(object_id)
+
+    def _evict_lingering_object(self, object_id):
+        _stats.increment("%s linger evictions" % self.name)
+        _stats.increment("%s lingering objects" % self.name, by=-1)
+        self._discard_object(object_id)
+
+    def _discard_object(self, object_id):
+        """
+        Stops tracking the unreferenced object with the given ID, telling
+        it to clean up if it was started.
+        """
+        obj = self.objects_by_id.pop(object_id)
+        if obj.ref_mgmt_state == CREATED:
+            _log.debug("%s was never started, discarding", obj)
+        else:
+            _log.debug("%s is running, cleaning it up", obj)
+            obj.ref_mgmt_state = STOPPING
+            obj.on_unreferenced(async=True)
+            self.stopping_objects_by_id[object_id].add(obj)
+        self.pending_ref_callbacks.pop(object_id, None)
+        self.pending_bulk_requests.pop(object_id, None)
 
     @actor_message()
     def on_object_cleanup_complete(self, object_id, obj):
@@ -199,6 +316,8 @@ class ReferenceManager(Actor):
             for cb in self.pending_ref_callbacks[object_id]:
                 cb(object_id, obj)
             self.pending_ref_callbacks.pop(object_id, None)
+            for request in self.pending_bulk_requests.pop(object_id, ()):
+                request.on_object_live(object_id, obj)
         else:
             _log.info("Cannot notify referrers for %s; object state: %s",
                       object_id, obj.ref_mgmt_state)
@@ -227,6 +346,23 @@ class ReferenceManager(Actor):
                 self.objects_by_id[obj_id].ref_mgmt_state in (STARTING, LIVE))
 
 
+class _BulkRefRequest(object):
+    """
+    Tracks an update_refs() request that is waiting for its objects to
+    become live.
+    """
+    def __init__(self, object_ids, callback):
+        self.waiting_ids = set(object_ids)
+        self.acquired = {}
+        self.callback = callback
+
+    def on_object_live(self, object_id, obj):
+        self.waiting_ids.discard(object_id)
+        self.acquired[object_id] = obj
+        if not self.waiting_ids:
+            self.callback(self.acquired)
+
+
 class RefHelper(object):
     """
     Helper class for a clients of a ReferenceManager that need to
@@ -245,7 +381,7 @@ class RefHelper(object):
         :param ready_callback: Callback to execute on the actor's greenlet
             when all the objects in the set have been acquired.  Should
             be a simple bound method, it will be called from the
-            on_ref_acquired @actor_message of this object.
+            on_refs_acquired @actor_message of this object.
         """
         self._actor = actor
         """Actor that we belong to, we'll use its queue for callbacks."""
@@ -271,25 +407,23 @@ class RefHelper(object):
         Change the set of references we require to the given set.
         """
         _log.debug("Setting required refs to %s", new_obj_ids)
-        for obj_id in new_obj_ids:
-            self.acquire_ref(obj_id)
-        for obj_id in [r for r in self.required_refs if r not in new_obj_ids]:
-            self.discard_ref(obj_id)
+        new_obj_ids = set(new_obj_ids)
+        self._update_refs(new_obj_ids - self.required_refs,
+                          self.required_refs - new_obj_ids)
 
     def acquire_ref(self, obj_id):
         """
         Add the given ID to the set of objects that we want to acquire.
         Idempotent; does nothing if the ID is already in the set.
         """
-        if obj_id not in self.required_refs:
-            # Immediately record that we require this ref.
-            self.required_refs.add(obj_id)
-            if obj_id not in self.pending_increfs:
-                # We're not already asking for the ref, request it.
-                _log.debug("Increffing object %s", obj_id)
-                cb = functools.partial(self.on_ref_acquired, async=True)
-                self.pending_increfs.add(obj_id)
-                self._ref_mgr.get_and_incref(obj_id, callback=cb, async=True)
+        self.acquire_refs([obj_id])
+
+    def acquire_refs(self, obj_ids):
+        """
+        Add the given IDs to the set of objects that we want to acquire.
+        IDs that are already in the set are ignored.
+        """
+        self._update_refs(set(obj_ids) - self.required_refs, ())
 
     def discard_ref(self, obj_id):
         """
@@ -297,7 +431,33 @@ class RefHelper(object):
         if the reference wasn't present.
         """
         if obj_id in self.required_refs:
-            _log.debug("Discarding object %s", obj_id)
+            self._update_refs((), [obj_id])
+
+    def discard_all(self):
+        """
+        Discards all references.
+        """
+        self._update_refs((), set(self.required_refs))
+
+    def _update_refs(self, added_ids, removed_ids):
+        """
+        Updates our required refs and sends a single update_refs() message
+        to the ReferenceManager covering all the resulting increfs and
+        decrefs.
+
+        :param added_ids: IDs to add; must not already be required.
+        :param removed_ids: IDs to remove; must currently be required.
+        """
+        to_incref = set()
+        to_decref = set()
+        for obj_id in added_ids:
+            # Immediately record that we require this ref.
+            self.required_refs.add(obj_id)
+            if obj_id not in self.pending_increfs:
+                # We're not already asking for the ref, request it.
+                self.pending_increfs.add(obj_id)
+                to_incref.add(obj_id)
+        for obj_id in removed_ids:
             # Immediately record that we no longer want the ref and throw it
             # away (if we've acquired it).
             self.required_refs.remove(obj_id)
@@ -306,29 +466,35 @@ class RefHelper(object):
                 # Only decref after we've actually acquired the ref.  This
                 # avoids a lot of complexity in managing multiple outstanding
                 # callbacks.
-                _log.debug("Decreffing object %s", obj_id)
-                self._ref_mgr.decref(obj_id, async=True)
-
-    def discard_all(self):
-        """
-        Discards all references.
-        """
-        for obj_id in list(self.required_refs):
-            self.discard_ref(obj_id)
+                to_decref.add(obj_id)
+        if to_incref or to_decref:
+            _log.debug("Increffing objects %s, decreffing objects %s",
+                       to_incref, to_decref)
+            cb = None
+            if to_incref:
+                cb = functools.partial(self.on_refs_acquired, async=True)
+            self._ref_mgr.update_refs(frozenset(to_incref),
+                                      frozenset(to_decref),
+                                      callback=cb, async=True)
 
     @actor_message()
-    def on_ref_acquired(self, obj_id, obj):
+    def on_refs_acquired(self, objs_by_id):
         was_ready = self.ready
-        self.pending_increfs.discard(obj_id)
-        if obj_id in self.required_refs:
-            # Still required, record it.
-            _log.debug("Reference %s acquired; still required", obj_id)
-            self.acquired_refs[obj_id] = obj
-        else:
-            # Deleted while we were waiting.
-            _log.debug("Object %s was discarded while waiting for its ref",
-                       obj_id)
-            self._ref_mgr.decref(obj_id, async=True)
+        discarded_ids = set()
+        for obj_id, obj in objs_by_id.iteritems():
+            self.pending_increfs.discard(obj_id)
+            if obj_id in self.required_refs:
+                # Still required, record it.
+                _log.debug("Reference %s acquired; still required", obj_id)
+                self.acquired_refs[obj_id] = obj
+            else:
+                # Deleted while we were waiting.
+                _log.debug("Object %s was discarded while waiting for its "
+                           "ref", obj_id)
+                discarded_ids.add(obj_id)
+        if discarded_ids:
+            self._ref_mgr.update_refs(frozenset(), frozenset(discarded_ids),
+                                      async=True)
         now_ready = self.ready
         if not was_ready and now_ready:
             _log.debug("Acquired all references, calling ready callback")
@@ -20,6 +20,7 @@ felix.splitter
 Function for fanning our updates to the IPv4 and IPv6 versions of
 the manager classes.
 """
+from collections import defaultdict
 import logging
 import os
 
@@ -27,6 +28,7 @@ import functools
 import gevent
 
 from calico.felix.actor import Actor, actor_message
+from calico.felix.tracebuffer import dump_before_exit
 
 _log = logging.getLogger(__name__)
 
@@ -55,9 +57,12 @@ class UpdateSplitter(object):
         self.selector_mgrs = self._managers_with("on_policy_selector_update")
         self.tier_data_mgrs = self._managers_with("on_tier_data_update")
         self.prof_labels_mgrs = self._managers_with("on_prof_labels_set")
-        self.ipset_added_upd_mgrs = self._managers_with("on_ipset_update")
         self.ipset_removed_upd_mgrs = self._managers_with("on_ipset_removed")
-        self.ipset_upd_mgrs = self._managers_with("on_ipset_delta_update")
+        # IP set members are routed only to the manager for their IP version.
+        self.ipset_upd_mgrs_by_type = defaultdict(list)
+        for mgr in self._managers_with("on_ipset_update"):
+            self.ipset_upd_mgrs_by_type[mgr.ip_type].append(mgr)
+        self.config_reloaded_mgrs = self._managers_with("on_config_reloaded")
 
     def _managers_with(self, method_name):
         return [m for m in self.managers if hasattr(m, method_name)]
@@ -172,23 +177,58 @@ class UpdateSplitter(object):
         for mgr in self.ipam_upd_mgrs:
             mgr.on_ipam_pool_updated(pool_id, pool, async=True)
 
-    def on_ipset_update(self, ipset_id, members):
+    def on_ipset_update(self, ipset_id, members_by_type):
+        """
+        Process a replacement of the members of an IP set.
+
+        :param members_by_type: dict mapping IPV4/IPV6 to the members of
+               that IP version.  Each manager only receives the members of
+               its own IP version; IP versions that are missing from the
+               dict are not passed on.
+        """
         _log.info("IP set update %s", ipset_id)
-        _log.debug("IP set update %s = %s", ipset_id, members)
-        for mgr in self.ipset_added_upd_mgrs:
-            mgr.on_ipset_update(ipset_id, members, async=True)
+        _log.debug("IP set update %s = %s", ipset_id, members_by_type)
+        for ip_type, mgrs in self.ipset_upd_mgrs_by_type.iteritems():
+            if ip_type not in members_by_type:
+                continue
+            members = members_by_type[ip_type]
+            for mgr in mgrs:
+                mgr.on_ipset_update(ipset_id, members, async=True)
 
     def on_ipset_removed(self, ipset_id):
         _log.info("IP set removed %s", ipset_id)
         for mgr in self.ipset_removed_upd_mgrs:
             mgr.on_ipset_removed(ipset_id, async=True)
 
-    def on_ipset_delta_update(self, ipset_id, added_ips, removed_ips):
+    def on_ipset_delta_update(self, ipset_id, added_by_type,
+                              removed_by_type):
+        """
+        Process incremental changes to the members of an IP set.
+
+        :param added_by_type: dict mapping IPV4/IPV6 to the added members.
+        :param removed_by_type: dict mapping IPV4/IPV6 to the removed
+               members.  IP versions with no changes are not passed on.
+        """
         _log.debug("IP set updates for %s: added: %s, removed: %s",
-                   ipset_id, added_ips, removed_ips)
-        for mgr in self.ipset_upd_mgrs:
-            mgr.on_ipset_delta_update(ipset_id, added_ips, removed_ips,
-                                      async=True)
+                   ipset_id, added_by_type, removed_by_type)
+        for ip_type, mgrs in self.ipset_upd_mgrs_by_type.iteritems():
+            added_ips = added_by_type.get(ip_type, ())
+            removed_ips = removed_by_type.get(ip_type, ())
+            if not added_ips and not removed_ips:
+                continue
+            for mgr in mgrs:
+                mgr.on_ipset_delta_update(ipset_id, added_ips, removed_ips,
+                                          async=True)
+
+    def on_config_reloaded(self, raw_config):
+        """
+        Called when reloadable config has changed.  Our managers share the
+        DatastoreReader's config object, which has already been updated,
+        so this only notifies those that need to react to the change.
+        """
+        _log.info("Config reloaded")
+        for mgr in self.config_reloaded_mgrs:
+            mgr.on_config_reloaded(raw_config, async=True)
 
 
 class CleanupManager(Actor):
@@ -242,5 +282,6 @@ class CleanupManager(Actor):
         except:
             _log.exception("Failed to cleanup iptables or ipsets state, "
                            "exiting")
+            dump_before_exit()
             os._exit(1)
             raise  # Keep linter happy.
@@ -17,6 +17,7 @@ import logging
 import sys
 import gc
 
+from calico.felix.actor import set_tracing_enabled
 from calico.felix.config import Config
 import gevent
 
@@ -49,6 +50,11 @@ class BaseTestCase(unittest2.TestCase):
             while actor._event_queue:
                 actor._step()
 
+    def enable_tracing(self):
+        # Tracing is a process-wide switch; turn it off again after the test.
+        set_tracing_enabled(True)
+        self.addCleanup(set_tracing_enabled, False)
+
 
 class JSONString(object):
     """
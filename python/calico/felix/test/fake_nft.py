@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.fake_nft
+~~~~~~~~~~~~~~~~~~~
+
+Fake "nft" binary, used to test the nftables backend without root or
+kernel support.
+
+Supports the subset of nft that Felix uses and validates its input
+strictly: unknown commands and rule expressions are rejected, as are
+references to missing chains, sets and maps, deletes of chains that are
+in use or of missing elements, and malformed addresses.  As with the real
+nft, a script given with "-f" is applied atomically; on any error nothing
+is changed, the error is written to stderr and the exit code is 1.
+
+The ruleset is kept as JSON in the file named by the FAKE_NFT_STATE
+environment variable.
+
+Usage::
+
+    fake_nft.py -f <file>
+    fake_nft.py list table <family> <table>
+    fake_nft.py list set <family> <table> <set>
+    fake_nft.py delete set <family> <table> <set>
+"""
+import copy
+import json
+import os
+import re
+import shlex
+import socket
+import sys
+
+FAMILIES = {"ip": socket.AF_INET, "ip6": socket.AF_INET6}
+ADDR_TYPES = {"ipv4_addr": "ip", "ipv6_addr": "ip6"}
+HOOKS = set(["prerouting", "input", "forward", "output", "postrouting"])
+CHAIN_TYPES = set(["filter", "nat"])
+CT_STATES = set(["new", "established", "related", "invalid", "untracked"])
+FIB_TYPES = set(["local", "unicast", "broadcast", "multicast"])
+LOG_LEVELS = set(["emerg", "alert", "crit", "err", "warn", "notice", "info",
+                  "debug"])
+VERDICTS = set(["accept", "drop", "return"])
+NAME_RE = re.compile(r"^[A-Za-z][A-Za-z0-9_.:-]*$")
+MAC_RE = re.compile(r"^([0-9a-f]{2}:){5}[0-9a-f]{2}$")
+
+
+class NftError(Exception):
+    pass
+
+
+def main(argv):
+    state_file = os.environ["FAKE_NFT_STATE"]
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+    else:
+        state = {}
+    try:
+        if argv[:1] == ["-f"] and len(argv) == 2:
+            if argv[1] in ("-", "/dev/stdin"):
+                script = sys.stdin.read()
+            else:
+                with open(argv[1]) as f:
+                    script = f.read()
+            new_state = apply_script(state, script)
+            with open(state_file, "w") as f:
+                json.dump(new_state, f)
+        elif argv[:2] == ["list", "table"] and len(argv) == 4:
+            sys.stdout.write(list_table(state, argv[2], argv[3]))
+        elif argv[:2] == ["list", "set"] and len(argv) == 5:
+            table = get_table(state, argv[2], argv[3])
+            sys.stdout.write(list_table(state, argv[2], argv[3],
+                                        only_set=get(table["sets"], argv[4],
+                                                     "set")))
+        elif argv[:2] == ["delete", "set"] and len(argv) == 5:
+            new_state = apply_script(state, "delete set %s\n" %
+                                     " ".join(argv[2:]))
+            with open(state_file, "w") as f:
+                json.dump(new_state, f)
+        else:
+            raise NftError("unsupported arguments %r" % (argv,))
+    except NftError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    return 0
+
+
+def get(objects, name, kind):
+    if name not in objects:
+        raise NftError("No such file or directory; %s %s does not exist" %
+                       (kind, name))
+    return objects[name]
+
+
+def get_table(state, family, name):
+    if family not in FAMILIES:
+        raise NftError("unknown family %s" % family)
+    return get(state, "%s %s" % (family, name), "table")
+
+
+def apply_script(state, script):
+    """
+    Applies the script to a copy of the state.
+
+    :returns: the new state.
+    :raises NftError: if the script is invalid.
+    """
+    state = copy.deepcopy(state)
+    for line_no, line in enumerate(script.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            apply_command(state, line)
+        except (NftError, ValueError) as e:
+            raise NftError("line %s: %s: %s" % (line_no, e, line))
+    check_references(state)
+    return state
+
+
+def apply_command(state, line):
+    words = line.split()
+    if len(words) < 3:
+        raise NftError("syntax error")
+    verb, kind, family = words[:3]
+    if verb not in ("add", "flush", "delete"):
+        raise NftError("syntax error, unexpected %s" % verb)
+    if family not in FAMILIES:
+        raise NftError("unknown family %s" % family)
+    if kind == "table":
+        if len(words) != 4:
+            raise NftError("syntax error")
+        key = "%s %s" % (family, words[3])
+        if verb == "add":
+            check_name(words[3])
+            state.setdefault(key, {"chains": {}, "sets": {}, "maps": {}})
+        elif verb == "delete":
+            get(state, key, "table")
+            del state[key]
+        else:
+            raise NftError("flush table is not supported")
+        return
+    if len(words) < 5:
+        raise NftError("syntax error")
+    table = get_table(state, family, words[3])
+    name = words[4]
+    rest = line.split(None, 5)[5] if len(words) > 5 else ""
+    if kind == "chain":
+        apply_chain_command(table, verb, name, rest)
+    elif kind == "rule":
+        if verb != "add":
+            raise NftError("only add rule is supported")
+        chain = get(table["chains"], name, "chain")
+        validate_rule(family, table, rest)
+        chain["rules"].append(rest)
+    elif kind in ("set", "map"):
+        objects = table[kind + "s"]
+        if verb == "add":
+            check_name(name)
+            spec = parse_set_spec(kind, rest)
+            if name in objects:
+                if objects[name]["spec"] != spec:
+                    raise NftError("Device or resource busy; %s %s exists "
+                                   "with a different type" % (kind, name))
+            else:
+                objects[name] = {"spec": spec,
+                                 "elements": {} if kind == "map" else []}
+        elif verb == "flush":
+            get(objects, name, kind)["elements"] = \
+                {} if kind == "map" else []
+        else:
+            get(objects, name, kind)
+            if kind == "set":
+                for chain in table["chains"].values():
+                    for rule in chain["rules"]:
+                        if "@" + name in rule.split():
+                            raise NftError("Device or resource busy; set "
+                                           "%s is in use" % name)
+            del objects[name]
+    elif kind == "element":
+        apply_element_command(family, table, verb, name, rest)
+    else:
+        raise NftError("syntax error, unexpected %s" % kind)
+
+
+def apply_chain_command(table, verb, name, rest):
+    chains = table["chains"]
+    if verb == "add":
+        check_name(name)
+        spec = None
+        if rest:
+            m = re.match(r"^\{ type (\w+) hook (\w+) priority (-?\d+) ; "
+                         r"policy (accept|drop) ; \}$", rest)
+            if not m or m.group(1) not in CHAIN_TYPES or \
+                    m.group(2) not in HOOKS:
+                raise NftError("syntax error in base chain spec")
+            spec = list(m.groups())
+        if name in chains:
+            if spec is not None and chains[name]["base"] != spec:
+                raise NftError("Operation not supported; can't change "
+                               "the type of chain %s" % name)
+        else:
+            chains[name] = {"base": spec, "rules": []}
+    elif rest:
+        raise NftError("syntax error, unexpected %s" % rest)
+    elif verb == "flush":
+        get(chains, name, "chain")["rules"] = []
+    else:
+        chain = get(chains, name, "chain")
+        if chain["rules"]:
+            raise NftError("Device or resource busy; chain %s is not empty" %
+                           name)
+        if refs_to_chain(table, name):
+            raise NftError("Device or resource busy; chain %s is in use" %
+                           name)
+        del chains[name]
+
+
+def apply_element_command(family, table, verb, name, rest):
+    if verb not in ("add", "delete"):
+        raise NftError("syntax error, unexpected %s" % verb)
+    m = re.match(r"^\{ (.*) \}$", rest)
+    if not m:
+        raise NftError("syntax error, expected { elements }")
+    items = [i.strip() for i in m.group(1).split(",")]
+    if name in table["maps"]:
+        elements = table["maps"][name]["elements"]
+        for item in items:
+            if verb == "delete":
+                key = parse_string(item)
+                get(elements, key, "element")
+                del elements[key]
+                continue
+            key, _, verdict = item.partition(" : ")
+            key = parse_string(key)
+            validate_verdict(table, verdict.split())
+            if elements.get(key, verdict) != verdict:
+                raise NftError("File exists; element %s" % key)
+            elements[key] = verdict
+        return
+    nft_set = get(table["sets"], name, "set")
+    addr_type, interval = nft_set["spec"][:2]
+    if ADDR_TYPES[addr_type] != family:
+        raise NftError("set %s is in the wrong family" % name)
+    elements = nft_set["elements"]
+    for item in items:
+        check_addr(family, item, allow_prefix=interval)
+        if verb == "add":
+            if item not in elements:
+                elements.append(item)
+        else:
+            if item not in elements:
+                raise NftError("No such file or directory; element %s" %
+                               item)
+            elements.remove(item)
+    if len(elements) > nft_set["spec"][2]:
+        raise NftError("No space left on device; set %s is full" % name)
+
+
+def parse_set_spec(kind, rest):
+    if kind == "map":
+        if rest != "{ type ifname : verdict ; }":
+            raise NftError("unsupported map type")
+        return ["ifname", "verdict"]
+    m = re.match(r"^\{ type (\w+) ; (flags interval ; )?size (\d+) ; \}$",
+                 rest)
+    if not m or m.group(1) not in ADDR_TYPES:
+        raise NftError("syntax error in set spec")
+    return [m.group(1), bool(m.group(2)), int(m.group(3))]
+
+
+def parse_string(token):
+    if len(token) < 2 or token[0] != '"' or token[-1] != '"':
+        raise NftError("expected quoted string, got %s" % token)
+    return token[1:-1]
+
+
+def check_name(name):
+    if not NAME_RE.match(name):
+        raise NftError("invalid name %s" % name)
+
+
+def check_addr(family, value, allow_prefix=True):
+    addr, slash, prefix = value.partition("/")
+    try:
+        socket.inet_pton(FAMILIES[family], addr)
+    except (socket.error, ValueError):
+        raise NftError("Could not resolve hostname: %s" % value)
+    if slash:
+        max_len = 32 if family == "ip" else 128
+        if not allow_prefix or not prefix.isdigit() or \
+                int(prefix) > max_len:
+            raise NftError("invalid prefix %s" % value)
+
+
+def validate_rule(family, table, rule):
+    """
+    Validates a rule expression against the subset of the nft grammar
+    that Felix uses.
+    """
+    try:
+        tokens = shlex.split(rule)
+    except ValueError as e:
+        raise NftError("syntax error: %s" % e)
+    if not tokens:
+        raise NftError("empty rule")
+
+    def pop(expected=None):
+        if not tokens:
+            raise NftError("syntax error, unexpected end of rule")
+        token = tokens.pop(0)
+        if expected is not None and token not in expected:
+            raise NftError("syntax error, unexpected %s" % token)
+        return token
+
+    def pop_op():
+        if tokens and tokens[0] in ("!=", "=="):
+            return tokens.pop(0)
+
+    def pop_value_set():
+        if tokens and tokens[0] == "{":
+            tokens.pop(0)
+            values = []
+            while True:
+                token = pop()
+                if token == "}":
+                    break
+                values.extend(v for v in token.split(",") if v)
+            return values
+        return [pop()]
+
+    verdict_seen = False
+    while tokens:
+        word = pop()
+        if verdict_seen and word != "comment":
+            raise NftError("syntax error, statement after verdict: %s" % word)
+        if word == "meta":
+            key = pop(["l4proto", "mark"])
+            if key == "l4proto":
+                pop_op()
+                pop()
+            elif tokens and tokens[0] == "and":
+                pop()
+                int(pop(), 0)
+                pop(["==", "!="])
+                int(pop(), 0)
+            elif tokens and tokens[0] == "set":
+                pop()
+                pop(["meta"])
+                pop(["mark"])
+                pop(["and"])
+                int(pop(), 0)
+                pop(["or"])
+                int(pop(), 0)
+            else:
+                pop_op()
+                int(pop(), 0)
+        elif word in FAMILIES:
+            if word != family:
+                raise NftError("conflicting protocols specified: %s vs. %s" %
+                               (word, family))
+            pop(["saddr", "daddr"])
+            pop_op()
+            value = pop()
+            if value.startswith("@"):
+                nft_set = get(table["sets"], value[1:], "set")
+                if ADDR_TYPES[nft_set["spec"][0]] != family:
+                    raise NftError("datatype mismatch for set %s" % value)
+            else:
+                check_addr(family, value)
+        elif word in ("iifname", "oifname"):
+            if tokens and tokens[0] == "vmap":
+                pop()
+                value = pop()
+                if not value.startswith("@"):
+                    raise NftError("expected map reference, got %s" % value)
+                get(table["maps"], value[1:], "map")
+                verdict_seen = True
+            else:
+                pop_op()
+                pop()
+        elif word == "ct":
+            pop(["state"])
+            pop_op()
+            for state in pop().split(","):
+                if state not in CT_STATES:
+                    raise NftError("invalid ct state %s" % state)
+        elif word in ("tcp", "udp"):
+            pop(["sport", "dport"])
+            pop_op()
+            for port in pop_value_set():
+                for p in port.split("-"):
+                    if not p.isdigit() or int(p) > 65535:
+                        raise NftError("invalid port %s" % port)
+        elif word in ("icmp", "icmpv6"):
+            pop(["type", "code"])
+            pop_op()
+            pop()
+        elif word == "ether":
+            pop(["saddr"])
+            pop_op()
+            if not MAC_RE.match(pop()):
+                raise NftError("invalid MAC address")
+        elif word == "fib":
+            pop(["saddr"])
+            if tokens and tokens[0] == ".":
+                pop()
+                pop(["oif", "iif"])
+            result = pop(["type", "oif"])
+            if result == "type":
+                pop_op()
+                if pop() not in FIB_TYPES:
+                    raise NftError("invalid fib type")
+            else:
+                pop(["missing", "exists"])
+        elif word in VERDICTS:
+            verdict_seen = True
+        elif word in ("jump", "goto"):
+            pop()
+            verdict_seen = True
+        elif word == "log":
+            while tokens and tokens[0] in ("prefix", "level"):
+                option, value = pop(), pop()
+                if option == "level" and value not in LOG_LEVELS:
+                    raise NftError("invalid log level %s" % value)
+        elif word in ("dnat", "snat"):
+            pop(["to"])
+            check_addr(family, pop(), allow_prefix=False)
+            verdict_seen = True
+        elif word == "masquerade":
+            verdict_seen = True
+        elif word == "comment":
+            pop()
+            if tokens:
+                raise NftError("syntax error, comment must be last")
+        else:
+            raise NftError("syntax error, unexpected %s" % word)
+
+
+def validate_verdict(table, words):
+    if len(words) == 1 and words[0] in VERDICTS:
+        return
+    if len(words) != 2 or words[0] not in ("jump", "goto"):
+        raise NftError("invalid verdict %s" % " ".join(words))
+
+
+def chain_refs(rule):
+    words = shlex.split(rule)
+    return [words[i + 1] for i, w in enumerate(words[:-1])
+            if w in ("jump", "goto")]
+
+
+def refs_to_chain(table, name):
+    count = 0
+    for chain in table["chains"].values():
+        for rule in chain["rules"]:
+            count += chain_refs(rule).count(name)
+    for nft_map in table["maps"].values():
+        for verdict in nft_map["elements"].values():
+            count += chain_refs(verdict).count(name)
+    return count
+
+
+def check_references(state):
+    """
+    Checks that every jump or goto in every table targets a chain that
+    exists and isn't a base chain.
+    """
+    for table_name, table in state.items():
+        chains = table["chains"]
+        targets = []
+        for chain in chains.values():
+            for rule in chain["rules"]:
+                targets.extend(chain_refs(rule))
+        for nft_map in table["maps"].values():
+            for verdict in nft_map["elements"].values():
+                targets.extend(chain_refs(verdict))
+        for target in targets:
+            if target not in chains:
+                raise NftError("Could not process rule: No such file or "
+                               "directory; chain %s does not exist in "
+                               "table %s" % (target, table_name))
+            if chains[target]["base"] is not None:
+                raise NftError("Operation not supported; can't jump to "
+                               "base chain %s" % target)
+
+
+def list_table(state, family, name, only_set=None):
+    table = get_table(state, family, name)
+    lines = ["table %s %s {" % (family, name)]
+    for set_name, nft_set in sorted(table["sets"].items()):
+        if only_set is not None and nft_set is not only_set:
+            continue
+        addr_type, interval, size = nft_set["spec"]
+        lines.append("\tset %s {" % set_name)
+        lines.append("\t\ttype %s" % addr_type)
+        lines.append("\t\tsize %s" % size)
+        if interval:
+            lines.append("\t\tflags interval")
+        if nft_set["elements"]:
+            lines.append("\t\telements = { %s }" %
+                         ", ".join(nft_set["elements"]))
+        lines.append("\t}")
+    if only_set is None:
+        for map_name, nft_map in sorted(table["maps"].items()):
+            lines.append("\tmap %s {" % map_name)
+            lines.append("\t\ttype ifname : verdict")
+            if nft_map["elements"]:
+                elements = sorted(nft_map["elements"].items())
+                lines.append("\t\telements = { %s }" % ",\n\t\t\t     ".join(
+                    '"%s" : %s' % i for i in elements
+                ))
+            lines.append("\t}")
+        for chain_name, chain in sorted(table["chains"].items()):
+            lines.append("\tchain %s {" % chain_name)
+            if chain["base"] is not None:
+                lines.append("\t\ttype %s hook %s priority %s; policy %s;" %
+                             tuple(chain["base"]))
+            for rule in chain["rules"]:
+                lines.append("\t\t%s" % rule)
+            lines.append("\t}")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
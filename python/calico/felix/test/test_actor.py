@@ -27,9 +27,10 @@ import sys
 import mock
 from gevent.event import AsyncResult
 
-from calico.felix import actor
+from calico.felix import actor, tracebuffer
 from calico.felix.actor import actor_message, ResultOrExc, SplitBatchAndRetry
 from calico.felix.test.base import BaseTestCase, ExpectedException
+from calico.felix.tracing import SequenceTracker
 
 # Logger
 log = logging.getLogger(__name__)
@@ -213,7 +214,8 @@ class TestActor(BaseTestCase):
 
     def test_wrap_msg_id(self):
         with mock.patch("calico.felix.actor.next_message_id"):
-            with mock.patch("calico.felix.actor.Message", autospec=True) as m_msg:
+            with mock.patch("calico.felix.actor._message_cls",
+                            autospec=True) as m_msg:
                 actor.next_message_id = sys.maxint
                 self._actor.do_a(async=True)
                 self._actor.do_a(async=True)
@@ -221,13 +223,97 @@ class TestActor(BaseTestCase):
         self.assertEqual(
             [c for c in m_msg.mock_calls if c[0] == ""],
             [
-                mock.call("M" + hex(sys.maxint)[2:], mock.ANY, mock.ANY,
+                mock.call(sys.maxint, mock.ANY, mock.ANY,
                           mock.ANY, mock.ANY, needs_own_batch=mock.ANY),
-                mock.call("M0000000000000000", mock.ANY, mock.ANY,
+                mock.call(0, mock.ANY, mock.ANY,
                           mock.ANY, mock.ANY, needs_own_batch=mock.ANY),
             ]
         )
 
+    def test_traces_follow_messages(self):
+        """
+        Tests that a trace is inherited by the messages sent on its behalf
+        and only completes once they have all been processed.
+        """
+        self.enable_tracing()
+        tracker = SequenceTracker()
+        trace = tracker.start_trace(10, "test")
+        other = ActorForTesting()
+        actor.actor_storage.traces = (trace,)
+        try:
+            self._actor.do_forward(other, async=True)
+        finally:
+            actor.actor_storage.traces = None
+        trace.release()
+        self.assertEqual(tracker.highest_programmed, None)
+        self.run_actor_loop()
+        # Forwarded message still pending on the other actor.
+        self.assertEqual(tracker.highest_programmed, None)
+        self.assertEqual(other._event_queue[0].traces, (trace,))
+        other._step()
+        self.assertEqual(tracker.highest_programmed, 10)
+
+    def test_untraced_messages(self):
+        self._actor.do_a(async=True)
+        self.assertEqual(self._actor._event_queue[0].traces, None)
+        self.run_actor_loop()
+        self.assertEqual(self._actor.actions, ["sb", "a", "fb"])
+
+    def test_tracing_disabled(self):
+        tracker = SequenceTracker()
+        trace = tracker.start_trace(10, "test")
+        actor.actor_storage.traces = (trace,)
+        try:
+            self._actor.do_a(async=True)
+        finally:
+            actor.actor_storage.traces = None
+        msg = self._actor._event_queue[0]
+        self.assertEqual(type(msg), actor.Message)
+        self.assertEqual(msg.traces, None)
+        self.assertEqual(msg.enqueue_time, None)
+        with mock.patch.object(self._actor, "_msg_wait_hist") as m_wait:
+            self.run_actor_loop()
+        self.assertFalse(m_wait.observe.called)
+
+    def test_scheduling_metrics(self):
+        self.enable_tracing()
+        with mock.patch.object(self._actor, "_batch_size_hist") as m_size, \
+                mock.patch.object(self._actor, "_msg_wait_hist") as m_wait, \
+                mock.patch.object(self._actor,
+                                  "_finish_batch_hist") as m_finish:
+            self._actor.do_a(async=True)
+            self._actor.do_b(async=True)
+            self.run_actor_loop()
+        m_size.observe.assert_called_once_with(2)
+        self.assertEqual(len(m_wait.observe.mock_calls), 1)
+        self.assertEqual(len(m_finish.observe.mock_calls), 1)
+
+    def test_trace_buffer(self):
+        with mock.patch("calico.felix.actor.trace_buffer") as m_buf:
+            self._actor.do_a(async=True)
+            self._actor.do_b(async=True)
+            self.run_actor_loop()
+        name = self._actor.name
+        self.assertEqual(m_buf.record.mock_calls, [
+            mock.call(tracebuffer.EVENT_BATCH_START, name, None, 2),
+            mock.call(tracebuffer.EVENT_MSG_START, name, "do_a", mock.ANY),
+            mock.call(tracebuffer.EVENT_MSG_START, name, "do_b", mock.ANY),
+            mock.call(tracebuffer.EVENT_FINISH_BATCH, name, None, 2),
+            mock.call(tracebuffer.EVENT_BATCH_END, name, None, 2),
+        ])
+
+    def test_stats_collector(self):
+        class QueueDepthTestActor(ActorForTesting):
+            pass
+        queued_actor = QueueDepthTestActor()
+        queued_actor.do_a(async=True)
+        queued_actor.do_a(async=True)
+        metrics = dict((m.name, m)
+                       for m in actor.ActorStatsCollector().collect())
+        depths = dict((s[1]["actor_class"], s[2])
+                      for s in metrics["felix_actor_queue_depth"].samples)
+        self.assertEqual(depths["QueueDepthTestActor"], 2)
+
 
 class TestExceptionTracking(BaseTestCase):
 
@@ -322,6 +408,11 @@ class ActorForTesting(actor.Actor):
         assert self._current_msg.name == "do_b"
         return "b"
 
+    @actor_message()
+    def do_forward(self, other):
+        self._batch_actions.append("forward")
+        other.do_a(async=True)
+
     @actor_message()
     def do_c(self):
         return self.do_c1() + self.do_c2()  # Same-actor calls skip queue.
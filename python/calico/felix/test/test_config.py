@@ -19,13 +19,16 @@ felix.test.test_config
 Top level tests for Felix configuration.
 """
 
+import importlib
 import logging
 import re
 import mock
 import socket
 import sys
 from contextlib import nested
+from calico.felix import config as felix_config
 from calico.felix.config import Config, ConfigException
+from calico.felix.plugins.fiptgenerator import FelixIptablesGenerator
 from calico.felix.test.base import load_config
 from unittest2 import skip
 
@@ -680,6 +683,63 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(config.FAILSAFE_INBOUND_PORTS, [])
         self.assertEqual(config.FAILSAFE_OUTBOUND_PORTS, [400, 500])
 
+    def test_reload_reloadable(self):
+        cfg_dict = {"InterfacePrefix": "tap",
+                    "MaxIpsetSize": "1000",
+                    "ReportingIntervalSecs": "10"}
+        config = load_config("felix_missing.cfg", host_dict=cfg_dict)
+        self.assertEqual(config.MAX_IPSET_SIZE, 1000)
+
+        new_dict = {"InterfacePrefix": "tap",
+                    "MaxIpsetSize": "2000",
+                    "LogSeverityScreen": "DEBUG"}
+        self.assertEqual(config.reload_from(new_dict), [])
+        self.assertEqual(config.MAX_IPSET_SIZE, 2000)
+        self.assertEqual(config.LOGLEVSCR, logging.DEBUG)
+        # Removed parameter reverts to its default.
+        self.assertEqual(config.REPORTING_INTERVAL_SECS, 30)
+
+    def test_reload_restart_required(self):
+        cfg_dict = {"InterfacePrefix": "tap",
+                    "MaxIpsetSize": "1000"}
+        config = load_config("felix_missing.cfg", host_dict=cfg_dict)
+
+        new_dict = {"InterfacePrefix": "cali",
+                    "IpInIpEnabled": "true",
+                    "MaxIpsetSize": "2000"}
+        self.assertEqual(config.reload_from(new_dict),
+                         ["InterfacePrefix", "IpInIpEnabled"])
+        # The startup cleanup delay only matters before the first cleanup.
+        new_dict = {"InterfacePrefix": "tap",
+                    "StartupCleanupDelay": "5",
+                    "MaxIpsetSize": "1000"}
+        self.assertEqual(config.reload_from(new_dict),
+                         ["StartupCleanupDelay"])
+        # Nothing should be applied.
+        self.assertEqual(config.IFACE_PREFIX, ["tap"])
+        self.assertEqual(config.MAX_IPSET_SIZE, 1000)
+
+    def test_reload_invalid(self):
+        cfg_dict = {"InterfacePrefix": "tap",
+                    "MaxIpsetSize": "1000"}
+        config = load_config("felix_missing.cfg", host_dict=cfg_dict)
+        old_screen_level = config.LOGLEVSCR
+
+        new_dict = {"InterfacePrefix": "tap",
+                    "MaxIpsetSize": "foo",
+                    "LogSeverityScreen": "DEBUG"}
+        self.assertRaises(ConfigException, config.reload_from, new_dict)
+        # Nothing should be applied.
+        self.assertEqual(config.MAX_IPSET_SIZE, 1000)
+        self.assertEqual(config.parameters["MaxIpsetSize"].value, 1000)
+        self.assertEqual(config.LOGLEVSCR, old_screen_level)
+
+        # A later, valid update is applied.
+        new_dict = {"InterfacePrefix": "tap",
+                    "MaxIpsetSize": "2000"}
+        self.assertEqual(config.reload_from(new_dict), [])
+        self.assertEqual(config.MAX_IPSET_SIZE, 2000)
+
     @skip("golang rewrite")
     def test_failsafe_ports_bad(self):
         cfg_dict = {
@@ -733,3 +793,44 @@ class TestConfig(unittest.TestCase):
         config = load_config("felix_interface_prefix.cfg",
                              host_dict=cfg_dict)
         self.assertEqual(config.IFACE_PREFIX, ['foo', 'bar'])
+
+
+class TestLoadPlugin(unittest.TestCase):
+    def setUp(self):
+        super(TestLoadPlugin, self).setUp()
+        felix_config._plugin_cache.clear()
+
+    def tearDown(self):
+        felix_config._plugin_cache.clear()
+        super(TestLoadPlugin, self).tearDown()
+
+    @mock.patch("pkg_resources.iter_entry_points", autospec=True)
+    def test_builtin_plugin(self, m_iter_entry_points):
+        plugin = felix_config._load_plugin(felix_config.FELIX_IPT_GENERATOR_PLUGIN_NAME,
+                                     "default")
+        self.assertTrue(plugin is FelixIptablesGenerator)
+        self.assertFalse(m_iter_entry_points.called)
+
+    @mock.patch("importlib.import_module", wraps=importlib.import_module)
+    def test_plugin_cached(self, m_import_module):
+        for _ in xrange(2):
+            plugin = felix_config._load_plugin(
+                felix_config.FELIX_IPT_GENERATOR_PLUGIN_NAME, "default"
+            )
+            self.assertTrue(plugin is FelixIptablesGenerator)
+        self.assertEqual(m_import_module.call_count, 1)
+
+    @mock.patch("pkg_resources.iter_entry_points", autospec=True)
+    def test_registered_plugin(self, m_iter_entry_points):
+        m_entry_point = mock.Mock()
+        m_iter_entry_points.return_value = [m_entry_point]
+        plugin = felix_config._load_plugin(felix_config.FELIX_IPT_GENERATOR_PLUGIN_NAME,
+                                     "custom")
+        self.assertEqual(plugin, m_entry_point.load.return_value)
+        m_iter_entry_points.assert_called_once_with(
+            felix_config.FELIX_IPT_GENERATOR_PLUGIN_NAME, "custom"
+        )
+
+    def test_unknown_plugin(self):
+        self.assertRaises(ImportError, felix_config._load_plugin,
+                          felix_config.FELIX_IPT_GENERATOR_PLUGIN_NAME, "unknown")
@@ -20,13 +20,14 @@ from datetime import datetime
 
 import gevent
 from calico.datamodel_v1 import WloadEndpointId, TieredPolicyId, HostEndpointId
-from calico.felix.config import Config
+from calico.felix import felixbackend_pb2
+from calico.felix.config import Config, ConfigException
 from calico.felix.datastore import (DatastoreReader, DatastoreAPI,
                                     die_and_restart, DatastoreWriter, combine_statuses)
 from calico.felix.futils import IPV4, IPV6
 from calico.felix.ipsets import IpsetActor
 from calico.felix.protocol import MessageReader, MessageWriter, \
-    MSG_TYPE_CONFIG_UPDATE, MSG_TYPE_IN_SYNC, \
+    MSG_TYPE_CONFIG_UPDATE, MSG_TYPE_IN_SYNC, MSG_TYPE_IPAM_POOL_UPDATE, \
     MSG_KEY_TYPE, \
     MSG_KEY_HOST_CONFIG, MSG_KEY_GLOBAL_CONFIG, MSG_TYPE_CONFIG_RESOLVED, \
     MSG_KEY_LOG_FILE, MSG_KEY_SEV_FILE, MSG_KEY_SEV_SCREEN, MSG_KEY_SEV_SYSLOG, \
@@ -719,6 +720,291 @@ class TestEtcdWatcher(BaseTestCase):
         # self.m_periodically_usage_report()
 
 
+class TestDatastoreReaderSkipsUnchanged(BaseTestCase):
+    def setUp(self):
+        super(TestDatastoreReaderSkipsUnchanged, self).setUp()
+        self.m_config = Mock()
+        self.m_config.HOSTNAME = "hostname"
+        self.reader = DatastoreReader(self.m_config, Mock(), Mock(), Mock())
+        self.m_splitter = Mock(spec=UpdateSplitter)
+        self.reader.splitter = self.m_splitter
+
+    def wl_ep_update(self, name):
+        msg = felixbackend_pb2.WorkloadEndpointUpdate()
+        msg.id.orchestrator_id = "o1"
+        msg.id.workload_id = "w1"
+        msg.id.endpoint_id = "e1"
+        msg.endpoint.state = "active"
+        msg.endpoint.name = name
+        msg.endpoint.profile_ids.append("prof1")
+        return msg
+
+    def policy_update(self, action):
+        msg = felixbackend_pb2.ActivePolicyUpdate()
+        msg.id.tier = "tiername"
+        msg.id.name = "polname"
+        msg.policy.inbound_rules.add().action = action
+        return msg
+
+    def test_unchanged_endpoint_skipped(self):
+        self.reader.on_wl_endpoint_update(self.wl_ep_update("tap1"))
+        self.reader.on_wl_endpoint_update(self.wl_ep_update("tap1"))
+        self.assertEqual(len(self.m_splitter.on_endpoint_update.mock_calls),
+                         1)
+        self.reader.on_wl_endpoint_update(self.wl_ep_update("tap2"))
+        self.assertEqual(len(self.m_splitter.on_endpoint_update.mock_calls),
+                         2)
+
+    def test_removal_resets_digest(self):
+        msg = self.wl_ep_update("tap1")
+        self.reader.on_wl_endpoint_update(msg)
+        self.reader.on_wl_endpoint_remove(msg)
+        self.reader.on_wl_endpoint_update(msg)
+        ep_id = WloadEndpointId("hostname", "o1", "w1", "e1")
+        self.assertEqual(
+            [c[1][1] is None
+             for c in self.m_splitter.on_endpoint_update.mock_calls],
+            [False, True, False]
+        )
+        self.assertEqual(self.m_splitter.on_endpoint_update.mock_calls[-1],
+                         call(ep_id, ANY))
+
+    def test_conversion_cached(self):
+        self.reader.on_tiered_policy_update(self.policy_update("allow"))
+        self.reader.on_tiered_policy_update(self.policy_update("deny"))
+        self.reader.on_tiered_policy_update(self.policy_update("allow"))
+        calls = self.m_splitter.on_rules_update.mock_calls
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[0][1][1]["inbound_rules"],
+                         ({"action": "allow"},))
+        # Flapping back re-uses the previous conversion.
+        self.assertTrue(calls[2][1][1] is calls[0][1][1])
+
+    def test_failed_conversion_retried(self):
+        convert = Mock(side_effect=[ValueError(), {"name": "tap1"}])
+        msg = self.wl_ep_update("tap1")
+        ep_id = WloadEndpointId("hostname", "o1", "w1", "e1")
+        self.assertRaises(ValueError, self.reader._convert_if_changed,
+                          ep_id, msg.endpoint, convert)
+        self.assertEqual(
+            self.reader._convert_if_changed(ep_id, msg.endpoint, convert),
+            {"name": "tap1"}
+        )
+        self.assertEqual(len(convert.mock_calls), 2)
+
+
+class TestDieAndRestart(BaseTestCase):
+    @patch("os._exit", autospec=True)
+    @patch("gevent.sleep", autospec=True)
+    @patch("calico.felix.datastore.dump_before_exit", autospec=True)
+    def test_trace_buffer_dumped(self, m_dump, m_sleep, m_exit):
+        calls = []
+        m_dump.side_effect = lambda: calls.append("dump")
+        m_exit.side_effect = lambda rc: calls.append(("exit", rc))
+        die_and_restart()
+        self.assertEqual(calls, ["dump", ("exit", 1)])
+
+
+class TestConfigReload(BaseTestCase):
+    def setUp(self):
+        super(TestConfigReload, self).setUp()
+        self.m_config = Mock()
+        self.m_config.HOSTNAME = "hostname"
+        self.m_config.reload_from.return_value = []
+        self.reader = DatastoreReader(self.m_config, Mock(), Mock(), Mock())
+        self.m_splitter = Mock(spec=UpdateSplitter)
+        self.reader.splitter = self.m_splitter
+        self.reader.configured.set()
+        self.reader.last_host_config = {"LogSeverityFile": "INFO"}
+        self.reader.last_global_config = {"LogSeverityFile": "INFO"}
+
+    def test_reloaded_config_passed_to_splitter(self):
+        msg = felixbackend_pb2.ConfigUpdate()
+        msg.config["LogSeverityFile"] = "DEBUG"
+        self.reader._on_config_update(msg)
+        self.m_config.reload_from.assert_called_once_with(
+            {"LogSeverityFile": "DEBUG"}
+        )
+        self.m_splitter.on_config_reloaded.assert_called_once_with(
+            {"LogSeverityFile": "DEBUG"}
+        )
+        self.assertEqual(self.reader.last_host_config,
+                         {"LogSeverityFile": "DEBUG"})
+
+    def test_rejected_config_not_passed_on(self):
+        self.m_config.reload_from.side_effect = ConfigException("Bad", None)
+        msg = felixbackend_pb2.ConfigUpdate()
+        msg.config["LogSeverityFile"] = "FOO"
+        self.reader._on_config_update(msg)
+        self.assertFalse(self.m_splitter.on_config_reloaded.called)
+        self.assertEqual(self.reader.last_host_config,
+                         {"LogSeverityFile": "INFO"})
+
+
+class TestHostsIpsetDeltas(BaseTestCase):
+    def setUp(self):
+        super(TestHostsIpsetDeltas, self).setUp()
+        self.m_config = Mock()
+        self.m_config.HOSTNAME = "hostname"
+        self.m_config.IP_IN_IP_ENABLED = True
+        self.m_hosts_ipset = Mock(spec=IpsetActor)
+        self.reader = DatastoreReader(self.m_config, Mock(), Mock(),
+                                      self.m_hosts_ipset)
+        self.reader.splitter = Mock(spec=UpdateSplitter)
+        self.reader.begin_polling.set()
+
+    def host_update(self, hostname, ip):
+        msg = felixbackend_pb2.HostMetadataUpdate()
+        msg.hostname = hostname
+        msg.ipv4_addr = ip
+        self.reader.on_host_meta_update(msg)
+
+    def host_remove(self, hostname):
+        msg = felixbackend_pb2.HostMetadataRemove()
+        msg.hostname = hostname
+        self.reader.on_host_meta_remove(msg)
+
+    def in_sync(self):
+        self.reader._on_in_sync(felixbackend_pb2.InSync())
+
+    def test_snapshot_sent_once_in_sync(self):
+        self.host_update("h1", "10.0.0.1")
+        self.host_update("h2", "10.0.0.2")
+        self.host_update("h2", "10.0.0.3")
+        self.host_remove("h1")
+        self.assertEqual(self.m_hosts_ipset.mock_calls, [])
+        self.in_sync()
+        self.assertEqual(self.m_hosts_ipset.mock_calls,
+                         [call.replace_members(frozenset(["10.0.0.3"]),
+                                               async=True)])
+
+    def test_deltas_after_in_sync(self):
+        self.host_update("h1", "10.0.0.1")
+        self.in_sync()
+        self.m_hosts_ipset.reset_mock()
+        self.host_update("h2", "10.0.0.2")
+        self.host_update("h1", "10.0.0.1")  # No-op.
+        self.host_update("h1", "10.0.0.3")
+        self.host_remove("h2")
+        self.host_remove("unknown")
+        self.assertEqual(self.m_hosts_ipset.mock_calls, [
+            call.add_members(["10.0.0.2"], async=True),
+            call.add_members(["10.0.0.3"], async=True),
+            call.remove_members(["10.0.0.1"], async=True),
+            call.remove_members(["10.0.0.2"], async=True),
+        ])
+
+    def test_shared_ip(self):
+        self.in_sync()
+        self.m_hosts_ipset.reset_mock()
+        self.host_update("h1", "10.0.0.1")
+        self.host_update("h2", "10.0.0.1")
+        self.host_remove("h1")
+        self.assertEqual(self.m_hosts_ipset.mock_calls,
+                         [call.add_members(["10.0.0.1"], async=True)])
+        self.host_remove("h2")
+        self.assertEqual(self.m_hosts_ipset.mock_calls[-1],
+                         call.remove_members(["10.0.0.1"], async=True))
+
+    def test_ipip_disabled(self):
+        self.m_config.IP_IN_IP_ENABLED = False
+        self.in_sync()
+        self.m_hosts_ipset.reset_mock()
+        self.host_update("h1", "10.0.0.1")
+        self.host_remove("h1")
+        self.assertEqual(self.m_hosts_ipset.mock_calls, [])
+
+
+class TestIpsetUpdates(BaseTestCase):
+    def setUp(self):
+        super(TestIpsetUpdates, self).setUp()
+        self.m_config = Mock()
+        self.m_config.HOSTNAME = "hostname"
+        self.reader = DatastoreReader(self.m_config, Mock(), Mock(), Mock())
+        self.reader.splitter = Mock(spec=UpdateSplitter)
+        self.reader.begin_polling.set()
+
+    def ipset_update(self, members):
+        msg = felixbackend_pb2.IPSetUpdate()
+        msg.id = "s1"
+        msg.members.extend(members)
+        self.reader._on_ipset_update_msg_from_driver(msg)
+        return self.reader.splitter.on_ipset_update.call_args[0]
+
+    def test_empty_family_skipped(self):
+        self.assertEqual(self.ipset_update(["10.0.0.1"]),
+                         ("s1", {IPV4: ["10.0.0.1"]}))
+        # IPv6 now has members, IPv4 needs clearing.
+        self.assertEqual(self.ipset_update(["feed::1"]),
+                         ("s1", {IPV4: (), IPV6: ["feed::1"]}))
+        # IPv4 already clear.
+        self.assertEqual(self.ipset_update(["feed::2"]),
+                         ("s1", {IPV6: ["feed::2"]}))
+
+    def test_delta_adds_family(self):
+        self.assertEqual(self.ipset_update([]), ("s1", {}))
+        msg = felixbackend_pb2.IPSetDeltaUpdate()
+        msg.id = "s1"
+        msg.added_members.append("10.0.0.1")
+        self.reader._on_ipset_delta_msg_from_driver(msg)
+        self.assertEqual(self.ipset_update([]), ("s1", {IPV4: ()}))
+
+    def test_removed_forgets_members(self):
+        self.ipset_update(["10.0.0.1"])
+        msg = felixbackend_pb2.IPSetRemove()
+        msg.id = "s1"
+        self.reader._on_ipset_removed_msg_from_driver(msg)
+        self.assertEqual(self.ipset_update([]), ("s1", {}))
+
+
+class TestProgressReporting(BaseTestCase):
+    def setUp(self):
+        super(TestProgressReporting, self).setUp()
+        self.m_config = Mock()
+        self.m_config.HOSTNAME = "hostname"
+        self.m_status_rep = Mock(spec=DatastoreWriter)
+        self.reader = DatastoreReader(self.m_config, Mock(),
+                                      self.m_status_rep, Mock())
+        self.reader.splitter = Mock(spec=UpdateSplitter)
+        self.reader.begin_polling.set()
+        self.m_msg_writer = Mock(spec=MessageWriter)
+        self.writer = DatastoreWriter(self.m_config, self.m_msg_writer)
+
+    def test_reader_reports_progress(self):
+        self.enable_tracing()
+        msg = felixbackend_pb2.IPAMPoolUpdate()
+        msg.id = "pool1"
+        msg.pool.cidr = "10.0.0.0/16"
+        self.reader._dispatch_msg_from_driver(MSG_TYPE_IPAM_POOL_UPDATE,
+                                              msg, 5)
+        self.assertEqual(self.m_status_rep.on_seq_no_programmed.mock_calls,
+                         [call(5, async=True)])
+
+    def test_no_progress_without_tracing(self):
+        msg = felixbackend_pb2.IPAMPoolUpdate()
+        msg.id = "pool1"
+        msg.pool.cidr = "10.0.0.0/16"
+        self.reader._dispatch_msg_from_driver(MSG_TYPE_IPAM_POOL_UPDATE,
+                                              msg, 5)
+        self.assertTrue(self.reader.splitter.on_ipam_pool_updated.called)
+        self.assertEqual(self.m_status_rep.on_seq_no_programmed.mock_calls,
+                         [])
+
+    def test_writer_sends_progress_once(self):
+        self.writer.on_seq_no_programmed(3, async=True)
+        self.writer.on_seq_no_programmed(4, async=True)
+        self.step_actor(self.writer)
+        envelope = felixbackend_pb2.FromDataplane()
+        envelope.dataplane_progress_update.\
+            highest_programmed_sequence_number = 4
+        self.assertEqual(self.m_msg_writer.send_message.mock_calls,
+                         [call(envelope)])
+        self.m_msg_writer.reset_mock()
+        self.writer.on_seq_no_programmed(4, async=True)
+        self.step_actor(self.writer)
+        self.assertFalse(self.m_msg_writer.send_message.called)
+
+
 @skip("golang rewrite")
 class TestEtcdReporting(BaseTestCase):
     def setUp(self):
@@ -22,7 +22,9 @@ from pprint import pformat
 
 import itertools
 import mock
+from gevent.event import AsyncResult
 
+from calico.felix import offload
 from calico.felix.test.base import BaseTestCase, load_config
 from calico.felix.dispatch import WorkloadDispatchChains, \
     HostEndpointDispatchChains
@@ -399,6 +401,52 @@ class TestWorkloadDispatchChains(BaseTestCase):
         # Confirm that we only got called twice.
         self.assertEqual(self.iptables_updater.rewrite_chains.call_count, 2)
 
+    def test_pool_sends_deltas(self):
+        """
+        Tests that, with the pool running, we send the worker the snapshot
+        and then only the interfaces that changed.
+        """
+        d = self.dispatch_chain()
+        inline = self.dispatch_chain()
+        worker_chains = {}
+
+        def submit(task, *args):
+            self.assertEqual(task, offload.DISPATCH_UPDATE)
+            result = AsyncResult()
+            result.set(offload._dispatch_update(worker_chains, self.config,
+                                                *args))
+            return result
+
+        with mock.patch("calico.felix.offload.pool_running",
+                        return_value=True), \
+                mock.patch("calico.felix.offload.submit",
+                           side_effect=submit) as m_submit:
+            d.apply_snapshot({'tapabcdef', 'tap123456'}, async=True)
+            self.step_actor(d)
+            m_submit.assert_called_once_with(
+                offload.DISPATCH_UPDATE, "WorkloadDispatchChains", 4,
+                {'tapabcdef', 'tap123456'}, (), ()
+            )
+            m_submit.reset_mock()
+            d.on_endpoint_added('tapb7d849', async=True)
+            d.on_endpoint_removed('tapabcdef', async=True)
+            self.step_actor(d)
+            m_submit.assert_called_once_with(
+                offload.DISPATCH_UPDATE, "WorkloadDispatchChains", 4,
+                None, {'tapb7d849'}, {'tapabcdef'}
+            )
+
+        # The worker's chains match those calculated inline.
+        self.assertEqual(
+            worker_chains[("WorkloadDispatchChains", 4)].ifaces,
+            {'tap123456', 'tapb7d849'}
+        )
+        self.assertEqual(d.programmed_leaf_chains,
+                         inline._calculate_update(d.ifaces)[3])
+        self.iptables_updater.rewrite_chains.assert_called_with(
+            inline._calculate_update(d.ifaces)[2], mock.ANY, async=True
+        )
+
 
 class TestHostDispatchChains(BaseTestCase):
     """
@@ -30,7 +30,7 @@ from calico.felix.dispatch import WorkloadDispatchChains
 from calico.felix.plugins.fiptgenerator import FelixIptablesGenerator
 
 from calico.felix.endpoint import EndpointManager, WorkloadEndpoint, \
-    HostEndpoint
+    HostEndpoint, WorkloadEndpointState
 from calico.felix.datastore import DatastoreWriter
 from calico.felix.fiptables import IptablesUpdater
 from calico.felix.futils import FailedSystemCall
@@ -526,18 +526,48 @@ class TestEndpointManager(BaseTestCase):
     def test_interface_poll_loop_disabled(self, m_sleep):
         self.mgr.config.HOST_IF_POLL_INTERVAL_SECS = -1
         with mock.patch.object(self.mgr, "_poll_interfaces",
-                               autospec=True) as m_poll:
+                               autospec=True) as m_poll, \
+                mock.patch.object(self.mgr, "_config_reloaded") as m_event:
+            m_event.wait.side_effect = iter([True, FinishLoop()])
             m_poll.side_effect = iter([{"a": [IPAddress("10.0.0.1")]},
                                        AssertionError()])
-            self.mgr._interface_poll_loop()
+            self.assertRaises(FinishLoop, self.mgr._interface_poll_loop)
             self.assertEqual(
                 m_poll.mock_calls,
                 [
                     mock.call({}),
                 ]
             )
+            # Disabled, so we wait for config reloads rather than polling.
             self.assertEqual(m_sleep.mock_calls, [])
 
+    @mock.patch("gevent.sleep", autospec=True)
+    def test_interface_poll_loop_reenabled(self, m_sleep):
+        self.mgr.config.HOST_IF_POLL_INTERVAL_SECS = 0
+
+        def wait():
+            # Simulate a config reload that enables polling.
+            self.mgr.config.HOST_IF_POLL_INTERVAL_SECS = 5
+            self.mgr.on_config_reloaded({}, async=True)
+            self.step_actor(self.mgr)
+            return True
+        with mock.patch.object(self.mgr, "_poll_interfaces",
+                               autospec=True) as m_poll, \
+                mock.patch.object(self.mgr, "_config_reloaded") as m_event:
+            m_event.wait.side_effect = wait
+            m_poll.side_effect = iter([{"a": [IPAddress("10.0.0.1")]},
+                                       FinishLoop()])
+            self.assertRaises(FinishLoop, self.mgr._interface_poll_loop)
+            self.assertEqual(
+                m_poll.mock_calls,
+                [
+                    mock.call({}),
+                    mock.call({"a": [IPAddress("10.0.0.1")]}),
+                ]
+            )
+            self.assertEqual(m_sleep.mock_calls, [mock.call(5)])
+            self.assertEqual(m_event.set.mock_calls, [mock.call()])
+
     @mock.patch("sys.exit", autospec=True)
     def test_on_worker_died(self, m_exit):
         m_glet = mock.Mock()
@@ -545,6 +575,99 @@ class TestEndpointManager(BaseTestCase):
         m_exit.assert_called_once_with(1)
 
 
+class TestBatchedEndpointManager(BaseTestCase):
+    def setUp(self):
+        super(TestBatchedEndpointManager, self).setUp()
+        self.config = load_config(
+            "felix_default.cfg",
+            global_dict={"FelixHostname": "hostname",
+                         "EndpointWorkerMode": "batched"},
+        )
+        self.m_updater = Mock(spec=IptablesUpdater)
+        self.m_wl_dispatch = Mock(spec=WorkloadDispatchChains)
+        self.m_host_dispatch = Mock(spec=HostEndpointDispatchChains)
+        self.m_rules_mgr = Mock(spec=RulesManager)
+        self.m_fip_manager = Mock(spec=FloatingIPManager)
+        self.m_status_reporter = Mock(spec=DatastoreWriter)
+        self.mgr = EndpointManager(self.config, "IPv4", self.m_updater,
+                                   self.m_wl_dispatch, self.m_host_dispatch,
+                                   self.m_rules_mgr, self.m_fip_manager,
+                                   self.m_status_reporter)
+        self.mgr.on_datamodel_in_sync(async=True)
+        self.step_actor(self.mgr)
+
+    def _endpoint_data(self, iface, ip):
+        return {
+            'state': "active",
+            'mac': stub_utils.get_mac(),
+            'name': iface,
+            'ipv4_nets': [ip],
+            'profile_ids': ["prof1"],
+        }
+
+    def test_create(self):
+        obj = self.mgr._create(ENDPOINT_ID)
+        self.assertTrue(isinstance(obj, WorkloadEndpointState))
+        # State objects shouldn't carry a per-instance dict.
+        self.assertFalse(hasattr(obj, "__dict__"))
+
+    def test_single_rewrite_per_batch(self):
+        with mock.patch("calico.felix.endpoint.devices", autospec=True):
+            self.mgr.on_endpoint_update(
+                ENDPOINT_ID, self._endpoint_data("tap1", "10.0.0.1/32"),
+                async=True)
+            self.mgr.on_endpoint_update(
+                ENDPOINT_ID_2, self._endpoint_data("tap2", "10.0.0.2/32"),
+                async=True)
+            self.step_actor(self.mgr)
+
+        # Both endpoints should be programmed by a single rewrite.
+        self.assertEqual(len(self.m_updater.rewrite_chains.mock_calls), 1)
+        for ep_id in (ENDPOINT_ID, ENDPOINT_ID_2):
+            ep = self.mgr.objects_by_id[ep_id]
+            self.assertTrue(ep._iptables_in_sync)
+            self.assertTrue(ep._chains_programmed)
+        self.assertItemsEqual(
+            self.m_wl_dispatch.on_endpoint_added.mock_calls,
+            [mock.call("tap1", async=True), mock.call("tap2", async=True)]
+        )
+        self.assertFalse(self.mgr.dirty_endpoint_states)
+
+    def test_batch_failure_retries_individually(self):
+        self.m_updater.rewrite_chains.side_effect = [
+            FailedSystemCall("", [], 1, "", ""),
+            None,
+            None,
+        ]
+        with mock.patch("calico.felix.endpoint.devices", autospec=True):
+            self.mgr.on_endpoint_update(
+                ENDPOINT_ID, self._endpoint_data("tap1", "10.0.0.1/32"),
+                async=True)
+            self.mgr.on_endpoint_update(
+                ENDPOINT_ID_2, self._endpoint_data("tap2", "10.0.0.2/32"),
+                async=True)
+            self.step_actor(self.mgr)
+        self.assertEqual(len(self.m_updater.rewrite_chains.mock_calls), 3)
+        for ep_id in (ENDPOINT_ID, ENDPOINT_ID_2):
+            self.assertTrue(self.mgr.objects_by_id[ep_id]._iptables_in_sync)
+
+    def test_delete(self):
+        with mock.patch("calico.felix.endpoint.devices", autospec=True):
+            self.mgr.on_endpoint_update(
+                ENDPOINT_ID, self._endpoint_data("tap1", "10.0.0.1/32"),
+                async=True)
+            self.step_actor(self.mgr)
+            ep = self.mgr.objects_by_id[ENDPOINT_ID]
+            self.mgr.on_endpoint_update(ENDPOINT_ID, None, async=True)
+            self.step_actor(self.mgr)
+        self.assertTrue(ep._cleaned_up)
+        self.assertFalse(ep._chains_programmed)
+        self.m_wl_dispatch.on_endpoint_removed.assert_called_once_with(
+            "tap1", async=True)
+        self.assertNotIn(ENDPOINT_ID, self.mgr.objects_by_id)
+        self.assertNotIn(ENDPOINT_ID, self.mgr.stopping_objects_by_id)
+
+
 class FinishLoop(Exception):
     pass
 
@@ -19,6 +19,7 @@ felix.test.test_felix
 Top level tests for Felix.
 """
 import logging
+import subprocess
 import gevent
 import mock
 import sys
@@ -33,6 +34,10 @@ from unittest2 import skip
 
 log = logging.getLogger(__name__)
 
+# Modules that are slow to import, which Felix only imports when it needs
+# them.  (Kept in step with utils/bench-startup.py.)
+SLOW_MODULES = ("pkg_resources", "posix_spawn", "urllib3")
+
 
 class TestException(Exception):
     pass
@@ -181,3 +186,21 @@ class TestBasic(BaseTestCase):
 
         # Cover the diags dump function.
         futils.dump_diags()
+
+
+class TestStartup(BaseTestCase):
+    def test_no_slow_imports(self):
+        """
+        Tests that importing Felix doesn't import any of the modules that
+        we only import lazily, to keep start-up fast.
+        """
+        script = (
+            "from gevent import monkey; monkey.patch_all()\n"
+            "import sys\n"
+            "before = set(sys.modules)\n"
+            "import calico.felix.felix\n"
+            "print ','.join(m for m in %r\n"
+            "               if m in sys.modules and m not in before)\n"
+        ) % (SLOW_MODULES,)
+        output = subprocess.check_output([sys.executable, "-c", script])
+        self.assertEqual(output.strip(), "")
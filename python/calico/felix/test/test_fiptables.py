@@ -464,6 +464,36 @@ class TestIptablesUpdater(BaseTestCase):
             ], fail_log_level=logging.DEBUG)
             self.assertEqual(m_exec.mock_calls, [exp_call])
 
+    @patch("random.random", autospec=True, return_value=0)
+    @patch("gevent.sleep", autospec=True)
+    def test_periodic_refresh_reenabled(self, m_sleep, m_random):
+        self.config.REFRESH_INTERVAL = 0
+        sleeps = []
+
+        def sleep(secs):
+            sleeps.append(secs)
+            if len(sleeps) == 2:
+                raise FinishLoop()
+        m_sleep.side_effect = sleep
+
+        def wait():
+            # Simulate a config reload that enables the refresh.
+            self.config.REFRESH_INTERVAL = 30
+            self.ipt.on_config_reloaded({}, async=True)
+            self.step_actor(self.ipt)
+            return True
+
+        with patch.object(self.ipt, "refresh_iptables",
+                          autospec=True) as m_refresh, \
+                patch.object(self.ipt, "_config_reloaded") as m_event:
+            m_event.wait.side_effect = wait
+            self.assertRaises(FinishLoop, self.ipt._periodic_refresh)
+        # Disabled, so we wait for the reload rather than polling.
+        self.assertEqual(m_event.wait.mock_calls, [call()])
+        self.assertEqual(m_event.set.mock_calls, [call()])
+        self.assertEqual(sleeps, [30, 30])
+        self.assertEqual(m_refresh.mock_calls, [call(async=True)])
+
     def test_refresh_iptables(self):
         self.ipt.ensure_rule_inserted("INPUT -j ACCEPT", async=True)
         self.ipt.ensure_rule_inserted("INPUT -j DROP", async=True)
@@ -561,6 +591,35 @@ class TestUtilityFunctions(BaseTestCase):
                               "iptables-restore: unknown\n")
 
 
+class TestExecuteIptables(BaseTestCase):
+    def setUp(self):
+        super(TestExecuteIptables, self).setUp()
+        self.config = load_config("felix_default.cfg",
+                                  env_dict={"FELIX_REFRESHINTERVAL": "0"})
+        self.ipt = IptablesUpdater("filter", self.config, 4)
+
+    @patch("gevent.sleep", autospec=True)
+    @patch("calico.felix.fiptables._restore_attempts", autospec=True)
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_commit_conflict_counted(self, m_check_call, m_attempts,
+                                     m_sleep):
+        m_check_call.side_effect = iter([
+            FailedSystemCall(stderr="iptables-restore: line 8 failed\n"),
+            None,
+        ])
+        self.ipt._execute_iptables(IPT_INPUT)
+        self.assertEqual(m_attempts.labels.mock_calls, [
+            call("4", "filter", "retry"),
+            call().inc(),
+            call("4", "filter", "success"),
+            call().inc(),
+        ])
+
+
+class FinishLoop(Exception):
+    pass
+
+
 class IptablesStub(object):
     """
     Fake version of the dataplane, accepts iptables-restore input and
@@ -19,6 +19,7 @@ felix.test.test_futils
 Test Felix utils.
 """
 import logging
+import subprocess
 from subprocess import CalledProcessError
 
 import mock
@@ -69,6 +70,18 @@ class TestFutils(unittest2.TestCase):
             self.assertEqual(result.stderr, "")
             self.assertTrue(m_sem.__enter__.called)
 
+    @mock.patch("calico.felix.futils._cmd_duration_histogram", autospec=True)
+    @mock.patch("calico.felix.futils._cmd_wait_histogram", autospec=True)
+    def test_check_call_timed(self, m_wait, m_duration):
+        futils.check_call(["/bin/true"])
+        m_wait.labels.assert_called_once_with("true")
+        self.assertEqual(len(m_wait.labels.return_value.observe.mock_calls),
+                         1)
+        m_duration.labels.assert_called_once_with("true")
+        self.assertEqual(
+            len(m_duration.labels.return_value.observe.mock_calls), 1
+        )
+
     def test_bad_check_call(self):
         # Test an invalid command - must parse but not return anything.
         args = ["ls", "wibble_wobble"]
@@ -94,6 +107,22 @@ class TestFutils(unittest2.TestCase):
         retcode = futils.call_silent(args)
         self.assertNotEqual(retcode, 0)
 
+    def test_spawned_process_unused_pipes(self):
+        # gevent marks the pipes that aren't in use with -1; they must be
+        # treated as "no pipe" rather than passed to posix_spawn as FDs.
+        import posix_spawn
+        with mock.patch("posix_spawn.FileActions",
+                        wraps=posix_spawn.FileActions) as m_actions:
+            proc = futils.SpawnedProcess(["echo", "hello"],
+                                         stdout=subprocess.PIPE)
+            stdout, stderr = proc.communicate()
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(stdout, "hello\n")
+        self.assertEqual(stderr, None)
+        for call in m_actions.return_value.mock_calls:
+            for fd in call[1]:
+                self.assertGreaterEqual(fd, 0)
+
     def stub_store_calls(self, args):
         log.debug("Args are : %s", args)
         self.assertEqual(args[0], "bash")
@@ -201,9 +230,9 @@ class TestFutils(unittest2.TestCase):
         m_check_call.side_effect = iter([None, futils.FailedSystemCall()])
         self.assertEqual(futils.detect_ipv6_supported(), (False, mock.ANY))
 
-    @mock.patch("calico.felix.futils.urllib3.disable_warnings", autospec=True)
-    @mock.patch("calico.felix.futils.urllib3.util.retry.Retry", autospec=True)
-    @mock.patch("calico.felix.futils.urllib3.PoolManager", autospec=True)
+    @mock.patch("urllib3.disable_warnings", autospec=True)
+    @mock.patch("urllib3.util.retry.Retry", autospec=True)
+    @mock.patch("urllib3.PoolManager", autospec=True)
     def test_report_usage_and_get_warnings(self, m_poolmanager, m_retry, m_disable):
         status = mock.Mock()
         status.status.side_effect = "200"
@@ -289,6 +318,22 @@ class TestStats(unittest2.TestCase):
             mock.call("%s: %s", "baz", 3),
         ])
 
+    def test_stat_handle(self):
+        handle = self.sc.stat("bar")
+        self.assertTrue(self.sc.stat("bar") is handle)
+        handle.value += 1
+        self.sc.increment("bar")
+        self.assertEqual(self.sc.stats["bar"], 2)
+
+    def test_collector(self):
+        self.sc.increment("bar baz", by=3)
+        other = futils.StatCounter("foo")
+        other.increment("bar baz")
+        gauges = dict((m.name, m) for m in
+                      futils.StatCounterCollector().collect())
+        gauge = gauges["felix_foo_bar_baz"]
+        self.assertEqual(gauge.samples[0][2], 4)
+
     def test_dump_diags(self):
         with mock.patch("calico.felix.futils.stat_log") as m_log:
             self.sc.increment("bar")
@@ -29,8 +29,8 @@ from netaddr import IPAddress
 from calico.datamodel_v1 import WloadEndpointId, HostEndpointId
 from calico.felix.futils import IPV4, FailedSystemCall, CommandOutput, IPV6
 from calico.felix.ipsets import (IpsetManager, IpsetActor,
-                                 RefCountedIpsetActor, Ipset,
-                                 list_ipset_names)
+                                 RefCountedIpsetActor, Ipset, IpsetHandle,
+                                 list_ipset_names, RETRY_DELAY_SECS)
 from calico.felix.refcount import CREATED
 from calico.felix.test.base import BaseTestCase
 
@@ -134,6 +134,9 @@ class TestIpsetManager(BaseTestCase):
         self.acquired_refs = {}
         self.config = Mock()
         self.config.MAX_IPSET_SIZE = 1234
+        self.config.REFERENCE_LINGER_SECS = 0
+        self.config.REFERENCE_LINGER_MAX_OBJECTS = 0
+        self.config.IPSET_ENGINE_MODE = "actor"
         self.mgr = IpsetManager(IPV4, self.config)
         self.m_create = Mock(spec=self.mgr._create,
                              side_effect = self.m_create)
@@ -659,6 +662,145 @@ class TestIpsetManager(BaseTestCase):
         self.step_mgr()
 
 
+class TestConsolidatedIpsetManager(BaseTestCase):
+    def setUp(self):
+        super(TestConsolidatedIpsetManager, self).setUp()
+        self.config = Mock()
+        self.config.MAX_IPSET_SIZE = 1234
+        self.config.REFERENCE_LINGER_SECS = 0
+        self.config.REFERENCE_LINGER_MAX_OBJECTS = 0
+        self.config.IPSET_ENGINE_MODE = "consolidated"
+        self.mgr = IpsetManager(IPV4, self.config)
+        self.acquired = {}
+
+        restore_patch = patch("calico.felix.ipsets.restore_ipsets")
+        self.m_restore = restore_patch.start()
+        self.addCleanup(restore_patch.stop)
+        list_patch = patch("calico.felix.ipsets.list_ipset_names")
+        self.m_list = list_patch.start()
+        self.m_list.return_value = ["felix-4-s2", "felix-4ts2"]
+        self.addCleanup(list_patch.stop)
+
+        self.mgr.on_datamodel_in_sync(async=True)
+        self.mgr.on_ipset_update("s1", ["10.0.0.1"], async=True)
+        self.mgr.on_ipset_update("s2", ["10.0.0.2"], async=True)
+        self.step_actor(self.mgr)
+
+    def on_ref(self, obj_id, obj):
+        self.acquired[obj_id] = obj
+
+    def acquire(self, *ipset_ids):
+        for ipset_id in ipset_ids:
+            self.mgr.get_and_incref(ipset_id, callback=self.on_ref,
+                                    async=True)
+        self.step_actor(self.mgr)
+
+    def restore_lines(self):
+        return [c[1][0] for c in self.m_restore.mock_calls]
+
+    def test_create_single_restore(self):
+        self.acquire("s1", "s2")
+        handle = self.acquired["s1"]
+        self.assertTrue(isinstance(handle, IpsetHandle))
+        self.assertEqual(handle.ipset_name, "felix-4-s1")
+        self.assertEqual(handle.owned_ipset_names(),
+                         set(["felix-4-s1", "felix-4ts1"]))
+        self.assertEqual(self.acquired["s2"].ipset_name, "felix-4-s2")
+        # Both ipsets are written with one restore.  s2 already exists, as
+        # does its temporary set, so neither is created.
+        lines = self.restore_lines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(set(lines[0]), set([
+            "create felix-4-s1 hash:ip family inet maxelem 1234 --exist",
+            "create felix-4ts1 hash:ip family inet maxelem 1234 --exist",
+            "add felix-4ts1 10.0.0.1",
+            "swap felix-4-s1 felix-4ts1",
+            "destroy felix-4ts1",
+            "destroy felix-4ts2",
+            "create felix-4ts2 hash:ip family inet maxelem 1234 --exist",
+            "add felix-4ts2 10.0.0.2",
+            "swap felix-4-s2 felix-4ts2",
+        ]))
+        self.assertEqual(self.m_list.mock_calls, [call()])
+
+    def test_deltas(self):
+        self.acquire("s1", "s2")
+        self.m_restore.reset_mock()
+        self.mgr.on_ipset_delta_update("s1", ["10.0.0.3", "10.0.0.1"],
+                                       ["10.0.0.1"], async=True)
+        self.mgr.on_ipset_delta_update("s2", ["10.0.0.2"], ["10.0.0.9"],
+                                       async=True)
+        self.mgr.on_ipset_delta_update("s3", ["10.0.0.4"], [], async=True)
+        self.step_actor(self.mgr)
+        # Changes that don't modify a set and changes to unreferenced sets
+        # are squashed.
+        self.assertEqual(self.restore_lines(), [[
+            "del felix-4-s1 10.0.0.1",
+            "add felix-4-s1 10.0.0.3",
+        ]])
+        self.assertEqual(self.mgr._pre_calc_ipsets_by_id, {
+            "s1": set(["10.0.0.3"]),
+            "s2": set(["10.0.0.2"]),
+            "s3": set(["10.0.0.4"]),
+        })
+
+    def test_restore_failure_falls_back(self):
+        self.acquire("s1")
+        self.m_restore.reset_mock()
+        self.m_restore.side_effect = FailedSystemCall()
+        with patch.object(Ipset, "replace_members") as m_replace:
+            self.mgr.on_ipset_delta_update("s1", ["10.0.0.3"], [],
+                                           async=True)
+            self.step_actor(self.mgr)
+        self.assertEqual(m_replace.mock_calls,
+                         [call(frozenset(["10.0.0.1", "10.0.0.3"]))])
+        self.assertTrue(self.mgr._existing_ipset_names is None)
+
+    @patch("gevent.spawn_later")
+    def test_fallback_failure_retried(self, m_spawn_later):
+        self.m_restore.side_effect = FailedSystemCall()
+        with patch.object(Ipset, "replace_members",
+                          side_effect=FailedSystemCall()) as m_replace:
+            self.mgr.get_and_incref("s1", callback=self.on_ref, async=True)
+            self.step_actor(self.mgr)
+        self.assertEqual(len(m_replace.mock_calls), 1)
+        # Not reported ready; left dirty and a retry is scheduled.
+        self.assertFalse("s1" in self.acquired)
+        self.assertEqual(self.mgr._handles_to_rewrite, set(["s1"]))
+        self.assertEqual(len(m_spawn_later.mock_calls), 1)
+        delay, retry = m_spawn_later.call_args[0]
+        self.assertEqual(delay, RETRY_DELAY_SECS)
+
+        self.m_restore.side_effect = None
+        retry()
+        self.step_actor(self.mgr)
+        self.assertTrue(self.acquired["s1"].programmed)
+        self.assertEqual(self.mgr._handles_to_rewrite, set())
+
+    def test_too_big(self):
+        self.config.MAX_IPSET_SIZE = 1
+        self.mgr.on_ipset_update("s1", ["10.0.0.1", "10.0.0.3"], async=True)
+        self.acquire("s1")
+        # Referrers still get the handle but there's nothing to program.
+        self.assertFalse(self.acquired["s1"].programmed)
+        self.assertFalse(self.m_restore.called)
+        # Once the set is small enough, it gets a full rewrite.
+        self.mgr.on_ipset_delta_update("s1", [], ["10.0.0.3"], async=True)
+        self.step_actor(self.mgr)
+        self.assertTrue(self.acquired["s1"].programmed)
+        self.assertTrue("swap felix-4-s1 felix-4ts1" in
+                        self.restore_lines()[0])
+
+    def test_unreferenced(self):
+        self.acquire("s1")
+        self.m_restore.reset_mock()
+        self.mgr.decref("s1", async=True)
+        self.step_actor(self.mgr)
+        self.assertEqual(self.restore_lines(), [["destroy felix-4-s1"]])
+        self.assertFalse("s1" in self.mgr.objects_by_id)
+        self.assertFalse("s1" in self.mgr.stopping_objects_by_id)
+
+
 class TestIpsetActor(BaseTestCase):
     def setUp(self):
         super(TestIpsetActor, self).setUp()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_multiprocess
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the multi-process dataplane.
+"""
+import logging
+from StringIO import StringIO
+
+import mock
+
+from calico.datamodel_v1 import WloadEndpointId
+from calico.felix import multiprocess
+from calico.felix.actor import actor_storage
+from calico.felix.config import ConfigException
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.records import WorkloadEndpointRecord, intern_record
+from calico.felix.test.base import BaseTestCase
+from calico.felix.tracing import SequenceTracker
+
+_log = logging.getLogger(__name__)
+
+EP_ID = WloadEndpointId("host", "orch", "wl", "ep")
+
+
+def frames_in(f):
+    frames = []
+    f = StringIO(f.getvalue())
+    while True:
+        try:
+            frames.append(multiprocess.read_frame(f))
+        except EOFError:
+            return frames
+
+
+class TestFrames(BaseTestCase):
+    def test_round_trip(self):
+        record = intern_record(WorkloadEndpointRecord,
+                               [("name", "tap1234"),
+                                ("profile_ids", ("prof1",))])
+        f = StringIO()
+        multiprocess.write_frame(f, ("call", "splitter", "on_endpoint_update",
+                                     (EP_ID, record), {}, 1))
+        multiprocess.write_frame(f, ("programmed", 1))
+        frames = frames_in(f)
+        self.assertEqual(frames[0], ("call", "splitter", "on_endpoint_update",
+                                     (EP_ID, record), {}, 1))
+        # Records are re-interned when they're unpickled.
+        self.assertTrue(frames[0][3][1] is record)
+        self.assertEqual(frames[1], ("programmed", 1))
+
+    def test_truncated(self):
+        f = StringIO()
+        multiprocess.write_frame(f, ("programmed", 1))
+        self.assertRaises(EOFError, multiprocess.read_frame,
+                          StringIO(f.getvalue()[:-1]))
+
+
+class TestForwardingSplitter(BaseTestCase):
+    def setUp(self):
+        super(TestForwardingSplitter, self).setUp()
+        self.v4_worker = mock.Mock(ip_type=IPV4)
+        self.v6_worker = mock.Mock(ip_type=IPV6)
+        self.splitter = multiprocess.ForwardingSplitter([self.v4_worker,
+                                                         self.v6_worker])
+
+    def test_forwards_to_all(self):
+        self.splitter.on_endpoint_update(EP_ID, None)
+        for worker in (self.v4_worker, self.v6_worker):
+            worker.send_call.assert_called_once_with(
+                "splitter", "on_endpoint_update", (EP_ID, None)
+            )
+
+    def test_ipset_update_split_by_type(self):
+        self.splitter.on_ipset_update("s", {IPV4: set(["10.0.0.1"]),
+                                            IPV6: set(["feed::1"])})
+        self.v4_worker.send_call.assert_called_once_with(
+            "splitter", "on_ipset_update", ("s", {IPV4: set(["10.0.0.1"])})
+        )
+        self.v6_worker.send_call.assert_called_once_with(
+            "splitter", "on_ipset_update", ("s", {IPV6: set(["feed::1"])})
+        )
+
+    def test_ipset_delta_skips_unchanged_type(self):
+        self.splitter.on_ipset_delta_update("s", {IPV4: set(["10.0.0.1"])},
+                                            {})
+        self.v4_worker.send_call.assert_called_once_with(
+            "splitter", "on_ipset_delta_update",
+            ("s", {IPV4: set(["10.0.0.1"])}, {IPV4: ()})
+        )
+        self.assertFalse(self.v6_worker.send_call.called)
+
+    def test_config_reloaded(self):
+        self.splitter.on_config_reloaded({"LogSeverityFile": "DEBUG"})
+        for worker in (self.v4_worker, self.v6_worker):
+            worker.reload_config.assert_called_once_with(
+                {"LogSeverityFile": "DEBUG"}
+            )
+
+
+class TestDataplaneWorker(BaseTestCase):
+    def setUp(self):
+        super(TestDataplaneWorker, self).setUp()
+        self.writer = mock.Mock()
+        self.worker = multiprocess.DataplaneWorker(4, self.writer)
+        self.worker._to_worker = StringIO()
+        self.on_progress = mock.Mock()
+        self.tracker = SequenceTracker(on_progress=self.on_progress)
+
+    def tearDown(self):
+        actor_storage.traces = None
+        super(TestDataplaneWorker, self).tearDown()
+
+    def send_traced_call(self, seq_no):
+        trace = self.tracker.start_trace(seq_no, "policy")
+        actor_storage.traces = (trace,)
+        self.worker.send_call("splitter", "on_rules_update", ("prof", None))
+        actor_storage.traces = None
+        trace.release()
+
+    def test_worker_cmd(self):
+        self.assertEqual(self.worker.worker_cmd()[-2:],
+                         ["dataplane-worker", "4"])
+
+    def test_traces_held_until_programmed(self):
+        self.send_traced_call(10)
+        self.send_traced_call(11)
+        self.assertEqual(
+            [f[-1] for f in frames_in(self.worker._to_worker)], [1, 2]
+        )
+        self.assertFalse(self.on_progress.called)
+        self.worker._on_programmed(1)
+        self.on_progress.assert_called_once_with(10)
+        self.worker._on_programmed(2)
+        self.assertEqual(self.tracker.highest_programmed, 11)
+
+    def test_read_loop(self):
+        from_worker = StringIO()
+        multiprocess.write_frame(from_worker,
+                                 ("endpoint_status", EP_ID, IPV4,
+                                  {"status": "up"}))
+        self.worker._from_worker = StringIO(from_worker.getvalue())
+        self.worker._process = mock.Mock()
+        self.worker._loop_reading_from_worker()
+        self.writer.on_endpoint_status_changed.assert_called_once_with(
+            EP_ID, IPV4, {"status": "up"}, async=True
+        )
+
+
+class TestHostsIpsetForwarder(BaseTestCase):
+    def test_replace_members(self):
+        worker = mock.Mock()
+        forwarder = multiprocess.HostsIpsetForwarder(worker)
+        forwarder.replace_members(frozenset(["10.0.0.1"]), async=True)
+        worker.send_call.assert_called_once_with(
+            "hosts_ipset", "replace_members", (frozenset(["10.0.0.1"]),),
+            {"async": True}
+        )
+
+    def test_deltas(self):
+        worker = mock.Mock()
+        forwarder = multiprocess.HostsIpsetForwarder(worker)
+        forwarder.add_members(["10.0.0.1"], async=True)
+        forwarder.remove_members(["10.0.0.2"], async=True)
+        self.assertEqual(worker.send_call.mock_calls, [
+            mock.call("hosts_ipset", "add_members", (["10.0.0.1"],),
+                      {"async": True}),
+            mock.call("hosts_ipset", "remove_members", (["10.0.0.2"],),
+                      {"async": True}),
+        ])
+
+
+class TestFrontEndConnection(BaseTestCase):
+    def setUp(self):
+        super(TestFrontEndConnection, self).setUp()
+        from_front_end = StringIO()
+        multiprocess.write_frame(from_front_end, ("config", {"a": "b"}))
+        multiprocess.write_frame(from_front_end,
+                                 ("call", "splitter", "on_rules_update",
+                                  ("prof", None), {}, 1))
+        multiprocess.write_frame(from_front_end,
+                                 ("reload_config", {"a": "c"}))
+        self.to_front_end = StringIO()
+        self.conn = multiprocess.FrontEndConnection(
+            StringIO(from_front_end.getvalue()), self.to_front_end
+        )
+        self.config = mock.Mock()
+        self.splitter = mock.Mock()
+
+    def test_rejected_config_not_passed_on(self):
+        self.config.reload_from.side_effect = ConfigException("Bad", None)
+        self.conn._config = self.config
+        self.conn._targets = {"splitter": self.splitter}
+        self.conn._reload_config({"a": "c"})
+        self.assertFalse(self.splitter.on_config_reloaded.called)
+
+    def test_calls_and_progress(self):
+        self.enable_tracing()
+        self.assertEqual(self.conn.read_config(), {"a": "b"})
+        # Hold a reference to the trace of the call, as an actor message
+        # would.
+        traces = []
+
+        def on_rules_update(*args):
+            traces.extend(actor_storage.traces)
+            actor_storage.traces[0].add_ref()
+        self.splitter.on_rules_update.side_effect = on_rules_update
+        self.conn._config = self.config
+        self.conn._targets = {"splitter": self.splitter}
+        self.conn._loop_reading_from_front_end()
+        self.splitter.on_rules_update.assert_called_once_with("prof", None)
+        self.config.reload_from.assert_called_once_with({"a": "c"})
+        self.splitter.on_config_reloaded.assert_called_once_with({"a": "c"})
+
+        self.conn.on_endpoint_status_changed(EP_ID, IPV4, {"status": "up"},
+                                             async=True)
+        self.step_actor(self.conn)
+        # Call not yet complete so no progress reported.
+        self.assertEqual(frames_in(self.to_front_end),
+                         [("endpoint_status", EP_ID, IPV4,
+                           {"status": "up"})])
+
+        traces[0].release()
+        self.step_actor(self.conn)
+        self.assertEqual(frames_in(self.to_front_end),
+                         [("endpoint_status", EP_ID, IPV4,
+                           {"status": "up"}),
+                          ("programmed", 1)])
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_nftables
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the nftables backend.  The dataplane tests run against the fake
+nft binary in fake_nft.py.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import mock
+
+from calico.felix import nftables
+from calico.felix.futils import FailedSystemCall, IPV4, IPV6, check_call
+from calico.felix.test.base import BaseTestCase, load_config
+
+_log = logging.getLogger(__name__)
+
+FAKE_NFT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "fake_nft.py")
+
+
+class TestTranslateFragment(BaseTestCase):
+    def assert_translates(self, fragment, chain, rule, ip_version=4):
+        self.assertEqual(nftables.translate_fragment(fragment, ip_version),
+                         (chain, rule))
+
+    def test_jump(self):
+        self.assert_translates("--append felix-INPUT --jump felix-FOO",
+                               "felix-INPUT", "jump felix-FOO")
+        self.assert_translates("INPUT --jump felix-INPUT",
+                               "INPUT", "jump felix-INPUT")
+        self.assert_translates("--append foo --goto felix-from-1234",
+                               "foo", "goto felix-from-1234")
+
+    def test_matches(self):
+        self.assert_translates(
+            "--append foo --protocol tcp --source 10.0.0.0/8 "
+            "--match multiport --destination-ports 80,8080:8090 "
+            "--jump ACCEPT",
+            "foo",
+            "meta l4proto tcp ip saddr 10.0.0.0/8 "
+            "tcp dport { 80, 8080-8090 } accept"
+        )
+        self.assert_translates(
+            "--append foo ! --protocol udp --match conntrack "
+            "--ctstate INVALID --jump DROP",
+            "foo", "meta l4proto != udp ct state invalid drop"
+        )
+        self.assert_translates(
+            "--append foo --in-interface tap+ --match set ! --match-set "
+            "felix-6-foo dst --jump RETURN",
+            "foo", 'iifname "tap*" ip6 daddr != @felix-6-foo return',
+            ip_version=6
+        )
+        self.assert_translates(
+            "--append foo --protocol icmpv6 --match icmp6 "
+            "--icmpv6-type 130 --jump ACCEPT",
+            "foo", "meta l4proto ipv6-icmp icmpv6 type 130 accept",
+            ip_version=6
+        )
+        self.assert_translates(
+            "--append foo --match mac ! --mac-source AA:BB:CC:DD:EE:FF "
+            "--jump DROP",
+            "foo", "ether saddr != aa:bb:cc:dd:ee:ff drop"
+        )
+
+    def test_marks_and_comments(self):
+        self.assert_translates(
+            '--append foo --match mark --mark 0x1000000/0x1000000 '
+            '--match comment --comment "Return if allowed" --jump RETURN',
+            "foo", 'meta mark and 0x1000000 == 0x1000000 return '
+                   'comment "Return if allowed"'
+        )
+        self.assert_translates(
+            "--append foo --jump MARK --set-mark 0x1000000/0x1000000",
+            "foo", "meta mark set meta mark and 0xfeffffff or 0x1000000"
+        )
+
+    def test_targets(self):
+        self.assert_translates(
+            '--append foo --jump LOG --log-prefix "calico-drop: " '
+            '--log-level 4',
+            "foo", 'log prefix "calico-drop: " level warn'
+        )
+        self.assert_translates(
+            "--append felix-FIP-DNAT -d 1.2.3.4 -j DNAT "
+            "--to-destination 10.0.0.1",
+            "felix-FIP-DNAT", "ip daddr 1.2.3.4 dnat to 10.0.0.1"
+        )
+        self.assert_translates(
+            "POSTROUTING --match set --match-set felix-masq-ipam-pools src "
+            "--match set ! --match-set felix-all-ipam-pools dst "
+            "--jump MASQUERADE",
+            "POSTROUTING", "ip saddr @felix-masq-ipam-pools "
+                           "ip daddr != @felix-all-ipam-pools masquerade"
+        )
+        self.assert_translates(
+            "POSTROUTING --out-interface tunl0 -m addrtype ! --src-type "
+            "LOCAL --limit-iface-out -m addrtype --src-type LOCAL "
+            "-j MASQUERADE",
+            "POSTROUTING", 'oifname "tunl0" fib saddr . oif type != local '
+                           'fib saddr type local masquerade'
+        )
+        self.assert_translates(
+            "PREROUTING --in-interface tap+ --match rpfilter --invert "
+            "--jump felix-PREROUTING",
+            "PREROUTING", 'iifname "tap*" fib saddr . iif oif missing '
+                          'jump felix-PREROUTING',
+            ip_version=6
+        )
+
+    def test_vmap(self):
+        self.assert_translates(
+            "--append felix-TO-ENDPOINT --out-interface-vmap "
+            "felix-TO-ENDPOINT",
+            "felix-TO-ENDPOINT", "oifname vmap @felix-TO-ENDPOINT"
+        )
+
+    def test_unsupported(self):
+        for fragment in ["--append foo --match owner --uid-owner 0",
+                         "--append foo --frobnicate",
+                         "--append foo --jump REJECT",
+                         "--append foo --dport 80 --jump ACCEPT",
+                         "--append foo --comment \"unterminated",
+                         "--append"]:
+            self.assertRaises(nftables.UnsupportedFragment,
+                              nftables.translate_fragment, fragment, 4)
+
+
+class FakeNftTestCase(BaseTestCase):
+    """
+    Test case that points the nftables module at the fake nft binary.
+    """
+    def setUp(self):
+        super(FakeNftTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp_dir, "state.json")
+        env_patch = mock.patch.dict(os.environ,
+                                    {"FAKE_NFT_STATE": self.state_file})
+        env_patch.start()
+        self.addCleanup(env_patch.stop)
+        cmd_patch = mock.patch("calico.felix.nftables.NFT_CMD", FAKE_NFT)
+        cmd_patch.start()
+        self.addCleanup(cmd_patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(FakeNftTestCase, self).tearDown()
+
+    def nft(self, script):
+        check_call([FAKE_NFT, "-f", "/dev/stdin"], input_str=script)
+
+    def table(self, name="felix-filter", family="ip"):
+        with open(self.state_file) as f:
+            return json.load(f)["%s %s" % (family, name)]
+
+    def rules(self, chain, table="felix-filter"):
+        return self.table(table)["chains"][chain]["rules"]
+
+
+class TestFakeNft(FakeNftTestCase):
+    def test_rejects_bad_input(self):
+        self.nft("add table ip felix-filter\n"
+                 "add chain ip felix-filter foo\n")
+        for script in [
+            # Unknown commands and expressions.
+            "replace table ip felix-filter\n",
+            "add rule ip felix-filter foo frobnicate\n",
+            "add rule ip felix-filter foo ip6 saddr ::1 accept\n",
+            "add rule ip felix-filter foo ip saddr 10.0.0.300 accept\n",
+            "add rule ip felix-filter foo accept drop\n",
+            # Missing objects.
+            "add rule ip felix-filter bar accept\n",
+            "add rule ip felix-filter foo jump bar\n",
+            "add rule ip felix-filter foo ip saddr @missing accept\n",
+            "delete chain ip felix-filter bar\n",
+            # Chain in use.
+            "add chain ip felix-filter bar\n"
+            "add rule ip felix-filter foo jump bar\n"
+            "delete chain ip felix-filter foo\n"
+            "delete chain ip felix-filter bar\n",
+        ]:
+            self.assertRaises(FailedSystemCall, self.nft, script)
+        # Nothing was applied.
+        self.assertEqual(set(self.table()["chains"]), set(["foo"]))
+        self.assertEqual(self.rules("foo"), [])
+
+    def test_transaction_is_atomic(self):
+        self.nft("add table ip felix-filter\n")
+        self.assertRaises(FailedSystemCall, self.nft,
+                          "add chain ip felix-filter foo\n"
+                          "add rule ip felix-filter foo jump missing\n")
+        self.assertEqual(self.table()["chains"], {})
+
+
+class TestNftablesUpdater(FakeNftTestCase):
+    def setUp(self):
+        super(TestNftablesUpdater, self).setUp()
+        self.config = load_config("felix_default.cfg",
+                                  env_dict={"FELIX_REFRESHINTERVAL": "0"})
+        self.nft_updater = nftables.NftablesUpdater("filter", self.config, 4)
+        self.step_actor(self.nft_updater)
+
+    def test_start_of_day(self):
+        chains = self.table()["chains"]
+        self.assertEqual(set(chains), set(["INPUT", "FORWARD", "OUTPUT"]))
+        self.assertEqual(chains["INPUT"]["base"],
+                         ["filter", "input", "0", "accept"])
+        self.assertEqual(self.nft_updater._chains_in_dataplane, set())
+
+    def test_rewrite_stubs_and_deletes(self):
+        self.nft_updater.rewrite_chains(
+            {"felix-foo": ["--append felix-foo --jump felix-bar",
+                           "--append felix-foo --jump ACCEPT"]},
+            {"felix-foo": set(["felix-bar"])},
+            async=True
+        )
+        self.step_actor(self.nft_updater)
+        self.assertEqual(self.rules("felix-foo"),
+                         ["jump felix-bar", "accept"])
+        # Missing dependency is stubbed out with a drop rule.
+        self.assertEqual(self.rules("felix-bar")[-1].split()[0], "drop")
+        self.assertEqual(self.nft_updater._chains_in_dataplane,
+                         set(["felix-foo", "felix-bar"]))
+
+        self.nft_updater.delete_chains(["felix-foo"], async=True)
+        self.step_actor(self.nft_updater)
+        self.assertEqual(set(self.table()["chains"]),
+                         set(["INPUT", "FORWARD", "OUTPUT"]))
+        self.assertEqual(self.nft_updater._chains_in_dataplane, set())
+
+    def test_untranslatable_rule(self):
+        self.nft_updater.rewrite_chains(
+            {"felix-foo": ["--append felix-foo --jump ACCEPT",
+                           "--append felix-foo --match owner --jump DROP"]},
+            {}, async=True
+        )
+        self.step_actor(self.nft_updater)
+        rules = self.rules("felix-foo")
+        self.assertEqual(rules[0], "accept")
+        self.assertEqual(rules[-1].split()[0], "drop")
+
+    def test_failure_is_reported(self):
+        with mock.patch.object(self.nft_updater, "_rule_lines",
+                               return_value=["add rule ip felix-filter "
+                                             "felix-foo frobnicate"]):
+            result = self.nft_updater.rewrite_chains(
+                {"felix-foo": ["--append felix-foo --jump ACCEPT"]}, {},
+                async=True
+            )
+            self.step_actor(self.nft_updater)
+        self.assertRaises(FailedSystemCall, result.get)
+        self.assertFalse("felix-foo" in self.table()["chains"])
+
+    def test_insert_and_remove(self):
+        self.nft_updater.rewrite_chains(
+            {"felix-INPUT": [], "felix-OUTPUT": []}, {}, async=True
+        )
+        self.nft_updater.ensure_rule_inserted("INPUT --jump felix-INPUT",
+                                              async=True)
+        self.step_actor(self.nft_updater)
+        self.nft_updater.ensure_rule_inserted("INPUT --jump felix-OUTPUT",
+                                              async=True)
+        self.step_actor(self.nft_updater)
+        self.assertEqual(self.rules("INPUT"),
+                         ["jump felix-OUTPUT", "jump felix-INPUT"])
+        # Re-inserting doesn't move the rule.
+        self.nft_updater.ensure_rule_inserted("INPUT --jump felix-INPUT",
+                                              async=True)
+        self.step_actor(self.nft_updater)
+        self.assertEqual(self.rules("INPUT"),
+                         ["jump felix-OUTPUT", "jump felix-INPUT"])
+        self.nft_updater.ensure_rule_removed("INPUT --jump felix-OUTPUT",
+                                             async=True)
+        self.step_actor(self.nft_updater)
+        self.assertEqual(self.rules("INPUT"), ["jump felix-INPUT"])
+
+    def test_dispatch_maps(self):
+        self.nft_updater.rewrite_dispatch_chains(
+            {"felix-TO-ENDPOINT": ["--append felix-TO-ENDPOINT "
+                                   "--out-interface-vmap felix-TO-ENDPOINT",
+                                   "--append felix-TO-ENDPOINT --jump DROP"]},
+            {"felix-TO-ENDPOINT": set(["felix-to-1", "felix-to-2"])},
+            {"felix-TO-ENDPOINT": {"tap1": "goto felix-to-1",
+                                   "tap2": "goto felix-to-2"}},
+            async=True
+        )
+        self.step_actor(self.nft_updater)
+        self.assertEqual(self.rules("felix-TO-ENDPOINT"),
+                         ["oifname vmap @felix-TO-ENDPOINT", "drop"])
+        self.assertEqual(self.table()["maps"]["felix-TO-ENDPOINT"]["elements"],
+                         {"tap1": "goto felix-to-1",
+                          "tap2": "goto felix-to-2"})
+
+        # Remove one endpoint and add another; only the changed elements
+        # are written and the unused chain is deleted.
+        with mock.patch.object(self.nft_updater, "_execute_iptables",
+                               wraps=self.nft_updater._execute_iptables) \
+                as m_execute:
+            self.nft_updater.rewrite_dispatch_chains(
+                {"felix-TO-ENDPOINT": [
+                    "--append felix-TO-ENDPOINT "
+                    "--out-interface-vmap felix-TO-ENDPOINT",
+                    "--append felix-TO-ENDPOINT --jump DROP"
+                ]},
+                {"felix-TO-ENDPOINT": set(["felix-to-1", "felix-to-3"])},
+                {"felix-TO-ENDPOINT": {"tap1": "goto felix-to-1",
+                                       "tap3": "goto felix-to-3"}},
+                async=True
+            )
+            self.step_actor(self.nft_updater)
+        modify_lines = m_execute.mock_calls[0][1][0]
+        self.assertTrue('delete element ip felix-filter felix-TO-ENDPOINT '
+                        '{ "tap2" }' in modify_lines)
+        self.assertTrue('add element ip felix-filter felix-TO-ENDPOINT '
+                        '{ "tap3" : goto felix-to-3 }' in modify_lines)
+        self.assertEqual(self.table()["maps"]["felix-TO-ENDPOINT"]["elements"],
+                         {"tap1": "goto felix-to-1",
+                          "tap3": "goto felix-to-3"})
+        self.assertFalse("felix-to-2" in self.table()["chains"])
+
+    def test_cleanup(self):
+        self.nft("add chain ip felix-filter felix-orphan\n"
+                 "add chain ip felix-filter other\n")
+        self.nft_updater._load_chain_names_from_iptables(async=True)
+        self.step_actor(self.nft_updater)
+        self.nft_updater.rewrite_chains({"felix-foo": []}, {}, async=True)
+        self.nft_updater.cleanup(async=True)
+        self.step_actor(self.nft_updater)
+        self.assertEqual(set(self.table()["chains"]),
+                         set(["INPUT", "FORWARD", "OUTPUT", "felix-foo",
+                              "other"]))
+
+
+class TestNftSet(FakeNftTestCase):
+    def test_lifecycle(self):
+        nft_set = nftables.NftSet("felix-4-foo", IPV4)
+        self.assertFalse(nft_set.exists())
+        nft_set.replace_members(set(["10.0.0.1", "10.0.0.2"]))
+        self.assertTrue(nft_set.exists())
+        nft_set.apply_changes(set(["10.0.0.3"]), set(["10.0.0.1"]))
+        self.assertEqual(
+            sorted(self.table()["sets"]["felix-4-foo"]["elements"]),
+            ["10.0.0.2", "10.0.0.3"]
+        )
+        nft_set.replace_members(set())
+        self.assertEqual(self.table()["sets"]["felix-4-foo"]["elements"], [])
+        nft_set.delete()
+        self.assertFalse(nft_set.exists())
+
+    def test_cidrs(self):
+        nft_set = nftables.NftSet("felix-all-ipam-pools", IPV6, table="nat",
+                                  ipset_type="hash:net")
+        nft_set.replace_members(set(["fd00::/64"]))
+        self.assertEqual(
+            self.table("felix-nat", "ip6")["sets"]["felix-all-ipam-pools"]
+            ["elements"],
+            ["fd00::/64"]
+        )
+
+
+class TestNftSetManager(FakeNftTestCase):
+    def test_cleanup(self):
+        config = load_config("felix_default.cfg",
+                             global_dict={"IpsetEngineMode": "consolidated"})
+        mgr = nftables.NftSetManager(IPV4, config)
+        self.assertFalse(mgr._consolidated)
+        nftables.NftSet("felix-4-old", IPV4).ensure_exists()
+        nftables.NftSet("other", IPV4).ensure_exists()
+        mgr.cleanup(async=True)
+        self.step_actor(mgr)
+        self.assertEqual(set(self.table()["sets"]), set(["other"]))
+
+
+class TestVerdictMapDispatch(BaseTestCase):
+    def test_reprogram(self):
+        config = load_config("felix_default.cfg")
+        m_updater = mock.Mock()
+        chains = nftables.NftWorkloadDispatchChains(config, 4, m_updater)
+        chains.apply_snapshot(set(["tapabcd"]), async=True)
+        self.step_actor(chains)
+        updates, deps, verdicts = \
+            m_updater.rewrite_dispatch_chains.mock_calls[-1][1]
+        self.assertEqual(updates["felix-FROM-ENDPOINT"][0],
+                         "--append felix-FROM-ENDPOINT --in-interface-vmap "
+                         "felix-FROM-ENDPOINT")
+        self.assertEqual(deps["felix-TO-ENDPOINT"],
+                         set(["felix-to-abcd"]))
+        self.assertEqual(verdicts,
+                         {"felix-FROM-ENDPOINT":
+                              {"tapabcd": "goto felix-from-abcd"},
+                          "felix-TO-ENDPOINT":
+                              {"tapabcd": "goto felix-to-abcd"}})
+        # The maps replace the prefix tree, so there are no leaf chains.
+        self.assertFalse(m_updater.rewrite_chains.called)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_offload
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the chain generation pool.
+"""
+import functools
+import logging
+import subprocess
+import tempfile
+from StringIO import StringIO
+
+import mock
+
+from calico.felix import offload
+from calico.felix.multiprocess import spawn_worker, write_frame
+from calico.felix.records import ProfileRulesRecord, RuleRecord, intern_record
+from calico.felix.test.base import BaseTestCase, load_config
+
+_log = logging.getLogger(__name__)
+
+
+class TestGenerateChains(BaseTestCase):
+    def test_inline(self):
+        generator = mock.Mock()
+        generator.profile_updates.return_value = ({"a": []}, {})
+        result = offload.generate_chains(generator, "profile_updates",
+                                         "prof", comment_tag="prof")
+        self.assertEqual(result.get(), ({"a": []}, {}))
+        generator.profile_updates.assert_called_once_with(
+            "prof", comment_tag="prof"
+        )
+
+    def test_inline_error(self):
+        generator = mock.Mock()
+        generator.profile_updates.side_effect = ValueError()
+        result = offload.generate_chains(generator, "profile_updates")
+        self.assertRaises(ValueError, result.get)
+
+    def test_pool(self):
+        m_pool = mock.Mock()
+        generator = mock.Mock()
+        with mock.patch("calico.felix.offload._pool", m_pool):
+            self.assertTrue(offload.pool_running())
+            result = offload.generate_chains(generator, "profile_updates",
+                                             "prof", comment_tag="prof")
+        self.assertEqual(result, m_pool.submit.return_value)
+        m_pool.submit.assert_called_once_with("profile_updates", "prof",
+                                              comment_tag="prof")
+        self.assertFalse(generator.profile_updates.called)
+
+
+class TestPoolWorker(BaseTestCase):
+    def setUp(self):
+        super(TestPoolWorker, self).setUp()
+        self.worker = offload._PoolWorker(0)
+        self.worker._to_worker = StringIO()
+        self.worker._process = mock.Mock()
+
+    def set_output(self, *frames):
+        f = StringIO()
+        for frame in frames:
+            write_frame(f, frame)
+        self.worker._from_worker = StringIO(f.getvalue())
+
+    def test_results_in_order(self):
+        r1 = self.worker.submit("profile_updates", ("a",), {})
+        r2 = self.worker.submit("profile_updates", ("b",), {})
+        r3 = self.worker.submit("profile_updates", ("c",), {})
+        self.set_output(("result", 1), ("error", ValueError()))
+        self.worker._loop_reading_from_worker()
+        self.assertEqual(r1.get(), 1)
+        self.assertRaises(ValueError, r2.get)
+        # Worker exited before answering.
+        self.assertRaises(RuntimeError, r3.get)
+        self.assertEqual(len(self.worker.pending), 0)
+
+    def test_least_loaded(self):
+        pool = offload.ChainGenerationPool(2)
+        busy, idle = pool._workers
+        busy.pending.append(mock.Mock())
+        with mock.patch.object(idle, "submit") as m_submit:
+            pool.submit("profile_updates", "a")
+        m_submit.assert_called_once_with("profile_updates", ("a",), {})
+
+
+class TestPoolProcess(BaseTestCase):
+    """
+    Runs tasks in a real worker process.
+    """
+    def test_profile_updates(self):
+        config = load_config("felix_default.cfg",
+                             global_dict={"ChainGenerationProcesses": "1",
+                                          "LogFilePath": "none"})
+        generator = config.plugins["iptables_generator"]
+        rules = tuple(
+            intern_record(RuleRecord, [("action", "allow"),
+                                       ("protocol", "tcp"),
+                                       ("dst_ports", (80 + i,))])
+            for i in xrange(10)
+        )
+        profile = intern_record(ProfileRulesRecord,
+                                [("inbound_rules", rules),
+                                 ("outbound_rules", rules)])
+        expected = generator.profile_updates("prof", profile, 4,
+                                             tag_to_ipset={},
+                                             selector_to_ipset={})
+        # Capture the worker's output, which gets the traceback of the
+        # failed task.
+        output = tempfile.TemporaryFile()
+        self.addCleanup(output.close)
+        pool = offload.ChainGenerationPool(1)
+        with mock.patch("calico.felix.offload.spawn_worker",
+                        functools.partial(spawn_worker, stdout=output,
+                                          stderr=subprocess.STDOUT)):
+            greenlets = pool.start(config.raw_config)
+        try:
+            result = pool.submit("profile_updates", "prof", profile, 4,
+                                 tag_to_ipset={}, selector_to_ipset={})
+            self.assertEqual(result.get(timeout=30), expected)
+            result = pool.submit("unknown")
+            self.assertRaises(ValueError, result.get, timeout=30)
+        finally:
+            for worker in pool._workers:
+                worker._to_worker.close()
+            for greenlet in greenlets:
+                greenlet.join(timeout=30)
+            for worker in pool._workers:
+                worker._from_worker.close()
+                worker._process.wait()
+        output.seek(0)
+        self.assertIn("Task unknown failed", output.read())
+
+
+class TestDispatchUpdate(BaseTestCase):
+    """
+    Tests of the worker side of DISPATCH_UPDATE.
+    """
+    def setUp(self):
+        super(TestDispatchUpdate, self).setUp()
+        self.config = load_config("felix_default.cfg")
+        self.dispatch_chains = {}
+
+    def update(self, snapshot, added=(), removed=()):
+        return offload._dispatch_update(self.dispatch_chains, self.config,
+                                        "WorkloadDispatchChains", 4,
+                                        snapshot, added, removed)
+
+    def test_deltas(self):
+        self.update({"tapa", "tapb"})
+        chains = self.dispatch_chains[("WorkloadDispatchChains", 4)]
+        self.assertEqual(chains.ifaces, {"tapa", "tapb"})
+        self.assertEqual(chains.programmed_leaf_chains, set())
+        self.update(None, added={"tapc"}, removed={"tapa"})
+        self.assertEqual(chains.ifaces, {"tapb", "tapc"})
+        # A new snapshot replaces the interfaces.
+        self.update({"tapd"})
+        self.assertEqual(chains.ifaces, {"tapd"})
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_profiler
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the sampling profiler.
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from calico.felix.actor import actor_storage
+from calico.felix.profiler import SamplingProfiler
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+class TestSamplingProfiler(BaseTestCase):
+    def setUp(self):
+        super(TestSamplingProfiler, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.profiler = SamplingProfiler(self.tmp_dir, 0.001)
+
+    def tearDown(self):
+        self.profiler.stop()
+        shutil.rmtree(self.tmp_dir)
+        super(TestSamplingProfiler, self).tearDown()
+
+    def test_sample_tagged_with_actor(self):
+        actor_storage.name = "TestActor(a)"
+        actor_storage.msg_name = "on_update"
+        try:
+            self.profiler._on_sigprof(None, sys._getframe())
+            self.profiler._on_sigprof(None, sys._getframe())
+        finally:
+            del actor_storage.name
+            del actor_storage.msg_name
+        [line] = self.profiler.folded_stacks()
+        stack, count = line.rsplit(" ", 1)
+        self.assertEqual(count, "2")
+        frames = stack.split(";")
+        self.assertEqual(frames[:2], ["TestActor(a)", "on_update"])
+        self.assertTrue(frames[-1].startswith(
+            "test_sample_tagged_with_actor (test_profiler.py:"))
+
+    def test_start_stop_writes_profile(self):
+        self.profiler.start()
+        end = time.time() + 0.1
+        while time.time() < end:
+            pass
+        self.profiler.stop()
+        with open(self.profiler.filename) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(any("test_start_stop_writes_profile" in line
+                            for line in lines))
+        self.assertEqual(os.listdir(self.tmp_dir),
+                         [os.path.basename(self.profiler.filename)])
@@ -382,7 +382,7 @@ class TestProfileRules(BaseTestCase):
         self.assertEqual(ref_helper.required_refs, set())
         # Early on_unreferenced should have prevented any ipset requests.
         self._process_ipset_refs(set([]))
-        self.assertFalse(self.m_ips_mgr.decref.called)
+        self.assertFalse(self.m_ips_mgr.update_refs.called)
         self.assertTrue(self.rules._dead)
         self.m_ipt_updater.delete_chains.assert_called_once_with(
             set(['felix-p-prof1-i', 'felix-p-prof1-o']), async=False
@@ -410,9 +410,9 @@ class TestProfileRules(BaseTestCase):
         self.assertTrue(self.rules._ipset_refs is None)
         self.assertEqual(ref_helper.required_refs, set())
         self.assertTrue(self.rules._dead)
-        self.m_ips_mgr.decref.assert_has_calls(
-            [call("src-tag", async=True), call("dst-tag", async=True)],
-            any_order=True
+        self.m_ips_mgr.update_refs.assert_called_once_with(
+            frozenset(), frozenset(["src-tag", "dst-tag"]),
+            callback=None, async=True
         )
         self.m_ipt_updater.delete_chains.assert_called_once_with(
             set(['felix-p-prof1-i', 'felix-p-prof1-o']), async=False
@@ -446,23 +446,28 @@ class TestProfileRules(BaseTestCase):
     def _process_ipset_refs(self, expected_tags):
         """
         Issues callbacks for all the mock calls to the mock ipset manager's
-        get_and_incref.
+        update_refs.
 
         Steps the actor as a side-effect.
 
         Asserts the set of tags that were requested.
         """
         seen_tags = set()
-        for name, args, kwargs in self.m_ips_mgr.get_and_incref.mock_calls:
-            obj_id = args[0]
+        for name, args, kwargs in self.m_ips_mgr.update_refs.mock_calls:
+            added_ids = args[0]
             callback = kwargs["callback"]
-            seen_tags.add(obj_id)
-            m_ipset = Mock(spec=RefCountedIpsetActor)
-            if obj_id == SELECTOR_1:
-                m_ipset.ipset_name = "selector-1-name"
-            else:
-                m_ipset.ipset_name = obj_id + "-name"
-            callback(obj_id, m_ipset)
+            if not added_ids:
+                continue
+            seen_tags.update(added_ids)
+            ipsets_by_id = {}
+            for obj_id in added_ids:
+                m_ipset = Mock(spec=RefCountedIpsetActor)
+                if obj_id == SELECTOR_1:
+                    m_ipset.ipset_name = "selector-1-name"
+                else:
+                    m_ipset.ipset_name = obj_id + "-name"
+                ipsets_by_id[obj_id] = m_ipset
+            callback(ipsets_by_id)
             self.step_actor(self.rules)
-        self.m_ips_mgr.get_and_incref.reset_mock()
+        self.m_ips_mgr.update_refs.reset_mock()
         self.assertEqual(seen_tags, expected_tags)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_protocol
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the Felix <-> driver protocol helpers.
+"""
+import logging
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+from calico.felix import felixbackend_pb2
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.protocol import (unpack_ips, MessageReader, MessageWriter,
+                                   FrameCapture, read_capture)
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+class TestUnpackIPs(BaseTestCase):
+    def test_empty(self):
+        self.assertEqual(unpack_ips("", IPV4), [])
+        self.assertEqual(unpack_ips("", IPV6), [])
+
+    def test_v4(self):
+        self.assertEqual(unpack_ips("\x0a\x00\x00\x01\xc0\xa8\x01\xff", IPV4),
+                         ["10.0.0.1", "192.168.1.255"])
+
+    def test_v6(self):
+        packed = ("\xfe\x80" + "\x00" * 13 + "\x01" +
+                  "\xde\xad" + "\x00" * 12 + "\xbe\xef")
+        self.assertEqual(unpack_ips(packed, IPV6),
+                         ["fe80::1", "dead::beef"])
+
+    def test_bad_length(self):
+        self.assertRaises(ValueError, unpack_ips, "\x0a\x00\x00", IPV4)
+        self.assertRaises(ValueError, unpack_ips, "\x00" * 4, IPV6)
+
+
+class TestCapture(BaseTestCase):
+    def setUp(self):
+        super(TestCapture, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "felix.cap")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(TestCapture, self).tearDown()
+
+    def make_reader(self, num_ipset_updates):
+        pipe = BytesIO()
+        writer = MessageWriter(pipe)
+        envelope = felixbackend_pb2.ToDataplane()
+        envelope.config_update.config["FelixHostname"] = "host"
+        writer.send_message(envelope)
+        for i in xrange(num_ipset_updates):
+            envelope = felixbackend_pb2.ToDataplane()
+            envelope.sequence_number = i + 1
+            envelope.ipset_update.id = "ipset-%d" % i
+            writer.send_message(envelope)
+        pipe.seek(0)
+        return MessageReader(pipe)
+
+    def read_all(self, reader, num_msgs):
+        return [msg for _ in xrange(num_msgs)
+                for msg in reader.new_messages()]
+
+    def captured_types(self, filename):
+        types = []
+        for _, data in read_capture(filename):
+            envelope = felixbackend_pb2.ToDataplane()
+            envelope.ParseFromString(data)
+            types.append(envelope.WhichOneof("payload"))
+        return types
+
+    def test_capture_starts_with_config(self):
+        reader = self.make_reader(2)
+        self.read_all(reader, 1)
+        capture = FrameCapture(self.filename, 1024 * 1024, 0)
+        reader.start_capture(capture)
+        msgs = self.read_all(reader, 2)
+        self.assertEqual([m[0] for m in msgs],
+                         ["ipset_update", "ipset_update"])
+        capture.close()
+        self.assertEqual(self.captured_types(self.filename),
+                         ["config_update", "ipset_update", "ipset_update"])
+        times = [t for t, _ in read_capture(self.filename)]
+        self.assertEqual(times, sorted(times))
+
+    def test_rotation(self):
+        reader = self.make_reader(6)
+        self.read_all(reader, 1)
+        # Room for the config frame and two ipset updates per file.
+        capture = FrameCapture(self.filename, 120, 2)
+        reader.start_capture(capture)
+        self.read_all(reader, 6)
+        capture.close()
+        for filename in [self.filename, self.filename + ".1",
+                         self.filename + ".2"]:
+            self.assertEqual(self.captured_types(filename),
+                             ["config_update", "ipset_update",
+                              "ipset_update"])
+        self.assertFalse(os.path.exists(self.filename + ".3"))
+
+    def test_partial_frame_ignored(self):
+        reader = self.make_reader(1)
+        self.read_all(reader, 1)
+        capture = FrameCapture(self.filename, 1024 * 1024, 0)
+        reader.start_capture(capture)
+        self.read_all(reader, 1)
+        capture.close()
+        with open(self.filename, "ab") as f:
+            f.write("\x00" * 5)
+        self.assertEqual(self.captured_types(self.filename),
+                         ["config_update", "ipset_update"])
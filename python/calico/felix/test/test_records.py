@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_records
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the compact endpoint and rule records and their conversion from
+protobufs.
+"""
+import logging
+
+from calico.felix import felixbackend_pb2
+from calico.felix.datastore import (convert_pb_wl_endpoint,
+                                    convert_pb_profile_rules)
+from calico.felix.records import (WorkloadEndpointRecord, RuleRecord,
+                                  InternPool, intern_tuple)
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+class TestRecords(BaseTestCase):
+    def test_mapping_interface(self):
+        rule = RuleRecord([("action", "deny"), ("!src_net", "10.0.0.0/8")])
+        self.assertEqual(rule["action"], "deny")
+        self.assertEqual(rule["!src_net"], "10.0.0.0/8")
+        self.assertEqual(rule.not_src_net, "10.0.0.0/8")
+        self.assertRaises(KeyError, rule.__getitem__, "src_net")
+        self.assertEqual(rule.get("src_net", "dflt"), "dflt")
+        self.assertTrue("!src_net" in rule)
+        self.assertFalse("src_net" in rule)
+        self.assertEqual(len(rule), 2)
+        self.assertEqual(sorted(rule.keys()), ["!src_net", "action"])
+        self.assertEqual(rule, {"action": "deny", "!src_net": "10.0.0.0/8"})
+        self.assertEqual({"action": "deny", "!src_net": "10.0.0.0/8"}, rule)
+        self.assertNotEqual(rule, {"action": "deny"})
+        self.assertEqual(dict(rule), rule.copy())
+
+    def test_immutable(self):
+        ep = WorkloadEndpointRecord([("name", "tap1")])
+        self.assertRaises(AttributeError, setattr, ep, "name", "tap2")
+        self.assertRaises(AttributeError, setattr, ep, "foo", "bar")
+        self.assertFalse(hasattr(ep, "__dict__"))
+        ep2 = ep.replace(state="active")
+        self.assertEqual(ep2, {"name": "tap1", "state": "active"})
+        self.assertEqual(ep, {"name": "tap1"})
+
+    def test_unknown_field(self):
+        self.assertRaises(AttributeError, WorkloadEndpointRecord,
+                          [("foo", "bar")])
+
+    def test_intern_pool_bounded(self):
+        pool = InternPool(max_size=2)
+        pool.add("a", 1)
+        pool.add("b", 2)
+        self.assertEqual(pool.get("a"), 1)
+        pool.add("c", 3)
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.get("a"), None)
+        self.assertEqual(pool.get("c"), 3)
+
+    def test_intern_tuple(self):
+        a = intern_tuple(["a", "b"])
+        self.assertEqual(a, ("a", "b"))
+        self.assertTrue(intern_tuple(iter(["a", "b"])) is a)
+
+
+class TestConversion(BaseTestCase):
+    def make_endpoint(self, name, ip):
+        ep = felixbackend_pb2.WorkloadEndpoint()
+        ep.state = "active"
+        ep.name = name
+        ep.profile_ids.extend(["prof1", "prof2"])
+        ep.ipv4_nets.append(ip)
+        tier = ep.tiers.add()
+        tier.name = "tier1"
+        tier.policies.extend(["pol1", "pol2"])
+        return ep
+
+    def test_endpoints_share_values(self):
+        ep1 = convert_pb_wl_endpoint(self.make_endpoint(u"tap1",
+                                                        u"10.0.0.1/32"))
+        ep2 = convert_pb_wl_endpoint(self.make_endpoint(u"tap2",
+                                                        u"10.0.0.2/32"))
+        self.assertEqual(ep1, {
+            "state": "active",
+            "name": "tap1",
+            "mac": None,
+            "profile_ids": ("prof1", "prof2"),
+            "ipv4_nets": ("10.0.0.1/32",),
+            "ipv6_nets": (),
+            "tiers": ({"name": "tier1", "policies": ("pol1", "pol2")},),
+        })
+        self.assertTrue(isinstance(ep1["name"], str))
+        self.assertTrue(ep1["profile_ids"] is ep2["profile_ids"])
+        self.assertTrue(ep1["tiers"] is ep2["tiers"])
+
+    def test_rules_interned(self):
+        profile = felixbackend_pb2.Profile()
+        for _ in xrange(2):
+            rule = profile.inbound_rules.add()
+            rule.action = "allow"
+            rule.not_src_net = "10.0.0.0/8"
+            rule.protocol.name = "tcp"
+            port_range = rule.dst_ports.add()
+            port_range.first = 80
+            port_range.last = 81
+        rule = profile.outbound_rules.add()
+        rule.action = "deny"
+        rule.icmp_type_code.type = 8
+        rule.icmp_type_code.code = 1
+        rules = convert_pb_profile_rules(profile)
+        inbound = rules["inbound_rules"]
+        self.assertEqual(inbound[0], {
+            "action": "allow",
+            "!src_net": "10.0.0.0/8",
+            "protocol": "tcp",
+            "dst_ports": ("80:81",),
+        })
+        self.assertTrue(inbound[0] is inbound[1])
+        self.assertEqual(rules["outbound_rules"], (
+            {"action": "deny", "icmp_type": 8, "icmp_code": 1},
+        ))
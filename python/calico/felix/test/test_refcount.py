@@ -13,6 +13,9 @@
 # limitations under the License.
 
 import logging
+
+import mock
+
 from calico.felix.actor import actor_message
 from calico.felix.refcount import ReferenceManager, RefCountedActor, \
     RefHelper, LIVE, STOPPING
@@ -119,6 +122,94 @@ class TestReferenceManager(BaseTestCase):
         ])
 
 
+    def test_update_refs(self):
+        objs_by_id = self.call_via_cb(self._rm.update_refs,
+                                      frozenset(["foo", "bar"]), frozenset(),
+                                      async=True)[0]
+        self.assertEqual(set(objs_by_id.keys()), set(["foo", "bar"]))
+        for obj in objs_by_id.itervalues():
+            self.assertEqual(obj.ref_count, 1)
+            self.assertEqual(obj.ref_mgmt_state, LIVE)
+
+        self._rm.update_refs(frozenset(), frozenset(["foo", "bar"]),
+                             async=False)
+        for obj in objs_by_id.itervalues():
+            self.assertEqual(obj.ref_count, 0)
+            self.assertEqual(obj.ref_mgmt_state, STOPPING)
+
+
+class TestLingeringReferenceManager(BaseTestCase):
+    def setUp(self):
+        super(TestLingeringReferenceManager, self).setUp()
+        self._rm = RefMgrForTesting(linger_secs=10, max_lingering_objects=1)
+        self._rm.start()
+
+    def call_via_cb(self, fn, *args, **kwargs):
+        result = AsyncResult()
+        fn(callback=lambda *a: result.set(a),
+           *args, **kwargs)
+        return result.get(timeout=5)
+
+    def test_revive_lingering_object(self):
+        with mock.patch("gevent.spawn_later"):
+            _, obj = self.call_via_cb(self._rm.get_and_incref, "foo",
+                                      async=True)
+            self._rm.decref("foo", async=False)
+            # Object is unreferenced but should be kept alive.
+            self.assertEqual(obj.ref_count, 0)
+            self.assertEqual(obj.ref_mgmt_state, LIVE)
+            self.assertTrue(self._rm._is_starting_or_live("foo"))
+
+            _, new_obj = self.call_via_cb(self._rm.get_and_incref, "foo",
+                                          async=True)
+        self.assertTrue(obj is new_obj)
+        self.assertEqual(new_obj.ref_count, 1)
+        self.assertFalse(self._rm._lingering_deadlines)
+        self.assertEqual(self._rm.ref_actions, [
+            ("rm", "activate 0"),
+            (0, 'on_referenced'),
+        ])
+
+    def test_lru_eviction(self):
+        with mock.patch("gevent.spawn_later"):
+            _, obj_foo = self.call_via_cb(self._rm.get_and_incref, "foo",
+                                          async=True)
+            _, obj_bar = self.call_via_cb(self._rm.get_and_incref, "bar",
+                                          async=True)
+            self._rm.decref("foo", async=False)
+            # Cache only holds one object so foo should get evicted.
+            self._rm.decref("bar", async=False)
+        self.assertEqual(obj_foo.ref_mgmt_state, STOPPING)
+        self.assertEqual(obj_bar.ref_mgmt_state, LIVE)
+        self.assertEqual(self._rm._lingering_deadlines.keys(), ["bar"])
+
+    def test_linger_expiry(self):
+        with mock.patch("gevent.spawn_later") as m_spawn, \
+                mock.patch("calico.felix.refcount.monotonic_time",
+                           autospec=True) as m_time:
+            m_time.return_value = 100
+            _, obj = self.call_via_cb(self._rm.get_and_incref, "foo",
+                                      async=True)
+            self._rm.decref("foo", async=False)
+            self.assertEqual(m_spawn.mock_calls, [mock.call(10, mock.ANY)])
+            expire = m_spawn.call_args[0][1]
+
+            # Timer firing early should reschedule.
+            m_time.return_value = 105
+            m_spawn.reset_mock()
+            expire().get(timeout=5)
+            self.assertEqual(obj.ref_mgmt_state, LIVE)
+            self.assertEqual(m_spawn.mock_calls, [mock.call(5, mock.ANY)])
+
+            # Once the period has passed, the object gets cleaned up.
+            m_time.return_value = 110
+            m_spawn.reset_mock()
+            expire().get(timeout=5)
+        self.assertEqual(obj.ref_mgmt_state, STOPPING)
+        self.assertEqual(m_spawn.mock_calls, [])
+        self.assertFalse(self._rm._lingering_deadlines)
+
+
 class TestRefHelper(TestReferenceManager):
     def setUp(self):
         super(TestRefHelper, self).setUp()
@@ -166,6 +257,29 @@ class TestRefHelper(TestReferenceManager):
         # Spin the actor framework
         _, obj = self.call_via_cb(self._rm.get_and_incref, "bar", async=True)
 
+    def test_replace_all_single_message(self):
+        with mock.patch.object(self._rm, "update_refs") as m_update_refs:
+            self._rh.replace_all(["foo", "bar", "baz"])
+            self.assertEqual(len(m_update_refs.mock_calls), 1)
+            _, args, kwargs = m_update_refs.mock_calls[0]
+            self.assertEqual(args, (frozenset(["foo", "bar", "baz"]),
+                                    frozenset()))
+            self.assertFalse(self._rh.ready)
+
+            # A single callback delivers all the refs.
+            kwargs["callback"]({"foo": "obj1", "bar": "obj2", "baz": "obj3"})
+            _, obj = self.call_via_cb(self._rm.get_and_incref, "x",
+                                      async=True)
+            self.assertTrue(self._rh.ready)
+            self.assertTrue(self._rm._ready_called)
+
+            m_update_refs.reset_mock()
+            self._rh.replace_all(["foo"])
+            m_update_refs.assert_called_once_with(
+                frozenset(), frozenset(["bar", "baz"]), callback=None,
+                async=True
+            )
+
     def test_acquire_discard_2(self):
         # Acquire two references
         self._rh.acquire_ref("foo")
@@ -182,8 +296,8 @@ class TestRefHelper(TestReferenceManager):
 
 
 class RefMgrForTesting(ReferenceManager):
-    def __init__(self):
-        super(RefMgrForTesting, self).__init__()
+    def __init__(self, **kwargs):
+        super(RefMgrForTesting, self).__init__(**kwargs)
         self.idx = 0
         self.ref_actions = []
         self._ready_called = False
@@ -23,11 +23,16 @@ import logging
 
 import mock
 
+from calico.felix.futils import IPV4, IPV6
 from calico.felix.test.base import BaseTestCase, load_config
 from calico.felix.splitter import UpdateSplitter, CleanupManager
 
 _log = logging.getLogger(__name__)
 
+# Methods that route their arguments by IP version rather than passing them
+# straight through.
+PER_IP_TYPE_METHODS = set(["on_ipset_update", "on_ipset_delta_update"])
+
 
 class TestUpdateSplitter(BaseTestCase):
     """
@@ -40,7 +45,8 @@ class TestUpdateSplitter(BaseTestCase):
         self.mgrs_by_method = {}
         mgrs = []
         for attr_name in UpdateSplitter.__dict__:
-            if attr_name.startswith("on_"):
+            if (attr_name.startswith("on_") and
+                    attr_name not in PER_IP_TYPE_METHODS):
                 class Mgr(object):
                     locals()[attr_name] = mock.Mock()
                 mgr = Mgr()
@@ -77,6 +83,35 @@ class TestUpdateSplitter(BaseTestCase):
                                meth_name)
                 raise
 
+    def test_ipset_routing_by_ip_type(self):
+        """
+        Test that IP set members only go to the manager for their IP version.
+        """
+        m_v4_mgr = mock.Mock(ip_type=IPV4)
+        m_v6_mgr = mock.Mock(ip_type=IPV6)
+        splitter = UpdateSplitter([m_v4_mgr, m_v6_mgr])
+
+        splitter.on_ipset_update("s1", {IPV4: ["10.0.0.1"]})
+        self.assertEqual(m_v4_mgr.on_ipset_update.mock_calls,
+                         [mock.call("s1", ["10.0.0.1"], async=True)])
+        # No IPv6 entry so the IPv6 manager shouldn't hear about it.
+        self.assertEqual(m_v6_mgr.on_ipset_update.mock_calls, [])
+
+        # An empty entry is passed on, to clear the IP set.
+        splitter.on_ipset_update("s1", {IPV4: [], IPV6: []})
+        self.assertEqual(m_v4_mgr.on_ipset_update.mock_calls[-1],
+                         mock.call("s1", [], async=True))
+        self.assertEqual(m_v6_mgr.on_ipset_update.mock_calls,
+                         [mock.call("s1", [], async=True)])
+
+        splitter.on_ipset_delta_update("s1",
+                                       {IPV4: [], IPV6: ["feed::1"]},
+                                       {IPV4: [], IPV6: []})
+        # No changes for IPv4 so the IPv4 manager shouldn't hear about it.
+        self.assertEqual(m_v4_mgr.on_ipset_delta_update.mock_calls, [])
+        self.assertEqual(m_v6_mgr.on_ipset_delta_update.mock_calls,
+                         [mock.call("s1", ["feed::1"], [], async=True)])
+
 
 class TestCleanupManager(BaseTestCase):
     def setUp(self):
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_tracebuffer
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the in-memory trace buffer.
+"""
+import logging
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+import mock
+
+from calico.felix import tracebuffer
+from calico.felix.tracebuffer import (
+    TraceBuffer, read_dump, EVENT_MSG_START, EVENT_BATCH_START
+)
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+class TestTraceBuffer(BaseTestCase):
+    def setUp(self):
+        super(TestTraceBuffer, self).setUp()
+        self.buf = TraceBuffer(3)
+
+    def test_records_in_order(self):
+        self.buf.record(EVENT_BATCH_START, "Actor", None, 1)
+        self.buf.record(EVENT_MSG_START, "Actor", "on_update", 1234)
+        self.assertEqual(len(self.buf), 2)
+        self.assertEqual(
+            [r[1:] for r in self.buf.records()],
+            [(EVENT_BATCH_START, "Actor", None, 1),
+             (EVENT_MSG_START, "Actor", "on_update", 1234)]
+        )
+
+    def test_wrap(self):
+        for ii in xrange(5):
+            self.buf.record(EVENT_MSG_START, "Actor", "msg%s" % ii, ii)
+        self.assertEqual(len(self.buf), 3)
+        self.assertEqual([r[4] for r in self.buf.records()], [2, 3, 4])
+
+    def test_write_and_read(self):
+        for ii in xrange(4):
+            self.buf.record(EVENT_MSG_START, "Actor", "msg%s" % ii, ii)
+        f = BytesIO()
+        self.buf.write(f)
+        f.seek(0)
+        self.assertEqual(read_dump(f), self.buf.records())
+
+    def test_read_bad_file(self):
+        self.assertRaises(ValueError, read_dump, BytesIO("not a dump"))
+        f = BytesIO()
+        self.buf.record(EVENT_MSG_START, "Actor", "msg", 1)
+        self.buf.write(f)
+        self.assertRaises(ValueError, read_dump,
+                          BytesIO(f.getvalue()[:-1]))
+
+    @mock.patch("calico.felix.tracebuffer.MAX_STRINGS", 3)
+    def test_string_overflow(self):
+        self.buf.record(EVENT_MSG_START, "Actor(a)", "msg", 1)
+        self.buf.record(EVENT_MSG_START, "Actor(b)", "msg", 2)
+        self.buf.record(EVENT_MSG_START, "Actor(c)", "msg", 3)
+        self.assertEqual(
+            [r[2] for r in self.buf.records()],
+            ["Actor(a)", tracebuffer.OVERFLOW_STRING,
+             tracebuffer.OVERFLOW_STRING]
+        )
+
+    def test_dump(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.buf.record(EVENT_MSG_START, "Actor", "msg", 1)
+            filename = self.buf.dump(tmp_dir)
+            self.assertEqual(os.path.dirname(filename), tmp_dir)
+            with open(filename, "rb") as f:
+                self.assertEqual(len(read_dump(f)), 1)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(self.buf.dump(tmp_dir), None)
+
+    def test_dump_before_exit(self):
+        with mock.patch.object(tracebuffer.trace_buffer, "dump",
+                               autospec=True) as m_dump:
+            tracebuffer.dump_before_exit()
+            m_dump.assert_called_once_with()
+            # Must not raise, so that it can't prevent the exit.
+            m_dump.side_effect = RuntimeError()
+            tracebuffer.dump_before_exit()
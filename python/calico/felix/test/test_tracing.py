@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_tracing
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the tracing of updates through to the dataplane.
+"""
+import logging
+
+import mock
+
+from calico.felix import tracing
+from calico.felix.actor import actor_storage
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+class TestSequenceTracker(BaseTestCase):
+    def setUp(self):
+        super(TestSequenceTracker, self).setUp()
+        self.on_progress = mock.Mock()
+        self.tracker = tracing.SequenceTracker(on_progress=self.on_progress)
+
+    def test_in_order(self):
+        t1 = self.tracker.start_trace(1, "policy")
+        t2 = self.tracker.start_trace(2, "policy")
+        t1.release()
+        self.on_progress.assert_called_once_with(1)
+        t2.release()
+        self.assertEqual(self.tracker.highest_programmed, 2)
+        self.assertEqual(self.on_progress.mock_calls,
+                         [mock.call(1), mock.call(2)])
+
+    def test_out_of_order(self):
+        t1 = self.tracker.start_trace(1, "policy")
+        t2 = self.tracker.start_trace(2, "policy")
+        t3 = self.tracker.start_trace(3, "policy")
+        t3.release()
+        t2.release()
+        # Can't advance past 1 until it completes.
+        self.assertFalse(self.on_progress.called)
+        self.assertEqual(self.tracker.highest_programmed, None)
+        t1.release()
+        self.on_progress.assert_called_once_with(3)
+
+    def test_refs(self):
+        t1 = self.tracker.start_trace(1, "policy")
+        t1.add_ref()
+        t1.release()
+        self.assertFalse(self.on_progress.called)
+        t1.release()
+        self.on_progress.assert_called_once_with(1)
+
+    def test_expiry(self):
+        tracker = tracing.SequenceTracker(on_progress=self.on_progress,
+                                          timeout=60)
+        t1 = tracker.start_trace(1, "policy", receipt_time=10)
+        t2 = tracker.start_trace(2, "policy", receipt_time=20)
+        t2.release()
+        # Not yet timed out.
+        t3 = tracker.start_trace(3, "policy", receipt_time=70)
+        self.assertFalse(self.on_progress.called)
+        # t1 has now been outstanding for too long so we stop waiting for
+        # it, but t3 is still outstanding.
+        tracker.start_trace(4, "policy", receipt_time=71)
+        self.on_progress.assert_called_once_with(2)
+        # Completing an expired trace has no effect on progress.
+        t1.release()
+        self.on_progress.assert_called_once_with(2)
+        t3.release()
+        self.assertEqual(self.on_progress.mock_calls,
+                         [mock.call(2), mock.call(3)])
+
+    @mock.patch("calico.felix.tracing.monotonic_time", autospec=True)
+    @mock.patch("calico.felix.tracing._latency_histogram", autospec=True)
+    def test_latency_recorded(self, m_hist, m_time):
+        m_time.return_value = 10
+        t1 = self.tracker.start_trace(1, "workload_endpoint")
+        t2 = self.tracker.start_trace(2, "profile")
+        m_time.return_value = 10.5
+        actor_storage.traces = (t1,)
+        try:
+            tracing.mark_programmed()
+        finally:
+            actor_storage.traces = None
+        t1.release()
+        t2.release()
+        # Only the update that caused a dataplane commit gets a sample.
+        m_hist.labels.assert_called_once_with("workload_endpoint")
+        m_hist.labels.return_value.observe.assert_called_once_with(0.5)
+
+    def test_mark_programmed_untraced(self):
+        tracing.mark_programmed()  # Should be a no-op.
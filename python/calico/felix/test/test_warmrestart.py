@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_warmrestart
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for warm restart.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import mock
+
+from calico.felix import warmrestart
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.futils import CommandOutput
+from calico.felix.ipsets import IpsetActor
+from calico.felix.test.base import BaseTestCase, load_config
+
+_log = logging.getLogger(__name__)
+
+IPT_SAVE = """*filter
+:INPUT ACCEPT [0:0]
+:felix-empty - [0:0]
+:felix-foo - [0:0]
+-A INPUT -j felix-foo
+-A felix-foo -p tcp -m tcp --dport 80 -j ACCEPT
+-A felix-foo -j DROP
+COMMIT
+"""
+
+IPSET_SAVE = """create felix-4-foo hash:ip family inet hashsize 1024 maxelem 10
+add felix-4-foo 10.0.0.2
+add felix-4-foo 10.0.0.1
+create other hash:ip family inet hashsize 1024 maxelem 10
+add other 10.0.0.3
+"""
+
+FOO_SAVED = ["-A felix-foo -p tcp -m tcp --dport 80 -j ACCEPT",
+             "-A felix-foo -j DROP"]
+FOO_IPSET_DIGEST = warmrestart.ipset_digest(
+    warmrestart.members_digest(["10.0.0.1", "10.0.0.2"]), 10
+)
+FOO_UPDATES = ["--flush felix-foo",
+               "--append felix-foo --protocol tcp --dport 80 --jump ACCEPT",
+               "--append felix-foo --jump DROP"]
+
+
+class WarmRestartTestCase(BaseTestCase):
+    def setUp(self):
+        super(WarmRestartTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "felix-dataplane-v4.json")
+        self.warm_restart = warmrestart.WarmRestart(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(WarmRestartTestCase, self).tearDown()
+
+    def write_snapshot_file(self, objects):
+        with open(self.path, "w") as f:
+            json.dump({"version": warmrestart.SNAPSHOT_VERSION,
+                       "objects": objects}, f)
+
+
+class TestParsing(BaseTestCase):
+    def test_parse_iptables_save(self):
+        self.assertEqual(warmrestart.parse_iptables_save(IPT_SAVE, "filter"),
+                         {"felix-empty": [], "felix-foo": FOO_SAVED})
+        self.assertEqual(warmrestart.parse_iptables_save(IPT_SAVE, "nat"),
+                         {})
+
+    def test_parse_ipset_save(self):
+        self.assertEqual(
+            warmrestart.parse_ipset_save(IPSET_SAVE),
+            {"felix-4-foo": FOO_IPSET_DIGEST}
+        )
+
+    def test_members_digest(self):
+        self.assertEqual(
+            warmrestart.members_digest(["10.0.0.1", "10.0.0.2"]),
+            warmrestart.members_digest(["10.0.0.2", "10.0.0.1"])
+        )
+        self.assertEqual(
+            warmrestart.members_digest(["10.0.0.1", "10.0.0.2"]) ^
+            warmrestart.member_hash("10.0.0.2"),
+            warmrestart.members_digest(["10.0.0.1"])
+        )
+
+
+class TestCreate(BaseTestCase):
+    def test_disabled(self):
+        config = load_config("felix_default.cfg")
+        self.assertEqual(warmrestart.create(config, 4), None)
+
+    def test_nftables(self):
+        config = load_config("felix_default.cfg",
+                             global_dict={"WarmRestartDir": "/tmp",
+                                          "DataplaneBackend": "nftables"})
+        self.assertEqual(warmrestart.create(config, 4), None)
+
+    def test_enabled(self):
+        config = load_config("felix_default.cfg",
+                             global_dict={"WarmRestartDir": "/tmp"})
+        self.assertEqual(warmrestart.create(config, 6).path,
+                         "/tmp/felix-dataplane-v6.json")
+
+
+class TestStart(WarmRestartTestCase):
+    def test_verify_ipsets(self):
+        self.write_snapshot_file({
+            "ipsets": {
+                "felix-4-foo": ["d1", FOO_IPSET_DIGEST],
+                "felix-4-bar": ["d2", "missing"],
+            },
+            "filter": {"felix-foo": ["d3", "d4"]},
+        })
+        with mock.patch("calico.felix.futils.check_call", autospec=True) \
+                as m_check_call, \
+                mock.patch("gevent.spawn") as m_spawn:
+            m_check_call.return_value = CommandOutput(IPSET_SAVE, "")
+            self.assertEqual(self.warm_restart.start(),
+                             [m_spawn.return_value])
+        m_check_call.assert_called_once_with(["ipset", "save"])
+        self.assertEqual(self.warm_restart._verified,
+                         {"ipsets": {"felix-4-foo": "d1"}})
+        # Chains are verified when the updater loads them.
+        self.assertEqual(self.warm_restart._loaded,
+                         {"filter": {"felix-foo": ["d3", "d4"]}})
+        self.assertFalse(self.warm_restart.unchanged_since_restart(
+            "ipsets", "felix-4-foo", "changed"))
+        # Only matches once.
+        self.assertFalse(self.warm_restart.unchanged_since_restart(
+            "ipsets", "felix-4-foo", "d1"))
+
+    def test_bad_snapshot(self):
+        with open(self.path, "w") as f:
+            f.write("{")
+        with mock.patch("gevent.spawn"):
+            self.warm_restart.start()
+        self.assertEqual(self.warm_restart._loaded, {})
+
+
+class TestIptablesUpdater(WarmRestartTestCase):
+    def setUp(self):
+        super(TestIptablesUpdater, self).setUp()
+        self.warm_restart._loaded["filter"] = {
+            "felix-foo": [warmrestart.digest(FOO_UPDATES),
+                          warmrestart.digest(FOO_SAVED)],
+            # Rewritten before the last snapshot, so we don't know how
+            # iptables-save shows it yet.
+            "felix-empty": [warmrestart.digest(["--flush felix-empty"]),
+                            None],
+        }
+        config = load_config("felix_default.cfg",
+                             env_dict={"FELIX_REFRESHINTERVAL": "0"})
+        with mock.patch("gevent.subprocess.check_output", autospec=True,
+                        return_value=IPT_SAVE):
+            self.ipt = IptablesUpdater("filter", config, 4,
+                                       warm_restart=self.warm_restart)
+            self.step_actor(self.ipt)
+        self.ipt._execute_iptables = mock.Mock()
+
+    def rewrite_foo(self, updates):
+        self.ipt.rewrite_chains({"felix-foo": updates[1:]}, {}, async=True)
+        self.step_actor(self.ipt)
+
+    def test_unchanged_chain_skipped(self):
+        self.rewrite_foo(FOO_UPDATES)
+        self.assertFalse(self.ipt._execute_iptables.called)
+        self.assertEqual(self.warm_restart._programmed["filter"],
+                         {"felix-foo": [warmrestart.digest(FOO_UPDATES),
+                                        warmrestart.digest(FOO_SAVED)]})
+        # Only the first rewrite is skipped.
+        self.rewrite_foo(FOO_UPDATES)
+        self.assertTrue(self.ipt._execute_iptables.called)
+
+    def test_changed_chain_rewritten(self):
+        updates = FOO_UPDATES[:2]
+        self.rewrite_foo(updates)
+        input_lines = self.ipt._execute_iptables.mock_calls[0][1][0]
+        self.assertTrue("--append felix-foo --jump DROP" not in input_lines)
+        self.assertTrue(updates[1] in input_lines)
+        # We don't know how iptables-save shows the new rules.
+        self.assertEqual(self.warm_restart._programmed["filter"],
+                         {"felix-foo": [warmrestart.digest(updates), None]})
+
+    def test_saved_digest_learned(self):
+        self.ipt.rewrite_chains({"felix-empty": []}, {}, async=True)
+        self.step_actor(self.ipt)
+        # Not verified, so rewritten, but the rules are the same as before
+        # the restart so we learn the saved digest.
+        self.assertTrue(self.ipt._execute_iptables.called)
+        self.assertEqual(self.warm_restart._programmed["filter"],
+                         {"felix-empty": [
+                             warmrestart.digest(["--flush felix-empty"]),
+                             warmrestart.digest([])
+                         ]})
+
+    def test_failed_write_not_recorded(self):
+        self.ipt._execute_iptables.side_effect = OSError()
+        result = self.ipt.rewrite_chains({"felix-bar": []}, {}, async=True)
+        self.step_actor(self.ipt)
+        self.assertRaises(OSError, result.get)
+        self.assertEqual(self.warm_restart._programmed["filter"],
+                         {"felix-bar": None})
+
+
+class TestIpsetActor(WarmRestartTestCase):
+    def setUp(self):
+        super(TestIpsetActor, self).setUp()
+        self.ipset = mock.Mock()
+        self.ipset.set_name = "felix-4-foo"
+        self.ipset.max_elem = 10
+        self.actor = IpsetActor(self.ipset, warm_restart=self.warm_restart)
+        self.members = set(["10.0.0.1", "10.0.0.2"])
+
+    def test_unchanged_ipset_skipped(self):
+        self.warm_restart._verified["ipsets"] = {
+            "felix-4-foo": FOO_IPSET_DIGEST
+        }
+        self.actor.replace_members(self.members, async=True)
+        self.step_actor(self.actor)
+        self.assertFalse(self.ipset.replace_members.called)
+        self.assertEqual(self.warm_restart._programmed["ipsets"],
+                         {"felix-4-foo": [FOO_IPSET_DIGEST,
+                                          FOO_IPSET_DIGEST]})
+
+    def test_deltas_tracked(self):
+        self.actor.replace_members(set(["10.0.0.1", "10.0.0.3"]), async=True)
+        self.step_actor(self.actor)
+        self.ipset.replace_members.assert_called_once_with(
+            set(["10.0.0.1", "10.0.0.3"])
+        )
+        self.actor.add_members(["10.0.0.2"], async=True)
+        self.actor.remove_members(["10.0.0.3"], async=True)
+        self.step_actor(self.actor)
+        self.ipset.apply_changes.assert_called_once_with(set(["10.0.0.2"]),
+                                                         set(["10.0.0.3"]))
+        self.assertEqual(self.warm_restart._programmed["ipsets"],
+                         {"felix-4-foo": [FOO_IPSET_DIGEST,
+                                          FOO_IPSET_DIGEST]})
+
+
+class TestWriteSnapshot(WarmRestartTestCase):
+    def test_write(self):
+        self.warm_restart.record("filter", "felix-foo", "d1", saved="s1")
+        self.warm_restart.record("filter", "felix-gone", "d2")
+        self.warm_restart.forget("filter", "felix-gone")
+        self.warm_restart.record("ipsets", "felix-4-foo", "d3", saved="d3")
+        # Being written.
+        self.warm_restart.mark_dirty("ipsets", ["felix-4-bar"])
+
+        with mock.patch("calico.felix.futils.check_call",
+                        autospec=True) as m_check_call:
+            self.warm_restart.write_snapshot()
+        # The snapshot is built from what we recorded; the dataplane isn't
+        # read.
+        self.assertFalse(m_check_call.called)
+        with open(self.path) as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot, {
+            "version": warmrestart.SNAPSHOT_VERSION,
+            "objects": {
+                "filter": {"felix-foo": ["d1", "s1"]},
+                "ipsets": {"felix-4-foo": ["d3", "d3"]},
+            },
+        })
+
+        # Nothing changed, so the next snapshot is skipped.
+        os.unlink(self.path)
+        self.warm_restart.write_snapshot()
+        self.assertFalse(os.path.exists(self.path))
+        self.warm_restart.record("ipsets", "felix-4-bar", "d4", saved="d4")
+        self.warm_restart.write_snapshot()
+        self.assertTrue(os.path.exists(self.path))
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.tracebuffer
+~~~~~~~~~~~~~~~~~
+
+Always-on, in-memory ring buffer of hot-path events.
+
+Debug logging is far too expensive to leave on in production so, instead,
+the actor framework, the driver message reader and check_call() record
+compact records of what they're doing into a fixed-size, preallocated
+ring buffer.  Each record is a timestamp, an event type, two interned
+strings (for example, the actor and message names) and an integer (for
+example, the message ID).  When the buffer is full, the oldest records are
+overwritten.
+
+The buffer is written to a file in TraceBufferDir on SIGUSR1 and when
+Felix dies, including via die_and_restart() and when an actor fails;
+utils/decode-trace-buffer.py renders the file as a timeline.
+"""
+import array
+import logging
+import os
+import struct
+import time
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 100000
+
+# Event types.
+EVENT_MSG_START = 1
+EVENT_BATCH_START = 2
+EVENT_FINISH_BATCH = 3
+EVENT_BATCH_END = 4
+EVENT_BATCH_SPLIT = 5
+EVENT_SUBPROCESS_START = 6
+EVENT_SUBPROCESS_END = 7
+EVENT_DRIVER_MSG = 8
+
+EVENT_NAMES = {
+    EVENT_MSG_START: "msg-start",
+    EVENT_BATCH_START: "batch-start",
+    EVENT_FINISH_BATCH: "finish-batch",
+    EVENT_BATCH_END: "batch-end",
+    EVENT_BATCH_SPLIT: "batch-split",
+    EVENT_SUBPROCESS_START: "subprocess-start",
+    EVENT_SUBPROCESS_END: "subprocess-end",
+    EVENT_DRIVER_MSG: "driver-msg",
+}
+
+# Limit on the number of distinct strings that we intern, so that, for
+# example, the names of short-lived per-endpoint actors can't grow the
+# string table without bound.  Further strings are recorded as
+# OVERFLOW_STRING.
+MAX_STRINGS = 65536
+OVERFLOW_STRING = "<too many strings>"
+
+# File format: a header, the string table (each string prefixed with its
+# length) and then the records, oldest first.  Little-endian throughout.
+MAGIC = "FLXTRCE1"
+_HEADER = struct.Struct("<8sII")
+_STRING_LEN = struct.Struct("<H")
+_RECORD = struct.Struct("<dBIIq")
+
+
+class TraceBuffer(object):
+    def __init__(self, size=DEFAULT_SIZE):
+        self.resize(size)
+        # Directory that dump() writes to by default; set from config.
+        self.dump_dir = "/tmp"
+
+    def resize(self, size):
+        """
+        Reallocates the buffer with room for the given number of records,
+        discarding its contents.
+        """
+        self.size = size
+        self._times = array.array("d", [0.0]) * size
+        self._events = array.array("B", [0]) * size
+        self._names = array.array("I", [0]) * size
+        self._details = array.array("I", [0]) * size
+        self._values = array.array("l", [0]) * size
+        # String ID 0 is reserved for None.
+        self._strings = [""]
+        self._string_ids = {None: 0}
+        # Index of the next record to write and whether we've wrapped.
+        self._next = 0
+        self._wrapped = False
+
+    def record(self, event, name, detail=None, value=0):
+        """
+        Records an event.  Must be fast, since it's called for every actor
+        message.
+
+        :param event: One of the EVENT_* constants.
+        :param name: String, for example, the name of the actor.
+        :param detail: String or None, for example, the message name.
+        :param value: Integer, for example, the message ID.
+        """
+        i = self._next
+        self._times[i] = time.time()
+        self._events[i] = event
+        ids = self._string_ids
+        try:
+            self._names[i] = ids[name]
+        except KeyError:
+            self._names[i] = self._intern(name)
+        try:
+            self._details[i] = ids[detail]
+        except KeyError:
+            self._details[i] = self._intern(detail)
+        self._values[i] = value
+        i += 1
+        if i == self.size:
+            i = 0
+            self._wrapped = True
+        self._next = i
+
+    def _intern(self, s):
+        if len(self._strings) >= MAX_STRINGS:
+            s = OVERFLOW_STRING
+            if s in self._string_ids:
+                return self._string_ids[s]
+        string_id = len(self._strings)
+        self._strings.append(s)
+        self._string_ids[s] = string_id
+        return string_id
+
+    def __len__(self):
+        return self.size if self._wrapped else self._next
+
+    def records(self):
+        """
+        :returns a list of (timestamp, event, name, detail, value) tuples,
+            oldest first.
+        """
+        if self._wrapped:
+            indexes = range(self._next, self.size) + range(self._next)
+        else:
+            indexes = range(self._next)
+        strings = self._strings
+        return [(self._times[i],
+                 self._events[i],
+                 strings[self._names[i]],
+                 strings[self._details[i]] if self._details[i] else None,
+                 self._values[i]) for i in indexes]
+
+    def write(self, f):
+        """
+        Writes the contents of the buffer to the given file object.
+        """
+        f.write(_HEADER.pack(MAGIC, len(self._strings), len(self)))
+        for s in self._strings:
+            if isinstance(s, unicode):
+                s = s.encode("utf-8")
+            else:
+                s = str(s)
+            f.write(_STRING_LEN.pack(len(s)))
+            f.write(s)
+        if self._wrapped:
+            indexes = range(self._next, self.size) + range(self._next)
+        else:
+            indexes = range(self._next)
+        for i in indexes:
+            f.write(_RECORD.pack(self._times[i], self._events[i],
+                                 self._names[i], self._details[i],
+                                 self._values[i]))
+
+    def dump(self, directory=None):
+        """
+        Writes the contents of the buffer to a new file in the given
+        directory, or in dump_dir if it is None.
+
+        :returns the name of the file or None on failure.
+        """
+        if directory is None:
+            directory = self.dump_dir
+        filename = os.path.join(
+            directory,
+            "felix-trace-%s-%s.bin" % (os.getpid(),
+                                       time.strftime("%Y%m%dT%H%M%S"))
+        )
+        try:
+            with open(filename, "wb") as f:
+                self.write(f)
+        except (IOError, OSError):
+            _log.exception("Failed to write trace buffer to %s", filename)
+            return None
+        _log.info("Wrote %s trace records to %s", len(self), filename)
+        return filename
+
+
+def read_dump(f):
+    """
+    Reads a file written by TraceBuffer.write().
+
+    :returns a list of (timestamp, event, name, detail, value) tuples,
+        oldest first.
+    :raises ValueError if the file is not a trace buffer dump.
+    """
+    magic, num_strings, num_records = _HEADER.unpack(
+        _read_exactly(f, _HEADER.size)
+    )
+    if magic != MAGIC:
+        raise ValueError("Not a Felix trace buffer dump")
+    strings = []
+    for _ in xrange(num_strings):
+        length, = _STRING_LEN.unpack(_read_exactly(f, _STRING_LEN.size))
+        strings.append(_read_exactly(f, length))
+    records = []
+    for _ in xrange(num_records):
+        timestamp, event, name_id, detail_id, value = _RECORD.unpack(
+            _read_exactly(f, _RECORD.size)
+        )
+        records.append((timestamp, event, strings[name_id],
+                        strings[detail_id] if detail_id else None, value))
+    return records
+
+
+def _read_exactly(f, num_bytes):
+    data = f.read(num_bytes)
+    if len(data) != num_bytes:
+        raise ValueError("Truncated trace buffer dump")
+    return data
+
+
+# The buffer that Felix records into.  Always allocated so that the hot
+# paths needn't check for it; felix.py resizes it according to config.
+trace_buffer = TraceBuffer()
+
+
+def dump_before_exit():
+    """
+    Writes the trace buffer to its dump directory.  For use just before
+    Felix exits because of an error; it never raises, so that it can't
+    stop the exit.
+    """
+    try:
+        trace_buffer.dump()
+    except Exception:
+        _log.exception("Failed to dump trace buffer before exiting")
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.tracing
+~~~~~~~~~~~~~
+
+Tracing of updates from the driver through to the dataplane.
+
+The DatastoreReader starts an UpdateTrace for each message that it
+receives, keyed on the message's sequence number.  The actor framework
+carries the traces of the message that an actor is processing onto any
+messages that it sends, so a trace follows its update through the
+UpdateSplitter and the managers down to the actors that program the
+dataplane.  Each message holds a reference to its traces until it has
+been processed, so a trace completes once all the work that resulted from
+its update is done.
+
+The points that program the dataplane (iptables-restore and ipset
+restore) call mark_programmed().  When a trace completes, the time from
+receipt of its update to the last of those commits is recorded in a
+histogram, labelled by resource type, and the SequenceTracker works out
+the highest sequence number for which all updates are fully programmed.
+A trace that is still outstanding after TRACE_TIMEOUT_SECS is given up on
+so that a message that is never processed can't stall that number forever.
+
+Tracing costs something on every actor message so it is off unless
+enabled with calico.felix.actor.set_tracing_enabled().
+"""
+import collections
+import logging
+
+from prometheus_client import Gauge, Histogram
+
+from calico.felix.actor import actor_storage
+from calico.monotonic import monotonic_time
+
+_log = logging.getLogger(__name__)
+
+# Time after which the SequenceTracker stops waiting for an outstanding
+# trace.
+TRACE_TIMEOUT_SECS = 60
+
+_latency_histogram = Histogram(
+    "felix_update_programming_latency_seconds",
+    "Time from receipt of an update from the driver to the last dataplane "
+    "commit that resulted from it.",
+    ["resource_type"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+             60, float("inf")),
+)
+_programmed_seq_no_gauge = Gauge(
+    "felix_dataplane_programmed_seq_no",
+    "Highest sequence number for which all the updates from the driver "
+    "have been fully programmed."
+)
+
+
+class UpdateTrace(object):
+    """
+    Trace of a single update from the driver.
+
+    Reference counted: the tracker holds a reference until the update has
+    been dispatched and each actor message that carries the trace holds a
+    reference until it has been processed.
+    """
+    __slots__ = ("seq_no", "resource_type", "receipt_time",
+                 "programmed_time", "complete", "_refs", "_tracker")
+
+    def __init__(self, tracker, seq_no, resource_type, receipt_time):
+        self.seq_no = seq_no
+        self.resource_type = resource_type
+        self.receipt_time = receipt_time
+        # Time of the last dataplane commit made on behalf of this update,
+        # or None if it hasn't caused any commits.
+        self.programmed_time = None
+        self.complete = False
+        self._refs = 1
+        self._tracker = tracker
+
+    def add_ref(self):
+        self._refs += 1
+
+    def release(self):
+        self._refs -= 1
+        if self._refs == 0:
+            self._tracker.on_trace_complete(self)
+
+    def __str__(self):
+        return "UpdateTrace(%s, %s)" % (self.seq_no, self.resource_type)
+
+
+class SequenceTracker(object):
+    """
+    Tracks the outstanding UpdateTraces and the highest fully-programmed
+    sequence number.
+
+    The driver sends its messages with increasing sequence numbers but
+    they can complete in any order so we keep the outstanding traces in
+    arrival order and only advance past the oldest once it is complete,
+    or once it has been outstanding for longer than the timeout.  The
+    timeout is only checked when a new trace starts, which is when we
+    already have the time to hand.
+    """
+
+    def __init__(self, on_progress=None, timeout=TRACE_TIMEOUT_SECS):
+        """
+        :param on_progress: Optional callback, called with the new highest
+            fully-programmed sequence number each time it advances.
+        :param timeout: Time after which we stop waiting for an
+            outstanding trace.
+        """
+        self._on_progress = on_progress
+        self._timeout = timeout
+        self._outstanding = collections.deque()
+        self.highest_programmed = None
+
+    def start_trace(self, seq_no, resource_type, receipt_time=None):
+        """
+        Starts tracing the update with the given sequence number.
+
+        The caller owns the initial reference to the returned trace and
+        must call release() on it once it has dispatched the update.
+        """
+        if receipt_time is None:
+            receipt_time = monotonic_time()
+        if (self._outstanding and
+                receipt_time - self._outstanding[0].receipt_time >
+                self._timeout):
+            self._advance(expire_before=receipt_time - self._timeout)
+        trace = UpdateTrace(self, seq_no, resource_type, receipt_time)
+        self._outstanding.append(trace)
+        return trace
+
+    def on_trace_complete(self, trace):
+        _log.debug("%s complete", trace)
+        if trace.programmed_time is not None:
+            _latency_histogram.labels(trace.resource_type).observe(
+                trace.programmed_time - trace.receipt_time
+            )
+        trace.complete = True
+        self._advance()
+
+    def _advance(self, expire_before=None):
+        """
+        Pops the complete traces from the front of the queue, along with
+        any incomplete ones that started before expire_before, and reports
+        progress if that moved us on.
+        """
+        highest = None
+        while self._outstanding:
+            trace = self._outstanding[0]
+            if not trace.complete:
+                if (expire_before is None or
+                        trace.receipt_time >= expire_before):
+                    break
+                _log.warning("%s still outstanding after %ss, no longer "
+                             "waiting for it.", trace, self._timeout)
+            highest = self._outstanding.popleft().seq_no
+        if highest is not None:
+            self.highest_programmed = highest
+            _programmed_seq_no_gauge.set(highest)
+            if self._on_progress is not None:
+                self._on_progress(highest)
+
+
+def mark_programmed():
+    """
+    Records that the current greenlet has just committed a change to
+    the dataplane on behalf of the traces that it is processing.
+    """
+    traces = getattr(actor_storage, "traces", None)
+    if traces:
+        now = monotonic_time()
+        for trace in traces:
+            trace.programmed_time = now
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.warmrestart
+~~~~~~~~~~~~~~~~~
+
+Warm restart: after a restart, skip rewriting the iptables chains and
+ipsets that are already programmed as Felix wants them.
+
+If WarmRestartDir is set, each Dataplane owns a WarmRestart, which it
+passes to its IptablesUpdaters and ipset actors.  They record a digest
+of each chain and ipset that they program, and the WarmRestart
+periodically writes the recorded digests to a snapshot file.  Writing a
+snapshot never reads the dataplane.
+
+At start of day, the dataplane is read once: the IptablesUpdaters already
+run one iptables-save per table, and the WarmRestart runs one ipset save.
+Each object in the snapshot that is unchanged in the dataplane is
+"verified".  The first time that Felix programs a verified object, if its
+digest is unchanged, it skips the write.  On a stable host, a restart
+then only rewrites the objects that changed while Felix was down.
+
+An ipset's digest is calculated from its members and size, so it can be
+checked against ipset save directly.  iptables normalises the rules that
+it is given, so for each chain the snapshot also holds a digest of the
+chain as iptables-save showed it.  We learn that at start of day, from
+the chains that we program with the same rules as before the restart.  A
+chain that was rewritten with new rules is only verified on the restart
+after next.
+"""
+import errno
+import hashlib
+import json
+import logging
+import os
+from collections import defaultdict
+
+import gevent
+
+from calico.felix import futils
+from calico.felix.futils import FailedSystemCall
+
+_log = logging.getLogger(__name__)
+
+# Key of the ipsets in the snapshot.  The chains are keyed by table.
+IPSETS_KEY = "ipsets"
+
+# Interval between snapshots, in seconds.
+SNAPSHOT_INTERVAL = 30
+SNAPSHOT_VERSION = 1
+
+
+def create(config, ip_version):
+    """
+    :returns: a WarmRestart for the given IP version's Dataplane, or None
+        if warm restart is disabled.
+    """
+    if config.WARM_RESTART_DIR is None:
+        return None
+    if config.DATAPLANE_BACKEND != "iptables":
+        _log.warning("Warm restart is only supported with the iptables "
+                     "dataplane backend, disabling.")
+        return None
+    return WarmRestart(os.path.join(config.WARM_RESTART_DIR,
+                                    "felix-dataplane-v%s.json" % ip_version))
+
+
+class WarmRestart(object):
+    """
+    Warm restart state for one Dataplane.  Only used from the gevent loop,
+    by the Dataplane's actors.
+    """
+    def __init__(self, path):
+        self.path = path
+        # Snapshot loaded at start of day, by key: {name: [desired, saved]}.
+        # Each key is removed once it has been verified.
+        self._loaded = {}
+        # Objects that are unchanged since the snapshot, by key:
+        # {name: desired}.
+        self._verified = {}
+        # The saved digests of the chains that we found in the dataplane at
+        # start of day, by key: {name: (desired, saved)}, where desired is
+        # the digest that we last programmed the chain with.
+        self._start_of_day = {}
+        # What we've programmed, by key: {name: [desired, saved]}.  The
+        # value is None while the object is being written.
+        self._programmed = defaultdict(dict)
+        # Set when _programmed changes; cleared when we write a snapshot.
+        self._changed = False
+
+    def start(self):
+        """
+        Loads the snapshot, verifies the ipsets in it against the dataplane
+        and starts writing snapshots.  Must be called before the
+        IptablesUpdaters are started.
+
+        :returns: the greenlets to monitor for failure.
+        """
+        self._loaded = _load_snapshot(self.path)
+        if self._loaded.get(IPSETS_KEY):
+            try:
+                ipset_output = futils.check_call(["ipset", "save"]).stdout
+            except FailedSystemCall:
+                _log.exception("Failed to load ipsets, they will be "
+                               "rewritten.")
+                self._loaded.pop(IPSETS_KEY)
+            else:
+                self._verify(IPSETS_KEY, parse_ipset_save(ipset_output))
+        greenlet = gevent.spawn(self._loop_writing_snapshots)
+        return [greenlet]
+
+    def on_chains_loaded(self, table, raw_ipt_save_output):
+        """
+        Called by the IptablesUpdater with the output from iptables-save at
+        start of day.  Verifies the table's chains in the snapshot.
+        """
+        if table not in self._loaded:
+            return
+        saved_digests = dict(
+            (name, digest(lines)) for name, lines in
+            parse_iptables_save(raw_ipt_save_output, table).iteritems()
+        )
+        snapshot = self._loaded[table]
+        self._start_of_day[table] = dict(
+            (name, (desired, saved_digests[name]))
+            for name, (desired, _) in snapshot.iteritems()
+            if name in saved_digests
+        )
+        self._verify(table, saved_digests)
+
+    def _verify(self, key, saved_digests):
+        """
+        Records the objects in the loaded snapshot that are unchanged in
+        the dataplane.
+
+        :param saved_digests: dict mapping object name to the digest of its
+            contents in the dataplane.
+        """
+        snapshot = self._loaded.pop(key, {})
+        verified = {}
+        for name, (desired, saved) in snapshot.iteritems():
+            if saved is not None and saved_digests.get(name) == saved:
+                verified[name] = desired
+        _log.info("Warm restart: %s of %s %s objects unchanged since the "
+                  "last snapshot", len(verified), len(snapshot), key)
+        self._verified[key] = verified
+
+    def unchanged_since_restart(self, key, name, desired):
+        """
+        :returns: True if the object was verified at start of day and its
+            desired digest is unchanged, in which case it doesn't need to
+            be rewritten.  Only returns True once for each object.
+        """
+        verified = self._verified.get(key)
+        if not verified:
+            return False
+        return verified.pop(name, None) == desired
+
+    def mark_dirty(self, key, names):
+        """
+        Records that the given objects are about to be written.  They're
+        left out of snapshots until they've been recorded again.
+        """
+        programmed = self._programmed[key]
+        for name in names:
+            programmed[name] = None
+        self._changed = True
+
+    def record(self, key, name, desired, saved=None):
+        """
+        Records that the given object is programmed with the given desired
+        digest.
+
+        :param saved: digest of the object as the dataplane will report it
+            at start of day, if known.  For a chain, we use the digest that
+            we found at start of day if the chain is programmed with the
+            same rules as it was then.
+        """
+        if saved is None:
+            start_of_day = self._start_of_day.get(key)
+            if start_of_day:
+                sod_desired, sod_saved = start_of_day.pop(name, (None, None))
+                if sod_desired == desired:
+                    saved = sod_saved
+        self._programmed[key][name] = [desired, saved]
+        self._changed = True
+
+    def forget(self, key, name):
+        """
+        Records that the given object is no longer programmed.
+        """
+        self._programmed[key].pop(name, None)
+        self._changed = True
+
+    def _loop_writing_snapshots(self):
+        while True:
+            gevent.sleep(SNAPSHOT_INTERVAL)
+            try:
+                self.write_snapshot()
+            except (IOError, OSError):
+                _log.exception("Failed to write warm restart snapshot, will "
+                               "retry.")
+
+    def write_snapshot(self):
+        """
+        Writes a snapshot of what we've programmed, if it has changed since
+        the last snapshot.
+        """
+        if not self._changed:
+            _log.debug("Programmed state unchanged, skipping snapshot")
+            return
+        objects = {}
+        for key, programmed in self._programmed.iteritems():
+            objects[key] = dict((name, digests) for name, digests in
+                                programmed.iteritems()
+                                if digests is not None)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "objects": objects}, f)
+        os.rename(tmp_path, self.path)
+        self._changed = False
+        _log.info("Wrote warm restart snapshot to %s", self.path)
+
+
+def digest(lines):
+    data = "\n".join(lines)
+    if isinstance(data, unicode):
+        data = data.encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+def member_hash(member):
+    """
+    :returns: hash of an ipset member, as an int.  The XOR of the hashes of
+        an ipset's members is a digest of its contents that can be updated
+        incrementally.
+    """
+    return int(hashlib.sha1(member).hexdigest()[:16], 16)
+
+
+def members_digest(members):
+    result = 0
+    for member in members:
+        result ^= member_hash(member)
+    return result
+
+
+def ipset_digest(members_xor, max_elem):
+    """
+    :returns: the digest of an ipset.
+    """
+    return "%016x-%s" % (members_xor, max_elem)
+
+
+def parse_iptables_save(raw_ipt_save_output, table):
+    """
+    :returns: dict mapping the name of each of our chains in the given
+        table to its list of rules, as output by iptables-save.
+    """
+    chains = {}
+    current_table = None
+    for line in raw_ipt_save_output.splitlines():
+        line = line.strip()
+        if line.startswith("*"):
+            current_table = line[1:]
+        elif current_table != table:
+            continue
+        elif line.startswith(":felix-"):
+            chains[line[1:].split()[0]] = []
+        elif line.startswith("-A felix-"):
+            chains[line.split()[1]].append(line)
+    return chains
+
+
+def parse_ipset_save(raw_ipset_save_output):
+    """
+    :returns: dict mapping the name of each of our ipsets to its digest, as
+        calculated by ipset_digest().
+    """
+    max_elems = {}
+    members_xors = {}
+    for line in raw_ipset_save_output.splitlines():
+        words = line.split()
+        if len(words) < 3 or not words[1].startswith("felix-"):
+            continue
+        if words[0] == "create":
+            if "maxelem" in words:
+                max_elems[words[1]] = words[words.index("maxelem") + 1]
+            members_xors[words[1]] = 0
+        elif words[0] == "add" and words[1] in members_xors:
+            members_xors[words[1]] ^= member_hash(words[2])
+    return dict((name, ipset_digest(members_xor, max_elems.get(name)))
+                for name, members_xor in members_xors.iteritems())
+
+
+def _load_snapshot(path):
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            _log.exception("Failed to read warm restart snapshot %s", path)
+        else:
+            _log.info("No warm restart snapshot at %s", path)
+        return {}
+    except ValueError:
+        _log.exception("Corrupt warm restart snapshot %s, ignoring", path)
+        return {}
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        _log.warning("Ignoring warm restart snapshot with version %s",
+                     snapshot.get("version"))
+        return {}
+    return snapshot["objects"]
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark for the EndpointManager's EndpointWorkerModes.
+
+Creates a number of local endpoints, then repeatedly deletes and
+re-creates them, reporting the memory used and the rate of endpoint
+updates that the EndpointManager sustains in each mode.  The dataplane is
+stubbed out so this measures Felix's own overhead only.
+
+Usage, from the python directory:
+
+    utils/bench-endpoints.py [actor|batched] [<num endpoints>] [<rounds>]
+
+Run each mode in a separate process so that the memory figures are
+comparable.
+"""
+import gc
+import resource
+import sys
+import time
+
+import gevent
+from gevent.event import Event
+
+from calico.datamodel_v1 import WloadEndpointId
+from calico.felix import endpoint
+from calico.felix.futils import IPV4
+from calico.felix.profilerules import RulesManager
+from calico.felix.test.base import load_config
+
+HOSTNAME = "bench-host"
+
+
+class StubDevices(object):
+    """Stands in for the devices module; the interfaces don't exist."""
+    def interface_exists(self, if_name):
+        return False
+
+    def interface_up(self, if_name):
+        return False
+
+    def list_ips_by_iface(self, ip_type):
+        return {}
+
+    def set_routes(self, ip_type, ips, interface, mac=None, reset_arp=False):
+        pass
+
+    def remove_conntrack_flows(self, ip_addresses, ip_version):
+        pass
+
+
+class StubPeer(object):
+    """Accepts any actor message and does nothing."""
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class StatusCounter(object):
+    """Stub status reporter, lets us wait for endpoints to be processed."""
+    def __init__(self):
+        self.count = 0
+        self.target = None
+        self.event = Event()
+
+    def expect(self, num_reports):
+        self.count = 0
+        self.target = num_reports
+        self.event.clear()
+
+    def on_endpoint_status_changed(self, ep_id, ip_type, status, async=None):
+        self.count += 1
+        if self.count >= self.target:
+            self.event.set()
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main(mode="batched", num_endpoints=1000, rounds=5):
+    endpoint.devices = StubDevices()
+    config = load_config("felix_default.cfg", global_dict={
+        "FelixHostname": HOSTNAME,
+        "EndpointWorkerMode": mode,
+        "EndpointReportingEnabled": "true",
+    })
+    rules_mgr = RulesManager(config, 4, StubPeer(), StubPeer())
+    rules_mgr.start()
+    status = StatusCounter()
+    mgr = endpoint.EndpointManager(config, IPV4, StubPeer(), StubPeer(),
+                                   StubPeer(), rules_mgr, StubPeer(), status)
+    mgr.start()
+    mgr.on_datamodel_in_sync(async=False)
+
+    endpoints = {}
+    for i in xrange(num_endpoints):
+        ep_id = WloadEndpointId(HOSTNAME, "orch", "wl%d" % i, "ep%d" % i)
+        endpoints[ep_id] = {
+            "state": "active",
+            "name": "tap%08d" % i,
+            "mac": "aa:bb:cc:%02x:%02x:%02x" % (i >> 16, (i >> 8) & 0xff,
+                                                i & 0xff),
+            "ipv4_nets": ["10.%d.%d.%d/32" % (i >> 16, (i >> 8) & 0xff,
+                                              i & 0xff)],
+            "profile_ids": ["prof-%d" % (i % 10)],
+        }
+
+    def send_all(deleted):
+        status.expect(len(endpoints))
+        start = time.time()
+        for ep_id, data in endpoints.iteritems():
+            mgr.on_endpoint_update(ep_id, None if deleted else data,
+                                   async=True)
+        status.event.wait()
+        return time.time() - start
+
+    gc.collect()
+    rss_before = max_rss_kb()
+    create_time = send_all(deleted=False)
+    gc.collect()
+    rss_after = max_rss_kb()
+    print "Mode: %s, %d endpoints" % (mode, num_endpoints)
+    print "Initial creation: %.2fs (%.0f endpoints/s)" % (
+        create_time, num_endpoints / create_time)
+    print "Max RSS growth: %d KB (%.2f KB per endpoint)" % (
+        rss_after - rss_before, float(rss_after - rss_before) / num_endpoints)
+
+    total_time = 0.0
+    for _ in xrange(rounds):
+        total_time += send_all(deleted=True)
+        # Give the cleanup messages a chance to be processed.
+        gevent.sleep(0.1)
+        total_time += send_all(deleted=False)
+    num_updates = 2 * rounds * num_endpoints
+    print "Churn: %d updates in %.2fs (%.0f updates/s)" % (
+        num_updates, total_time, num_updates / total_time)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(mode=args[0] if args else "batched",
+         num_endpoints=int(args[1]) if len(args) > 1 else 1000,
+         rounds=int(args[2]) if len(args) > 2 else 5)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Memory benchmark for the in-memory representation of endpoints.
+
+Converts a number of WorkloadEndpoint protobufs, as the DatastoreReader
+does, and keeps the results alive, as the EndpointManager does.  Reports
+the resulting memory use per endpoint.  The "dicts" mode uses the
+previous representation (a dict per endpoint and tier, referencing the
+protobuf's repeated fields); "records" uses the calico.felix.records
+types.
+
+Usage, from the python directory:
+
+    utils/bench-records.py [records|dicts] [<num endpoints>]
+
+Run each mode in a separate process so that the figures are comparable.
+"""
+import gc
+import resource
+import sys
+
+from calico.felix import felixbackend_pb2
+from calico.felix.datastore import convert_pb_wl_endpoint
+
+NUM_PROFILES = 20
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_pb_endpoint(i):
+    ep = felixbackend_pb2.WorkloadEndpoint()
+    ep.state = "active"
+    ep.name = "cali%08d" % i
+    ep.mac = "aa:bb:cc:%02x:%02x:%02x" % (i >> 16, (i >> 8) & 0xff,
+                                          i & 0xff)
+    ep.profile_ids.extend(["k8s_ns.namespace-%d" % (i % NUM_PROFILES),
+                           "default"])
+    ep.ipv4_nets.append("10.%d.%d.%d/32" % (i >> 16, (i >> 8) & 0xff,
+                                            i & 0xff))
+    tier = ep.tiers.add()
+    tier.name = "default"
+    tier.policies.extend(["allow-dns", "namespace-%d-isolation" %
+                          (i % NUM_PROFILES)])
+    return ep
+
+
+def convert_to_dict(pb_endpoint):
+    """The representation that the DatastoreReader used to create."""
+    return {
+        "state": pb_endpoint.state,
+        "name": pb_endpoint.name,
+        "mac": pb_endpoint.mac or None,
+        "profile_ids": pb_endpoint.profile_ids,
+        "ipv4_nets": pb_endpoint.ipv4_nets,
+        "ipv6_nets": pb_endpoint.ipv6_nets,
+        "tiers": [{"name": t.name, "policies": t.policies}
+                  for t in pb_endpoint.tiers],
+    }
+
+
+def main(mode="records", num_endpoints=5000):
+    convert = convert_pb_wl_endpoint if mode == "records" else convert_to_dict
+    gc.collect()
+    rss_before = max_rss_kb()
+    endpoints = []
+    for i in xrange(num_endpoints):
+        # Each update arrives in its own message, which is discarded once
+        # it has been converted.
+        msg = felixbackend_pb2.WorkloadEndpointUpdate()
+        msg.endpoint.CopyFrom(make_pb_endpoint(i))
+        endpoints.append(convert(msg.endpoint))
+    gc.collect()
+    rss_growth = max_rss_kb() - rss_before
+    print "Mode: %s, %d endpoints" % (mode, num_endpoints)
+    print "Max RSS growth: %d KB (%d bytes per endpoint)" % (
+        rss_growth, rss_growth * 1024 / num_endpoints)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(mode=args[0] if args else "records",
+         num_endpoints=int(args[1]) if len(args) > 1 else 5000)
@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Synthetic scale benchmark for the Python dataplane.
+
+Runs Felix's IPv4 actors in-process and drives them through a real
+DatastoreReader with a generated stream of driver protobuf messages: a
+config update, a snapshot of N endpoints, P policies and S selector IP
+sets, the in-sync message and then a configurable amount of churn.  The
+dataplane commands are replaced by utils/fake-dataplane.py, which
+validates and records its input and simulates the real commands'
+latency, so the benchmark runs offline and without root.
+
+Reports:
+
+* the time taken to converge after the in-sync message (until every
+  endpoint has reported its status and the dataplane has gone quiet);
+* percentiles of the latency from sending each churn update until the
+  dataplane command that applies it completes;
+* the number of dataplane commands run, by command;
+* the peak RSS of Felix (including this harness).
+
+Usage, from the python directory:
+
+    utils/bench-scale.py [--endpoints N] [--policies P] [--selectors S]
+                         [--churn C] [--churn-rate R]
+                         [--set FelixParam=value ...]
+
+Run utils/bench-scale.py --help for the full list of options.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import gevent
+from gevent.fileobject import FileObject
+
+from calico import common
+from calico.felix import devices
+from calico.felix import futils
+from calico.felix import felixbackend_pb2
+from calico.felix.config import Config
+from calico.felix.datastore import DatastoreReader
+from calico.felix.dispatch import (HostEndpointDispatchChains,
+                                   WorkloadDispatchChains)
+from calico.felix.endpoint import EndpointManager
+from calico.felix.fipmanager import FloatingIPManager
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.frules import install_global_rules, load_nf_conntrack
+from calico.felix.futils import IPV4
+from calico.felix.ipsets import IpsetActor, IpsetManager, HOSTS_IPSET_V4
+from calico.felix.masq import MasqueradeManager
+from calico.felix.profilerules import RulesManager
+from calico.felix.protocol import MessageReader, MessageWriter
+from calico.felix.splitter import CleanupManager, UpdateSplitter
+
+HOSTNAME = "bench-host"
+TIER = "default"
+NUM_PROFILES = 10
+FIRST_CHURN_PORT = 20000
+
+FAKE_COMMANDS = [
+    "iptables-restore", "iptables-save", "iptables",
+    "ip6tables-restore", "ip6tables-save", "ip6tables",
+    "ipset", "ip", "arp", "conntrack",
+]
+
+
+def make_fake_bin_dir(work_dir):
+    """
+    Creates a directory of wrappers that run the fake dataplane commands
+    with this interpreter.  (Avoids the overhead of finding the
+    interpreter on every call.)
+
+    :returns: the path of the directory.
+    """
+    fake_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "fake-dataplane.py")
+    bin_dir = os.path.join(work_dir, "bin")
+    os.mkdir(bin_dir)
+    for cmd in FAKE_COMMANDS:
+        path = os.path.join(bin_dir, cmd)
+        with open(path, "w") as f:
+            f.write("#!%s\nimport runpy\nrunpy.run_path(%r, "
+                    "init_globals={'INVOKED_AS': __file__}, "
+                    "run_name='__main__')\n" % (sys.executable, fake_script))
+        os.chmod(path, 0755)
+    return bin_dir
+
+
+def ip_addr(prefix, i):
+    return "%s.%d.%d" % (prefix, (i >> 8) & 0xff, i & 0xff)
+
+
+class ScaleStream(object):
+    """
+    Generates the messages that the driver would send for a synthetic
+    cluster.
+
+    Endpoint i uses profile i % NUM_PROFILES and two policies.  Each policy
+    allows TCP traffic from two of the selector IP sets.
+    """
+    def __init__(self, num_endpoints, num_policies, num_selectors,
+                 ipset_size, felix_config):
+        self.num_endpoints = num_endpoints
+        self.num_policies = num_policies
+        self.num_selectors = num_selectors
+        self.ipset_size = ipset_size
+        self.felix_config = felix_config
+        self.seq_no = 0
+        self.churn_count = 0
+
+    def envelope(self):
+        self.seq_no += 1
+        envelope = felixbackend_pb2.ToDataplane()
+        envelope.sequence_number = self.seq_no
+        return envelope
+
+    def config_update(self):
+        envelope = self.envelope()
+        envelope.config_update.config.update(self.felix_config)
+        return envelope
+
+    def in_sync(self):
+        envelope = self.envelope()
+        envelope.in_sync.SetInParent()
+        return envelope
+
+    def snapshot(self):
+        """Generates the messages for the initial snapshot."""
+        for s in xrange(self.num_selectors):
+            envelope = self.envelope()
+            envelope.ipset_update.id = self.selector_id(s)
+            envelope.ipset_update.members.extend(
+                ip_addr("10.%d" % (128 + s % 64), s * self.ipset_size + m)
+                for m in xrange(self.ipset_size)
+            )
+            yield envelope
+        for p in xrange(NUM_PROFILES):
+            envelope = self.envelope()
+            envelope.active_profile_update.id.name = "profile-%d" % p
+            profile = envelope.active_profile_update.profile
+            profile.inbound_rules.add().action = "allow"
+            profile.outbound_rules.add().action = "allow"
+            yield envelope
+        for p in xrange(self.num_policies):
+            yield self.policy_update(p, 80 + p % 1000)
+        for i in xrange(self.num_endpoints):
+            yield self.endpoint_update(i, self.mac(i))
+
+    def selector_id(self, s):
+        return "sel-%d" % s
+
+    def mac(self, i):
+        return "ee:ee:%02x:%02x:%02x:%02x" % ((i >> 24) & 0xff,
+                                               (i >> 16) & 0xff,
+                                               (i >> 8) & 0xff, i & 0xff)
+
+    def policy_update(self, p, port):
+        envelope = self.envelope()
+        envelope.active_policy_update.id.tier = TIER
+        envelope.active_policy_update.id.name = "policy-%d" % p
+        policy = envelope.active_policy_update.policy
+        rule = policy.inbound_rules.add()
+        rule.action = "allow"
+        rule.protocol.name = "tcp"
+        rule.src_ip_set_ids.extend(
+            set([self.selector_id(p % self.num_selectors),
+                 self.selector_id((p + 1) % self.num_selectors)])
+        )
+        port_range = rule.dst_ports.add()
+        port_range.first = port_range.last = port
+        policy.outbound_rules.add().action = "allow"
+        return envelope
+
+    def endpoint_policies(self, i):
+        return sorted(set(["policy-%d" % (i % self.num_policies),
+                           "policy-%d" % ((i * 7 + 1) % self.num_policies)]))
+
+    def endpoint_update(self, i, mac):
+        envelope = self.envelope()
+        update = envelope.workload_endpoint_update
+        update.id.orchestrator_id = "bench"
+        update.id.workload_id = "workload-%d" % i
+        update.id.endpoint_id = "eth0"
+        endpoint = update.endpoint
+        endpoint.state = "active"
+        endpoint.name = "tap%08x" % i
+        endpoint.mac = mac
+        endpoint.profile_ids.append("profile-%d" % (i % NUM_PROFILES))
+        endpoint.ipv4_nets.append(ip_addr("10.0", i + 1) + "/32")
+        tier = endpoint.tiers.add()
+        tier.name = TIER
+        tier.policies.extend(self.endpoint_policies(i))
+        return envelope
+
+    def churn_update(self, kind):
+        """
+        :returns: tuple of the next churn update of the given kind and a
+            function that returns True for a dataplane call that applies
+            it.
+        """
+        k = self.churn_count
+        self.churn_count += 1
+        if kind == "endpoint":
+            # Change the MAC of an endpoint, which is matched in its chain.
+            mac = self.mac(0x80000000 + k)
+            envelope = self.endpoint_update(k % self.num_endpoints, mac)
+            return envelope, lambda call: (
+                call["cmd"] == "iptables-restore" and mac in call["input"])
+        elif kind == "ipset":
+            # Add a new member to a selector IP set.
+            member = ip_addr("172.16", k)
+            envelope = self.envelope()
+            delta = envelope.ipset_delta_update
+            delta.id = self.selector_id(k % min(self.num_selectors,
+                                                self.num_policies))
+            delta.added_members.append(member)
+            needle = " %s\n" % member
+            return envelope, lambda call: (
+                call["cmd"] == "ipset" and needle in call["input"])
+        else:
+            # Change the port in a policy that's in use.
+            port = FIRST_CHURN_PORT + k
+            envelope = self.policy_update(
+                k % min(self.num_policies, self.num_endpoints), port)
+            regex = re.compile(r"\b%d\b" % port)
+            return envelope, lambda call: (
+                call["cmd"] == "iptables-restore" and
+                regex.search(call["input"]) is not None)
+
+
+class StatusRecorder(object):
+    """
+    Stands in for the DatastoreWriter; records when each endpoint first
+    reports its status.
+    """
+    def __init__(self):
+        self.first_report_times = {}
+        self.programmed_seq_no = None
+
+    def on_config_resolved(self, async=None):
+        pass
+
+    def on_seq_no_programmed(self, seq_no, async=None):
+        self.programmed_seq_no = seq_no
+
+    def on_endpoint_status_changed(self, ep_id, ip_type, status,
+                                   async=None):
+        if status is not None:
+            self.first_report_times.setdefault(ep_id, time.time())
+
+
+class CallLog(object):
+    """
+    Tails the fake dataplane's call log and matches the calls against the
+    churn updates that are waiting to be applied.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.calls = []
+        self._offset = 0
+        self._partial = ""
+        # List of (send time, matcher) for the outstanding churn updates.
+        self.pending = []
+        self.latencies = []
+
+    def poll(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            f.seek(self._offset)
+            data = f.read()
+            self._offset = f.tell()
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            call = json.loads(line)
+            self.calls.append(call)
+            still_pending = []
+            for send_time, matches in self.pending:
+                if call["end"] >= send_time and matches(call):
+                    self.latencies.append(call["end"] - send_time)
+                else:
+                    still_pending.append((send_time, matches))
+            self.pending = still_pending
+
+    def last_call_end(self):
+        return max(c["end"] for c in self.calls) if self.calls else 0
+
+
+def start_dataplane(config, hosts_ipset, status_recorder):
+    """
+    Starts the IPv4 actors, as felix.py does, but without touching the
+    kernel's global config or watching interfaces.
+
+    :returns: the UpdateSplitter.
+    """
+    filter_updater = IptablesUpdater("filter", ip_version=4, config=config)
+    nat_updater = IptablesUpdater("nat", ip_version=4, config=config)
+    ipset_mgr = IpsetManager(IPV4, config)
+    masq_manager = MasqueradeManager(IPV4, nat_updater)
+    rules_manager = RulesManager(config, 4, filter_updater, ipset_mgr)
+    ep_dispatch_chains = WorkloadDispatchChains(config, 4, filter_updater)
+    if_dispatch_chains = HostEndpointDispatchChains(config, 4,
+                                                    filter_updater)
+    fip_manager = FloatingIPManager(config, 4, nat_updater)
+    ep_manager = EndpointManager(config, IPV4, filter_updater,
+                                 ep_dispatch_chains, if_dispatch_chains,
+                                 rules_manager, fip_manager, status_recorder)
+    cleanup_mgr = CleanupManager(config, [filter_updater, nat_updater],
+                                 [ipset_mgr])
+    for actor in [hosts_ipset, filter_updater, nat_updater, ipset_mgr,
+                  masq_manager, rules_manager, ep_dispatch_chains,
+                  if_dispatch_chains, ep_manager, fip_manager, cleanup_mgr]:
+        actor.start()
+    load_nf_conntrack()
+    if_dispatch_chains.configure_iptables(async=False)
+    install_global_rules(config, filter_updater, nat_updater, ip_version=4)
+    return UpdateSplitter([ipset_mgr, rules_manager, ep_manager,
+                           masq_manager, nat_updater, cleanup_mgr])
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return float("nan")
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Synthetic scale benchmark for the Python dataplane.")
+    parser.add_argument("--endpoints", type=int, default=1000,
+                        help="number of local endpoints")
+    parser.add_argument("--policies", type=int, default=100,
+                        help="number of active policies")
+    parser.add_argument("--selectors", type=int, default=50,
+                        help="number of selector IP sets")
+    parser.add_argument("--ipset-size", type=int, default=20,
+                        help="initial members in each selector IP set")
+    parser.add_argument("--churn", type=int, default=300,
+                        help="number of updates to send after in-sync")
+    parser.add_argument("--churn-rate", type=float, default=20.0,
+                        help="churn updates per second")
+    parser.add_argument("--churn-types", default="endpoint,ipset,policy",
+                        help="comma-separated churn update types, used in "
+                             "rotation")
+    parser.add_argument("--base-latency", type=float, default=0.005,
+                        help="simulated latency of each dataplane command")
+    parser.add_argument("--line-latency", type=float, default=0.00001,
+                        help="simulated latency per line of command input")
+    parser.add_argument("--quiet-period", type=float, default=1.0,
+                        help="time without dataplane commands after which "
+                             "the dataplane is considered converged")
+    parser.add_argument("--timeout", type=float, default=300.0,
+                        help="maximum time to wait for each phase")
+    parser.add_argument("--set", action="append", default=[],
+                        metavar="PARAM=VALUE",
+                        help="override a Felix config parameter")
+    parser.add_argument("--keep-state", action="store_true",
+                        help="keep the fake dataplane's state directory")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    common.default_logging(gevent_in_use=True)
+    work_dir = tempfile.mkdtemp(prefix="felix-bench-scale-")
+    os.environ["PATH"] = make_fake_bin_dir(work_dir) + ":" + \
+        os.environ["PATH"]
+    os.environ["FAKE_DATAPLANE_DIR"] = work_dir
+    os.environ["FAKE_DATAPLANE_BASE_LATENCY"] = str(args.base_latency)
+    os.environ["FAKE_DATAPLANE_LINE_LATENCY"] = str(args.line_latency)
+
+    # The endpoints' interfaces don't exist; pretend they do so that Felix
+    # programs their routes (using the fake "ip" command).
+    devices.interface_exists = lambda if_name: True
+    devices.interface_up = lambda if_name: True
+    devices._write_proc_sys = lambda name, value: None
+
+    felix_config = {
+        "FelixHostname": HOSTNAME,
+        "InterfacePrefix": "tap",
+        "EndpointReportingEnabled": "true",
+        "Ipv6Support": "false",
+        "LogFilePath": "none",
+        "LogSeveritySys": "none",
+        "LogSeverityScreen": "error",
+        "PrometheusMetricsEnabled": "false",
+    }
+    for setting in args.set:
+        name, value = setting.split("=", 1)
+        felix_config[name] = value
+    stream = ScaleStream(args.endpoints, args.policies, args.selectors,
+                         args.ipset_size, felix_config)
+
+    read_fd, write_fd = os.pipe()
+    msg_writer = MessageWriter(FileObject(os.fdopen(write_fd, "wb", -1),
+                                          "wb"))
+    status_recorder = StatusRecorder()
+    hosts_ipset = IpsetActor(HOSTS_IPSET_V4)
+    config = Config()
+    reader = DatastoreReader(
+        config,
+        MessageReader(FileObject(os.fdopen(read_fd, "rb", -1), "rb")),
+        status_recorder,
+        hosts_ipset,
+    )
+    reader.start()
+    reader.load_config.set()
+    msg_writer.send_message(stream.config_update())
+    reader.configured.wait()
+    futils.check_command_deps()
+
+    splitter = start_dataplane(config, hosts_ipset, status_recorder)
+    reader.splitter = splitter
+    reader.begin_polling.set()
+    call_log = CallLog(os.path.join(work_dir, "calls.log"))
+
+    # Initial snapshot and convergence.
+    start = time.time()
+    for envelope in stream.snapshot():
+        msg_writer.send_message(envelope, flush=False)
+    msg_writer.send_message(stream.in_sync())
+    in_sync_time = time.time()
+    deadline = in_sync_time + args.timeout
+    while time.time() < deadline:
+        gevent.sleep(0.1)
+        call_log.poll()
+        if (len(status_recorder.first_report_times) >= args.endpoints and
+                time.time() - call_log.last_call_end() > args.quiet_period):
+            break
+    converged_time = max([call_log.last_call_end()] +
+                         status_recorder.first_report_times.values())
+    snapshot_calls = len(call_log.calls)
+    print "Endpoints: %d, policies: %d, selectors: %d (%d members each)" % (
+        args.endpoints, args.policies, args.selectors, args.ipset_size)
+    print "Snapshot sent in %.2fs; converged %.2fs after in-sync" % (
+        in_sync_time - start, converged_time - in_sync_time)
+    report_times = status_recorder.first_report_times.values()
+    print "Endpoints reporting status: %d/%d, the last %.2fs after " \
+          "in-sync" % (len(report_times), args.endpoints,
+                       max(report_times or [in_sync_time]) - in_sync_time)
+
+    # Churn.
+    kinds = args.churn_types.split(",")
+    for k in xrange(args.churn):
+        envelope, matches = stream.churn_update(kinds[k % len(kinds)])
+        call_log.pending.append((time.time(), matches))
+        msg_writer.send_message(envelope)
+        gevent.sleep(1.0 / args.churn_rate)
+        call_log.poll()
+    deadline = time.time() + args.timeout
+    while call_log.pending and time.time() < deadline:
+        gevent.sleep(0.1)
+        call_log.poll()
+    latencies = sorted(call_log.latencies)
+    print "Churn: %d updates at %.0f/s; %d applied, %d not seen" % (
+        args.churn, args.churn_rate, len(latencies), len(call_log.pending))
+    if latencies:
+        print "Update latency: p50 %.3fs, p90 %.3fs, p99 %.3fs, " \
+              "max %.3fs" % (percentile(latencies, 50),
+                             percentile(latencies, 90),
+                             percentile(latencies, 99), latencies[-1])
+    print "Highest fully-programmed sequence number: %s of %s" % (
+        status_recorder.programmed_seq_no, stream.seq_no)
+
+    # Dataplane commands.
+    counts = {}
+    failures = 0
+    for call in call_log.calls:
+        name = " ".join([call["cmd"]] + call["args"][:1])
+        counts[name] = counts.get(name, 0) + 1
+        failures += 1 if call["rc"] else 0
+    print "Dataplane commands: %d (%d during snapshot), %d failed" % (
+        len(call_log.calls), snapshot_calls, failures)
+    for name, count in sorted(counts.iteritems(), key=lambda x: -x[1]):
+        print "  %-30s %d" % (name, count)
+    print "Peak RSS: %d KB" % resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss
+
+    if args.keep_state:
+        print "Fake dataplane state kept in %s" % work_dir
+    else:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Start-up time benchmark for Felix.
+
+Measures, in a fresh interpreter each time, how long it takes to import
+Felix's main module and to load the iptables generator plugin.  Both
+happen before Felix connects to the driver so they delay every restart.
+gevent's monkey-patching is done before the timer starts since it isn't
+under our control.
+
+Exits with a non-zero code if the best import time exceeds
+--max-import-secs or if Felix's imports pull in any of the modules that we
+deliberately import lazily because they're slow (SLOW_MODULES).
+
+Usage, from the python directory:
+
+    utils/bench-startup.py [--runs N] [--max-import-secs S]
+"""
+import argparse
+import subprocess
+import sys
+
+# Modules that are slow to import and are only needed later on, if at
+# all.  Felix must not import these at start of day.
+SLOW_MODULES = ("pkg_resources", "posix_spawn", "urllib3")
+
+MEASURE_SCRIPT = """
+from gevent import monkey
+monkey.patch_all()
+import sys
+import time
+before = set(sys.modules)
+start = time.time()
+import calico.felix.felix
+from calico.felix import config
+imported = time.time()
+config._load_plugin(config.FELIX_IPT_GENERATOR_PLUGIN_NAME, "default")
+loaded = time.time()
+slow = [m for m in %r if m in sys.modules and m not in before]
+print imported - start, loaded - imported, ",".join(slow)
+""" % (SLOW_MODULES,)
+
+
+def measure():
+    output = subprocess.check_output([sys.executable, "-c", MEASURE_SCRIPT])
+    fields = output.split()
+    slow = fields[2].split(",") if len(fields) > 2 else []
+    return float(fields[0]), float(fields[1]), slow
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures Felix's start-up time.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-secs", type=float, default=0.15,
+                        help="fail if the best import time exceeds this")
+    args = parser.parse_args()
+
+    results = [measure() for _ in xrange(args.runs)]
+    best_import = min(r[0] for r in results)
+    best_plugin = min(r[1] for r in results)
+    slow_modules = sorted(set(m for r in results for m in r[2]))
+    print "Import of calico.felix.felix: %.1fms" % (best_import * 1000)
+    print "Load of iptables generator plugin: %.1fms" % (best_plugin * 1000)
+
+    failed = False
+    if best_import > args.max_import_secs:
+        print "FAIL: import took longer than %.1fms" % (
+            args.max_import_secs * 1000)
+        failed = True
+    if slow_modules:
+        print "FAIL: slow modules imported at start of day: %s" % (
+            ", ".join(slow_modules))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
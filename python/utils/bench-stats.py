@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Micro-benchmark of the cost of Felix's stat counters.
+
+Compares incrementing a counter that is mirrored to a Prometheus Gauge on
+every increment (as StatCounter used to) with StatCounter.increment() and
+with incrementing a preallocated Stat handle.  Then measures the
+per-message cost of sending messages to an actor and processing them,
+which includes the actor framework's own counters.
+
+Usage, from the python directory:
+
+    utils/bench-stats.py [--increments N] [--messages N]
+"""
+import argparse
+import collections
+import timeit
+
+from prometheus_client import Gauge
+
+from calico.felix.actor import Actor, actor_message
+from calico.felix.futils import StatCounter, sanitize_name
+
+
+class GaugeStatCounter(object):
+    """The previous StatCounter, which updated a Gauge on each increment."""
+    def __init__(self, name):
+        self.name = name
+        self.stats = collections.defaultdict(lambda: 0)
+        self.prom_gauges = {}
+
+    def increment(self, stat, by=1):
+        self.stats[stat] += by
+        if stat not in self.prom_gauges:
+            gauge = Gauge(sanitize_name("bench_" + self.name + " " + stat),
+                          "%s: %s" % (self.name, stat))
+            self.prom_gauges[stat] = gauge
+        else:
+            gauge = self.prom_gauges[stat]
+        gauge.inc(by)
+
+
+class NullActor(Actor):
+    @actor_message()
+    def do_nothing(self):
+        pass
+
+
+def time_per_op(fn, number):
+    # Best of three, to reduce noise.
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the cost of Felix's stat counters.")
+    parser.add_argument("--increments", type=int, default=1000000)
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+
+    gauge_counter = GaugeStatCounter("gauge")
+    counter = StatCounter("Benchmark counters")
+    handle = counter.stat("Increments")
+
+    def increment_handle():
+        handle.value += 1
+
+    print "Per increment:"
+    for name, fn in [
+        ("Gauge-backed increment()", lambda: gauge_counter.increment("Foo")),
+        ("StatCounter.increment()", lambda: counter.increment("Foo")),
+        ("Stat handle", increment_handle),
+    ]:
+        print "  %-26s %6.3f us" % (name, time_per_op(fn, args.increments) *
+                                    1e6)
+
+    actor = NullActor()
+
+    def send_and_process():
+        for _ in xrange(100):
+            actor.do_nothing(async=True)
+        actor._step()
+
+    print "Per actor message (send and process, batches of 100): %.2f us" % (
+        time_per_op(send_and_process, args.messages // 100) / 100 * 1e6)
+
+
+if __name__ == "__main__":
+    main()
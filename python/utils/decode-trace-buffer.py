@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Renders a dump of Felix's trace buffer as a timeline.
+
+Felix writes the dump to TraceBufferDir on SIGUSR1 and when it dies.  Each
+line of output shows the time of an event, the time since the previous
+event, the event type, the actor (or command) and the message name.
+Message IDs are shown in the same form as in Felix's logs.  The ends of
+batches and subprocesses also show how long they took.
+
+Usage, from the python directory:
+
+    utils/decode-trace-buffer.py [--actor NAME] <dump file>
+"""
+import argparse
+import datetime
+
+from calico.felix.tracebuffer import (
+    read_dump, EVENT_NAMES, EVENT_MSG_START, EVENT_BATCH_START,
+    EVENT_BATCH_END, EVENT_SUBPROCESS_START, EVENT_SUBPROCESS_END,
+    EVENT_DRIVER_MSG
+)
+
+
+def describe_value(event, value):
+    if event == EVENT_MSG_START:
+        return "M%016x" % value
+    elif event == EVENT_DRIVER_MSG:
+        return "seq=%s" % value
+    elif event == EVENT_SUBPROCESS_START:
+        return "pid=%s" % value
+    elif event == EVENT_SUBPROCESS_END:
+        return "rc=%s" % value
+    else:
+        return "len=%s" % value
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Renders a Felix trace buffer dump as a timeline.")
+    parser.add_argument("dump")
+    parser.add_argument("--actor",
+                        help="only show events for actors (or commands) "
+                             "whose name contains this string")
+    args = parser.parse_args()
+
+    with open(args.dump, "rb") as f:
+        records = read_dump(f)
+
+    # Start time of the open batch for each actor and the open subprocess
+    # for each command, so that we can show durations.
+    start_times = {}
+    last_time = None
+    for timestamp, event, name, detail, value in records:
+        if args.actor and args.actor not in name:
+            continue
+        if event in (EVENT_BATCH_START, EVENT_SUBPROCESS_START):
+            start_times[(event, name)] = timestamp
+        duration = ""
+        if event == EVENT_BATCH_END:
+            start = start_times.pop((EVENT_BATCH_START, name), None)
+        elif event == EVENT_SUBPROCESS_END:
+            start = start_times.pop((EVENT_SUBPROCESS_START, name), None)
+        else:
+            start = None
+        if start is not None:
+            duration = "took %.3fms" % ((timestamp - start) * 1000)
+        delta = 0 if last_time is None else timestamp - last_time
+        last_time = timestamp
+        print "%s %+10.3fms %-16s %-40s %-30s %-20s %s" % (
+            datetime.datetime.fromtimestamp(timestamp).strftime(
+                "%H:%M:%S.%f"),
+            delta * 1000,
+            EVENT_NAMES.get(event, event),
+            name,
+            detail or "",
+            describe_value(event, value),
+            duration,
+        ).rstrip()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Replays a capture of the messages from the datastore driver into Felix.
+
+Felix writes the capture when DriverCaptureFile is set.  This script
+stands in for the driver: it starts Felix with the usual pair of pipes as
+FDs 3 and 4, writes the captured messages to it, with the same
+length-prefixed framing, and discards the messages that Felix sends back.
+
+By default, the messages are sent with their original timing; --speed
+scales the timing and --speed 0 sends them as fast as Felix reads them.
+Once the capture has been sent, Felix is left running for --linger
+seconds and then stopped.
+
+Usage, from the python directory:
+
+    utils/replay-driver-capture.py [--speed S] [--linger L]
+                                   [--felix-cmd CMD] <capture file>...
+
+Rotated capture files should be listed oldest first, for example
+felix.cap.2 felix.cap.1 felix.cap.  Each file starts with a copy of the
+config (which is skipped for all but the first file listed) but only the
+first file starts with the full snapshot, so replaying a later file on its
+own only reproduces part of the state.
+"""
+import argparse
+import os
+import shlex
+import struct
+import subprocess
+import threading
+import time
+
+from calico.felix import felixbackend_pb2
+from calico.felix.protocol import MSG_TYPE_CONFIG_UPDATE, read_capture
+
+
+def drain(pipe):
+    """Reads and discards the messages that Felix sends."""
+    while pipe.read(65536):
+        pass
+
+
+def is_config(data):
+    envelope = felixbackend_pb2.ToDataplane()
+    envelope.ParseFromString(data)
+    return envelope.WhichOneof("payload") == MSG_TYPE_CONFIG_UPDATE
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replays a driver capture into Felix.")
+    parser.add_argument("captures", nargs="+", metavar="CAPTURE_FILE")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed relative to the original; 0 "
+                             "for as fast as possible")
+    parser.add_argument("--linger", type=float, default=30.0,
+                        help="time to leave Felix running after the last "
+                             "message")
+    parser.add_argument("--felix-cmd",
+                        default="calico-iptables-plugin",
+                        help="command to start Felix")
+    args = parser.parse_args()
+
+    to_felix_read, to_felix_write = os.pipe()
+    from_felix_read, from_felix_write = os.pipe()
+
+    def set_up_fds():
+        # Felix expects its pipes from the driver as FDs 3 and 4.
+        os.dup2(to_felix_read, 3)
+        os.dup2(from_felix_write, 4)
+
+    felix = subprocess.Popen(shlex.split(args.felix_cmd),
+                             preexec_fn=set_up_fds)
+    os.close(to_felix_read)
+    os.close(from_felix_write)
+    to_felix = os.fdopen(to_felix_write, "wb")
+    drainer = threading.Thread(target=drain,
+                               args=(os.fdopen(from_felix_read, "rb"),))
+    drainer.daemon = True
+    drainer.start()
+
+    num_msgs = 0
+    num_bytes = 0
+    first_capture_time = None
+    start = time.time()
+    try:
+        for file_num, filename in enumerate(args.captures):
+            for frame_num, (capture_time, data) in enumerate(
+                    read_capture(filename)):
+                if file_num > 0 and frame_num == 0 and is_config(data):
+                    # Each rotated file starts with a copy of the config,
+                    # which Felix has already seen.
+                    continue
+                if first_capture_time is None:
+                    first_capture_time = capture_time
+                if args.speed > 0:
+                    due = start + ((capture_time - first_capture_time) /
+                                   args.speed)
+                    delay = due - time.time()
+                    if delay > 0:
+                        to_felix.flush()
+                        time.sleep(delay)
+                to_felix.write(struct.pack("<Q", len(data)))
+                to_felix.write(data)
+                num_msgs += 1
+                num_bytes += len(data)
+        to_felix.flush()
+        elapsed = time.time() - start
+        print "Replayed %d messages (%d bytes) in %.2fs" % (
+            num_msgs, num_bytes, elapsed)
+        deadline = time.time() + args.linger
+        while felix.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+    finally:
+        if felix.poll() is None:
+            felix.terminate()
+        felix.wait()
+    print "Felix exited with code %s" % felix.returncode
+
+
+if __name__ == "__main__":
+    main()